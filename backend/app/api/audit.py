@@ -18,7 +18,7 @@ from app.schemas import (
 )
 from app.services.audit_service import AuditService
 from app.api.deps import (
-    get_auditor_user, get_audit_service, get_client_ip
+    get_auditor_user, get_audit_service, get_client_ip, admit_download
 )
 
 router = APIRouter(prefix="/audit", tags=["Audit"])
@@ -130,34 +130,38 @@ async def export_audit_logs(
         except ValueError:
             pass
     
-    # Log export action
-    await audit_service.log(
-        action=AuditAction.EXPORT,
-        user_id=current_user.id,
-        username=current_user.username,
-        ip_address=get_client_ip(request),
-        user_agent=request.headers.get("User-Agent", ""),
-        details={"format": format, "filters": filters.model_dump()}
-    )
-    
-    if format == "json":
-        content = await audit_service.export_json(filters)
-        return Response(
-            content=content,
-            media_type="application/json",
-            headers={
-                "Content-Disposition": "attachment; filename=audit_logs.json"
-            }
-        )
-    else:
-        content = await audit_service.export_csv(filters)
-        return Response(
-            content=content,
-            media_type="text/csv",
-            headers={
-                "Content-Disposition": "attachment; filename=audit_logs.csv"
-            }
+    # Exportações pesadas competem pelos mesmos slots dos streams
+    ticket = await admit_download(current_user, "export")
+    
+    async with ticket:
+        # Log export action
+        await audit_service.log(
+            action=AuditAction.EXPORT,
+            user_id=current_user.id,
+            username=current_user.username,
+            ip_address=get_client_ip(request),
+            user_agent=request.headers.get("User-Agent", ""),
+            details={"format": format, "filters": filters.model_dump()}
         )
+        
+        if format == "json":
+            content = await audit_service.export_json(filters)
+            return Response(
+                content=content,
+                media_type="application/json",
+                headers={
+                    "Content-Disposition": "attachment; filename=audit_logs.json"
+                }
+            )
+        else:
+            content = await audit_service.export_csv(filters)
+            return Response(
+                content=content,
+                media_type="text/csv",
+                headers={
+                    "Content-Disposition": "attachment; filename=audit_logs.csv"
+                }
+            )
 
 
 @router.get("/stats")
@@ -17,6 +17,21 @@ from app.models import User, UserRole, TokenBlacklist, Group
 from app.utils.security import decode_token
 from app.services.audit_service import AuditService
 from app.services.replay_service import ReplayService
+from app.services.clip_service import ClipService
+from app.services.rendition_service import RenditionService
+from app.services.activity_service import ActivityService
+from app.services.thumbnail_service import ThumbnailService
+from app.services.transcript_service import TranscriptService
+from app.services.dictionary_service import DictionaryService
+from app.services.chunk_store_service import ChunkStoreService
+from app.services.quota_service import QuotaService
+from app.services.integrity_service import IntegrityService
+from app.services.reconcile_service import ReconcileService
+from app.services.pack_service import PackService
+from app.services.blob_service import BlobService
+from app.services.admission_service import (
+    AdmissionRejected, StreamTicket, get_admission_controller
+)
 
 security = HTTPBearer()
 
@@ -218,6 +233,102 @@ async def get_replay_service(
     return ReplayService(db)
 
 
+async def admit_download(current_user: User, kind: str = "stream") -> StreamTicket:
+    """Admit a stream/export download or raise 429 with Retry-After."""
+    try:
+        return await get_admission_controller().acquire(str(current_user.id), kind)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=e.reason,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+async def get_clip_service(
+    db: AsyncSession = Depends(get_db)
+) -> ClipService:
+    """Get clip service instance."""
+    return ClipService(db)
+
+
+async def get_rendition_service(
+    db: AsyncSession = Depends(get_db)
+) -> RenditionService:
+    """Get rendition service instance."""
+    return RenditionService(db)
+
+
+async def get_activity_service(
+    db: AsyncSession = Depends(get_db)
+) -> ActivityService:
+    """Get activity service instance."""
+    return ActivityService(db)
+
+
+async def get_thumbnail_service(
+    db: AsyncSession = Depends(get_db)
+) -> ThumbnailService:
+    """Get thumbnail service instance."""
+    return ThumbnailService(db)
+
+
+async def get_dictionary_service(
+    db: AsyncSession = Depends(get_db)
+) -> DictionaryService:
+    """Get compression dictionary service instance."""
+    return DictionaryService(db)
+
+
+async def get_chunk_store_service(
+    db: AsyncSession = Depends(get_db)
+) -> ChunkStoreService:
+    """Get chunk store service instance."""
+    return ChunkStoreService(db)
+
+
+async def get_blob_service(
+    db: AsyncSession = Depends(get_db)
+) -> BlobService:
+    """Get shared blob (whole-file deduplication) service instance."""
+    return BlobService(db)
+
+
+async def get_quota_service(
+    db: AsyncSession = Depends(get_db)
+) -> QuotaService:
+    """Get storage quota service instance."""
+    return QuotaService(db)
+
+
+async def get_integrity_service(
+    db: AsyncSession = Depends(get_db)
+) -> IntegrityService:
+    """Get integrity scrubber service instance."""
+    return IntegrityService(db)
+
+
+async def get_reconcile_service(
+    db: AsyncSession = Depends(get_db)
+) -> ReconcileService:
+    """Get storage reconciler service instance."""
+    return ReconcileService(db)
+
+
+async def get_pack_service(
+    db: AsyncSession = Depends(get_db)
+) -> PackService:
+    """Get COLD pack file service instance."""
+    return PackService(db)
+
+
+async def get_transcript_service(
+    db: AsyncSession = Depends(get_db)
+) -> TranscriptService:
+    """Get transcript service instance."""
+    return TranscriptService(db)
+
+
 def get_client_ip(request: Request) -> str:
     """Extract client IP from request."""
     # Check for forwarded IP (when behind proxy)
@@ -288,3 +399,11 @@ async def get_allowed_usernames(
                     allowed.append(row[0])
     
     return allowed
+
+
+async def get_allowed_usernames_from_token_or_query(
+    current_user: User = Depends(get_user_from_token_or_query),
+    db: AsyncSession = Depends(get_db)
+) -> Optional[List[str]]:
+    """Same as get_allowed_usernames, for endpoints that accept ?token= (e.g. <img>)."""
+    return await get_allowed_usernames(current_user, db)
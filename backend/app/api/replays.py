@@ -2,28 +2,54 @@
 Nachos Replay for Guaca - Replays API
 Endpoints for replay management and streaming.
 """
-from typing import Optional
+from pathlib import Path
+from typing import Optional, List, Tuple
 from uuid import UUID
+import asyncio
+import io
 import math
 import logging
+import os
+import re
 
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Query, File, UploadFile
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.config import settings
 from app.database import get_db
 from app.models import User, AuditAction
 from app.schemas import (
     ReplayResponse, ReplayDetail, ReplaySearch, ReplayUpdate,
+    ClipCreate, ReplayActivityResponse, TranscriptSegmentResponse, TranscriptSearchResult,
     PaginationParams, PaginatedResponse
 )
 from app.services.replay_service import ReplayService
+from app.services.blob_service import BlobService
 from app.services.audit_service import AuditService
+from app.services.prefetch_service import get_prefetch_service
+from app.services.restore_cache_service import get_restore_cache_service
+from app.services.clip_service import ClipService, ClipError
+from app.services.rendition_service import RenditionService, RenditionError
+from app.services.activity_service import ActivityService
+from app.services.thumbnail_service import ThumbnailService, ThumbnailError, THUMBNAIL_KINDS
+from app.services.transcript_service import TranscriptService
+from app.services.admission_service import StreamTicket
+from app.services.integrity_service import IntegrityService, get_hash_pool
+from app.utils.chunk_store import ChunkedReader
+from app.utils.compression import SeekableGzipReader, is_random_access
+from app.utils.storage import delete_location
+from app.utils.guacamole import GuacamoleParseError
+from app.utils.hash_tree import BlockMismatchError, ContentHasher, HashTree, VerifiedReader
+from app.utils.layout import recording_dir
 from app.api.deps import (
     get_current_active_user, get_admin_user,
-    get_replay_service, get_audit_service,
-    get_client_ip, get_allowed_usernames,
-    get_user_from_token_or_query
+    get_replay_service, get_audit_service, get_clip_service,
+    get_rendition_service, get_activity_service, get_thumbnail_service,
+    get_transcript_service, get_blob_service, get_integrity_service,
+    get_client_ip, get_allowed_usernames, get_allowed_usernames_from_token_or_query,
+    get_user_from_token_or_query, admit_download
 )
 
 logger = logging.getLogger(__name__)
@@ -94,6 +120,9 @@ async def list_replays(
         allowed_usernames=allowed_usernames
     )
     
+    # Aquecer o cache dos primeiros resultados (próximo clique provável)
+    get_prefetch_service().warm_heads(replays)
+    
     # Log search action
     await audit_service.log(
         action=AuditAction.SEARCH,
@@ -113,6 +142,36 @@ async def list_replays(
     )
 
 
+@router.get("/transcript-search", response_model=List[TranscriptSearchResult])
+async def search_transcripts(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=500, description="Text typed or copied during the session"),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_active_user),
+    allowed_usernames: Optional[list] = Depends(get_allowed_usernames),
+    transcript_service: TranscriptService = Depends(get_transcript_service),
+    audit_service: AuditService = Depends(get_audit_service)
+):
+    """Search replays by typed text and clipboard content."""
+    results = await transcript_service.search(
+        q,
+        user_id=current_user.id,
+        allowed_usernames=allowed_usernames,
+        limit=limit
+    )
+    
+    await audit_service.log(
+        action=AuditAction.SEARCH,
+        user_id=current_user.id,
+        username=current_user.username,
+        ip_address=get_client_ip(request),
+        user_agent=request.headers.get("User-Agent", ""),
+        details={"transcript_query": q, "results_count": len(results)}
+    )
+    
+    return results
+
+
 @router.get("/{replay_id}", response_model=ReplayDetail)
 async def get_replay(
     replay_id: UUID,
@@ -139,6 +198,9 @@ async def get_replay(
                 detail="Access denied to this replay"
             )
     
+    # Página de detalhe aberta: aquecer o arquivo inteiro
+    get_prefetch_service().warm_full(replay)
+    
     # Log view action
     await audit_service.log(
         action=AuditAction.VIEW,
@@ -153,16 +215,169 @@ async def get_replay(
     return ReplayDetail.model_validate(replay)
 
 
+@router.get("/{replay_id}/activity", response_model=ReplayActivityResponse)
+async def get_replay_activity(
+    replay_id: UUID,
+    idle_threshold_seconds: int = Query(30, ge=1, le=86400),
+    current_user: User = Depends(get_current_active_user),
+    allowed_usernames: Optional[list] = Depends(get_allowed_usernames),
+    replay_service: ReplayService = Depends(get_replay_service),
+    activity_service: ActivityService = Depends(get_activity_service),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get the activity histogram and idle segments of a replay."""
+    replay = await replay_service.get_replay(replay_id)
+    
+    if not replay:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay not found"
+        )
+    
+    if allowed_usernames is not None:
+        if replay.owner_username not in allowed_usernames and replay.owner_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied to this replay"
+            )
+    
+    try:
+        activity = await activity_service.get_activity(replay, idle_threshold_seconds)
+    except GuacamoleParseError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Replay file is malformed: {e}"
+        )
+    
+    if activity is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay file not found"
+        )
+    
+    # Replays importados antes do histograma: guardar o cálculo sob demanda
+    await db.commit()
+    return activity
+
+
+@router.get("/{replay_id}/transcript", response_model=List[TranscriptSegmentResponse])
+async def get_replay_transcript(
+    replay_id: UUID,
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+    allowed_usernames: Optional[list] = Depends(get_allowed_usernames),
+    replay_service: ReplayService = Depends(get_replay_service),
+    transcript_service: TranscriptService = Depends(get_transcript_service),
+    audit_service: AuditService = Depends(get_audit_service)
+):
+    """Get the typed text and clipboard transcript of a replay."""
+    replay = await replay_service.get_replay(replay_id)
+    
+    if not replay:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay not found"
+        )
+    
+    if allowed_usernames is not None:
+        if replay.owner_username not in allowed_usernames and replay.owner_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied to this replay"
+            )
+    
+    # Transcrição pode conter dados sensíveis digitados: registrar o acesso
+    await audit_service.log(
+        action=AuditAction.VIEW,
+        user_id=current_user.id,
+        username=current_user.username,
+        replay_id=replay.id,
+        ip_address=get_client_ip(request),
+        user_agent=request.headers.get("User-Agent", ""),
+        details={"filename": replay.filename, "variant": "transcript"}
+    )
+    
+    return await transcript_service.get_transcript(replay)
+
+
+@router.get("/{replay_id}/thumbnails/{kind}")
+async def get_replay_thumbnail(
+    replay_id: UUID,
+    kind: str,
+    current_user: User = Depends(get_user_from_token_or_query),
+    allowed_usernames: Optional[list] = Depends(get_allowed_usernames_from_token_or_query),
+    replay_service: ReplayService = Depends(get_replay_service),
+    thumbnail_service: ThumbnailService = Depends(get_thumbnail_service),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get the poster frame or hover-preview sprite sheet of a replay."""
+    if kind not in THUMBNAIL_KINDS:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown thumbnail"
+        )
+    
+    replay = await replay_service.get_replay(replay_id)
+    
+    if not replay:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay not found"
+        )
+    
+    if allowed_usernames is not None:
+        if replay.owner_username not in allowed_usernames and replay.owner_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied to this replay"
+            )
+    
+    try:
+        path = await thumbnail_service.get_thumbnail(replay, kind)
+        await db.commit()
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay file not found"
+        )
+    except (ThumbnailError, GuacamoleParseError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e)
+        )
+    
+    # Conteúdo imutável por replay: o cliente versiona a URL com rendered_at
+    info = replay.metadata_json.get("thumbnails", {})
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={
+            "Cache-Control": "private, max-age=31536000, immutable",
+            "ETag": f'"{replay.id.hex}-{kind}-{info.get("rendered_at", "")}"',
+        }
+    )
+
+
 @router.get("/{replay_id}/stream")
 async def stream_replay(
     replay_id: UUID,
     request: Request,
+    repair: bool = Query(True, description="Cut a damaged tail at the last complete sync"),
+    verify: Optional[bool] = Query(
+        None, description="Check ranged reads against the hash tree (default: HASH_TREE_VERIFY_RANGES)"
+    ),
     current_user: User = Depends(get_user_from_token_or_query),
     replay_service: ReplayService = Depends(get_replay_service),
+    integrity_service: IntegrityService = Depends(get_integrity_service),
     audit_service: AuditService = Depends(get_audit_service),
     db: AsyncSession = Depends(get_db)
 ):
-    """Stream replay file content."""
+    """
+    Stream replay file content, decompressed. Plain and seekable (sgzip)
+    replays accept a single ``Range: bytes=`` request (206); only the
+    frames covering the range are decompressed. With ``verify``, the
+    blocks served are checked against the replay's hash tree first.
+    """
     replay = await replay_service.get_replay(replay_id)
     
     if not replay:
@@ -171,43 +386,337 @@ async def stream_replay(
             detail="Replay not found"
         )
     
-    file_handle = await replay_service.get_replay_file(replay)
+    # Controle de admissão: limita downloads simultâneos por usuário/servidor
+    ticket = await admit_download(current_user, "stream")
+    
+    # COLD: cópia restaurada em disco local, se houver (senão é restaurada em segundo plano)
+    file_handle = await get_restore_cache_service().open(replay)
+    if not file_handle:
+        file_handle = await replay_service.get_replay_file(replay)
     
     if not file_handle:
+        await ticket.release()
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Replay file not found"
         )
     
+    get_prefetch_service().record_access(replay.stored_path)
+    
     # Log download action
-    await audit_service.log(
-        action=AuditAction.DOWNLOAD,
-        user_id=current_user.id,
-        username=current_user.username,
-        replay_id=replay.id,
-        ip_address=get_client_ip(request),
-        user_agent=request.headers.get("User-Agent", ""),
-        details={"filename": replay.filename}
+    try:
+        await audit_service.log(
+            action=AuditAction.DOWNLOAD,
+            user_id=current_user.id,
+            username=current_user.username,
+            replay_id=replay.id,
+            ip_address=get_client_ip(request),
+            user_agent=request.headers.get("User-Agent", ""),
+            details={"filename": replay.filename}
+        )
+    except Exception:
+        file_handle.close()
+        await ticket.release()
+        raise
+    
+    # Final truncado/corrompido: servir até o último sync completo, sem alterar o arquivo
+    integrity = (replay.metadata_json or {}).get("integrity", {})
+    repair_offset = integrity.get("repair_offset")
+    content_size = _content_size(replay, file_handle)
+    extra_headers = {}
+    size = content_size
+    if repair and repair_offset:
+        size = min(repair_offset, content_size)
+        extra_headers.update({
+            "X-Replay-Repaired": "true",
+            "X-Replay-Original-Size": str(content_size),
+        })
+    
+    if is_random_access(file_handle):
+        extra_headers["Accept-Ranges"] = "bytes"
+        byte_range = _parse_range(request.headers.get("Range"), size)
+        if byte_range is False:
+            file_handle.close()
+            await ticket.release()
+            raise HTTPException(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                detail="Requested range not satisfiable",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        if byte_range:
+            start, end = byte_range
+            if settings.hash_tree_verify_ranges if verify is None else verify:
+                file_handle = await _verified_handle(
+                    file_handle, ticket, replay, content_size, start, integrity_service
+                )
+            await asyncio.to_thread(file_handle.seek, start)
+            extra_headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return _file_streaming_response(
+                file_handle, ticket, replay.filename, end - start + 1,
+                extra_headers=extra_headers,
+                limit=end - start + 1,
+                status_code=status.HTTP_206_PARTIAL_CONTENT
+            )
+    
+    return _file_streaming_response(
+        file_handle, ticket, replay.filename, size,
+        extra_headers=extra_headers,
+        limit=size if size != content_size else None
     )
+
+
+async def _verified_handle(
+    file_handle,
+    ticket: StreamTicket,
+    replay,
+    content_size: int,
+    start: int,
+    integrity_service: IntegrityService
+):
+    """
+    Wrap a stream in a VerifiedReader when the replay has a hash tree. The
+    first block is checked before responding (500 if it is corrupted);
+    later blocks are checked as they are read and a mismatch aborts the
+    response instead of serving the damaged bytes.
+    """
+    tree = await integrity_service.get_hash_tree(replay)
+    if tree is None or tree.size != content_size:
+        return file_handle
+    
+    verified = VerifiedReader(file_handle, tree)
+    verified.seek(start)
+    try:
+        await asyncio.to_thread(verified.check)
+    except BlockMismatchError as e:
+        verified.close()
+        await ticket.release()
+        logger.error(f"Replay {replay.id} ({replay.filename}): {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Stored content is corrupted: {e}"
+        )
+    return verified
+
+
+def _content_size(replay, file_handle) -> int:
+    """Size of the decompressed content being streamed."""
+    if isinstance(file_handle, (SeekableGzipReader, ChunkedReader)):
+        return file_handle.size
+    if isinstance(file_handle, io.BufferedReader):
+        # Objeto S3 ou membro de pack (FileRangeReader): sem descritor próprio
+        size = getattr(file_handle.raw, "size", None)
+        if size is not None:
+            return size
+        return os.fstat(file_handle.fileno()).st_size
+    return replay.original_size or replay.file_size
+
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _parse_range(header: Optional[str], size: int):
+    """
+    (start, end) of a single byte range, None to serve the whole content
+    (no header, or one we don't handle such as multiple ranges), or False
+    if the range is unsatisfiable.
+    """
+    if not header:
+        return None
+    match = _RANGE_PATTERN.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    
+    if not match.group(1):
+        # Sufixo: os últimos N bytes
+        length = int(match.group(2))
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+@router.get("/{replay_id}/stream/review/{speed}")
+async def stream_review_rendition(
+    replay_id: UUID,
+    speed: int,
+    request: Request,
+    current_user: User = Depends(get_user_from_token_or_query),
+    replay_service: ReplayService = Depends(get_replay_service),
+    rendition_service: RenditionService = Depends(get_rendition_service),
+    audit_service: AuditService = Depends(get_audit_service),
+    db: AsyncSession = Depends(get_db)
+):
+    """Stream a cached fast-forward rendition for high-speed review."""
+    replay = await replay_service.get_replay(replay_id)
+    
+    if not replay:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay not found"
+        )
     
-    def iterfile():
+    ticket = await admit_download(current_user, "stream")
+    
+    try:
+        rendition = await rendition_service.get_rendition(replay, speed)
+        await db.commit()
+        
+        await audit_service.log(
+            action=AuditAction.DOWNLOAD,
+            user_id=current_user.id,
+            username=current_user.username,
+            replay_id=replay.id,
+            ip_address=get_client_ip(request),
+            user_agent=request.headers.get("User-Agent", ""),
+            details={"filename": replay.filename, "variant": f"review-{speed}x"}
+        )
+        
+        file_handle = open(rendition, 'rb')
+    except RenditionError as e:
+        await ticket.release()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except FileNotFoundError:
+        await ticket.release()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay file not found"
+        )
+    except Exception:
+        await ticket.release()
+        raise
+    
+    return _file_streaming_response(
+        file_handle, ticket, rendition.name, rendition.stat().st_size,
+        extra_headers={"X-Review-Speed": str(speed)}
+    )
+
+
+def _file_streaming_response(
+    file_handle,
+    ticket: StreamTicket,
+    filename: str,
+    size: int,
+    extra_headers: Optional[dict] = None,
+    limit: Optional[int] = None,
+    status_code: int = status.HTTP_200_OK
+) -> StreamingResponse:
+    """Stream an open file under an admission ticket, pacing its reads."""
+    async def iterfile():
+        remaining = limit
         try:
-            while chunk := file_handle.read(65536):
+            while True:
+                read_size = 65536 if remaining is None else min(65536, remaining)
+                if read_size <= 0:
+                    break
+                chunk = await asyncio.to_thread(file_handle.read, read_size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                await ticket.throttle(len(chunk))
                 yield chunk
         finally:
             file_handle.close()
+            await ticket.release()
     
     return StreamingResponse(
         iterfile(),
+        status_code=status_code,
         media_type="text/plain",
         headers={
-            "Content-Disposition": f'inline; filename="{replay.filename}"',
-            "Content-Length": str(replay.file_size),
+            "Content-Disposition": f'inline; filename="{filename}"',
+            "Content-Length": str(size),
             "Cache-Control": "no-cache",
             "Access-Control-Allow-Origin": "*",
-            "Access-Control-Expose-Headers": "Content-Length, Content-Type"
+            "Access-Control-Expose-Headers": (
+                "Content-Length, Content-Type, Content-Range, Accept-Ranges, "
+                "X-Replay-Repaired, X-Replay-Original-Size"
+            ),
+            **(extra_headers or {})
+        },
+        # Garante a liberação do slot mesmo se o cliente desconectar
+        background=BackgroundTask(ticket.release)
+    )
+
+
+@router.post("/{replay_id}/clips", response_model=ReplayDetail, status_code=status.HTTP_201_CREATED)
+async def create_clip(
+    replay_id: UUID,
+    clip_request: ClipCreate,
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+    allowed_usernames: Optional[list] = Depends(get_allowed_usernames),
+    replay_service: ReplayService = Depends(get_replay_service),
+    clip_service: ClipService = Depends(get_clip_service),
+    audit_service: AuditService = Depends(get_audit_service),
+    db: AsyncSession = Depends(get_db)
+):
+    """Cut a time range of a replay into a new standalone replay."""
+    replay = await replay_service.get_replay(replay_id)
+    
+    if not replay:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Replay not found"
+        )
+    
+    # Check access
+    if allowed_usernames is not None:
+        if replay.owner_username not in allowed_usernames and replay.owner_id != current_user.id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Access denied to this replay"
+            )
+    
+    # A geração lê o replay inteiro: conta como exportação na admissão
+    async with await admit_download(current_user, "clip"):
+        try:
+            clip = await clip_service.create_clip(
+                replay,
+                start_ms=clip_request.start_ms,
+                end_ms=clip_request.end_ms,
+                created_by=current_user,
+                session_name=clip_request.session_name
+            )
+        except FileNotFoundError:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Replay file not found"
+            )
+        except (ClipError, GuacamoleParseError) as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e)
+            )
+    
+    await audit_service.log(
+        action=AuditAction.EXPORT,
+        user_id=current_user.id,
+        username=current_user.username,
+        replay_id=replay.id,
+        ip_address=get_client_ip(request),
+        user_agent=request.headers.get("User-Agent", ""),
+        details={
+            "action": "clip",
+            "filename": replay.filename,
+            "clip_id": str(clip.id),
+            "start_ms": clip_request.start_ms,
+            "end_ms": clip_request.end_ms
         }
     )
+    
+    await db.commit()
+    await db.refresh(clip)
+    
+    return ReplayDetail.model_validate(clip)
 
 
 @router.patch("/{replay_id}", response_model=ReplayDetail)
@@ -288,19 +797,32 @@ async def delete_replay(
     return {"message": "Replay deleted successfully"}
 
 
+def _save_upload(source, target: Path) -> Tuple[str, HashTree]:
+    """Copy an uploaded file to ``target``, hashing it on the way (runs in a worker thread)."""
+    hasher = ContentHasher(executor=get_hash_pool())
+    with open(target, 'wb') as f:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            hasher.update(chunk)
+            f.write(chunk)
+    return hasher.finish()
+
+
 @router.post("/upload", response_model=ReplayDetail)
 async def upload_replay(
     file: UploadFile = File(...),
     request: Request = None,
     current_user: User = Depends(get_current_active_user),
     replay_service: ReplayService = Depends(get_replay_service),
+    blob_service: BlobService = Depends(get_blob_service),
+    integrity_service: IntegrityService = Depends(get_integrity_service),
     audit_service: AuditService = Depends(get_audit_service),
     db: AsyncSession = Depends(get_db)
 ):
-    """Upload a replay file (.guac) for immediate playback."""
-    from pathlib import Path
+    """
+    Upload a replay file (.guac) for immediate playback.
+    A file already stored (same SHA-256) is shared instead of copied.
+    """
     from datetime import datetime, timezone
-    import shutil
     
     # Validate file extension
     if not file.filename.endswith('.guac'):
@@ -327,23 +849,27 @@ async def upload_replay(
             detail="File is empty"
         )
     
+    target_file = None
+    # Local devolvido pelo backend do tier (ex.: objeto no bucket HOT)
+    stored_location = None
     try:
-        # Create storage directory structure: uploads/YYYY/MM/
-        now = datetime.now(timezone.utc)
-        storage_path = Path(replay_service.storage_path) / "uploads" / str(now.year) / f"{now.month:02d}"
-        storage_path.mkdir(parents=True, exist_ok=True)
-        
         # Generate unique filename
         from uuid import uuid4
         unique_filename = f"{current_user.username}_{uuid4().hex[:8]}_{file.filename}"
+        
+        # Create storage directory structure: uploads/YYYY/MM/<shards>/
+        now = datetime.now(timezone.utc)
+        storage_path = recording_dir("uploads", now, unique_filename)
+        storage_path.mkdir(parents=True, exist_ok=True)
         target_file = storage_path / unique_filename
         
-        # Save file
-        with open(target_file, 'wb') as f:
-            shutil.copyfileobj(file.file, f)
+        # Save file, computing its checksum and hash tree on the way
+        checksum, tree = await asyncio.to_thread(_save_upload, file.file, target_file)
         
-        # Extract duration from file
+        # Extract duration and header from file
         duration = await replay_service._extract_replay_duration(target_file)
+        header = await replay_service.read_header(target_file)
+        blob = await blob_service.find(checksum)
         
         # Create database record
         from app.models import Replay, ReplayStatus
@@ -360,16 +886,32 @@ async def upload_replay(
             session_start=now,
             session_end=now if duration == 0 else now,
             status=ReplayStatus.ACTIVE,
+            checksum_sha256=checksum,
+            original_size=file_size,
             metadata_json={
                 "uploaded": True,
                 "upload_time": now.isoformat(),
-                "original_filename": file.filename
-            }
+                "original_filename": file.filename,
+                "header": header.to_dict() if header else None
+            },
+            connection_name=header.name[:255] if header and header.name else None
         )
+        if blob is not None:
+            # Mesmo conteúdo já armazenado: a cópia enviada é descartada
+            BlobService.share(replay, blob)
+            replay.metadata_json["deduplicated_from"] = str(blob.id)
+            target_file.unlink()
+        else:
+            # Bucket do tier HOT, se configurado
+            stored_location = await replay_service.store_in_tier(target_file, target_file, "hot")
+            replay.stored_path = stored_location
         
         db.add(replay)
         await db.flush()
+        await integrity_service.save_hash_tree(replay, tree)
         await db.refresh(replay)
+        await replay_service.validate_replay(replay)
+        await replay_service.analyze_replay(replay)
         
         # Log upload action
         await audit_service.log(
@@ -382,18 +924,25 @@ async def upload_replay(
             details={
                 "action": "upload",
                 "filename": file.filename,
-                "size_bytes": file_size
+                "size_bytes": file_size,
+                "checksum_sha256": checksum,
+                "deduplicated": blob is not None
             }
         )
         
         await db.commit()
         
         return ReplayDetail.model_validate(replay)
-        
+    
     except Exception as e:
         # Clean up file if database operation failed
-        if target_file.exists():
+        if target_file is not None and target_file.exists():
             target_file.unlink()
+        if stored_location and stored_location != str(target_file):
+            try:
+                await asyncio.to_thread(delete_location, stored_location)
+            except Exception as cleanup_error:
+                logger.warning(f"Could not remove uploaded copy {stored_location}: {cleanup_error}")
         
         logger.error(f"Failed to upload replay: {e}")
         raise HTTPException(
@@ -13,7 +13,21 @@ from app.database import get_db
 from app.models import User, Replay, ReplayStatus, AuditLog
 from app.schemas import DashboardStats, TopUser, StorageStats
 from app.services.replay_service import ReplayService
-from app.api.deps import get_current_active_user, get_replay_service
+from app.services.prefetch_service import get_prefetch_service
+from app.services.restore_cache_service import get_restore_cache_service
+from app.services.admission_service import get_admission_controller
+from app.services.job_progress import get_job_registry
+from app.services.dictionary_service import DictionaryService
+from app.services.chunk_store_service import ChunkStoreService
+from app.services.quota_service import QuotaService
+from app.services.integrity_service import IntegrityService
+from app.services.reconcile_service import ReconcileService
+from app.services.pack_service import PackService
+from app.api.deps import (
+    get_current_active_user, get_admin_user, get_replay_service, get_dictionary_service,
+    get_chunk_store_service, get_quota_service, get_integrity_service, get_reconcile_service,
+    get_pack_service
+)
 
 router = APIRouter(prefix="/stats", tags=["Statistics"])
 
@@ -148,6 +162,94 @@ async def get_storage_stats(
     )
 
 
+@router.get("/prefetch")
+async def get_prefetch_stats(
+    current_user: User = Depends(get_admin_user)
+):
+    """Get page-cache prefetch hit/miss metrics (admin only)."""
+    return get_prefetch_service().get_metrics()
+
+
+@router.get("/restore-cache")
+async def get_restore_cache_stats(
+    current_user: User = Depends(get_admin_user)
+):
+    """Get COLD restore cache hit ratio and restore latency (admin only)."""
+    return get_restore_cache_service().get_metrics()
+
+
+@router.get("/admission")
+async def get_admission_stats(
+    current_user: User = Depends(get_admin_user)
+):
+    """Get stream/export admission control metrics (admin only)."""
+    return await get_admission_controller().get_metrics()
+
+
+@router.get("/jobs")
+async def get_job_stats(
+    current_user: User = Depends(get_admin_user)
+):
+    """Get progress and throughput of the last run of each maintenance job (admin only)."""
+    return get_job_registry().get_metrics()
+
+
+@router.get("/dictionaries")
+async def get_dictionary_stats(
+    current_user: User = Depends(get_admin_user),
+    dictionary_service: DictionaryService = Depends(get_dictionary_service)
+):
+    """Get zstd dictionary versions and how many replays use each (admin only)."""
+    return await dictionary_service.get_usage()
+
+
+@router.get("/chunks")
+async def get_chunk_stats(
+    current_user: User = Depends(get_admin_user),
+    chunk_store_service: ChunkStoreService = Depends(get_chunk_store_service)
+):
+    """Get chunk store deduplication: logical, unique and stored bytes (admin only)."""
+    return await chunk_store_service.get_report()
+
+
+@router.get("/packs")
+async def get_pack_stats(
+    current_user: User = Depends(get_admin_user),
+    pack_service: PackService = Depends(get_pack_service)
+):
+    """Get COLD pack files: members, bytes and dead bytes awaiting compaction (admin only)."""
+    return await pack_service.get_report()
+
+
+@router.get("/quota")
+async def get_quota_plan(
+    force: bool = Query(False, description="Plan down to the low watermark even below the high one"),
+    current_user: User = Depends(get_admin_user),
+    quota_service: QuotaService = Depends(get_quota_service)
+):
+    """Get storage usage against MAX_STORAGE_GB and the quota plan, without running it (admin only)."""
+    return await quota_service.build_plan(force=force)
+
+
+@router.get("/integrity")
+async def get_integrity_stats(
+    current_user: User = Depends(get_admin_user),
+    integrity_service: IntegrityService = Depends(get_integrity_service)
+):
+    """Get integrity scrub progress and replays whose last check failed (admin only)."""
+    return await integrity_service.get_report()
+
+
+@router.get("/reconcile")
+async def get_reconcile_stats(
+    kind: Optional[str] = Query(None, description="Only unresolved drift of this kind: missing, orphan or size"),
+    current_user: User = Depends(get_admin_user),
+    reconcile_service: ReconcileService = Depends(get_reconcile_service)
+):
+    """Get the last storage reconcile run: missing files, orphans and size drift (admin only)."""
+    return await reconcile_service.get_report(kind)
+
+
 @router.get("/replays-over-time")
 async def get_replays_over_time(
     days: int = Query(30, ge=1, le=365),
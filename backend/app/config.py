@@ -42,12 +42,162 @@ class Settings(BaseSettings):
     guacamole_recordings_path: str = "/guacamole/recordings"
     replay_storage_path: str = "/app/replays"
     replay_import_delay_hours: int = 24
+    # Templates de nome por diretório de gravações (ver app/utils/filename_templates.py)
+    replay_filename_templates: str = (
+        "*={username}_{protocol}_{hostname}_{timestamp}"
+        "|{protocol}-{hostname}_{timestamp}"
+        "|{username}_{connection_name}_{timestamp}"
+        "|{username}_{timestamp}"
+        "|{date}-{time}"
+    )
+    replay_header_sniff_bytes: int = 16 * 1024
     
     # Storage
     retention_days: int = 365
     max_storage_gb: int = 500
     archive_enabled: bool = True
-    archive_compression: str = "gzip"
+    archive_compression: str = "sgzip"  # gzip, pgzip (blocos paralelos), sgzip (pgzip com índice, seekable) ou zstd
+    archive_compression_level: int = 0  # 0 = padrão do codec
+    archive_compression_threads: int = 0  # 0 = todos os núcleos
+    archive_batch_size: int = 200
+    archive_workers: int = 4
+    archive_max_inflight_mb: int = 2048
+    file_dedup_enabled: bool = True  # gravações idênticas (SHA-256) compartilham o arquivo
+    
+    # Backend de cada tier: local (REPLAY_STORAGE_PATH) ou s3 (um bucket por tier)
+    storage_backend_hot: str = "local"
+    storage_backend_warm: str = "local"
+    storage_backend_cold: str = "local"
+    s3_endpoint_url: str = ""  # MinIO ou outro serviço compatível; vazio = AWS
+    s3_region: str = ""
+    s3_access_key_id: str = ""  # vazio = credenciais do ambiente (IAM, ~/.aws)
+    s3_secret_access_key: str = ""
+    s3_bucket_hot: str = "nachos-replays-hot"
+    s3_bucket_warm: str = "nachos-replays-warm"
+    s3_bucket_cold: str = "nachos-replays-cold"
+    s3_prefix: str = "replays"
+    s3_max_pool_connections: int = 32
+    s3_multipart_threshold_mb: int = 64
+    s3_multipart_chunk_mb: int = 16
+    s3_transfer_concurrency: int = 8  # partes enviadas/baixadas em paralelo por arquivo
+    s3_read_block_kb: int = 1024  # leitura antecipada de cada GET com Range
+    
+    # Migração entre tiers (HOT -> WARM -> COLD)
+    tier_migration_enabled: bool = True
+    tier_migration_hour: int = 3
+    tier_migration_batch_size: int = 200
+    tier_migration_workers: int = 4
+    
+    # Cota de armazenamento (max_storage_gb): marcas alta e baixa em % da cota
+    quota_enabled: bool = True
+    quota_high_watermark_percent: int = 90
+    quota_low_watermark_percent: int = 80
+    quota_check_minutes: int = 30
+    quota_compress_min_file_mb: int = 16  # menores ficam para a compressão na ida para COLD
+    quota_purge_deleted: bool = False  # permite purgar replays removidos (soft delete)
+    quota_purge_grace_days: int = 30  # só removidos há mais tempo que isso
+    quota_batch_size: int = 100
+    quota_max_actions: int = 2000  # ações planejadas por execução
+    
+    # Verificação contínua de integridade (re-hash dos arquivos armazenados)
+    scrub_enabled: bool = True
+    scrub_fraction_per_day: float = 0.05  # 5% do acervo por dia: cobertura total a cada 20 dias
+    scrub_interval_minutes: int = 30
+    scrub_io_mb_per_second: float = 50  # orçamento de leitura; 0 = sem limite
+    scrub_read_buffer_kb: int = 4096
+    scrub_workers: int = 2
+    scrub_batch_size: int = 50
+    scrub_include_remote: bool = False  # objetos em S3 custam GETs e tráfego
+    scrub_history_days: int = 90  # verificações ok mais antigas são descartadas
+    
+    # Árvore de hashes por bloco (verificação parcial, localização de dano)
+    hash_tree_block_mb: int = 4
+    hash_tree_workers: int = 0  # threads de hashing; 0 = todos os núcleos
+    hash_tree_verify_ranges: bool = False  # verifica os blocos servidos em requisições Range
+    
+    # Layout dos diretórios: área/ano/mês/<shards>/arquivo, shards pelo hash do nome
+    storage_shard_levels: int = 2  # 0 = sem shards (layout antigo)
+    storage_shard_width: int = 2  # dígitos hex por nível: 256 diretórios cada
+    storage_layout_migration_enabled: bool = True  # move arquivos existentes para o layout atual
+    storage_layout_migration_minutes: int = 15
+    storage_layout_batch_size: int = 500
+    storage_layout_max_files: int = 20000  # replays verificados por execução
+    
+    # Reconciliação entre os arquivos armazenados e a tabela de replays
+    reconcile_enabled: bool = True
+    reconcile_hour: int = 6  # diária, depois da migração e da coleta de chunks
+    reconcile_fix: bool = False  # false = só relata; true = religa, corrige e põe em quarentena
+    reconcile_batch_size: int = 1000
+    reconcile_orphan_min_age_hours: int = 24  # arquivos mais novos podem estar em gravação/movimentação
+    reconcile_relink_max_gb: int = 100  # leitura máxima de órfãos por execução para religar por checksum
+    reconcile_quarantine_days: int = 30  # 0 = a quarentena nunca é esvaziada
+    
+    # Dicionários zstd para gravações pequenas (SSH/telnet), treinados por protocolo
+    compression_dictionary_enabled: bool = True
+    compression_dictionary_max_file_kb: int = 256  # gravações até este tamanho usam o dicionário
+    compression_dictionary_size_kb: int = 112
+    compression_dictionary_samples: int = 1000  # gravações amostradas por protocolo
+    compression_dictionary_sample_kb: int = 64  # início de cada gravação usado no treino
+    compression_dictionary_min_samples: int = 100
+    compression_dictionary_training_hour: int = 1  # semanal, aos domingos
+    
+    # Armazenamento em chunks deduplicados (gravações COLD)
+    chunk_store_enabled: bool = True
+    chunk_store_min_file_kb: int = 1024  # gravações menores são só comprimidas
+    chunk_min_kb: int = 4
+    chunk_avg_kb: int = 16
+    chunk_max_kb: int = 128
+    chunk_gc_hour: int = 5
+    chunk_gc_grace_hours: int = 24  # chunks sem referências são removidos após este período
+    chunk_gc_batch_size: int = 1000
+    
+    # Pack files no COLD: gravações pequenas agrupadas em arquivos grandes (menos inodes)
+    pack_enabled: bool = True
+    pack_hour: int = 4  # diário, depois da migração de tiers
+    pack_member_max_kb: int = 1024  # só gravações menores (as maiores viram chunks)
+    pack_target_mb: int = 1024  # tamanho de cada pack
+    pack_max_files: int = 200000  # gravações empacotadas por execução
+    pack_compact_dead_ratio: float = 0.3  # reescreve packs com essa fração de bytes mortos
+    pack_compact_grace_days: int = 30  # removidos (soft delete) há mais tempo contam como mortos
+    pack_compact_max_packs: int = 20  # packs reescritos por execução
+    
+    # Prefetch (aquecimento do page cache)
+    prefetch_enabled: bool = True
+    prefetch_top_n: int = 5
+    prefetch_head_bytes: int = 8 * 1024 * 1024
+    prefetch_memory_budget_mb: int = 1024
+    prefetch_metrics_enabled: bool = True
+    
+    # Cache de restauração (replays COLD descomprimidos em disco local rápido)
+    restore_cache_enabled: bool = True
+    restore_cache_path: str = ""  # vazio = <replay_storage_path>/restore-cache
+    restore_cache_budget_mb: int = 10240
+    
+    # Controle de admissão de downloads (stream/export)
+    stream_max_per_user: int = 3
+    stream_max_global: int = 64
+    stream_bandwidth_limit_mbps: float = 0  # 0 = sem limite
+    stream_queue_timeout_seconds: float = 2.0
+    stream_retry_after_seconds: int = 5
+    admission_backend: str = "memory"  # memory ou redis
+    admission_lease_ttl_seconds: int = 300
+    
+    # Rendições de revisão (fast-forward)
+    rendition_speeds: str = "8,32"
+    rendition_idle_cap_ms: int = 1000
+    
+    # Miniaturas (poster e sprite de pré-visualização)
+    thumbnail_enabled: bool = True
+    thumbnail_count: int = 20
+    thumbnail_columns: int = 10
+    thumbnail_width: int = 160
+    thumbnail_poster_width: int = 640
+    thumbnail_workers: int = 2
+    thumbnail_worker_memory_mb: int = 1024
+    thumbnail_batch_size: int = 20
+    
+    # Redis
+    redis_url: str = "redis://localhost:6379/0"
     
     # Security
     cors_origins: str = "http://localhost,http://localhost:5173"
@@ -11,7 +11,7 @@ from fastapi.responses import JSONResponse
 
 from app import __version__
 from app.config import settings
-from app.database import init_db
+from app.database import init_db, async_session_maker
 from app.api import api_router
 from app.tasks.scheduler import start_scheduler, stop_scheduler
 
@@ -32,6 +32,14 @@ async def lifespan(app: FastAPI):
     await init_db()
     logger.info("Database initialized")
     
+    # Dicionários zstd: os leitores os carregam do store local pelo ID no arquivo
+    try:
+        from app.services.dictionary_service import DictionaryService
+        async with async_session_maker() as db:
+            await DictionaryService(db).sync_store()
+    except Exception as e:
+        logger.warning(f"Could not sync compression dictionaries: {e}")
+    
     # Start scheduler for background tasks
     start_scheduler()
     logger.info("Scheduler started")
@@ -8,9 +8,9 @@ import enum
 
 from sqlalchemy import (
     Column, String, Boolean, DateTime, Integer, BigInteger,
-    ForeignKey, Text, Enum, UniqueConstraint, Index
+    ForeignKey, Text, Enum, UniqueConstraint, Index, LargeBinary, Computed, Float, text, DDL, event
 )
-from sqlalchemy.dialects.postgresql import UUID as PGUUID, JSONB
+from sqlalchemy.dialects.postgresql import UUID as PGUUID, JSONB, TSVECTOR
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.sql import func
 
@@ -243,8 +243,13 @@ class Replay(Base):
         default=StorageTier.HOT
     )
     checksum_sha256: Mapped[Optional[str]] = mapped_column(String(64))  # Hash para integridade
+    hash_tree_root: Mapped[Optional[str]] = mapped_column(String(64))  # Raiz da árvore de hashes por bloco
     is_compressed: Mapped[bool] = mapped_column(Boolean, default=False)
     original_size: Mapped[Optional[int]] = mapped_column(BigInteger)  # Tamanho antes de compressão
+    compression_dict_id: Mapped[Optional[int]] = mapped_column(
+        BigInteger,
+        ForeignKey("compression_dictionaries.id", ondelete="RESTRICT")
+    )  # Dicionário zstd usado na compressão
     
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
@@ -272,6 +277,306 @@ class Replay(Base):
         Index("idx_replays_session_start", "session_start"),
         Index("idx_replays_storage_tier", "storage_tier"),
         Index("idx_replays_protocol", "protocol"),
+        Index("idx_replays_tier_imported", "storage_tier", "imported_at", "id"),
+        Index("idx_replays_compression_dict", "compression_dict_id"),
+        Index("idx_replays_checksum", "checksum_sha256"),
+        Index("idx_replays_stored_path", "stored_path"),
+        # Varredura do reconciliador em ordem de bytes, a mesma do os.scandir ordenado
+        Index("idx_replays_stored_path_c", text('stored_path COLLATE "C"'), "id"),
+        # Candidatos do motor de cota: maiores WARM sem compressão e removidos (soft delete)
+        Index(
+            "idx_replays_warm_uncompressed", text("file_size DESC"), "id",
+            postgresql_where=text("storage_tier = 'warm' AND NOT is_compressed")
+        ),
+        Index("idx_replays_deleted", "updated_at", "id", postgresql_where=text("status = 'deleted'")),
+    )
+
+
+class CompressionDictionary(Base):
+    """zstd dictionary trained on small recordings of one protocol (versioned)."""
+    __tablename__ = "compression_dictionaries"
+    
+    # ID gravado no cabeçalho dos quadros zstd (escolhido pelo treinamento)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    protocol: Mapped[str] = mapped_column(String(20), nullable=False)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    size_bytes: Mapped[int] = mapped_column(Integer, default=0)
+    sample_count: Mapped[int] = mapped_column(Integer, default=0)
+    sample_bytes: Mapped[int] = mapped_column(BigInteger, default=0)
+    # Razão de compressão na amostra de validação, com e sem o dicionário
+    ratio: Mapped[Optional[float]] = mapped_column(Float)
+    baseline_ratio: Mapped[Optional[float]] = mapped_column(Float)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+    
+    __table_args__ = (
+        UniqueConstraint("protocol", "version"),
+    )
+
+
+class Chunk(Base):
+    """Deduplicated chunk of COLD recordings (see utils.chunk_store)."""
+    __tablename__ = "chunks"
+    
+    # SHA-256 do conteúdo descomprimido; o arquivo fica em chunks/ab/cd/<hash>
+    hash: Mapped[bytes] = mapped_column(LargeBinary(32), primary_key=True)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    stored_size: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Manifestos que usam o chunk; em zero, o coletor remove após o período de carência
+    refcount: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now()
+    )
+    
+    __table_args__ = (
+        Index("idx_chunks_unreferenced", "updated_at", postgresql_where=text("refcount <= 0")),
+    )
+
+
+class StoragePack(Base):
+    """Pack file of small COLD recordings (see utils.pack_store)."""
+    __tablename__ = "storage_packs"
+    
+    id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        primary_key=True,
+        default=uuid4
+    )
+    # Caminho relativo a replay_storage_path: packs/YYYY/MM/<uuid>.pack
+    key: Mapped[str] = mapped_column(String(500), unique=True, nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    member_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+
+class StoragePackMember(Base):
+    """Entry of a pack's index; replays reference it by ``location`` (their stored_path)."""
+    __tablename__ = "storage_pack_members"
+    
+    pack_id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("storage_packs.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    offset: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    length: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    checksum: Mapped[str] = mapped_column(String(64), nullable=False)  # SHA-256 dos bytes armazenados
+    name: Mapped[str] = mapped_column(String(500), nullable=False)
+    location: Mapped[str] = mapped_column(String(1000), nullable=False)
+    
+    __table_args__ = (
+        Index("idx_storage_pack_members_location", "location"),
+    )
+
+
+class StorageUsage(Base):
+    """Stored replay bytes per tier, status, compression and location (see QuotaService)."""
+    __tablename__ = "storage_usage"
+    
+    storage_tier: Mapped[str] = mapped_column(String(10), primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), primary_key=True)
+    is_compressed: Mapped[bool] = mapped_column(Boolean, primary_key=True)
+    is_remote: Mapped[bool] = mapped_column(Boolean, primary_key=True)
+    files: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    bytes: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    # Tamanho antes da compressão (igual a bytes nos arquivos sem compressão)
+    original_bytes: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+
+
+class StorageUsageDelta(Base):
+    """
+    Change to storage_usage written by the replays trigger. Appending
+    deltas keeps writers from contending on the totals' rows; QuotaService
+    folds them into storage_usage.
+    """
+    __tablename__ = "storage_usage_deltas"
+    
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    storage_tier: Mapped[str] = mapped_column(String(10), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)
+    is_compressed: Mapped[bool] = mapped_column(Boolean, nullable=False)
+    is_remote: Mapped[bool] = mapped_column(Boolean, nullable=False)
+    files: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    original_bytes: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+# Contabilidade incremental: cada mudança em replays vira um delta (linha
+# antiga subtraída, nova somada), inclusive updates em massa
+STORAGE_USAGE_FUNCTION = DDL("""
+CREATE OR REPLACE FUNCTION account_storage_usage() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.stored_path IS NOT NULL THEN
+        INSERT INTO storage_usage_deltas
+            (storage_tier, status, is_compressed, is_remote, files, bytes, original_bytes)
+        VALUES (
+            COALESCE(OLD.storage_tier::text, 'hot'), COALESCE(OLD.status::text, 'active'),
+            COALESCE(OLD.is_compressed, false), left(OLD.stored_path, 5) = 's3://',
+            -1, -COALESCE(OLD.file_size, 0), -COALESCE(OLD.original_size, OLD.file_size, 0)
+        );
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.stored_path IS NOT NULL THEN
+        INSERT INTO storage_usage_deltas
+            (storage_tier, status, is_compressed, is_remote, files, bytes, original_bytes)
+        VALUES (
+            COALESCE(NEW.storage_tier::text, 'hot'), COALESCE(NEW.status::text, 'active'),
+            COALESCE(NEW.is_compressed, false), left(NEW.stored_path, 5) = 's3://',
+            1, COALESCE(NEW.file_size, 0), COALESCE(NEW.original_size, NEW.file_size, 0)
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+""")
+
+STORAGE_USAGE_TRIGGER = DDL("""
+CREATE OR REPLACE TRIGGER replays_storage_usage
+AFTER INSERT OR DELETE OR UPDATE OF stored_path, storage_tier, status, is_compressed, file_size, original_size
+ON replays FOR EACH ROW EXECUTE FUNCTION account_storage_usage()
+""")
+
+event.listen(Base.metadata, "after_create", STORAGE_USAGE_FUNCTION)
+event.listen(Base.metadata, "after_create", STORAGE_USAGE_TRIGGER)
+
+
+class ReplayActivity(Base):
+    """Per-second activity histogram of a replay (computed at import)."""
+    __tablename__ = "replay_activity"
+    
+    replay_id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("replays.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    bucket_ms: Mapped[int] = mapped_column(Integer, default=1000)
+    bucket_count: Mapped[int] = mapped_column(Integer, default=0)
+    # Dois arrays uint32 little-endian concatenados: bytes e instruções por bucket
+    histogram: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+
+class ReplayIntegrityCheck(Base):
+    """Result of re-hashing a replay's stored recording (see IntegrityService)."""
+    __tablename__ = "replay_integrity_checks"
+    
+    id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        primary_key=True,
+        default=uuid4
+    )
+    replay_id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("replays.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    checked_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+    status: Mapped[str] = mapped_column(String(20), nullable=False)  # ok, recorded, mismatch, missing, error
+    expected_checksum: Mapped[Optional[str]] = mapped_column(String(64))
+    actual_checksum: Mapped[Optional[str]] = mapped_column(String(64))
+    bytes_read: Mapped[int] = mapped_column(BigInteger, default=0)
+    duration_ms: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[Optional[str]] = mapped_column(Text)
+    # Trechos [início, fim] do conteúdo cujos blocos não conferem com a árvore de hashes
+    bad_ranges: Mapped[Optional[list]] = mapped_column(JSONB)
+    
+    __table_args__ = (
+        Index("idx_integrity_replay_checked", "replay_id", "checked_at"),
+        Index("idx_integrity_checked_at", "checked_at"),
+    )
+
+
+class ReplayHashTree(Base):
+    """Per-block SHA-256 of a replay's content (see utils.hash_tree)."""
+    __tablename__ = "replay_hash_trees"
+    
+    replay_id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("replays.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    block_size: Mapped[int] = mapped_column(Integer, nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)  # Conteúdo descomprimido
+    # Folhas concatenadas, 32 bytes por bloco; sha256(leaves) = replays.hash_tree_root
+    leaves: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+
+
+class StorageDrift(Base):
+    """Difference between the stored files and the replays table (see ReconcileService)."""
+    __tablename__ = "storage_drift"
+    
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    run_id: Mapped[UUID] = mapped_column(PGUUID(as_uuid=True), nullable=False)
+    kind: Mapped[str] = mapped_column(String(20), nullable=False)  # missing, orphan, size
+    path: Mapped[str] = mapped_column(Text, nullable=False)
+    replay_id: Mapped[Optional[UUID]] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("replays.id", ondelete="CASCADE")
+    )
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)  # Tamanho no disco
+    expected_size: Mapped[Optional[int]] = mapped_column(BigInteger)  # file_size do replay
+    modified_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
+    checksum: Mapped[Optional[str]] = mapped_column(String(64))  # Conteúdo do órfão, para religar
+    resolution: Mapped[Optional[str]] = mapped_column(String(20))  # relinked, quarantined, resized
+    resolved_path: Mapped[Optional[str]] = mapped_column(Text)
+    found_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
+    
+    __table_args__ = (
+        Index("idx_storage_drift_run", "run_id", "kind", "id"),
+        Index("idx_storage_drift_checksum", "run_id", "checksum"),
+    )
+
+
+class ReplayTranscriptSegment(Base):
+    """Typed text or clipboard content of a replay, indexed for full-text search."""
+    __tablename__ = "replay_transcript_segments"
+    
+    id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        primary_key=True,
+        default=uuid4
+    )
+    replay_id: Mapped[UUID] = mapped_column(
+        PGUUID(as_uuid=True),
+        ForeignKey("replays.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    offset_ms: Mapped[int] = mapped_column(BigInteger, default=0)
+    kind: Mapped[str] = mapped_column(String(20), nullable=False)  # keys ou clipboard
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    # Configuração 'simple': comandos e nomes não devem sofrer stemming
+    tsv = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('simple', text)", persisted=True)
+    )
+    
+    __table_args__ = (
+        Index("idx_transcript_replay_offset", "replay_id", "offset_ms"),
+        Index("idx_transcript_tsv", "tsv", postgresql_using="gin"),
     )
 
 
@@ -6,7 +6,7 @@ from typing import Optional, List, Any
 from uuid import UUID
 from enum import Enum
 
-from pydantic import BaseModel, EmailStr, Field, ConfigDict
+from pydantic import BaseModel, EmailStr, Field, ConfigDict, model_validator
 
 
 # ============================================
@@ -244,6 +244,58 @@ class ReplaySearch(BaseModel):
     storage_tier: Optional[StorageTierEnum] = None
 
 
+class ClipCreate(BaseModel):
+    """Clip extraction request (milliseconds from the recording start)."""
+    start_ms: int = Field(..., ge=0)
+    end_ms: int = Field(..., gt=0)
+    session_name: Optional[str] = Field(None, max_length=255)
+    
+    @model_validator(mode="after")
+    def check_range(self) -> "ClipCreate":
+        if self.end_ms <= self.start_ms:
+            raise ValueError("end_ms must be greater than start_ms")
+        return self
+
+
+class IdleSegment(BaseModel):
+    """Idle period of a replay (milliseconds from the recording start)."""
+    start_ms: int
+    end_ms: int
+    duration_ms: int
+
+
+class ReplayActivityResponse(BaseModel):
+    """Per-bucket activity histogram of a replay."""
+    replay_id: UUID
+    bucket_ms: int
+    bytes: List[int]
+    instructions: List[int]
+    idle_threshold_seconds: int
+    idle_segments: List[IdleSegment]
+
+
+class TranscriptSegmentResponse(BaseModel):
+    """Typed text or clipboard content at an offset of a replay."""
+    offset_ms: int
+    kind: str
+    text: str
+    
+    model_config = ConfigDict(from_attributes=True)
+
+
+class TranscriptMatch(BaseModel):
+    """Transcript search hit inside a replay."""
+    offset_ms: int
+    kind: str
+    snippet: str
+
+
+class TranscriptSearchResult(BaseModel):
+    """Replay matching a transcript search, with the offsets of each hit."""
+    replay: ReplayResponse
+    matches: List[TranscriptMatch]
+
+
 # ============================================
 # Audit Schemas
 # ============================================
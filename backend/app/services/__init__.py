@@ -2,6 +2,22 @@
 from app.services.ldap_service import LDAPService, MockLDAPService, get_ldap_service
 from app.services.audit_service import AuditService
 from app.services.replay_service import ReplayService
+from app.services.prefetch_service import PrefetchService, get_prefetch_service
+from app.services.restore_cache_service import RestoreCacheService, get_restore_cache_service
+from app.services.clip_service import ClipService
+from app.services.rendition_service import RenditionService
+from app.services.activity_service import ActivityService
+from app.services.thumbnail_service import ThumbnailService
+from app.services.transcript_service import TranscriptService
+from app.services.job_progress import JobRegistry, get_job_registry
+from app.services.dictionary_service import DictionaryService
+from app.services.chunk_store_service import ChunkStoreService
+from app.services.blob_service import BlobService
+from app.services.quota_service import QuotaService
+from app.services.integrity_service import IntegrityService
+from app.services.reconcile_service import ReconcileService
+from app.services.layout_service import StorageLayoutService
+from app.services.pack_service import PackService
 
 __all__ = [
     "LDAPService",
@@ -9,4 +25,23 @@ __all__ = [
     "get_ldap_service",
     "AuditService",
     "ReplayService",
+    "PrefetchService",
+    "get_prefetch_service",
+    "RestoreCacheService",
+    "get_restore_cache_service",
+    "ClipService",
+    "RenditionService",
+    "ActivityService",
+    "ThumbnailService",
+    "TranscriptService",
+    "JobRegistry",
+    "get_job_registry",
+    "DictionaryService",
+    "ChunkStoreService",
+    "BlobService",
+    "QuotaService",
+    "IntegrityService",
+    "ReconcileService",
+    "StorageLayoutService",
+    "PackService",
 ]
@@ -0,0 +1,173 @@
+"""
+Nachos Replay for Guaca - Activity Service
+Per-second activity histograms and idle-gap detection for replays.
+"""
+import asyncio
+import logging
+import sys
+from array import array
+from typing import BinaryIO, Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Replay, ReplayActivity
+from app.services.replay_service import ReplayService
+from app.utils.guacamole import RawInstructionReader, sync_timestamp
+
+logger = logging.getLogger(__name__)
+
+BUCKET_MS = 1000
+
+
+class ActivityHistogram:
+    """
+    Accumulates bytes and instruction counts per time bucket.
+    
+    Instructions are attributed to the frame that the following ``sync``
+    closes. Syncs themselves are not counted: guacd keeps emitting them while
+    the session is idle, so counting them would hide idle periods.
+    """
+    
+    def __init__(self, bucket_ms: int = BUCKET_MS):
+        self.bucket_ms = bucket_ms
+        self.bytes = array("I")
+        self.instructions = array("I")
+        self._first_ts: Optional[int] = None
+        self._frame_bytes = 0
+        self._frame_count = 0
+    
+    def feed(self, opcode: str, size: int, ts: Optional[int]):
+        if ts is None:
+            self._frame_bytes += size
+            self._frame_count += 1
+            return
+        
+        if self._first_ts is None:
+            self._first_ts = ts
+        bucket = max(ts - self._first_ts, 0) // self.bucket_ms
+        self._add(bucket, self._frame_bytes, self._frame_count)
+        self._frame_bytes = 0
+        self._frame_count = 0
+    
+    def finish(self):
+        """Account instructions after the last sync to the last bucket."""
+        if self._frame_count:
+            self._add(max(len(self.bytes) - 1, 0), self._frame_bytes, self._frame_count)
+            self._frame_bytes = 0
+            self._frame_count = 0
+    
+    def _add(self, bucket: int, nbytes: int, count: int):
+        missing = bucket + 1 - len(self.bytes)
+        if missing > 0:
+            self.bytes.extend(array("I", [0]) * missing)
+            self.instructions.extend(array("I", [0]) * missing)
+        self.bytes[bucket] = min(self.bytes[bucket] + nbytes, 0xFFFFFFFF)
+        self.instructions[bucket] = min(self.instructions[bucket] + count, 0xFFFFFFFF)
+    
+    def to_blob(self) -> bytes:
+        """Serialize as two little-endian uint32 arrays (bytes, then counts)."""
+        data_bytes, data_counts = array("I", self.bytes), array("I", self.instructions)
+        if sys.byteorder == "big":
+            data_bytes.byteswap()
+            data_counts.byteswap()
+        return data_bytes.tobytes() + data_counts.tobytes()
+    
+    @staticmethod
+    def from_blob(blob: bytes) -> Tuple[array, array]:
+        values = array("I")
+        values.frombytes(blob)
+        if sys.byteorder == "big":
+            values.byteswap()
+        half = len(values) // 2
+        return values[:half], values[half:]
+
+
+def compute_histogram(fileobj: BinaryIO, bucket_ms: int = BUCKET_MS) -> ActivityHistogram:
+    """Single forward pass over a recording."""
+    histogram = ActivityHistogram(bucket_ms)
+    for instruction in RawInstructionReader(fileobj):
+        histogram.feed(instruction.opcode, instruction.size, sync_timestamp(instruction))
+    histogram.finish()
+    return histogram
+
+
+def find_idle_segments(instructions: array, bucket_ms: int, threshold_seconds: int) -> List[Dict[str, int]]:
+    """Runs of buckets with no instructions lasting at least ``threshold_seconds``."""
+    min_buckets = max(1, (threshold_seconds * 1000) // bucket_ms)
+    segments = []
+    run_start = None
+    
+    for index, count in enumerate(list(instructions) + [1]):
+        if count == 0:
+            if run_start is None:
+                run_start = index
+        elif run_start is not None:
+            if index - run_start >= min_buckets:
+                segments.append({
+                    "start_ms": run_start * bucket_ms,
+                    "end_ms": index * bucket_ms,
+                    "duration_ms": (index - run_start) * bucket_ms,
+                })
+            run_start = None
+    
+    return segments
+
+
+class ActivityService:
+    """Service for replay activity histograms."""
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.replay_service = ReplayService(db)
+    
+    async def compute_for_replay(self, replay: Replay) -> Optional[ReplayActivity]:
+        """Compute (or recompute) and store the histogram of a replay."""
+        histogram = await asyncio.to_thread(self._compute, replay)
+        if histogram is None:
+            return None
+        return await self.save_histogram(replay, histogram)
+    
+    async def save_histogram(self, replay: Replay, histogram: ActivityHistogram) -> ReplayActivity:
+        """Store an already computed histogram."""
+        activity = await self.db.get(ReplayActivity, replay.id)
+        if activity is None:
+            activity = ReplayActivity(replay_id=replay.id)
+            self.db.add(activity)
+        
+        activity.bucket_ms = histogram.bucket_ms
+        activity.bucket_count = len(histogram.bytes)
+        activity.histogram = histogram.to_blob()
+        await self.db.flush()
+        return activity
+    
+    def _compute(self, replay: Replay) -> Optional[ActivityHistogram]:
+        source = self.replay_service.open_replay_data(replay)
+        if source is None:
+            return None
+        with source:
+            return compute_histogram(source)
+    
+    async def get_activity(self, replay: Replay, idle_threshold_seconds: int) -> Optional[Dict[str, Any]]:
+        """Histogram plus idle segments; computed on demand for older replays."""
+        result = await self.db.execute(
+            select(ReplayActivity).where(ReplayActivity.replay_id == replay.id)
+        )
+        activity = result.scalar_one_or_none()
+        
+        if activity is None:
+            activity = await self.compute_for_replay(replay)
+            if activity is None:
+                return None
+        
+        bytes_per_bucket, instructions_per_bucket = ActivityHistogram.from_blob(activity.histogram)
+        return {
+            "replay_id": replay.id,
+            "bucket_ms": activity.bucket_ms,
+            "bytes": bytes_per_bucket.tolist(),
+            "instructions": instructions_per_bucket.tolist(),
+            "idle_threshold_seconds": idle_threshold_seconds,
+            "idle_segments": find_idle_segments(
+                instructions_per_bucket, activity.bucket_ms, idle_threshold_seconds
+            ),
+        }
@@ -0,0 +1,302 @@
+"""
+Nachos Replay for Guaca - Admission Control
+Limits concurrent stream/export downloads and shares bandwidth fairly.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Any, Optional
+from uuid import uuid4
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Quanto um ticket pode "adiantar" de banda antes de dormir (em segundos)
+BUCKET_BURST_SECONDS = 0.5
+
+# Intervalo para recalcular a fatia de banda de um ticket (consulta o backend)
+FAIR_SHARE_REFRESH_SECONDS = 1.0
+
+
+class AdmissionRejected(Exception):
+    """Raised when a download cannot be admitted in time."""
+    
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class StreamTicket:
+    """
+    An admitted download slot.
+
+    Each ticket paces its own reads against a token bucket whose rate is the
+    viewer's fair share of the global bandwidth cap: the cap is split evenly
+    between active users, then between that user's streams. The share is
+    recomputed every ``FAIR_SHARE_REFRESH_SECONDS``, not for every chunk.
+    """
+    
+    def __init__(self, controller: "AdmissionController", user_key: str, kind: str):
+        self.controller = controller
+        self.user_key = user_key
+        self.kind = kind
+        self.ticket_id = uuid4().hex
+        self.bytes_sent = 0
+        self._released = False
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._last_renew = self._last
+        self._rate: Optional[float] = None
+        self._rate_at = 0.0
+    
+    async def throttle(self, nbytes: int):
+        """Wait until ``nbytes`` may be sent under the current fair share."""
+        self.bytes_sent += nbytes
+        now = time.monotonic()
+        
+        if now - self._last_renew > self.controller.lease_ttl / 3:
+            self._last_renew = now
+            await self.controller.backend.renew(self)
+        
+        if self._rate is None or now - self._rate_at >= FAIR_SHARE_REFRESH_SECONDS:
+            self._rate = await self.controller.fair_share(self.user_key)
+            self._rate_at = now
+        rate = self._rate
+        if rate <= 0:
+            return
+        
+        self._tokens = min(
+            self._tokens + (now - self._last) * rate,
+            rate * BUCKET_BURST_SECONDS
+        )
+        self._last = now
+        self._tokens -= nbytes
+        
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / rate)
+    
+    async def release(self):
+        """Free the slot (idempotent)."""
+        if self._released:
+            return
+        self._released = True
+        await self.controller.backend.release(self)
+    
+    async def __aenter__(self) -> "StreamTicket":
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+
+class MemoryAdmissionBackend:
+    """In-process slot accounting (single replica)."""
+    
+    def __init__(self):
+        self._by_user: Dict[str, int] = defaultdict(int)
+        self._total = 0
+        self._changed = asyncio.Condition()
+    
+    async def try_acquire(self, ticket: StreamTicket, per_user: int, global_max: int) -> Optional[str]:
+        """Take a slot, or return the name of the exhausted limit."""
+        async with self._changed:
+            if self._by_user[ticket.user_key] >= per_user:
+                return "user"
+            if self._total >= global_max:
+                return "global"
+            self._by_user[ticket.user_key] += 1
+            self._total += 1
+            return None
+    
+    async def wait_for_release(self, timeout: float):
+        """Block until some slot is released or ``timeout`` elapses."""
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def release(self, ticket: StreamTicket):
+        async with self._changed:
+            self._by_user[ticket.user_key] -= 1
+            if self._by_user[ticket.user_key] <= 0:
+                del self._by_user[ticket.user_key]
+            self._total -= 1
+            self._changed.notify_all()
+    
+    async def renew(self, ticket: StreamTicket):
+        return None
+    
+    async def counts(self, user_key: Optional[str] = None) -> Dict[str, int]:
+        return {
+            "streams": self._total,
+            "users": len(self._by_user),
+            "user_streams": self._by_user.get(user_key, 0) if user_key else 0,
+        }
+
+
+class RedisAdmissionBackend:
+    """
+    Slot accounting shared between replicas through Redis.
+
+    Slots are members of sorted sets scored by lease expiry, so a replica
+    that dies without releasing only holds its slots until the lease ends.
+    """
+    
+    ACQUIRE_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[3]) then return 'user' end
+    if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then return 'global' end
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[5])
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[5])
+    redis.call('ZADD', KEYS[3], ARGV[2], ARGV[6])
+    redis.call('EXPIRE', KEYS[2], ARGV[7])
+    return ''
+    """
+    
+    def __init__(self, url: str, lease_ttl: int, prefix: str = "nachos:admission"):
+        import redis.asyncio as aioredis
+        
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.lease_ttl = lease_ttl
+        self.prefix = prefix
+        self._acquire = self.redis.register_script(self.ACQUIRE_SCRIPT)
+    
+    def _keys(self, user_key: str):
+        return (
+            f"{self.prefix}:streams",
+            f"{self.prefix}:user:{user_key}",
+            f"{self.prefix}:users",
+        )
+    
+    async def try_acquire(self, ticket: StreamTicket, per_user: int, global_max: int) -> Optional[str]:
+        now = time.time()
+        result = await self._acquire(
+            keys=list(self._keys(ticket.user_key)),
+            args=[now, now + self.lease_ttl, per_user, global_max,
+                  ticket.ticket_id, ticket.user_key, self.lease_ttl],
+        )
+        return result or None
+    
+    async def wait_for_release(self, timeout: float):
+        await asyncio.sleep(min(timeout, 0.25))
+    
+    async def release(self, ticket: StreamTicket):
+        streams, user, users = self._keys(ticket.user_key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(streams, ticket.ticket_id)
+            pipe.zrem(user, ticket.ticket_id)
+            await pipe.execute()
+        if not await self.redis.zcard(user):
+            await self.redis.zrem(users, ticket.user_key)
+    
+    async def renew(self, ticket: StreamTicket):
+        streams, user, users = self._keys(ticket.user_key)
+        expiry = time.time() + self.lease_ttl
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(streams, {ticket.ticket_id: expiry})
+            pipe.zadd(user, {ticket.ticket_id: expiry})
+            pipe.zadd(users, {ticket.user_key: expiry})
+            pipe.expire(user, self.lease_ttl)
+            await pipe.execute()
+    
+    async def counts(self, user_key: Optional[str] = None) -> Dict[str, int]:
+        streams, user, users = self._keys(user_key or "")
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zcount(streams, now, "+inf")
+            pipe.zcount(users, now, "+inf")
+            pipe.zcount(user, now, "+inf")
+            total, active_users, user_streams = await pipe.execute()
+        return {
+            "streams": total,
+            "users": active_users,
+            "user_streams": user_streams if user_key else 0,
+        }
+
+
+class AdmissionController:
+    """Admission control for stream and export endpoints."""
+    
+    def __init__(self, backend=None):
+        self.per_user = settings.stream_max_per_user
+        self.global_max = settings.stream_max_global
+        self.bandwidth_bytes = int(settings.stream_bandwidth_limit_mbps * 1024 * 1024 / 8)
+        self.queue_timeout = settings.stream_queue_timeout_seconds
+        self.retry_after = settings.stream_retry_after_seconds
+        self.lease_ttl = settings.admission_lease_ttl_seconds
+        self.backend = backend or self._create_backend()
+        self._metrics = defaultdict(int)
+    
+    def _create_backend(self):
+        if settings.admission_backend == "redis":
+            try:
+                return RedisAdmissionBackend(settings.redis_url, self.lease_ttl)
+            except ImportError:
+                logger.warning("redis package not installed, using in-process admission control")
+        return MemoryAdmissionBackend()
+    
+    async def acquire(self, user_key: str, kind: str = "stream") -> StreamTicket:
+        """
+        Admit a download, waiting up to ``stream_queue_timeout_seconds``.
+        Raises AdmissionRejected when the user or the server is saturated.
+        """
+        ticket = StreamTicket(self, user_key, kind)
+        deadline = time.monotonic() + self.queue_timeout
+        
+        while True:
+            exhausted = await self.backend.try_acquire(ticket, self.per_user, self.global_max)
+            if exhausted is None:
+                self._metrics["admitted"] += 1
+                return ticket
+            
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._metrics[f"rejected_{exhausted}"] += 1
+                raise AdmissionRejected(
+                    "Too many concurrent downloads for this user"
+                    if exhausted == "user" else
+                    "Server is busy serving other downloads",
+                    self.retry_after
+                )
+            
+            self._metrics["queued"] += 1
+            await self.backend.wait_for_release(remaining)
+    
+    async def fair_share(self, user_key: str) -> float:
+        """Bytes per second available to one stream of ``user_key``."""
+        if self.bandwidth_bytes <= 0:
+            return 0
+        
+        counts = await self.backend.counts(user_key)
+        users = max(counts["users"], 1)
+        user_streams = max(counts["user_streams"], 1)
+        return self.bandwidth_bytes / users / user_streams
+    
+    async def get_metrics(self) -> Dict[str, Any]:
+        """Return admission counters and current occupancy."""
+        counts = await self.backend.counts()
+        return {
+            **dict(self._metrics),
+            "active_streams": counts["streams"],
+            "active_users": counts["users"],
+            "max_per_user": self.per_user,
+            "max_global": self.global_max,
+            "bandwidth_limit_bytes": self.bandwidth_bytes,
+        }
+
+
+_admission_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """Get the process-wide admission controller."""
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
@@ -0,0 +1,167 @@
+"""
+Nachos Replay for Guaca - Analysis Service
+Single-pass structural analysis of recordings at import.
+"""
+import asyncio
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import BinaryIO, Dict, Any, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Replay
+from app.services.activity_service import ActivityHistogram, ActivityService
+from app.services.replay_service import ReplayService
+from app.services.transcript_service import TranscriptExtractor, TranscriptSegment, TranscriptService
+from app.utils.guacamole import DEFAULT_LAYER, RawInstruction, RawInstructionReader, sync_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Instruções que abrem um stream (o primeiro argumento é o índice do stream)
+STREAM_OPCODES = {"img", "audio", "video", "file", "pipe", "clipboard", "argv", "body"}
+
+MAX_RESOLUTION_CHANGES = 50
+
+
+class RecordingStats:
+    """Structural statistics of a recording, gathered from raw instructions."""
+    
+    def __init__(self):
+        self.opcodes: Counter = Counter()
+        self.instructions = 0
+        self.bytes = 0
+        self.sync_count = 0
+        self.first_ts: Optional[int] = None
+        self.last_ts: Optional[int] = None
+        self.max_frame_gap_ms = 0
+        self.resolution_changes = 0
+        self.resolutions: List[Dict[str, int]] = []
+        self.streams = 0
+        self.blob_count = 0
+        self.blob_bytes = 0
+    
+    def feed(self, instruction: RawInstruction, ts: Optional[int]):
+        opcode = instruction.opcode
+        self.opcodes[opcode] += 1
+        self.instructions += 1
+        self.bytes += instruction.size
+        
+        if ts is not None:
+            self.sync_count += 1
+            if self.first_ts is None:
+                self.first_ts = ts
+            elif ts - self.last_ts > self.max_frame_gap_ms:
+                self.max_frame_gap_ms = ts - self.last_ts
+            self.last_ts = ts
+        
+        elif opcode == "blob":
+            self.blob_count += 1
+            if instruction.arg_count >= 2:
+                self.blob_bytes += instruction.arg_size(1)
+        
+        elif opcode in STREAM_OPCODES:
+            self.streams += 1
+        
+        elif opcode == "size" and instruction.arg_count >= 3 and instruction.arg(0) == DEFAULT_LAYER:
+            self.resolution_changes += 1
+            if len(self.resolutions) < MAX_RESOLUTION_CHANGES:
+                try:
+                    self.resolutions.append({
+                        "offset_ms": (self.last_ts - self.first_ts) if self.first_ts is not None else 0,
+                        "width": int(instruction.arg_bytes(1)),
+                        "height": int(instruction.arg_bytes(2)),
+                    })
+                except ValueError:
+                    pass
+    
+    @property
+    def duration_ms(self) -> int:
+        if self.first_ts is None:
+            return 0
+        return max(self.last_ts - self.first_ts, 0)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "instructions": self.instructions,
+            "bytes": self.bytes,
+            "opcodes": dict(self.opcodes.most_common()),
+            "sync_count": self.sync_count,
+            "duration_ms": self.duration_ms,
+            "max_frame_gap_ms": self.max_frame_gap_ms,
+            "resolution_changes": self.resolution_changes,
+            "resolutions": self.resolutions,
+            "streams": self.streams,
+            "blob_count": self.blob_count,
+            "blob_bytes": self.blob_bytes,
+        }
+
+
+@dataclass
+class RecordingAnalysis:
+    """Everything computed by the import pass."""
+    stats: RecordingStats
+    histogram: ActivityHistogram
+    transcript: List[TranscriptSegment]
+    trailing_bytes: int = 0
+
+
+def analyze_recording(fileobj: BinaryIO) -> RecordingAnalysis:
+    """
+    Read a recording once, feeding every collector.
+    Instructions are not decoded unless a collector needs their arguments.
+    """
+    stats = RecordingStats()
+    histogram = ActivityHistogram()
+    transcript = TranscriptExtractor()
+    
+    reader = RawInstructionReader(fileobj)
+    for instruction in reader:
+        ts = sync_timestamp(instruction)
+        stats.feed(instruction, ts)
+        histogram.feed(instruction.opcode, instruction.size, ts)
+        transcript.feed_raw(instruction, ts)
+    
+    histogram.finish()
+    return RecordingAnalysis(stats, histogram, transcript.finish(), reader.trailing_bytes)
+
+
+class AnalysisService:
+    """Service running the import-time analysis of replays."""
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.replay_service = ReplayService(db)
+    
+    async def analyze_replay(self, replay: Replay) -> Optional[RecordingAnalysis]:
+        """Analyze a replay and store its statistics, histogram and transcript."""
+        analysis = await asyncio.to_thread(self._analyze, replay)
+        if analysis is None:
+            return None
+        
+        stats = analysis.stats.to_dict()
+        stats["trailing_bytes"] = analysis.trailing_bytes
+        replay.metadata_json = {**(replay.metadata_json or {}), "stats": stats}
+        
+        # A duração real vem dos syncs (a estimativa da importação lê só o início e o fim)
+        if analysis.stats.sync_count:
+            replay.duration_seconds = stats["duration_ms"] // 1000
+            if replay.session_start:
+                replay.session_end = replay.session_start + timedelta(milliseconds=stats["duration_ms"])
+        
+        await ActivityService(self.db).save_histogram(replay, analysis.histogram)
+        await TranscriptService(self.db).save_segments(replay, analysis.transcript)
+        
+        logger.info(
+            f"Analyzed {replay.filename}: {stats['instructions']} instructions, "
+            f"{stats['sync_count']} frames, {len(analysis.transcript)} transcript segments"
+        )
+        return analysis
+    
+    def _analyze(self, replay: Replay) -> Optional[RecordingAnalysis]:
+        source = self.replay_service.open_replay_data(replay)
+        if source is None:
+            return None
+        with source:
+            return analyze_recording(source)
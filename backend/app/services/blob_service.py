@@ -0,0 +1,96 @@
+"""
+Nachos Replay for Guaca - Blob Service
+Whole-file deduplication: replays with the same content share one stored file.
+"""
+import asyncio
+import logging
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import select, update, func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay
+from app.utils.storage import location_exists
+
+logger = logging.getLogger(__name__)
+
+# Candidatos verificados no disco antes de compartilhar
+MAX_CANDIDATES = 5
+
+
+class BlobService:
+    """
+    Shares stored recording files (blobs) between replays by SHA-256.
+    
+    Uploads and imports of a recording already stored point the new replay
+    at the existing file instead of writing a second copy. The replays
+    sharing a file are its references: the file is removed only with the
+    last of them, and moving or compressing it (archival, tier migration)
+    updates all of them. The file follows the oldest replay through the
+    tiers.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def find(self, checksum: Optional[str]) -> Optional[Replay]:
+        """A replay whose stored file has content ``checksum``, if any."""
+        if not settings.file_dedup_enabled or not checksum:
+            return None
+        
+        result = await self.db.execute(
+            select(Replay)
+            .where(and_(Replay.checksum_sha256 == checksum, Replay.stored_path.isnot(None)))
+            .order_by(Replay.imported_at)
+            .limit(MAX_CANDIDATES)
+        )
+        for replay in result.scalars().all():
+            if await asyncio.to_thread(location_exists, replay.stored_path):
+                return replay
+        return None
+    
+    @staticmethod
+    def share(replay: Replay, blob: Replay):
+        """Point ``replay`` at the stored file of ``blob``."""
+        replay.stored_path = blob.stored_path
+        replay.storage_tier = blob.storage_tier
+        replay.is_compressed = blob.is_compressed
+        replay.original_size = blob.original_size
+        replay.file_size = blob.file_size
+        replay.compression_dict_id = blob.compression_dict_id
+        replay.checksum_sha256 = blob.checksum_sha256
+    
+    async def count_references(self, stored_path: str, exclude_id: Optional[UUID] = None) -> int:
+        """Replays using ``stored_path``, other than ``exclude_id``."""
+        conditions = [Replay.stored_path == stored_path]
+        if exclude_id is not None:
+            conditions.append(Replay.id != exclude_id)
+        return await self.db.scalar(select(func.count(Replay.id)).where(and_(*conditions))) or 0
+    
+    async def relocate(self, old_path: str, replay: Replay) -> int:
+        """
+        After ``replay``'s file moved from ``old_path`` (or was compressed),
+        point the other replays sharing it at the new file. Returns how
+        many were updated.
+        """
+        if replay.stored_path == old_path:
+            return 0
+        
+        result = await self.db.execute(
+            update(Replay)
+            .where(and_(Replay.stored_path == old_path, Replay.id != replay.id))
+            .values(
+                stored_path=replay.stored_path,
+                storage_tier=replay.storage_tier,
+                is_compressed=replay.is_compressed,
+                original_size=replay.original_size,
+                file_size=replay.file_size,
+                compression_dict_id=replay.compression_dict_id
+            )
+            .execution_options(synchronize_session="fetch")
+        )
+        if result.rowcount:
+            logger.debug(f"{result.rowcount} replays follow {old_path} to {replay.stored_path}")
+        return result.rowcount
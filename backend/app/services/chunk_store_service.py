@@ -0,0 +1,285 @@
+"""
+Nachos Replay for Guaca - Chunk Store Service
+Reference counting, garbage collection and reporting of the COLD chunk store.
+"""
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, update, delete, func, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Chunk, Replay
+from app.services.job_progress import get_job_registry
+from app.utils.chunk_store import (
+    MANIFEST_SUFFIX, ChunkWriter, ManifestSummary, chunk_path, chunk_root, read_manifest
+)
+from app.utils.compression import open_recording
+
+logger = logging.getLogger(__name__)
+
+CHUNK_GC_JOB = "chunk_gc"
+REFERENCE_BATCH_SIZE = 1000
+
+
+class ChunkStoreService:
+    """
+    Keeps the reference counts of the chunk store in the database.
+    
+    Writers store chunk files first and add references in the same
+    transaction that points the replay at its manifest; deleting a replay
+    releases them. Chunks left without references are removed by
+    collect_garbage only after ``chunk_gc_grace_hours``, and writers check
+    their chunks still exist after referencing them, so a chunk reused while
+    being collected is written again instead of lost. Files without a row
+    (interrupted writes) are orphans once older than the grace period; a
+    writer reusing one touches it, and the sweep re-checks the mtime before
+    unlinking.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def add_references(self, manifests: Iterable[ManifestSummary]):
+        """Add one reference per manifest to each of its chunks."""
+        counts: Counter = Counter()
+        sizes: Dict[bytes, Tuple[int, int]] = {}
+        for manifest in manifests:
+            for chunk in manifest.chunks:
+                counts[chunk.digest] += 1
+                sizes[chunk.digest] = (chunk.size, chunk.stored_size)
+        
+        # Ordem fixa das linhas: escritores concorrentes não entram em deadlock
+        digests = sorted(counts)
+        for start in range(0, len(digests), REFERENCE_BATCH_SIZE):
+            rows = [
+                {
+                    "hash": digest,
+                    "size": sizes[digest][0],
+                    "stored_size": sizes[digest][1],
+                    "refcount": counts[digest],
+                }
+                for digest in digests[start:start + REFERENCE_BATCH_SIZE]
+            ]
+            stmt = insert(Chunk).values(rows)
+            await self.db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[Chunk.hash],
+                    set_={
+                        "refcount": Chunk.refcount + stmt.excluded.refcount,
+                        "updated_at": func.now(),
+                    }
+                )
+            )
+    
+    async def release_manifest(self, manifest_path: str) -> int:
+        """Drop the references of a manifest about to be deleted. Returns the chunk count."""
+        try:
+            manifest = await asyncio.to_thread(read_manifest, manifest_path, False)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Cannot release chunk manifest {manifest_path}: {e}")
+            return 0
+        
+        digests = [digest for digest, _ in manifest.chunks]
+        for start in range(0, len(digests), REFERENCE_BATCH_SIZE):
+            await self.db.execute(
+                update(Chunk)
+                .where(Chunk.hash.in_(digests[start:start + REFERENCE_BATCH_SIZE]))
+                .values(refcount=Chunk.refcount - 1, updated_at=func.now())
+            )
+        return len(digests)
+    
+    async def collect_garbage(self, batch_size: Optional[int] = None) -> Dict[str, int]:
+        """
+        Remove chunks unreferenced for longer than the grace period, then
+        chunk files without a record (writes interrupted before their
+        references were committed). Each batch is committed on its own.
+        """
+        batch_size = batch_size or settings.chunk_gc_batch_size
+        grace = timedelta(hours=settings.chunk_gc_grace_hours)
+        cutoff = datetime.now(timezone.utc) - grace
+        progress = get_job_registry().start(CHUNK_GC_JOB)
+        stats = {"chunks": 0, "orphans": 0, "bytes_freed": 0}
+        try:
+            while True:
+                result = await self.db.execute(
+                    select(Chunk.hash)
+                    .where(and_(Chunk.refcount <= 0, Chunk.updated_at < cutoff))
+                    .order_by(Chunk.updated_at)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                )
+                digests = list(result.scalars().all())
+                if not digests:
+                    break
+                
+                freed = await asyncio.to_thread(_unlink_chunks, digests)
+                await self.db.execute(delete(Chunk).where(Chunk.hash.in_(digests)))
+                await self.db.commit()
+                stats["chunks"] += len(digests)
+                stats["bytes_freed"] += freed
+                progress.add_batch(len(digests), nbytes=freed)
+                progress.count("bytes_freed", freed)
+            
+            orphans, freed = await self._collect_orphans(cutoff.timestamp(), batch_size, progress)
+            stats["orphans"] += orphans
+            stats["bytes_freed"] += freed
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        logger.info(
+            f"Chunk GC: {stats['chunks']} unreferenced chunks and {stats['orphans']} orphan files removed, "
+            f"{stats['bytes_freed'] / 1024 / 1024:.1f} MB freed"
+        )
+        return stats
+    
+    async def _collect_orphans(self, cutoff: float, batch_size: int, progress) -> Tuple[int, int]:
+        root = chunk_root()
+        if not root.is_dir():
+            return 0, 0
+        
+        removed = freed = 0
+        # Um diretório de primeiro nível (1/256 do store) por vez
+        for directory in sorted(await asyncio.to_thread(_subdirectories, root)):
+            files = await asyncio.to_thread(_old_chunk_files, directory, cutoff)
+            for start in range(0, len(files), batch_size):
+                batch = files[start:start + batch_size]
+                digests = [digest for digest, _, _ in batch if digest is not None]
+                result = await self.db.execute(select(Chunk.hash).where(Chunk.hash.in_(digests)))
+                known = set(result.scalars().all())
+                orphans = [(path, size) for digest, path, size in batch if digest not in known]
+                if not orphans:
+                    continue
+                
+                removed_now, freed_now = await asyncio.to_thread(
+                    _unlink_orphans, [path for path, _ in orphans], cutoff
+                )
+                removed += removed_now
+                freed += freed_now
+                progress.count("orphans", removed_now)
+                progress.count("bytes_freed", freed_now)
+        return removed, freed
+    
+    async def get_report(self) -> Dict[str, Any]:
+        """Logical vs unique vs stored bytes of the chunked recordings."""
+        result = await self.db.execute(
+            select(func.count(Replay.id), func.coalesce(func.sum(Replay.original_size), 0))
+            .where(Replay.stored_path.like(f"%{MANIFEST_SUFFIX}"))
+        )
+        recordings, logical_bytes = result.one()
+        
+        result = await self.db.execute(
+            select(
+                func.count(),
+                func.coalesce(func.sum(Chunk.size), 0),
+                func.coalesce(func.sum(Chunk.stored_size), 0)
+            )
+            .where(Chunk.refcount > 0)
+        )
+        chunk_count, unique_bytes, stored_bytes = result.one()
+        
+        result = await self.db.execute(
+            select(func.count(), func.coalesce(func.sum(Chunk.stored_size), 0))
+            .where(Chunk.refcount <= 0)
+        )
+        unreferenced_chunks, unreferenced_bytes = result.one()
+        
+        return {
+            "recordings": recordings,
+            "logical_bytes": logical_bytes,
+            "chunk_count": chunk_count,
+            "unique_bytes": unique_bytes,
+            "stored_bytes": stored_bytes,
+            # Deduplicação sozinha e deduplicação + compressão
+            "dedup_ratio": round(logical_bytes / unique_bytes, 3) if unique_bytes else None,
+            "storage_ratio": round(logical_bytes / stored_bytes, 3) if stored_bytes else None,
+            "unreferenced_chunks": unreferenced_chunks,
+            "unreferenced_bytes": unreferenced_bytes,
+        }
+
+
+def store_recording(source_path: Path, manifest_path: Path) -> ManifestSummary:
+    """
+    Chunk a recording (plain or compressed) into the store and write its
+    manifest; runs in a worker thread. The source is left in place.
+    """
+    writer = ChunkWriter(
+        min_size=settings.chunk_min_kb * 1024,
+        avg_size=settings.chunk_avg_kb * 1024,
+        max_size=settings.chunk_max_kb * 1024
+    )
+    with open_recording(source_path) as source:
+        return writer.write(source, manifest_path)
+
+
+def _unlink_chunks(digests: List[bytes]) -> int:
+    return _unlink_files([chunk_path(digest) for digest in digests])
+
+
+def _unlink_files(paths: List[Path]) -> int:
+    freed = 0
+    for path in paths:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        freed += size
+    return freed
+
+
+def _unlink_orphans(paths: List[Path], cutoff: float) -> Tuple[int, int]:
+    """
+    Remove orphan files still last modified before ``cutoff``; returns
+    (removed, bytes freed). A chunk reused by a write in progress since it
+    was listed has been touched (see ChunkWriter._store) and is kept.
+    """
+    removed = freed = 0
+    for path in paths:
+        try:
+            stat = path.stat()
+            if stat.st_mtime >= cutoff:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        removed += 1
+        freed += stat.st_size
+    return removed, freed
+
+
+def _subdirectories(root: Path) -> List[Path]:
+    return [Path(entry.path) for entry in os.scandir(root) if entry.is_dir()]
+
+
+def _old_chunk_files(directory: Path, cutoff: float) -> List[Tuple[Optional[bytes], Path, int]]:
+    """
+    (digest, path, size) of the files under ``directory`` last modified
+    before ``cutoff``. Leftover ``.part`` files have no digest.
+    """
+    files = []
+    for sub in os.scandir(directory):
+        if not sub.is_dir():
+            continue
+        for entry in os.scandir(sub.path):
+            stat = entry.stat()
+            if stat.st_mtime >= cutoff:
+                continue
+            try:
+                digest = bytes.fromhex(entry.name)
+            except ValueError:
+                digest = None
+            files.append((digest if digest is not None and len(digest) == 32 else None, Path(entry.path), stat.st_size))
+    return files
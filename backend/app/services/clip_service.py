@@ -0,0 +1,242 @@
+"""
+Nachos Replay for Guaca - Clip Service
+Cuts a time range of a recording into a standalone derived replay.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay, ReplayStatus, StorageTier, User
+from app.services.integrity_service import IntegrityService, get_hash_pool
+from app.services.replay_service import ReplayService
+from app.utils.guacamole import (
+    DEFAULT_LAYER, DISPLAY_OPCODES, LAYER_STATE_OPCODES, InstructionReader, KeyframeTracker,
+    drawing_layer, encode_instruction, source_layer, sync_timestamp
+)
+from app.utils.hash_tree import ContentHasher, HashTree
+from app.utils.layout import recording_dir
+
+logger = logging.getLogger(__name__)
+
+class ClipError(Exception):
+    """Raised when a clip cannot be produced from a recording."""
+
+
+@dataclass
+class CutPlan:
+    """Byte offsets and timing found by the forward scan."""
+    origin_ts: int                    # timestamp (ms) of the clip start
+    keyframe_offset: int = 0          # last full repaint before the start
+    drop_from: int = 0                # default-layer drawing before this is still read
+    start_offset: int = 0             # first instruction of the clip range
+    end_offset: int = 0               # end of the last sync inside the range
+    last_ts: int = 0                  # timestamp (ms) of that last sync
+
+
+def scan_cut_points(fileobj: BinaryIO, start_ms: int, end_ms: int) -> CutPlan:
+    """
+    Forward scan locating the cut points in constant memory.
+
+    Besides the range boundaries it records the last full repaint of the
+    default layer before ``start_ms``: default-layer drawing before that point
+    is invisible at the start and can be left out of the clip, except what
+    a later copy from the default layer into another layer still reads.
+    """
+    tracker = KeyframeTracker()
+    keyframe_offset = 0
+    drop_from = 0
+    last_read: Optional[int] = None
+    first_ts: Optional[int] = None
+    plan: Optional[CutPlan] = None
+    frame_start = 0
+    
+    for instruction in InstructionReader(fileobj):
+        if plan is None:
+            if (source_layer(instruction) == DEFAULT_LAYER
+                    and drawing_layer(instruction) != DEFAULT_LAYER):
+                last_read = instruction.offset
+            keyframe = tracker.feed(instruction)
+            if keyframe is not None:
+                keyframe_offset = keyframe
+                drop_from = 0 if last_read is None else min(last_read, keyframe)
+        
+        ts = sync_timestamp(instruction)
+        if ts is None:
+            continue
+        
+        if first_ts is None:
+            first_ts = ts
+        relative = ts - first_ts
+        
+        if plan is None and relative >= start_ms:
+            plan = CutPlan(
+                origin_ts=first_ts + start_ms,
+                keyframe_offset=keyframe_offset,
+                drop_from=drop_from,
+                start_offset=frame_start,
+                end_offset=instruction.offset + len(instruction.raw),
+                last_ts=ts,
+            )
+        elif plan is not None:
+            if relative > end_ms:
+                break
+            plan.end_offset = instruction.offset + len(instruction.raw)
+            plan.last_ts = ts
+        
+        frame_start = instruction.offset + len(instruction.raw)
+    
+    if plan is None:
+        raise ClipError("Start point is beyond the end of the recording")
+    
+    return plan
+
+
+def write_clip(fileobj: BinaryIO, plan: CutPlan, out: BinaryIO) -> Tuple[str, HashTree]:
+    """Write the clip described by ``plan``; return its SHA-256 and hash tree."""
+    hasher = ContentHasher(executor=get_hash_pool())
+    
+    def emit(data: bytes):
+        out.write(data)
+        hasher.update(data)
+    
+    # Prefixo: reconstrói só o estado da tela no início do recorte, aplicado no
+    # primeiro quadro (sem syncs). Entrada (key, mouse), clipboard, áudio e
+    # arquivos de fora do intervalo ficam de fora, e o desenho na camada padrão
+    # anterior ao último repaint completo é omitido (salvo o que ainda é copiado).
+    image_streams = set()
+    fileobj.seek(0)
+    for instruction in InstructionReader(fileobj):
+        if instruction.offset >= plan.start_offset:
+            break
+        
+        opcode, args = instruction.opcode, instruction.args
+        if opcode not in DISPLAY_OPCODES:
+            continue
+        if opcode in ("blob", "end"):
+            if not args or args[0] not in image_streams:
+                continue
+            if opcode == "end":
+                image_streams.discard(args[0])
+        elif (plan.drop_from <= instruction.offset < plan.keyframe_offset
+                and drawing_layer(instruction) == DEFAULT_LAYER
+                and opcode not in LAYER_STATE_OPCODES):
+            continue
+        elif opcode == "img" and args:
+            image_streams.add(args[0])
+        
+        emit(instruction.raw)
+    
+    emit(encode_instruction("sync", 0))
+    
+    # Intervalo do recorte com timestamps rebaseados para começar em 0
+    fileobj.seek(plan.start_offset)
+    for instruction in InstructionReader(fileobj, plan.start_offset):
+        if instruction.offset >= plan.end_offset:
+            break
+        ts = sync_timestamp(instruction)
+        if ts is not None:
+            emit(encode_instruction("sync", max(ts - plan.origin_ts, 0), *instruction.args[1:]))
+        else:
+            emit(instruction.raw)
+    
+    return hasher.finish()
+
+
+class ClipService:
+    """Service for extracting time-range clips from replays."""
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.replay_service = ReplayService(db)
+        self.storage_path = Path(settings.replay_storage_path)
+    
+    async def create_clip(
+        self,
+        replay: Replay,
+        start_ms: int,
+        end_ms: int,
+        created_by: User,
+        session_name: Optional[str] = None
+    ) -> Replay:
+        """Cut ``[start_ms, end_ms]`` of ``replay`` into a new derived replay."""
+        now = datetime.now(timezone.utc)
+        stem = replay.filename[:-len(".guac")] if replay.filename.endswith(".guac") else replay.filename
+        filename = f"{stem}_clip_{start_ms}-{end_ms}_{now.strftime('%Y%m%d%H%M%S')}.guac"
+        target_dir = recording_dir("clips", now, filename)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        target_file = target_dir / filename
+        
+        plan, (checksum, tree) = await asyncio.to_thread(
+            self._build_clip, replay, start_ms, end_ms, target_file
+        )
+        
+        file_size = target_file.stat().st_size
+        duration = max(plan.last_ts - plan.origin_ts, 0) // 1000
+        clip_start = replay.session_start + timedelta(milliseconds=start_ms) if replay.session_start else None
+        
+        clip = Replay(
+            filename=filename,
+            original_path=replay.stored_path,
+            stored_path=str(target_file),
+            session_name=(session_name or f"{replay.session_name or stem} [{start_ms // 1000}s-{end_ms // 1000}s]")[:255],
+            owner_id=replay.owner_id,
+            owner_username=replay.owner_username,
+            client_ip=replay.client_ip,
+            file_size=file_size,
+            duration_seconds=duration,
+            session_start=clip_start,
+            session_end=clip_start + timedelta(seconds=duration) if clip_start else None,
+            status=ReplayStatus.ACTIVE,
+            protocol=replay.protocol,
+            hostname=replay.hostname,
+            connection_name=replay.connection_name,
+            storage_tier=StorageTier.HOT,
+            checksum_sha256=checksum,
+            is_compressed=False,
+            original_size=file_size,
+            metadata_json={
+                "derived_from": str(replay.id),
+                "clip": {
+                    "start_ms": start_ms,
+                    "end_ms": end_ms,
+                    "created_by": created_by.username,
+                    "created_at": now.isoformat(),
+                    "source_checksum_sha256": replay.checksum_sha256,
+                },
+            },
+        )
+        
+        self.db.add(clip)
+        await self.db.flush()
+        await IntegrityService(self.db).save_hash_tree(clip, tree)
+        
+        logger.info(f"Created clip {filename} from replay {replay.id}")
+        return clip
+    
+    def _build_clip(self, replay: Replay, start_ms: int, end_ms: int, target_file: Path):
+        """Scan and write the clip (runs in a worker thread)."""
+        source = self.replay_service.open_replay_data(replay)
+        if source is None:
+            raise FileNotFoundError(replay.stored_path)
+        
+        fd, tmp_name = tempfile.mkstemp(dir=target_file.parent, suffix=".part")
+        try:
+            with source, os.fdopen(fd, "wb") as out:
+                plan = scan_cut_points(source, start_ms, end_ms)
+                hashes = write_clip(source, plan, out)
+            os.replace(tmp_name, target_file)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        
+        return plan, hashes
+
@@ -0,0 +1,253 @@
+"""
+Nachos Replay for Guaca - Dictionary Service
+Trains versioned zstd dictionaries per protocol for small recordings.
+"""
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay, ReplayStatus, CompressionDictionary
+from app.services.job_progress import get_job_registry
+from app.utils.compression import (
+    DEFAULT_LEVELS, dictionary_path, open_recording, save_dictionary, train_dictionary
+)
+
+logger = logging.getLogger(__name__)
+
+DICTIONARY_TRAINING_JOB = "dictionary_training"
+
+# Uma em cada N amostras fica de fora do treino para medir o ganho
+HOLDOUT_EVERY = 10
+# Só adota o dicionário se a razão na validação melhorar pelo menos 5%
+MIN_RATIO_GAIN = 1.05
+
+
+class DictionaryService:
+    """
+    Trains and serves zstd dictionaries for small recordings.
+    
+    SSH/telnet sessions are mostly small files sharing the same protocol
+    boilerplate, which a compressor without history can't exploit. Each
+    training run samples recordings of one protocol and stores a new
+    version; archival and tier migration compress small files with the
+    latest version, and older versions are kept for the files that use them.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def train_all(self) -> List[CompressionDictionary]:
+        """Train a new dictionary for every protocol with enough small recordings."""
+        progress = get_job_registry().start(DICTIONARY_TRAINING_JOB)
+        trained: List[CompressionDictionary] = []
+        try:
+            for protocol in await self._candidate_protocols():
+                try:
+                    dictionary = await self.train(protocol)
+                except Exception as e:
+                    progress.add_batch(0, failed=1)
+                    progress.error(f"{protocol}: {e}")
+                    logger.error(f"Failed to train zstd dictionary for {protocol}: {e}")
+                    continue
+                
+                if dictionary is None:
+                    progress.add_batch(0)
+                    progress.count("skipped")
+                    continue
+                trained.append(dictionary)
+                progress.add_batch(1, nbytes=dictionary.sample_bytes)
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        return trained
+    
+    async def train(self, protocol: str) -> Optional[CompressionDictionary]:
+        """
+        Train a new version for ``protocol`` from a random sample of its
+        small recordings. Returns None when there are too few samples or
+        the dictionary doesn't beat plain zstd on the held-out samples.
+        """
+        result = await self.db.execute(
+            select(Replay.stored_path)
+            .where(and_(*self._small_replay_conditions(), Replay.protocol == protocol))
+            .order_by(func.random())
+            .limit(settings.compression_dictionary_samples)
+        )
+        paths = [path for path in result.scalars().all() if path]
+        samples = await asyncio.to_thread(
+            _read_samples, paths, settings.compression_dictionary_sample_kb * 1024
+        )
+        if len(samples) < settings.compression_dictionary_min_samples:
+            logger.info(f"Not enough small {protocol} recordings to train a dictionary ({len(samples)})")
+            return None
+        
+        dictionary_id, data, ratio, baseline_ratio = await asyncio.to_thread(
+            _train_and_evaluate, samples, settings.compression_dictionary_size_kb * 1024
+        )
+        if ratio < baseline_ratio * MIN_RATIO_GAIN:
+            logger.info(
+                f"Discarding {protocol} dictionary: ratio {ratio:.2f} vs {baseline_ratio:.2f} without it"
+            )
+            return None
+        if await self.db.get(CompressionDictionary, dictionary_id) is not None:
+            # Mesmas amostras geram o mesmo dicionário (e o mesmo ID)
+            logger.info(f"zstd dictionary {dictionary_id} already stored, keeping the current version")
+            return None
+        
+        version = await self.db.scalar(
+            select(func.max(CompressionDictionary.version))
+            .where(CompressionDictionary.protocol == protocol)
+        )
+        # Gravar no store local antes do registro: nenhum arquivo usa o ID sem o dicionário
+        await asyncio.to_thread(save_dictionary, dictionary_id, data)
+        dictionary = CompressionDictionary(
+            id=dictionary_id,
+            protocol=protocol,
+            version=(version or 0) + 1,
+            data=data,
+            size_bytes=len(data),
+            sample_count=len(samples),
+            sample_bytes=sum(len(sample) for sample in samples),
+            ratio=round(ratio, 3),
+            baseline_ratio=round(baseline_ratio, 3)
+        )
+        self.db.add(dictionary)
+        await self.db.flush()
+        
+        logger.info(
+            f"Trained {protocol} dictionary v{dictionary.version} ({dictionary_id}) "
+            f"from {len(samples)} recordings: ratio {ratio:.2f} vs {baseline_ratio:.2f}"
+        )
+        return dictionary
+    
+    async def get_latest_ids(self) -> Dict[str, int]:
+        """Protocol -> ID of its latest dictionary, present in the local store."""
+        if not settings.compression_dictionary_enabled:
+            return {}
+        
+        await self.sync_store()
+        result = await self.db.execute(
+            select(CompressionDictionary.protocol, CompressionDictionary.id)
+            .order_by(CompressionDictionary.protocol, CompressionDictionary.version)
+        )
+        return {protocol: dictionary_id for protocol, dictionary_id in result.all()}
+    
+    async def sync_store(self) -> int:
+        """
+        Write dictionaries missing from the local store (new host or lost
+        volume); readers load them from there by the ID in the file header.
+        """
+        result = await self.db.execute(select(CompressionDictionary.id))
+        missing = [
+            dictionary_id for dictionary_id in result.scalars().all()
+            if not dictionary_path(dictionary_id).exists()
+        ]
+        for dictionary_id in missing:
+            dictionary = await self.db.get(CompressionDictionary, dictionary_id)
+            await asyncio.to_thread(save_dictionary, dictionary_id, dictionary.data)
+        
+        if missing:
+            logger.info(f"Restored {len(missing)} zstd dictionaries to the local store")
+        return len(missing)
+    
+    async def get_usage(self) -> List[Dict[str, Any]]:
+        """Dictionaries with the number of replays and bytes compressed with each."""
+        result = await self.db.execute(
+            select(
+                CompressionDictionary,
+                func.count(Replay.id),
+                func.coalesce(func.sum(Replay.original_size), 0),
+                func.coalesce(func.sum(Replay.file_size), 0)
+            )
+            .outerjoin(Replay, Replay.compression_dict_id == CompressionDictionary.id)
+            .group_by(CompressionDictionary.id)
+            .order_by(CompressionDictionary.protocol, CompressionDictionary.version)
+        )
+        return [
+            {
+                "id": dictionary.id,
+                "protocol": dictionary.protocol,
+                "version": dictionary.version,
+                "size_bytes": dictionary.size_bytes,
+                "sample_count": dictionary.sample_count,
+                "ratio": dictionary.ratio,
+                "baseline_ratio": dictionary.baseline_ratio,
+                "created_at": dictionary.created_at.isoformat() if dictionary.created_at else None,
+                "replay_count": count,
+                "original_bytes": original_bytes,
+                "compressed_bytes": compressed_bytes,
+            }
+            for dictionary, count, original_bytes, compressed_bytes in result.all()
+        ]
+    
+    async def _candidate_protocols(self) -> List[str]:
+        result = await self.db.execute(
+            select(Replay.protocol)
+            .where(and_(*self._small_replay_conditions(), Replay.protocol.isnot(None)))
+            .group_by(Replay.protocol)
+            .having(func.count(Replay.id) >= settings.compression_dictionary_min_samples)
+        )
+        return list(result.scalars().all())
+    
+    @staticmethod
+    def _small_replay_conditions() -> list:
+        size = func.coalesce(Replay.original_size, Replay.file_size)
+        return [
+            Replay.status != ReplayStatus.DELETED,
+            Replay.stored_path.isnot(None),
+            size > 0,
+            size <= settings.compression_dictionary_max_file_kb * 1024,
+        ]
+
+
+def select_dictionary(dictionaries: Dict[str, int], protocol: Optional[str], size: int) -> Optional[int]:
+    """Dictionary to compress a recording with: its protocol's latest, if the file is small."""
+    if size > settings.compression_dictionary_max_file_kb * 1024:
+        return None
+    return dictionaries.get(protocol) if protocol else None
+
+
+def _read_samples(paths: List[str], max_bytes: int) -> List[bytes]:
+    """Beginning of each recording (decompressed); unreadable files are skipped."""
+    samples = []
+    for path in paths:
+        try:
+            with open_recording(path) as f:
+                sample = f.read(max_bytes)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Skipping dictionary sample {path}: {e}")
+            continue
+        if sample:
+            samples.append(sample)
+    return samples
+
+
+def _train_and_evaluate(samples: List[bytes], size: int) -> Tuple[int, bytes, float, float]:
+    """
+    Train on all but every ``HOLDOUT_EVERY``-th sample and measure the
+    compression ratio of the held-out ones with and without the dictionary.
+    Returns (dictionary ID, content, ratio, baseline ratio).
+    """
+    import zstandard
+    
+    holdout = samples[::HOLDOUT_EVERY]
+    training = [sample for i, sample in enumerate(samples) if i % HOLDOUT_EVERY]
+    level = DEFAULT_LEVELS["zstd"]
+    dictionary_id, data = train_dictionary(training, size, level)
+    
+    raw = sum(len(sample) for sample in holdout)
+    with_dictionary = zstandard.ZstdCompressor(level=level, dict_data=zstandard.ZstdCompressionDict(data))
+    without = zstandard.ZstdCompressor(level=level)
+    ratio = raw / max(sum(len(with_dictionary.compress(sample)) for sample in holdout), 1)
+    baseline_ratio = raw / max(sum(len(without.compress(sample)) for sample in holdout), 1)
+    return dictionary_id, data, ratio, baseline_ratio
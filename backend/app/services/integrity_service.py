@@ -0,0 +1,457 @@
+"""
+Nachos Replay for Guaca - Integrity Service
+Continuous re-hashing (scrubbing) of stored recordings against their checksums.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+from uuid import UUID
+
+from sqlalchemy import select, delete, func, and_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.config import settings
+from app.models import Replay, ReplayHashTree, ReplayIntegrityCheck, ReplayStatus, StorageUsage
+from app.services.job_progress import (
+    decode_cursor, encode_cursor, get_job_registry, load_checkpoint, save_checkpoint
+)
+from app.utils.compression import open_recording
+from app.utils.hash_tree import HashTree, block_ranges, hash_content, rehash_blocks
+from app.utils.storage import location_exists
+
+logger = logging.getLogger(__name__)
+
+INTEGRITY_SCRUB_JOB = "integrity_scrub"
+
+OK = "ok"
+RECORDED = "recorded"  # replay sem checksum: o calculado passa a ser o de referência
+MISMATCH = "mismatch"
+MISSING = "missing"
+ERROR = "error"
+FAILED_STATUSES = (MISMATCH, MISSING, ERROR)
+
+REPORTED_FAILURES = 100
+
+
+class IORateLimiter:
+    """
+    Token bucket shared by the scrubber's threads: ``consume`` blocks the
+    calling thread until ``nbytes`` fit in ``bytes_per_second``.
+    """
+    
+    def __init__(self, bytes_per_second: float):
+        self.rate = bytes_per_second
+        self._allowance = bytes_per_second
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def consume(self, nbytes: float):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Rajada máxima de um segundo de orçamento
+            self._allowance = min(self._allowance + (now - self._last) * self.rate, self.rate)
+            self._last = now
+            self._allowance -= nbytes
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+def hash_recording(
+    location: str,
+    buffer_size: Optional[int] = None,
+    limiter: Optional[IORateLimiter] = None,
+    io_ratio: float = 1.0
+) -> Tuple[str, int]:
+    """
+    SHA-256 of a recording's content (decompressed, chunks reassembled) and
+    its size; runs in a worker thread. Reads go into one reusable buffer
+    and hashlib releases the GIL while hashing it, so several threads hash
+    in parallel. With ``limiter``, each read is charged ``io_ratio`` times
+    its size (stored/original bytes, for compressed recordings).
+    """
+    buffer = bytearray(buffer_size or settings.scrub_read_buffer_kb * 1024)
+    view = memoryview(buffer)
+    sha256 = hashlib.sha256()
+    total = 0
+    with open_recording(location) as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            sha256.update(view[:n])
+            total += n
+            if limiter is not None:
+                limiter.consume(n * io_ratio)
+    return sha256.hexdigest(), total
+
+
+class ScrubOutcome(NamedTuple):
+    """
+    Result of re-hashing a stored file. Files with a hash tree are checked
+    per block (``tree`` is the re-hashed one, no whole-file ``checksum``);
+    the others are hashed whole and get a new ``tree``.
+    """
+    found: bool
+    checksum: Optional[str] = None
+    tree: Optional[HashTree] = None
+    bytes_read: int = 0
+    duration_ms: int = 0
+
+
+def _scrub_file(
+    location: str,
+    limiter: IORateLimiter,
+    io_ratio: float,
+    expected: Optional[HashTree] = None
+) -> ScrubOutcome:
+    start = time.monotonic()
+    if not location_exists(location):
+        return ScrubOutcome(False)
+    pool = get_hash_pool()
+    if expected is not None:
+        checksum = None
+        tree = rehash_blocks(location, expected.block_size, pool, limiter, io_ratio)
+    else:
+        checksum, tree = hash_content(location, None, pool, limiter, io_ratio)
+    return ScrubOutcome(True, checksum, tree, tree.size, int((time.monotonic() - start) * 1000))
+
+
+class IntegrityService:
+    """
+    Verifies stored recordings against their SHA-256, a slice at a time.
+    
+    Each scheduled run re-hashes the next replays, in (imported_at, id)
+    order from a checkpoint, until it has read its share of
+    ``scrub_fraction_per_day`` of the stored bytes; when the end is
+    reached a new cycle starts from the beginning, so the whole archive is
+    covered every 1 / fraction days without load spikes. Files are hashed
+    in ``scrub_workers`` threads under a shared I/O budget
+    (``scrub_io_mb_per_second``). Every check is recorded in
+    ``replay_integrity_checks``; mismatches and missing files are logged
+    as errors and listed by get_report.
+    
+    Replays with a hash tree (see utils.hash_tree) are checked block by
+    block, their blocks read and hashed in parallel, and a mismatch records
+    the damaged byte ranges. The others get their whole-file checksum
+    verified and, if it matches, a hash tree from the same read.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def scrub(self) -> Dict[str, int]:
+        """Run one slice of the scrub cycle. Returns counts per status."""
+        progress = get_job_registry().start(INTEGRITY_SCRUB_JOB)
+        checkpoint = await load_checkpoint(self.db, INTEGRITY_SCRUB_JOB)
+        after = decode_cursor(checkpoint.get("after"))
+        checkpoint.setdefault("cycle", 1)
+        checkpoint.setdefault("cycle_started", datetime.now(timezone.utc).isoformat())
+        
+        budget = await self._slice_budget()
+        limiter = IORateLimiter(settings.scrub_io_mb_per_second * 1024 * 1024)
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.scrub_workers),
+            thread_name_prefix="integrity-scrub"
+        )
+        stats = {status: 0 for status in (OK, RECORDED) + FAILED_STATUSES}
+        wrapped = False
+        try:
+            while budget > 0:
+                page = await self._next_page(after, settings.scrub_batch_size)
+                if not page:
+                    if wrapped or after is None:
+                        break
+                    logger.info(
+                        f"Integrity scrub cycle {checkpoint['cycle']} complete "
+                        f"(started {checkpoint['cycle_started']})"
+                    )
+                    checkpoint["cycle"] += 1
+                    checkpoint["cycle_started"] = datetime.now(timezone.utc).isoformat()
+                    after = None
+                    wrapped = True
+                    continue
+                
+                selected = []
+                for replay in page:
+                    selected.append(replay)
+                    budget -= replay.file_size or 0
+                    if budget <= 0:
+                        break
+                
+                checks = await self._check_batch(selected, executor, limiter)
+                failed = nbytes = 0
+                for check in checks:
+                    self.db.add(check)
+                    stats[check.status] += 1
+                    progress.count(check.status)
+                    nbytes += check.bytes_read or 0
+                    if check.status in FAILED_STATUSES:
+                        failed += 1
+                        progress.error(f"{check.replay_id}: {check.status}")
+                
+                after = (selected[-1].imported_at, selected[-1].id)
+                checkpoint["after"] = encode_cursor(after)
+                await save_checkpoint(self.db, INTEGRITY_SCRUB_JOB, checkpoint)
+                await self.db.commit()
+                progress.add_batch(len(checks), failed, nbytes)
+            
+            # Falhas não resolvidas voltam a ser registradas a cada ciclo
+            cutoff = datetime.now(timezone.utc) - timedelta(days=settings.scrub_history_days)
+            await self.db.execute(
+                delete(ReplayIntegrityCheck).where(ReplayIntegrityCheck.checked_at < cutoff)
+            )
+            await self.db.commit()
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        finally:
+            executor.shutdown(wait=False)
+        
+        metrics = progress.to_dict()
+        logger.info(
+            f"Integrity scrub: {metrics['processed']} replays checked, "
+            f"{metrics['failed']} failures, {metrics['mb_per_second']} MB/s"
+        )
+        return stats
+    
+    async def check_replay(self, replay: Replay) -> Optional[ReplayIntegrityCheck]:
+        """
+        Re-hash one replay now (no I/O budget) and record the result. None
+        if its file moved while being read.
+        """
+        checks = await self._check_batch([replay], None, IORateLimiter(0))
+        if not checks:
+            return None
+        self.db.add(checks[0])
+        await self.db.flush()
+        return checks[0]
+    
+    async def _check_batch(
+        self,
+        replays: List[Replay],
+        executor: Optional[ThreadPoolExecutor],
+        limiter: IORateLimiter
+    ) -> List[ReplayIntegrityCheck]:
+        loop = asyncio.get_running_loop()
+        trees = await self.get_hash_trees(replays)
+        # Arquivo compartilhado por vários replays é lido uma vez
+        futures: Dict[str, asyncio.Future] = {}
+        expected: Dict[str, Optional[HashTree]] = {}
+        for replay in replays:
+            if replay.stored_path not in futures:
+                expected[replay.stored_path] = tree = trees.get(replay.id)
+                io_ratio = (replay.file_size or 0) / replay.original_size if replay.original_size else 1.0
+                futures[replay.stored_path] = loop.run_in_executor(
+                    executor, _scrub_file, replay.stored_path, limiter, min(io_ratio, 1.0), tree
+                )
+        outcomes = dict(zip(futures, await asyncio.gather(*futures.values(), return_exceptions=True)))
+        
+        checks = []
+        for replay in replays:
+            checked_path = replay.stored_path
+            outcome = outcomes[checked_path]
+            check = self._to_check(replay, outcome, expected[checked_path])
+            if check.status in (MISSING, ERROR):
+                # Movido (migração de tier, arquivamento) durante a leitura: não é falha
+                await self.db.refresh(replay)
+                if replay.stored_path != checked_path:
+                    continue
+            if check.status in FAILED_STATUSES:
+                logger.error(
+                    f"Integrity check failed for replay {replay.id} ({replay.filename}): "
+                    f"{check.status} {check.error or ''}".rstrip()
+                )
+            elif (
+                replay.id not in trees
+                and replay.status != ReplayStatus.DELETED
+                and isinstance(outcome, ScrubOutcome)
+                and outcome.tree is not None
+            ):
+                # Conteúdo conferido: a árvore calculada na mesma leitura passa a valer
+                await self.save_hash_tree(replay, outcome.tree)
+            checks.append(check)
+        return checks
+    
+    @staticmethod
+    def _to_check(
+        replay: Replay,
+        outcome: Union[ScrubOutcome, BaseException],
+        expected: Optional[HashTree] = None
+    ) -> ReplayIntegrityCheck:
+        check = ReplayIntegrityCheck(replay_id=replay.id, expected_checksum=replay.checksum_sha256)
+        if isinstance(outcome, BaseException):
+            check.status = ERROR
+            check.error = str(outcome)[:1000]
+            return check
+        
+        check.bytes_read, check.duration_ms = outcome.bytes_read, outcome.duration_ms
+        check.actual_checksum = outcome.checksum
+        if not outcome.found:
+            check.status = MISSING
+        elif expected is not None:
+            # Verificação por bloco: localiza os trechos danificados
+            bad = expected.diff(outcome.tree)
+            check.status = MISMATCH if bad else OK
+            if bad:
+                check.bad_ranges = block_ranges(expected, bad)
+                check.error = f"{len(bad)} of {expected.block_count} blocks differ"
+        elif not replay.checksum_sha256:
+            check.status = RECORDED
+            # Não mexe em removidos: updated_at marca o início da carência da purga
+            if replay.status != ReplayStatus.DELETED:
+                replay.checksum_sha256 = outcome.checksum
+        elif outcome.checksum == replay.checksum_sha256:
+            check.status = OK
+        else:
+            check.status = MISMATCH
+        return check
+    
+    async def get_hash_trees(self, replays: Iterable[Replay]) -> Dict[UUID, HashTree]:
+        """Stored hash trees of ``replays`` whose leaves still match their root."""
+        roots = {replay.id: replay.hash_tree_root for replay in replays if replay.hash_tree_root}
+        if not roots:
+            return {}
+        result = await self.db.execute(
+            select(ReplayHashTree).where(ReplayHashTree.replay_id.in_(list(roots)))
+        )
+        trees = {}
+        for row in result.scalars().all():
+            tree = HashTree(row.block_size, row.size, row.leaves)
+            if tree.root == roots[row.replay_id]:
+                trees[row.replay_id] = tree
+            else:
+                logger.warning(f"Hash tree of replay {row.replay_id} does not match its root, ignoring it")
+        return trees
+    
+    async def get_hash_tree(self, replay: Replay) -> Optional[HashTree]:
+        return (await self.get_hash_trees([replay])).get(replay.id)
+    
+    async def save_hash_tree(self, replay: Replay, tree: HashTree):
+        """Store ``tree`` as the hash tree of ``replay`` (flushed, replacing any previous one)."""
+        await self.db.flush()
+        values = {"block_size": tree.block_size, "size": tree.size, "leaves": tree.leaves}
+        await self.db.execute(
+            insert(ReplayHashTree)
+            .values(replay_id=replay.id, **values)
+            .on_conflict_do_update(index_elements=[ReplayHashTree.replay_id], set_=values)
+        )
+        replay.hash_tree_root = tree.root
+    
+    async def _slice_budget(self) -> int:
+        """Stored bytes one run should read: its share of the daily fraction."""
+        conditions = [] if settings.scrub_include_remote else [~StorageUsage.is_remote]
+        total = await self.db.scalar(
+            select(func.coalesce(func.sum(StorageUsage.bytes), 0)).where(*conditions)
+        ) or 0
+        share = settings.scrub_fraction_per_day * settings.scrub_interval_minutes / (24 * 60)
+        # Ao menos um arquivo por execução
+        return max(int(total * share), 1)
+    
+    async def _next_page(self, after: Optional[Tuple[datetime, UUID]], limit: int) -> List[Replay]:
+        conditions = [Replay.stored_path.isnot(None)]
+        if not settings.scrub_include_remote:
+            conditions.append(func.left(Replay.stored_path, 5) != "s3://")
+        if after is not None:
+            conditions.append(tuple_(Replay.imported_at, Replay.id) > tuple_(*after))
+        result = await self.db.execute(
+            select(Replay)
+            .where(and_(*conditions))
+            .order_by(Replay.imported_at, Replay.id)
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+    
+    async def get_report(self) -> Dict[str, Any]:
+        """Scrub cycle position, recent results and replays whose last check failed."""
+        checkpoint = await load_checkpoint(self.db, INTEGRITY_SCRUB_JOB)
+        
+        since = datetime.now(timezone.utc) - timedelta(days=1)
+        result = await self.db.execute(
+            select(ReplayIntegrityCheck.status, func.count(), func.coalesce(func.sum(ReplayIntegrityCheck.bytes_read), 0))
+            .where(ReplayIntegrityCheck.checked_at >= since)
+            .group_by(ReplayIntegrityCheck.status)
+        )
+        last_24h = {status: {"count": count, "bytes": nbytes} for status, count, nbytes in result.all()}
+        
+        # Última verificação de cada replay que já falhou alguma vez
+        failed_ids = select(ReplayIntegrityCheck.replay_id).where(
+            ReplayIntegrityCheck.status.in_(FAILED_STATUSES)
+        )
+        latest = (
+            select(ReplayIntegrityCheck)
+            .distinct(ReplayIntegrityCheck.replay_id)
+            .where(ReplayIntegrityCheck.replay_id.in_(failed_ids))
+            .order_by(ReplayIntegrityCheck.replay_id, ReplayIntegrityCheck.checked_at.desc())
+            .subquery()
+        )
+        check = aliased(ReplayIntegrityCheck, latest)
+        result = await self.db.execute(
+            select(check, Replay.filename, Replay.stored_path)
+            .join(Replay, Replay.id == check.replay_id)
+            .where(check.status.in_(FAILED_STATUSES))
+            .order_by(check.checked_at.desc())
+            .limit(REPORTED_FAILURES)
+        )
+        failures = [
+            {
+                "replay_id": str(failed.replay_id),
+                "filename": filename,
+                "stored_path": stored_path,
+                "status": failed.status,
+                "checked_at": failed.checked_at.isoformat() if failed.checked_at else None,
+                "expected_checksum": failed.expected_checksum,
+                "actual_checksum": failed.actual_checksum,
+                "bad_ranges": failed.bad_ranges,
+                "error": failed.error,
+            }
+            for failed, filename, stored_path in result.all()
+        ]
+        
+        return {
+            "cycle": checkpoint.get("cycle"),
+            "cycle_started": checkpoint.get("cycle_started"),
+            "position": checkpoint.get("after"),
+            "fraction_per_day": settings.scrub_fraction_per_day,
+            "last_24h": last_24h,
+            "failures": failures,
+        }
+
+
+_hash_pool: Optional[ThreadPoolExecutor] = None
+_hash_pool_lock = threading.Lock()
+
+
+def get_hash_pool() -> ThreadPoolExecutor:
+    """Threads that hash hash-tree blocks (hashlib releases the GIL), shared by ingest and scrubbing."""
+    global _hash_pool
+    if _hash_pool is None:
+        with _hash_pool_lock:
+            if _hash_pool is None:
+                _hash_pool = ThreadPoolExecutor(
+                    max_workers=settings.hash_tree_workers or os.cpu_count() or 1,
+                    thread_name_prefix="hash-tree"
+                )
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False, cancel_futures=True)
+        _hash_pool = None
@@ -0,0 +1,145 @@
+"""
+Nachos Replay for Guaca - Job Progress
+Progress of long-running maintenance jobs and their resume checkpoints.
+"""
+import json
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import SystemSetting
+
+CHECKPOINT_PREFIX = "checkpoint."
+
+
+class JobProgress:
+    """Counters of one run of a batched job."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.status = "running"
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at: Optional[datetime] = None
+        self.batches = 0
+        self.processed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.counters: Dict[str, int] = {}
+        self.last_error: Optional[str] = None
+        self._start = time.monotonic()
+        self._elapsed: Optional[float] = None
+    
+    def add_batch(self, processed: int, failed: int = 0, nbytes: int = 0):
+        self.batches += 1
+        self.processed += processed
+        self.failed += failed
+        self.bytes += nbytes
+    
+    def count(self, counter: str, amount: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+    
+    def error(self, message: str):
+        self.last_error = message
+    
+    def finish(self, status: str = "completed"):
+        self.status = status
+        self.finished_at = datetime.now(timezone.utc)
+        self._elapsed = time.monotonic() - self._start
+    
+    @property
+    def elapsed_seconds(self) -> float:
+        return self._elapsed if self._elapsed is not None else time.monotonic() - self._start
+    
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = self.elapsed_seconds
+        return {
+            "name": self.name,
+            "status": self.status,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "elapsed_seconds": round(elapsed, 1),
+            "batches": self.batches,
+            "processed": self.processed,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "items_per_second": round(self.processed / elapsed, 2) if elapsed else 0.0,
+            "mb_per_second": round(self.bytes / elapsed / (1024 * 1024), 2) if elapsed else 0.0,
+            "counters": dict(self.counters),
+            "last_error": self.last_error,
+        }
+
+
+class JobRegistry:
+    """Latest run of each job, kept in memory for the metrics endpoint."""
+    
+    def __init__(self):
+        self._jobs: Dict[str, JobProgress] = {}
+    
+    def start(self, name: str) -> JobProgress:
+        progress = JobProgress(name)
+        self._jobs[name] = progress
+        return progress
+    
+    def get(self, name: str) -> Optional[JobProgress]:
+        return self._jobs.get(name)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        return {name: progress.to_dict() for name, progress in self._jobs.items()}
+
+
+_job_registry: Optional[JobRegistry] = None
+
+
+def get_job_registry() -> JobRegistry:
+    """Get the process-wide job registry."""
+    global _job_registry
+    if _job_registry is None:
+        _job_registry = JobRegistry()
+    return _job_registry
+
+
+async def load_checkpoint(db: AsyncSession, job: str) -> Dict[str, Any]:
+    """Checkpoint left by an interrupted run of ``job`` (empty if none)."""
+    setting = await db.get(SystemSetting, CHECKPOINT_PREFIX + job)
+    if setting is None or not setting.value:
+        return {}
+    try:
+        return json.loads(setting.value)
+    except ValueError:
+        return {}
+
+
+async def save_checkpoint(db: AsyncSession, job: str, checkpoint: Dict[str, Any]):
+    """Store the checkpoint; committed together with the batch it follows."""
+    setting = await db.get(SystemSetting, CHECKPOINT_PREFIX + job)
+    if setting is None:
+        setting = SystemSetting(
+            key=CHECKPOINT_PREFIX + job,
+            description=f"Resume point of the {job} job"
+        )
+        db.add(setting)
+    setting.value = json.dumps(checkpoint)
+
+
+def encode_cursor(after: Tuple[datetime, Any]) -> List[str]:
+    """Checkpoint form of a (timestamp, id) keyset position."""
+    return [after[0].isoformat(), str(after[1])]
+
+
+def decode_cursor(value: Optional[List[str]]) -> Optional[Tuple[datetime, UUID]]:
+    """(timestamp, id) keyset position stored by encode_cursor, or None if absent or invalid."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value[0]), UUID(value[1])
+    except (ValueError, IndexError, TypeError):
+        return None
+
+
+async def clear_checkpoint(db: AsyncSession, job: str):
+    setting = await db.get(SystemSetting, CHECKPOINT_PREFIX + job)
+    if setting is not None:
+        await db.delete(setting)
@@ -0,0 +1,204 @@
+"""
+Nachos Replay for Guaca - Storage Layout Service
+Moves stored recordings into the configured directory layout, online.
+"""
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import select, update, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay
+from app.services.job_progress import get_job_registry, load_checkpoint, save_checkpoint
+from app.utils.layout import DATE_DEPTH, layout_location
+
+logger = logging.getLogger(__name__)
+
+LAYOUT_JOB = "storage_layout"
+
+# Resultados de _link_batch por arquivo
+LINKED = "linked"
+CONFLICT = "conflict"
+MISSING = "missing"
+
+
+class StorageLayoutService:
+    """
+    Moves the local recordings whose stored_path isn't where the layout
+    (``storage_shard_levels``/``storage_shard_width``, see app.utils.layout)
+    puts them, e.g. the flat ``hot/2025/03/`` of earlier versions.
+    
+    Replays are walked by id, ``storage_layout_batch_size`` at a time and
+    at most ``storage_layout_max_files`` per run, with the position in a
+    checkpoint: the job resumes where it stopped and starts over when the
+    layout settings change. Each file is hard-linked at its new location
+    (copied if the link fails), then the replays still pointing to the old
+    path are switched with a compare-and-swap UPDATE; the old name is
+    removed only after that commits, so a reader always finds the file
+    under the path it read. A file whose replays were changed meanwhile
+    (tier migration, deletion) loses the new name instead.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.storage_path = Path(settings.replay_storage_path)
+    
+    async def migrate(self) -> Dict[str, int]:
+        """Run one slice of the migration. Returns counts of moved, conflicting and missing files."""
+        layout = [settings.storage_shard_levels, settings.storage_shard_width]
+        checkpoint = await load_checkpoint(self.db, LAYOUT_JOB)
+        if checkpoint.get("layout") != layout:
+            checkpoint = {"layout": layout, "after": None, "done": False}
+        stats = {LINKED: 0, CONFLICT: 0, MISSING: 0}
+        if checkpoint["done"]:
+            return stats
+        
+        progress = get_job_registry().start(LAYOUT_JOB)
+        batch = max(1, settings.storage_layout_batch_size)
+        budget = max(batch, settings.storage_layout_max_files)
+        after = UUID(checkpoint["after"]) if checkpoint["after"] else None
+        
+        try:
+            while budget > 0:
+                rows = await self._rows_page(after, min(batch, budget))
+                if not rows:
+                    checkpoint["done"] = True
+                    break
+                budget -= len(rows)
+                after = rows[-1].id
+                
+                moves = {}
+                for row in rows:
+                    target = layout_location(row.stored_path)
+                    if target is not None and target != row.stored_path:
+                        moves[row.stored_path] = target
+                
+                results = await asyncio.to_thread(_link_batch, list(moves.items()))
+                switched, abandoned = [], []
+                for (old, new), result in zip(moves.items(), results):
+                    stats[result] += 1
+                    progress.count(result)
+                    if result != LINKED:
+                        continue
+                    updated = await self.db.execute(
+                        update(Replay)
+                        .where(Replay.stored_path == old)
+                        .values(stored_path=new)
+                        .execution_options(synchronize_session=False)
+                    )
+                    (switched if updated.rowcount else abandoned).append((old, new))
+                
+                checkpoint["after"] = str(after)
+                await save_checkpoint(self.db, LAYOUT_JOB, checkpoint)
+                await self.db.commit()
+                await asyncio.to_thread(self._unlink_batch, switched, abandoned)
+                progress.add_batch(len(rows), len(moves) - len(switched))
+            
+            if checkpoint["done"]:
+                await save_checkpoint(self.db, LAYOUT_JOB, checkpoint)
+                await self.db.commit()
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        if stats[LINKED] or stats[CONFLICT]:
+            logger.info(
+                f"Storage layout: {stats[LINKED]} files moved, {stats[CONFLICT]} conflicts, "
+                f"{stats[MISSING]} missing" + (" (done)" if checkpoint["done"] else "")
+            )
+        return stats
+    
+    async def _rows_page(self, after: Optional[UUID], limit: int) -> List:
+        """Replays with a stored file, by id, after ``after``."""
+        conditions = [Replay.stored_path.isnot(None)]
+        if after is not None:
+            conditions.append(Replay.id > after)
+        result = await self.db.execute(
+            select(Replay.id, Replay.stored_path)
+            .where(and_(*conditions))
+            .order_by(Replay.id)
+            .limit(limit)
+        )
+        return list(result.all())
+    
+    def _unlink_batch(self, switched: List[Tuple[str, str]], abandoned: List[Tuple[str, str]]):
+        """Drop the old names of the switched files and the new names of the abandoned ones."""
+        for old, _ in switched:
+            _unlink(old)
+            self._prune_dirs(Path(old))
+        for _, new in abandoned:
+            _unlink(new)
+            self._prune_dirs(Path(new))
+    
+    def _prune_dirs(self, path: Path):
+        """Remove the shard directories left empty above ``path`` (never the area or date ones)."""
+        parts = path.relative_to(self.storage_path).parts
+        keep = DATE_DEPTH[parts[0]] + 1
+        for parent in list(path.parents)[:len(parts) - 1 - keep]:
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+
+
+def _link_batch(moves: List[Tuple[str, str]]) -> List[str]:
+    """Give each old file its new name too (hard link, or copy); runs in a worker thread."""
+    results = []
+    for old, new in moves:
+        try:
+            results.append(_link(old, new))
+        except FileNotFoundError:
+            results.append(MISSING)
+    return results
+
+
+def _link(old: str, new: str) -> str:
+    target = Path(new)
+    os.stat(old)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(old, new)
+        return LINKED
+    except FileExistsError:
+        # Ligado (ou copiado) por uma execução interrompida, ou outro arquivo com o mesmo nome
+        return LINKED if _same_file(old, new) else CONFLICT
+    except FileNotFoundError:
+        raise
+    except OSError:
+        pass
+    
+    # Sem hard links (SMB, alguns NFS): cópia com os mesmos metadados, renomeada no fim
+    temp = target.with_name(target.name + ".layout")
+    try:
+        shutil.copy2(old, temp)
+        if target.exists():
+            return LINKED if _same_file(old, new) else CONFLICT
+        os.replace(temp, target)
+    finally:
+        _unlink(str(temp))
+    return LINKED
+
+
+def _same_file(old: str, new: str) -> bool:
+    if os.path.samefile(old, new):
+        return True
+    a, b = os.stat(old), os.stat(new)
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+def _unlink(location: str):
+    try:
+        os.unlink(location)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,429 @@
+"""
+Nachos Replay for Guaca - Pack Service
+Packing of small COLD recordings into pack files, and pack compaction.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update, delete, func, and_, or_, case, desc, exists, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay, ReplayStatus, StoragePack, StoragePackMember, StorageTier
+from app.services.job_progress import get_job_registry
+from app.utils.chunk_store import MANIFEST_SUFFIX
+from app.utils.pack_store import (
+    PACK_SUFFIX, PARTIAL_SUFFIX, PackMember, PackWriter, copy_member, new_pack_path, pack_root, remove_pack
+)
+from app.utils.storage import get_tier_backend, pack_location, tier_key
+
+logger = logging.getLogger(__name__)
+
+PACK_JOB = "cold_packing"
+COMPACT_JOB = "pack_compaction"
+
+PAGE_SIZE = 1000
+# Packs sem registro no banco (escrita ou commit interrompidos) mais velhos que isso são removidos
+STRAY_PACK_MIN_AGE_HOURS = 24
+
+
+class PackService:
+    """
+    Moves small COLD recordings into pack files and compacts the packs.
+    
+    pack_cold walks the loose COLD files up to ``pack_member_max_kb`` in
+    path order (related recordings end up side by side) and appends them
+    to a pack until ``pack_target_mb``. Each sealed pack is registered
+    with its index in the same transaction that points the replays at
+    their members, with a compare-and-swap on the old path; the loose
+    files are removed after the commit, unless a replay started using
+    them meanwhile. Larger recordings stay loose or chunked.
+    
+    A member is dead when no replay uses it, or only replays soft-deleted
+    more than ``pack_compact_grace_days`` ago. compact rewrites the packs
+    whose dead bytes reach ``pack_compact_dead_ratio``: the live members
+    are copied (and their checksums verified) into a new pack, the
+    replays are repointed, the soft-deleted replays of dead members are
+    removed for good and the old pack is deleted after the commit.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.storage_path = Path(settings.replay_storage_path)
+    
+    async def pack_cold(self) -> Dict[str, int]:
+        """Pack loose COLD recordings. Returns counts of packs, packed files and missing files."""
+        stats = {"packs": 0, "packed": 0, "missing": 0}
+        if get_tier_backend(StorageTier.COLD.value).name != "local":
+            # Objetos em S3 não ocupam inodes locais
+            return stats
+        
+        progress = get_job_registry().start(PACK_JOB)
+        target = settings.pack_target_mb * 1024 * 1024
+        budget = settings.pack_max_files
+        writer: Optional[PackWriter] = None
+        packed: Dict[str, PackMember] = {}
+        pending: Deque[str] = deque()
+        after: Optional[Tuple[str, Any]] = None
+        exhausted = False
+        
+        try:
+            known = set((await self.db.execute(select(StoragePack.key))).scalars().all())
+            removed = await asyncio.to_thread(self._remove_stray_packs, known)
+            progress.count("stray_removed", removed)
+            
+            while True:
+                if not pending:
+                    if exhausted or budget <= 0:
+                        break
+                    rows = await self._candidates(after, min(PAGE_SIZE, budget))
+                    exhausted = len(rows) < min(PAGE_SIZE, budget)
+                    if rows:
+                        budget -= len(rows)
+                        after = (rows[-1].stored_path, rows[-1].id)
+                        pending.extend(dict.fromkeys(
+                            row.stored_path for row in rows if row.stored_path not in packed
+                        ))
+                    continue
+                
+                if writer is None:
+                    writer = await asyncio.to_thread(PackWriter, new_pack_path(datetime.now(timezone.utc)))
+                missing = await asyncio.to_thread(_fill, writer, pending, packed, target)
+                stats["missing"] += missing
+                progress.count("missing", missing)
+                if writer.size >= target:
+                    await self._register(writer, packed, progress, stats)
+                    writer, packed = None, {}
+            
+            if writer is not None:
+                if packed:
+                    await self._register(writer, packed, progress, stats)
+                else:
+                    await asyncio.to_thread(writer.abort)
+                writer = None
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        finally:
+            if writer is not None:
+                await asyncio.to_thread(writer.abort)
+        
+        if stats["packed"]:
+            logger.info(f"Cold packing: {stats['packed']} files in {stats['packs']} packs, {stats['missing']} missing")
+        return stats
+    
+    async def _candidates(self, after: Optional[Tuple[str, Any]], limit: int) -> List:
+        """Loose COLD recordings small enough to pack, in byte order of stored_path."""
+        root = str(self.storage_path / StorageTier.COLD.value)
+        path = Replay.stored_path.collate("C")
+        conditions = [
+            path >= root + "/",
+            path < root + "0",
+            Replay.storage_tier == StorageTier.COLD,
+            Replay.status != ReplayStatus.DELETED,
+            Replay.file_size <= settings.pack_member_max_kb * 1024,
+            ~Replay.stored_path.endswith(MANIFEST_SUFFIX),
+        ]
+        if after is not None:
+            conditions.append(tuple_(path, Replay.id) > tuple_(*after))
+        result = await self.db.execute(
+            select(Replay.id, Replay.stored_path)
+            .where(and_(*conditions))
+            .order_by(path, Replay.id)
+            .limit(limit)
+        )
+        return list(result.all())
+    
+    async def _register(self, writer: PackWriter, packed: Dict[str, PackMember], progress, stats: Dict[str, int]):
+        """Seal a pack, point the replays at its members and remove the loose files."""
+        size = await asyncio.to_thread(writer.seal)
+        key = tier_key(writer.path)
+        try:
+            pack = StoragePack(key=key, size=size, member_count=len(writer.members))
+            self.db.add(pack)
+            await self.db.flush()
+            for path, member in packed.items():
+                location = pack_location(key, member.offset, member.length)
+                self.db.add(StoragePackMember(
+                    pack_id=pack.id,
+                    offset=member.offset,
+                    length=member.length,
+                    checksum=member.checksum,
+                    name=member.name,
+                    location=location
+                ))
+                await self.db.execute(
+                    update(Replay)
+                    .where(Replay.stored_path == path)
+                    .values(stored_path=location)
+                    .execution_options(synchronize_session=False)
+                )
+            await self.db.commit()
+        except BaseException:
+            await self.db.rollback()
+            await asyncio.to_thread(remove_pack, writer.path)
+            raise
+        
+        # Arquivo que voltou a ser usado entre a leitura e o commit fica (seu membro está morto)
+        in_use = await self._referenced(packed)
+        loose = [path for path in packed if path not in in_use]
+        await asyncio.to_thread(_remove_files, loose)
+        stats["packs"] += 1
+        stats["packed"] += len(packed)
+        progress.count("packs")
+        progress.count("packed", len(packed))
+        progress.add_batch(len(packed), 0, size)
+    
+    async def compact(self) -> Dict[str, int]:
+        """Rewrite packs with too many dead members. Returns counts of packs, purged replays and bytes."""
+        stats = {"compacted": 0, "purged": 0, "bytes_reclaimed": 0}
+        progress = get_job_registry().start(COMPACT_JOB)
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.pack_compact_grace_days)
+        
+        try:
+            dead, total = self._dead_bytes(cutoff), func.sum(StoragePackMember.length)
+            result = await self.db.execute(
+                select(StoragePackMember.pack_id, dead.label("dead_bytes"))
+                .group_by(StoragePackMember.pack_id)
+                .having(dead >= total * settings.pack_compact_dead_ratio)
+                .order_by(desc("dead_bytes"))
+                .limit(settings.pack_compact_max_packs)
+            )
+            for pack_id in result.scalars().all():
+                try:
+                    outcome = await self._compact_pack(pack_id, cutoff)
+                except Exception as e:
+                    await self.db.rollback()
+                    progress.error(f"{pack_id}: {e}")
+                    progress.add_batch(0, 1)
+                    logger.error(f"Failed to compact pack {pack_id}: {e}")
+                    continue
+                if outcome is None:
+                    progress.count("busy")
+                    continue
+                purged, reclaimed = outcome
+                stats["compacted"] += 1
+                stats["purged"] += purged
+                stats["bytes_reclaimed"] += reclaimed
+                progress.count("purged", purged)
+                progress.count("bytes_reclaimed", reclaimed)
+                progress.add_batch(1, 0, reclaimed)
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        if stats["compacted"]:
+            logger.info(
+                f"Pack compaction: {stats['compacted']} packs rewritten, {stats['purged']} deleted replays purged, "
+                f"{stats['bytes_reclaimed'] / 1024 / 1024:.1f} MB reclaimed"
+            )
+        return stats
+    
+    async def _compact_pack(self, pack_id, cutoff: datetime) -> Optional[Tuple[int, int]]:
+        """
+        Rewrite one pack with its live members. Returns (purged replays,
+        bytes reclaimed), or None if a replay started using a dead member.
+        """
+        pack = await self.db.get(StoragePack, pack_id)
+        members = (await self.db.execute(
+            select(StoragePackMember)
+            .where(StoragePackMember.pack_id == pack_id)
+            .order_by(StoragePackMember.offset)
+        )).scalars().all()
+        old_path, old_size = self.storage_path / pack.key, pack.size
+        live = await self._referenced((m.location for m in members), self._live(cutoff))
+        keep = [m for m in members if m.location in live]
+        dead = [m.location for m in members if m.location not in live]
+        
+        writer = None
+        if keep:
+            writer = await asyncio.to_thread(
+                _rewrite, old_path, keep, new_pack_path(datetime.now(timezone.utc))
+            )
+        try:
+            new_size = 0
+            if writer is not None:
+                key = tier_key(writer.path)
+                new_size = writer.size
+                new_pack = StoragePack(key=key, size=writer.size, member_count=len(writer.members))
+                self.db.add(new_pack)
+                await self.db.flush()
+                for old, member in zip(keep, writer.members):
+                    location = pack_location(key, member.offset, member.length)
+                    self.db.add(StoragePackMember(
+                        pack_id=new_pack.id,
+                        offset=member.offset,
+                        length=member.length,
+                        checksum=member.checksum,
+                        name=member.name,
+                        location=location
+                    ))
+                    await self.db.execute(
+                        update(Replay)
+                        .where(Replay.stored_path == old.location)
+                        .values(stored_path=location)
+                        .execution_options(synchronize_session=False)
+                    )
+            
+            purged = 0
+            for start in range(0, len(dead), PAGE_SIZE):
+                result = await self.db.execute(
+                    delete(Replay)
+                    .where(and_(
+                        Replay.stored_path.in_(dead[start:start + PAGE_SIZE]),
+                        Replay.status == ReplayStatus.DELETED,
+                        Replay.updated_at < cutoff
+                    ))
+                    .execution_options(synchronize_session=False)
+                )
+                purged += result.rowcount or 0
+            
+            # Um membro morto que voltou a ser usado (upload deduplicado) adia a compactação
+            if await self._referenced(m.location for m in members):
+                await self.db.rollback()
+                if writer is not None:
+                    await asyncio.to_thread(remove_pack, writer.path)
+                return None
+            
+            await self.db.execute(delete(StoragePack).where(StoragePack.id == pack_id))
+            await self.db.commit()
+        except BaseException:
+            await self.db.rollback()
+            if writer is not None:
+                await asyncio.to_thread(remove_pack, writer.path)
+            raise
+        
+        await asyncio.to_thread(remove_pack, old_path)
+        return purged, old_size - new_size
+    
+    async def _referenced(self, locations: Iterable[str], *conditions) -> Set[str]:
+        """Which of ``locations`` some replay (matching ``conditions``) uses."""
+        locations = list(locations)
+        found: Set[str] = set()
+        for start in range(0, len(locations), PAGE_SIZE):
+            result = await self.db.execute(
+                select(Replay.stored_path)
+                .where(and_(Replay.stored_path.in_(locations[start:start + PAGE_SIZE]), *conditions))
+                .distinct()
+            )
+            found.update(result.scalars().all())
+        return found
+    
+    @staticmethod
+    def _live(cutoff: datetime):
+        return or_(Replay.status != ReplayStatus.DELETED, Replay.updated_at >= cutoff)
+    
+    def _dead_bytes(self, cutoff: datetime):
+        """Sum of the member lengths no live replay uses (per group)."""
+        live = exists().where(and_(Replay.stored_path == StoragePackMember.location, self._live(cutoff)))
+        return func.coalesce(func.sum(case((~live, StoragePackMember.length), else_=0)), 0)
+    
+    async def get_report(self) -> Dict[str, Any]:
+        """Packs, their members and bytes, and how much of them compaction would reclaim."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.pack_compact_grace_days)
+        dead = self._dead_bytes(cutoff)
+        per_pack = (
+            select(
+                StoragePackMember.pack_id,
+                func.count().label("members"),
+                func.sum(StoragePackMember.length).label("member_bytes"),
+                dead.label("dead_bytes"),
+            )
+            .group_by(StoragePackMember.pack_id)
+            .subquery()
+        )
+        row = (await self.db.execute(
+            select(
+                func.count(StoragePack.id),
+                func.coalesce(func.sum(StoragePack.size), 0),
+                func.coalesce(func.sum(per_pack.c.members), 0),
+                func.coalesce(func.sum(per_pack.c.dead_bytes), 0),
+                func.count().filter(
+                    per_pack.c.dead_bytes >= per_pack.c.member_bytes * settings.pack_compact_dead_ratio
+                ),
+            )
+            .select_from(StoragePack)
+            .outerjoin(per_pack, per_pack.c.pack_id == StoragePack.id)
+        )).one()
+        packs, size, members, dead_bytes, compactable = row
+        return {
+            "enabled": settings.pack_enabled,
+            "packs": packs,
+            "members": int(members),
+            "bytes": int(size),
+            "dead_bytes": int(dead_bytes),
+            "compactable_packs": compactable,
+            "target_mb": settings.pack_target_mb,
+            "member_max_kb": settings.pack_member_max_kb,
+            "compact_dead_ratio": settings.pack_compact_dead_ratio,
+        }
+    
+    def _remove_stray_packs(self, known: Set[str]) -> int:
+        """Remove pack files the database doesn't know (interrupted writes or commits)."""
+        root = pack_root()
+        min_age = time.time() - STRAY_PACK_MIN_AGE_HOURS * 3600
+        removed = 0
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = Path(directory) / name
+                if not name.endswith((PACK_SUFFIX, PACK_SUFFIX + PARTIAL_SUFFIX)) or tier_key(path) in known:
+                    continue
+                try:
+                    if path.stat().st_mtime < min_age:
+                        remove_pack(path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        if removed:
+            logger.warning(f"Removed {removed} unregistered pack files from {root}")
+        return removed
+
+
+def _fill(writer: PackWriter, pending: Deque[str], packed: Dict[str, PackMember], target: int) -> int:
+    """Append pending files to ``writer`` until it reaches ``target`` bytes; runs in a worker thread."""
+    missing = 0
+    while pending and writer.size < target:
+        path = pending.popleft()
+        try:
+            packed[path] = writer.add_file(path)
+        except FileNotFoundError:
+            missing += 1
+    return missing
+
+
+def _rewrite(source: Path, members: List[StoragePackMember], target: Path) -> PackWriter:
+    """Copy ``members`` of the pack ``source`` into a new sealed pack; runs in a worker thread."""
+    writer = PackWriter(target)
+    try:
+        with open(source, "rb") as f:
+            for member in members:
+                copy_member(f, PackMember(member.offset, member.length, member.checksum, member.name), writer)
+        writer.seal()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer
+
+
+def _remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,189 @@
+"""
+Nachos Replay for Guaca - Prefetch Service
+Warms the OS page cache for replays that are likely to be played next.
+"""
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, Iterable, Optional, Set
+
+from app.config import settings
+from app.models import Replay
+from app.utils.storage import is_packed, is_remote, parse_pack_location
+
+logger = logging.getLogger(__name__)
+
+# Tamanho do bloco usado no fallback por leitura (sem posix_fadvise)
+READ_WARM_CHUNK = 1024 * 1024
+
+
+class PrefetchService:
+    """
+    Page-cache warming for replay files.
+
+    The service never holds file data itself: it only asks the kernel to
+    read ahead (``posix_fadvise(WILLNEED)``). The memory budget caps how many
+    bytes are kept "warm" in the LRU bookkeeping at any time, so a large
+    listing cannot push the whole working set out of the cache.
+    """
+    
+    def __init__(self):
+        self.enabled = settings.prefetch_enabled
+        self.head_bytes = settings.prefetch_head_bytes
+        self.budget_bytes = settings.prefetch_memory_budget_mb * 1024 * 1024
+        self.metrics_enabled = settings.prefetch_metrics_enabled
+        
+        self._lock = threading.Lock()
+        self._warm: "OrderedDict[str, int]" = OrderedDict()
+        self._warm_bytes = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._metrics = {
+            "hits": 0,
+            "misses": 0,
+            "warm_requests": 0,
+            "bytes_warmed": 0,
+            "evictions": 0,
+            "skipped_budget": 0,
+            "errors": 0,
+        }
+    
+    def warm_heads(self, replays: Iterable[Replay], limit: Optional[int] = None):
+        """Warm the first ``prefetch_head_bytes`` of the top listed replays."""
+        if not self.enabled:
+            return
+        
+        limit = settings.prefetch_top_n if limit is None else limit
+        for replay in list(replays)[:limit]:
+            self._schedule(replay.stored_path, self.head_bytes)
+    
+    def warm_full(self, replay: Replay):
+        """Warm an entire replay file (detail page was opened)."""
+        if not self.enabled:
+            return
+        
+        self._schedule(replay.stored_path, None)
+    
+    def record_access(self, path: Optional[str]):
+        """Record whether a streamed file had been warmed beforehand."""
+        if not self.metrics_enabled or not path:
+            return
+        
+        with self._lock:
+            if path in self._warm:
+                self._warm.move_to_end(path)
+                self._metrics["hits"] += 1
+            else:
+                self._metrics["misses"] += 1
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return prefetch counters and current budget usage."""
+        with self._lock:
+            metrics = dict(self._metrics)
+            lookups = metrics["hits"] + metrics["misses"]
+            metrics.update({
+                "enabled": self.enabled,
+                "hit_ratio": metrics["hits"] / lookups if lookups else 0.0,
+                "warm_files": len(self._warm),
+                "warm_bytes": self._warm_bytes,
+                "budget_bytes": self.budget_bytes,
+                "in_flight": len(self._tasks),
+            })
+        return metrics
+    
+    def _schedule(self, stored_path: Optional[str], length: Optional[int]):
+        """Run a warm request in a worker thread without blocking the caller."""
+        if not stored_path or is_remote(stored_path):
+            # Objetos remotos não passam pelo page cache local
+            return
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        
+        task = loop.create_task(asyncio.to_thread(self._warm_file, stored_path, length))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _warm_file(self, stored_path: str, length: Optional[int]):
+        """Advise the kernel to read ``length`` bytes (or all) of a file (or pack member)."""
+        try:
+            if is_packed(stored_path):
+                # Membro de pack: a faixa dele no arquivo do pack
+                path, base, size = parse_pack_location(stored_path)
+                path.stat()
+            else:
+                path, base = Path(stored_path), 0
+                size = path.stat().st_size
+        except (OSError, ValueError):
+            return
+        
+        wanted = size if length is None else min(size, length)
+        if wanted <= 0:
+            return
+        
+        with self._lock:
+            self._metrics["warm_requests"] += 1
+            already = self._warm.get(stored_path, 0)
+            if already >= wanted:
+                self._warm.move_to_end(stored_path)
+                return
+            if wanted > self.budget_bytes:
+                self._metrics["skipped_budget"] += 1
+                return
+            self._reserve(stored_path, wanted - already)
+            self._warm[stored_path] = wanted
+        
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, base + already, wanted - already, os.POSIX_FADV_WILLNEED)
+                else:
+                    # Fallback: ler os blocos para forçar o cache
+                    os.lseek(fd, base + already, os.SEEK_SET)
+                    remaining = wanted - already
+                    while remaining > 0:
+                        chunk = os.read(fd, min(READ_WARM_CHUNK, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+            finally:
+                os.close(fd)
+            
+            with self._lock:
+                self._metrics["bytes_warmed"] += wanted - already
+        
+        except OSError as e:
+            logger.debug(f"Could not warm {stored_path}: {e}")
+            with self._lock:
+                self._metrics["errors"] += 1
+                self._warm_bytes -= self._warm.pop(stored_path, 0)
+    
+    def _reserve(self, stored_path: str, extra: int):
+        """Evict least recently warmed files until ``extra`` bytes fit (lock held)."""
+        self._warm_bytes += extra
+        while self._warm_bytes > self.budget_bytes and self._warm:
+            oldest, size = next(iter(self._warm.items()))
+            if oldest == stored_path:
+                self._warm.move_to_end(oldest)
+                if len(self._warm) == 1:
+                    break
+                continue
+            self._warm.popitem(last=False)
+            self._warm_bytes -= size
+            self._metrics["evictions"] += 1
+
+
+_prefetch_service: Optional[PrefetchService] = None
+
+
+def get_prefetch_service() -> PrefetchService:
+    """Get the process-wide prefetch service."""
+    global _prefetch_service
+    if _prefetch_service is None:
+        _prefetch_service = PrefetchService()
+    return _prefetch_service
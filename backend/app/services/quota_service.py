@@ -0,0 +1,396 @@
+"""
+Nachos Replay for Guaca - Quota Service
+Keeps local replay storage under MAX_STORAGE_GB with high/low watermarks.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import (
+    select, delete, func, and_, or_, cast, exists, false, literal_column, text, String
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay, ReplayStatus, StorageTier, StorageUsage, StorageUsageDelta
+from app.services.job_progress import get_job_registry
+from app.utils.storage import get_tier_backend
+
+logger = logging.getLogger(__name__)
+
+QUOTA_JOB = "storage_quota"
+
+# Ações do plano, da mais barata para a mais cara
+COMPRESS = "compress"
+MIGRATE = "migrate"
+PURGE = "purge"
+ACTIONS = (COMPRESS, MIGRATE, PURGE)
+
+# Razão comprimido/original presumida enquanto não há arquivos comprimidos para medir
+DEFAULT_COMPRESSION_RATIO = 0.3
+# Ações listadas individualmente no relatório
+REPORTED_ACTIONS = 100
+
+USAGE_KEYS = ("storage_tier", "status", "is_compressed", "is_remote")
+USAGE_VALUES = ("files", "bytes", "original_bytes")
+
+
+@dataclass
+class QuotaAction:
+    """One step of a quota plan: what to do with which replay, and what it should free."""
+    action: str
+    replay_id: UUID
+    filename: str
+    size: int
+    estimated_savings: int
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "action": self.action,
+            "replay_id": str(self.replay_id),
+            "filename": self.filename,
+            "size": self.size,
+            "estimated_savings": self.estimated_savings,
+        }
+
+
+class QuotaService:
+    """
+    Enforces ``max_storage_gb`` on the local replay storage.
+    
+    Usage is accounted incrementally: a trigger on ``replays`` appends a
+    delta for every change to a stored file (see StorageUsageDelta) and the
+    deltas are folded into ``storage_usage`` here, so reading the usage
+    never scans the replays table. Objects in remote tiers are reported but
+    don't count toward the quota. Replays sharing a file are each counted,
+    which errs on the side of freeing space early.
+    
+    When usage crosses the high watermark, a plan is built to bring it
+    under the low watermark, cheapest actions first: compress the largest
+    uncompressed WARM files, then move WARM replays to COLD (oldest first),
+    then, if QUOTA_PURGE_DELETED allows, purge soft-deleted replays. The
+    plan is executed in batches, re-reading the usage after each, and
+    stops as soon as the low watermark is reached.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    async def get_usage(self) -> Dict[str, Any]:
+        """Current usage against the quota and its watermarks."""
+        # Banco com replays anteriores ao trigger: totais montados uma única vez
+        if not await self.db.scalar(select(func.count()).select_from(StorageUsage)):
+            if await self.db.scalar(select(exists().where(Replay.stored_path.isnot(None)))):
+                await self.recount()
+        await self._fold_deltas()
+        
+        result = await self.db.execute(select(StorageUsage))
+        by_tier = {
+            tier.value: {"files": 0, "bytes": 0, "original_bytes": 0, "remote_files": 0, "remote_bytes": 0}
+            for tier in StorageTier
+        }
+        by_status: Dict[str, Dict[str, int]] = {}
+        compressed_bytes = compressed_original = 0
+        for row in result.scalars().all():
+            tier = by_tier[row.storage_tier]
+            if row.is_remote:
+                tier["remote_files"] += row.files
+                tier["remote_bytes"] += row.bytes
+                continue
+            for key in USAGE_VALUES:
+                tier[key] += getattr(row, key)
+            status = by_status.setdefault(row.status, {"files": 0, "bytes": 0})
+            status["files"] += row.files
+            status["bytes"] += row.bytes
+            if row.is_compressed:
+                compressed_bytes += row.bytes
+                compressed_original += row.original_bytes
+        
+        max_bytes = settings.max_storage_gb * 1024 ** 3
+        used_bytes = sum(tier["bytes"] for tier in by_tier.values())
+        return {
+            "used_bytes": used_bytes,
+            "remote_bytes": sum(tier["remote_bytes"] for tier in by_tier.values()),
+            "max_bytes": max_bytes,
+            "high_watermark_bytes": max_bytes * settings.quota_high_watermark_percent // 100,
+            "low_watermark_bytes": max_bytes * settings.quota_low_watermark_percent // 100,
+            "used_percent": round(used_bytes * 100 / max_bytes, 2) if max_bytes else None,
+            # Razão medida nos arquivos já comprimidos, usada nas estimativas do plano
+            "compression_ratio": (
+                round(compressed_bytes / compressed_original, 3) if compressed_original else None
+            ),
+            "by_tier": by_tier,
+            "by_status": by_status,
+        }
+    
+    async def recount(self):
+        """
+        Rebuild ``storage_usage`` from the replays table. Only needed once,
+        on databases that had replays before the accounting trigger; writes
+        to replays wait for it to finish.
+        """
+        logger.info("Recontando o uso de armazenamento a partir da tabela replays")
+        await self.db.execute(text("LOCK TABLE replays IN SHARE MODE"))
+        await self.db.execute(delete(StorageUsageDelta))
+        await self.db.execute(delete(StorageUsage))
+        
+        # Sem parâmetros nas chaves: o GROUP BY precisa repetir as mesmas expressões
+        keys = (
+            func.coalesce(cast(Replay.storage_tier, String), literal_column("'hot'")),
+            func.coalesce(cast(Replay.status, String), literal_column("'active'")),
+            func.coalesce(Replay.is_compressed, false()),
+            func.left(Replay.stored_path, literal_column("5")) == literal_column("'s3://'"),
+        )
+        totals = (
+            select(
+                *keys,
+                func.count(),
+                func.coalesce(func.sum(Replay.file_size), 0),
+                func.coalesce(func.sum(func.coalesce(Replay.original_size, Replay.file_size)), 0)
+            )
+            .where(Replay.stored_path.isnot(None))
+            .group_by(*keys)
+        )
+        await self.db.execute(insert(StorageUsage).from_select(USAGE_KEYS + USAGE_VALUES, totals))
+        await self.db.commit()
+    
+    async def _fold_deltas(self):
+        """Move pending deltas into the totals, in one statement."""
+        moved = (
+            delete(StorageUsageDelta)
+            .returning(*(getattr(StorageUsageDelta, column) for column in USAGE_KEYS + USAGE_VALUES))
+            .cte("moved")
+        )
+        keys = [moved.c[column] for column in USAGE_KEYS]
+        totals = select(
+            *keys, *(func.sum(moved.c[column]) for column in USAGE_VALUES)
+        ).group_by(*keys)
+        stmt = insert(StorageUsage).from_select(USAGE_KEYS + USAGE_VALUES, totals)
+        await self.db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=list(USAGE_KEYS),
+                set_={
+                    column: getattr(StorageUsage, column) + getattr(stmt.excluded, column)
+                    for column in USAGE_VALUES
+                }
+            )
+        )
+        await self.db.commit()
+    
+    async def build_plan(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Plan what to do to get under the low watermark, without doing it
+        (dry run). Nothing is planned below the high watermark unless
+        ``force`` is set.
+        """
+        report, _ = await self._plan(await self.get_usage(), force)
+        report["dry_run"] = True
+        return report
+    
+    async def _plan(self, usage: Dict[str, Any], force: bool = False) -> Tuple[Dict[str, Any], List[QuotaAction]]:
+        over_high = usage["used_bytes"] > usage["high_watermark_bytes"]
+        to_free = max(usage["used_bytes"] - usage["low_watermark_bytes"], 0) if over_high or force else 0
+        ratio = usage["compression_ratio"] or DEFAULT_COMPRESSION_RATIO
+        
+        actions: List[QuotaAction] = []
+        planned = set()
+        remaining = to_free
+        for action in ACTIONS:
+            after = None
+            while remaining > 0 and len(actions) < settings.quota_max_actions:
+                page = await self._candidates(action, after, settings.quota_batch_size)
+                if not page:
+                    break
+                after = page[-1]
+                for replay in page:
+                    if replay.id in planned:
+                        continue
+                    savings = self._estimate_savings(action, replay, ratio)
+                    if savings <= 0:
+                        continue
+                    actions.append(QuotaAction(action, replay.id, replay.filename, replay.file_size or 0, savings))
+                    planned.add(replay.id)
+                    remaining -= savings
+                    if remaining <= 0 or len(actions) >= settings.quota_max_actions:
+                        break
+        
+        steps = []
+        for action in ACTIONS:
+            selected = [a for a in actions if a.action == action]
+            steps.append({
+                "action": action,
+                "count": len(selected),
+                "bytes": sum(a.size for a in selected),
+                "estimated_savings": sum(a.estimated_savings for a in selected),
+            })
+        estimated = sum(a.estimated_savings for a in actions)
+        return {
+            "usage": usage,
+            "over_high_watermark": over_high,
+            "bytes_to_free": to_free,
+            "estimated_bytes_freed": estimated,
+            # O que faltaria mesmo com o plano todo (p.ex. purga desativada)
+            "shortfall_bytes": max(to_free - estimated, 0),
+            "purge_allowed": settings.quota_purge_deleted,
+            "steps": steps,
+            "actions": [a.to_dict() for a in actions[:REPORTED_ACTIONS]],
+        }, actions
+    
+    async def enforce(self) -> Dict[str, Any]:
+        """
+        Run the plan when usage is over the high watermark, batch by batch,
+        until it drops under the low watermark. Returns the plan report with
+        what was executed.
+        """
+        progress = get_job_registry().start(QUOTA_JOB)
+        try:
+            report, plan = await self._plan(await self.get_usage())
+            usage = report["usage"]
+            executed = {action: 0 for action in ACTIONS}
+            
+            batch_size = max(1, settings.quota_batch_size)
+            for start in range(0, len(plan), batch_size):
+                if usage["used_bytes"] <= usage["low_watermark_bytes"]:
+                    break
+                batch = plan[start:start + batch_size]
+                # Um lote pode juntar o fim de um passo e o início do seguinte
+                for action in ACTIONS:
+                    ids = [a.replay_id for a in batch if a.action == action]
+                    if not ids:
+                        continue
+                    before = usage["used_bytes"]
+                    done, failed, nbytes = await self._execute(action, ids, progress)
+                    usage = await self.get_usage()
+                    executed[action] += done
+                    progress.count(action, done)
+                    progress.count("bytes_freed", max(before - usage["used_bytes"], 0))
+                    progress.add_batch(done, failed, nbytes)
+            
+            report["executed"] = executed
+            report["usage_after"] = usage
+            report["dry_run"] = False
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        if report["over_high_watermark"]:
+            logger.info(
+                f"Cota de armazenamento: {report['usage']['used_bytes'] / 1024 ** 3:.1f} GB -> "
+                f"{usage['used_bytes'] / 1024 ** 3:.1f} GB "
+                f"(marca baixa {usage['low_watermark_bytes'] / 1024 ** 3:.1f} GB); executado: {executed}"
+            )
+            if usage["used_bytes"] > usage["low_watermark_bytes"]:
+                logger.warning(
+                    f"Cota de armazenamento ainda acima da marca baixa; faltam "
+                    f"{report['shortfall_bytes'] / 1024 ** 3:.1f} GB no plano"
+                )
+        return report
+    
+    async def _execute(self, action: str, ids: List[UUID], progress) -> Tuple[int, int, int]:
+        """Carry out one action on a batch of replays and commit."""
+        from app.services.replay_service import ReplayService
+        from app.tasks.maintenance_tasks import MaintenanceService
+        
+        result = await self.db.execute(select(Replay).where(Replay.id.in_(ids)))
+        # Revalida: o replay pode ter mudado desde o planejamento
+        replays = [replay for replay in result.scalars().all() if self._still_applies(action, replay)]
+        if not replays:
+            return 0, 0, 0
+        
+        if action == COMPRESS:
+            return await ReplayService(self.db).compress_replays(replays, progress)
+        if action == MIGRATE:
+            return await MaintenanceService(self.db).migrate_replays(replays, StorageTier.COLD, progress)
+        
+        service = ReplayService(self.db)
+        purged = failed = nbytes = 0
+        for replay in replays:
+            size = replay.file_size or 0
+            if await service.delete_replay(replay, hard_delete=True):
+                purged += 1
+                nbytes += size
+            else:
+                failed += 1
+        await self.db.commit()
+        return purged, failed, nbytes
+    
+    async def _candidates(self, action: str, after: Optional[Replay], limit: int) -> List[Replay]:
+        """Next page of candidates for ``action``, after the replay ``after``."""
+        local = func.left(Replay.stored_path, 5) != "s3://"
+        if action == COMPRESS:
+            # Maiores primeiro (idx_replays_warm_uncompressed)
+            conditions = [
+                Replay.storage_tier == StorageTier.WARM,
+                ~Replay.is_compressed,
+                Replay.stored_path.isnot(None),
+                local,
+                Replay.file_size >= settings.quota_compress_min_file_mb * 1024 * 1024,
+            ]
+            if after is not None:
+                conditions.append(or_(
+                    Replay.file_size < after.file_size,
+                    and_(Replay.file_size == after.file_size, Replay.id > after.id)
+                ))
+            order = (Replay.file_size.desc(), Replay.id)
+        elif action == MIGRATE:
+            # Mais antigos primeiro (idx_replays_tier_imported)
+            conditions = [Replay.storage_tier == StorageTier.WARM, Replay.stored_path.isnot(None), local]
+            if get_tier_backend(StorageTier.COLD.value).name == "local":
+                # Com COLD local só ganha quem ainda será comprimido
+                conditions.append(~Replay.is_compressed)
+            if after is not None:
+                conditions.append(or_(
+                    Replay.imported_at > after.imported_at,
+                    and_(Replay.imported_at == after.imported_at, Replay.id > after.id)
+                ))
+            order = (Replay.imported_at, Replay.id)
+        else:
+            if not settings.quota_purge_deleted:
+                return []
+            # Removidos há mais tempo primeiro (idx_replays_deleted)
+            cutoff = datetime.now(timezone.utc) - timedelta(days=settings.quota_purge_grace_days)
+            conditions = [
+                Replay.status == ReplayStatus.DELETED,
+                Replay.updated_at < cutoff,
+                Replay.stored_path.isnot(None),
+                local,
+            ]
+            if after is not None:
+                conditions.append(or_(
+                    Replay.updated_at > after.updated_at,
+                    and_(Replay.updated_at == after.updated_at, Replay.id > after.id)
+                ))
+            order = (Replay.updated_at, Replay.id)
+        
+        result = await self.db.execute(select(Replay).where(and_(*conditions)).order_by(*order).limit(limit))
+        return list(result.scalars().all())
+    
+    @staticmethod
+    def _estimate_savings(action: str, replay: Replay, ratio: float) -> int:
+        size = replay.file_size or 0
+        if action == COMPRESS:
+            return int(size * (1 - ratio))
+        if action == MIGRATE:
+            if get_tier_backend(StorageTier.COLD.value).name != "local":
+                return size
+            return 0 if replay.is_compressed else int(size * (1 - ratio))
+        return size
+    
+    @staticmethod
+    def _still_applies(action: str, replay: Replay) -> bool:
+        if not replay.stored_path:
+            return False
+        if action == COMPRESS:
+            return replay.storage_tier == StorageTier.WARM and not replay.is_compressed
+        if action == MIGRATE:
+            return replay.storage_tier == StorageTier.WARM
+        return replay.status == ReplayStatus.DELETED
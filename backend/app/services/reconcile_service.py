@@ -0,0 +1,592 @@
+"""
+Nachos Replay for Guaca - Reconcile Service
+Finds and fixes drift between the stored recording files and the replays table.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from uuid import UUID, uuid4
+
+from sqlalchemy import select, delete, func, and_, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.config import settings
+from app.models import Replay, StorageDrift, StorageTier
+from app.services.blob_service import BlobService
+from app.services.integrity_service import hash_recording
+from app.services.job_progress import get_job_registry, load_checkpoint, save_checkpoint
+from app.utils.compression import detect_codec, frame_dictionary_id
+from app.utils.layout import REPLAY_CACHE_DIRS, replay_cache_dir
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_JOB = "storage_reconcile"
+
+# Diretórios de gravações sob replay_storage_path, em ordem; os demais (chunks,
+# dictionaries, renditions, restore-cache, thumbnails, staging, quarantine) são
+# dados derivados e packs/ tem seu índice no banco (storage_pack_members)
+RECORDING_DIRS = ("clips", "cold", "hot", "uploads", "warm")
+QUARANTINE_DIR = "quarantine"
+
+MISSING = "missing"
+ORPHAN = "orphan"
+SIZE = "size"
+DRIFT_KINDS = (MISSING, ORPHAN, SIZE)
+
+RELINKED = "relinked"
+QUARANTINED = "quarantined"
+RESIZED = "resized"
+
+REPORTED_DRIFT = 100
+
+
+class StoredFile(NamedTuple):
+    path: str
+    size: int
+    changed: float  # max(mtime, ctime): um rename (migração de tier) atualiza o ctime
+
+
+def _sort_key(entry: os.DirEntry) -> str:
+    # Diretório ordena como "nome/", para que o percurso siga a ordem de bytes dos caminhos
+    try:
+        return entry.name + "/" if entry.is_dir(follow_symlinks=False) else entry.name
+    except OSError:
+        return entry.name
+
+
+def walk_sorted(directory: str, after: Optional[str] = None) -> Iterator[StoredFile]:
+    """
+    Regular files under ``directory`` in byte order of their full path (the
+    order of ``ORDER BY path COLLATE "C"``), starting after the path
+    ``after``. Holds one sorted listing per directory level.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=_sort_key)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    
+    for entry in entries:
+        path = entry.path
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                prefix = path + "/"
+                if after is None or prefix > after:
+                    yield from walk_sorted(path)
+                elif after.startswith(prefix):
+                    yield from walk_sorted(path, after)
+                continue
+            if (after is not None and path <= after) or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        yield StoredFile(path, stat.st_size, max(stat.st_mtime, stat.st_ctime))
+
+
+class _Batches:
+    """Pulls batches from an iterator; each pull may run in a different worker thread."""
+    
+    def __init__(self, iterator: Iterator):
+        self.iterator = iterator
+    
+    def next(self, size: int) -> List:
+        return list(islice(self.iterator, size))
+
+
+class ReconcileService:
+    """
+    Reconciles the recording files under ``replay_storage_path`` with the
+    replays that reference them.
+    
+    For each recording directory, a sorted walk of its files (os.scandir,
+    each listing sorted) is merged with a keyset-paginated scan of the
+    replays whose stored_path falls under it, ordered by path in byte
+    order, so memory stays at one batch of each side whatever the number
+    of files. Differences go to ``storage_drift`` as they are found:
+    
+    - ``missing``: a replay whose file doesn't exist;
+    - ``orphan``: a file no replay references, older than
+      ``reconcile_orphan_min_age_hours`` (files being written or moved
+      between tiers are left alone);
+    - ``size``: a file whose size differs from the replay's file_size.
+    
+    With ``reconcile_fix``, missing replays are re-linked to an orphan with
+    the same content (e.g. a file left by a tier move or upload that failed
+    before its commit), sizes are corrected and the remaining orphans are
+    moved to ``quarantine/<date>/`` instead of deleted. Every fix re-checks
+    the row and the file first. Fixing also removes the rendition and
+    thumbnail caches of replays that no longer exist (e.g. purged in bulk
+    by pack compaction). The walk position is checkpointed, so an
+    interrupted run resumes where it stopped; only the latest run's drift
+    is kept.
+    """
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.storage_path = Path(settings.replay_storage_path)
+    
+    async def run(self, fix: Optional[bool] = None) -> Dict[str, int]:
+        """Scan (and, with ``fix``, repair) the storage. Returns counts per drift kind."""
+        fix = settings.reconcile_fix if fix is None else fix
+        progress = get_job_registry().start(RECONCILE_JOB)
+        checkpoint = await load_checkpoint(self.db, RECONCILE_JOB)
+        if not checkpoint.get("run_id") or checkpoint.get("finished"):
+            checkpoint = {
+                "run_id": str(uuid4()),
+                "started": datetime.now(timezone.utc).isoformat(),
+                "position": None,
+                "scanned": False,
+            }
+        checkpoint["fix"] = fix
+        run_id = UUID(checkpoint["run_id"])
+        
+        try:
+            if not checkpoint["scanned"]:
+                position = checkpoint.get("position")
+                for directory in RECORDING_DIRS:
+                    if position and directory < position["dir"]:
+                        continue
+                    resume = position if position and position["dir"] == directory else None
+                    await self._scan_directory(run_id, directory, resume, checkpoint, progress)
+                checkpoint["scanned"] = True
+                checkpoint["position"] = None
+                await save_checkpoint(self.db, RECONCILE_JOB, checkpoint)
+                await self.db.commit()
+            
+            if fix:
+                await self._fix_sizes(run_id, progress)
+                await self._relink_missing(run_id, progress)
+                await self._quarantine_orphans(run_id, progress)
+                if settings.reconcile_quarantine_days > 0:
+                    removed = await asyncio.to_thread(self._purge_quarantine)
+                    progress.count("quarantine_purged", removed)
+                progress.count("replay_caches_removed", await self._remove_stale_caches())
+            
+            await self.db.execute(delete(StorageDrift).where(StorageDrift.run_id != run_id))
+            checkpoint["finished"] = datetime.now(timezone.utc).isoformat()
+            await save_checkpoint(self.db, RECONCILE_JOB, checkpoint)
+            await self.db.commit()
+            progress.finish()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        counts = await self._counts(run_id)
+        stats = {kind: sum(counts.get(kind, {}).values()) for kind in DRIFT_KINDS}
+        unresolved = counts.get(MISSING, {}).get("open", 0)
+        if unresolved:
+            logger.error(f"Storage reconcile: {unresolved} replays have no stored file (see /stats/reconcile)")
+        logger.info(
+            f"Storage reconcile: {progress.processed} files and replays compared, "
+            f"{stats[MISSING]} missing, {stats[ORPHAN]} orphans, {stats[SIZE]} size mismatches"
+        )
+        return stats
+    
+    async def _scan_directory(
+        self,
+        run_id: UUID,
+        directory: str,
+        position: Optional[Dict[str, Any]],
+        checkpoint: Dict[str, Any],
+        progress
+    ):
+        """Sorted merge of the files under one recording directory with their replays."""
+        root = str(self.storage_path / directory)
+        batch = max(1, settings.reconcile_batch_size)
+        disk_after = position.get("disk_after") if position else None
+        row_after = _decode_row_cursor(position.get("row_after")) if position else None
+        min_age = time.time() - settings.reconcile_orphan_min_age_hours * 3600
+        
+        files = _Batches(walk_sorted(root, disk_after))
+        disk: Deque[StoredFile] = deque()
+        rows: Deque = deque()
+        disk_done = rows_done = False
+        found: List[StorageDrift] = []
+        compared = 0
+        
+        async def flush():
+            nonlocal found, compared
+            self.db.add_all(found)
+            checkpoint["position"] = {
+                "dir": directory,
+                "disk_after": disk_after,
+                "row_after": [row_after[0], str(row_after[1])] if row_after else None,
+            }
+            await save_checkpoint(self.db, RECONCILE_JOB, checkpoint)
+            await self.db.commit()
+            progress.add_batch(compared, len(found))
+            found, compared = [], 0
+        
+        while True:
+            if not disk and not disk_done:
+                disk.extend(await asyncio.to_thread(files.next, batch))
+                disk_done = len(disk) < batch
+            if not rows and not rows_done:
+                page = await self._rows_page(root, row_after, batch)
+                rows.extend(page)
+                rows_done = len(page) < batch
+            if not disk and not rows:
+                break
+            
+            if disk and (not rows or disk[0].path < rows[0].stored_path):
+                stored = disk.popleft()
+                disk_after = stored.path
+                if stored.changed < min_age:
+                    found.append(self._drift(run_id, ORPHAN, stored.path, size=stored.size, stored=stored))
+                    progress.count(ORPHAN)
+            elif not disk or rows[0].stored_path < disk[0].path:
+                row = rows.popleft()
+                row_after = (row.stored_path, row.id)
+                found.append(self._drift(run_id, MISSING, row.stored_path, row.id, expected_size=row.file_size))
+                progress.count(MISSING)
+            else:
+                stored = disk.popleft()
+                disk_after = stored.path
+                # Todos os replays que compartilham o arquivo (deduplicação)
+                while True:
+                    while rows and rows[0].stored_path == stored.path:
+                        row = rows.popleft()
+                        row_after = (row.stored_path, row.id)
+                        compared += 1
+                        if row.file_size != stored.size:
+                            found.append(self._drift(
+                                run_id, SIZE, stored.path, row.id, stored.size, row.file_size, stored
+                            ))
+                            progress.count(SIZE)
+                    if rows or rows_done:
+                        break
+                    page = await self._rows_page(root, row_after, batch)
+                    rows.extend(page)
+                    rows_done = len(page) < batch
+            
+            compared += 1
+            if compared >= batch:
+                await flush()
+        
+        await flush()
+    
+    async def _rows_page(self, root: str, after: Optional[Tuple[str, UUID]], limit: int) -> List:
+        """Replays stored under ``root``, in byte order of stored_path, after ``after``."""
+        path = Replay.stored_path.collate("C")
+        # Intervalo de prefixo: "0" é o caractere seguinte a "/"
+        conditions = [path >= root + "/", path < root + "0"]
+        if after is not None:
+            conditions.append(tuple_(path, Replay.id) > tuple_(*after))
+        result = await self.db.execute(
+            select(Replay.id, Replay.stored_path, Replay.file_size)
+            .where(and_(*conditions))
+            .order_by(path, Replay.id)
+            .limit(limit)
+        )
+        return list(result.all())
+    
+    @staticmethod
+    def _drift(
+        run_id: UUID,
+        kind: str,
+        path: str,
+        replay_id: Optional[UUID] = None,
+        size: Optional[int] = None,
+        expected_size: Optional[int] = None,
+        stored: Optional[StoredFile] = None
+    ) -> StorageDrift:
+        return StorageDrift(
+            run_id=run_id,
+            kind=kind,
+            path=path,
+            replay_id=replay_id,
+            size=size,
+            expected_size=expected_size,
+            modified_at=datetime.fromtimestamp(stored.changed, tz=timezone.utc) if stored else None
+        )
+    
+    async def _open_drift(self, run_id: UUID, kind: str, after_id: int, extra=()) -> List[StorageDrift]:
+        result = await self.db.execute(
+            select(StorageDrift)
+            .where(and_(
+                StorageDrift.run_id == run_id,
+                StorageDrift.kind == kind,
+                StorageDrift.resolution.is_(None),
+                StorageDrift.id > after_id,
+                *extra
+            ))
+            .order_by(StorageDrift.id)
+            .limit(max(1, settings.reconcile_batch_size))
+        )
+        return list(result.scalars().all())
+    
+    async def _fix_sizes(self, run_id: UUID, progress):
+        """Set file_size to the stored size (the content itself is the scrubber's job)."""
+        after_id = 0
+        while True:
+            drifts = await self._open_drift(run_id, SIZE, after_id)
+            if not drifts:
+                break
+            after_id = drifts[-1].id
+            for drift in drifts:
+                replay = await self.db.get(Replay, drift.replay_id)
+                if replay is None or replay.stored_path != drift.path:
+                    continue
+                size = await asyncio.to_thread(_file_size, drift.path)
+                if size is None or size == replay.file_size:
+                    continue
+                replay.file_size = size
+                drift.resolution = RESIZED
+                progress.count(RESIZED)
+            await self.db.commit()
+    
+    async def _relink_missing(self, run_id: UUID, progress):
+        """Point replays without a file at an orphan with the same content."""
+        missing_count = await self.db.scalar(
+            select(func.count(StorageDrift.id)).where(and_(
+                StorageDrift.run_id == run_id,
+                StorageDrift.kind == MISSING,
+                StorageDrift.resolution.is_(None)
+            ))
+        )
+        if not missing_count:
+            return
+        
+        # Checksum do conteúdo dos órfãos, até o orçamento de leitura
+        budget = settings.reconcile_relink_max_gb * 1024 ** 3
+        after_id = 0
+        while budget > 0:
+            orphans = await self._open_drift(run_id, ORPHAN, after_id, (StorageDrift.checksum.is_(None),))
+            if not orphans:
+                break
+            after_id = orphans[-1].id
+            for orphan in orphans:
+                if (orphan.size or 0) > budget:
+                    budget = 0
+                    break
+                try:
+                    orphan.checksum, _ = await asyncio.to_thread(hash_recording, orphan.path)
+                except OSError as e:
+                    logger.debug(f"Could not hash orphan {orphan.path}: {e}")
+                    continue
+                budget -= orphan.size or 0
+                progress.count("orphans_hashed")
+            await self.db.commit()
+        
+        missing = aliased(StorageDrift)
+        orphan = aliased(StorageDrift)
+        after_id = 0
+        while True:
+            result = await self.db.execute(
+                select(missing, orphan)
+                .join(Replay, Replay.id == missing.replay_id)
+                .join(orphan, and_(
+                    orphan.run_id == run_id,
+                    orphan.kind == ORPHAN,
+                    orphan.checksum == Replay.checksum_sha256
+                ))
+                .where(and_(
+                    missing.run_id == run_id,
+                    missing.kind == MISSING,
+                    missing.resolution.is_(None),
+                    missing.id > after_id
+                ))
+                .distinct(missing.id)
+                .order_by(missing.id, orphan.id)
+                .limit(max(1, settings.reconcile_batch_size))
+            )
+            pairs = result.all()
+            if not pairs:
+                break
+            after_id = pairs[-1][0].id
+            for missing_drift, orphan_drift in pairs:
+                replay = await self.db.get(Replay, missing_drift.replay_id)
+                if replay is None or replay.stored_path != missing_drift.path:
+                    continue
+                if await asyncio.to_thread(os.path.exists, missing_drift.path):
+                    continue
+                if not await self._relink(replay, orphan_drift.path):
+                    continue
+                logger.warning(f"Replay {replay.id} ({replay.filename}) re-linked from {missing_drift.path} to {orphan_drift.path}")
+                missing_drift.resolution = orphan_drift.resolution = RELINKED
+                missing_drift.resolved_path = orphan_drift.path
+                orphan_drift.replay_id = replay.id
+                progress.count(RELINKED)
+            await self.db.commit()
+    
+    async def _relink(self, replay: Replay, path: str) -> bool:
+        """Point ``replay`` at the file ``path`` (same content), updating what depends on the file."""
+        size = await asyncio.to_thread(_file_size, path)
+        if size is None:
+            return False
+        codec = await asyncio.to_thread(detect_codec, path)
+        replay.stored_path = path
+        replay.file_size = size
+        replay.is_compressed = codec is not None
+        replay.compression_dict_id = await asyncio.to_thread(frame_dictionary_id, path) if codec == "zstd" else None
+        # O tier é o do diretório onde o arquivo está
+        tier = Path(path).relative_to(self.storage_path).parts[0]
+        if tier in {t.value for t in StorageTier}:
+            replay.storage_tier = StorageTier(tier)
+        return True
+    
+    async def _quarantine_orphans(self, run_id: UUID, progress):
+        """Move the orphans still unreferenced to ``quarantine/<date>/``, keeping their relative path."""
+        quarantine = self.storage_path / QUARANTINE_DIR / date.today().isoformat()
+        min_age = time.time() - settings.reconcile_orphan_min_age_hours * 3600
+        blob_service = BlobService(self.db)
+        after_id = 0
+        while True:
+            orphans = await self._open_drift(run_id, ORPHAN, after_id)
+            if not orphans:
+                break
+            after_id = orphans[-1].id
+            for orphan in orphans:
+                if await blob_service.count_references(orphan.path):
+                    continue
+                target = quarantine / Path(orphan.path).relative_to(self.storage_path)
+                try:
+                    moved = await asyncio.to_thread(_quarantine_file, orphan.path, target, min_age)
+                except OSError as e:
+                    logger.error(f"Could not quarantine {orphan.path}: {e}")
+                    progress.error(f"{orphan.path}: {e}")
+                    continue
+                if moved:
+                    orphan.resolution = QUARANTINED
+                    orphan.resolved_path = str(target)
+                    progress.count(QUARANTINED)
+            await self.db.commit()
+    
+    def _purge_quarantine(self) -> int:
+        """Remove quarantine days older than ``reconcile_quarantine_days``; returns how many."""
+        cutoff = date.today() - timedelta(days=settings.reconcile_quarantine_days)
+        removed = 0
+        try:
+            entries = list(os.scandir(self.storage_path / QUARANTINE_DIR))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                day = date.fromisoformat(entry.name)
+            except ValueError:
+                continue
+            if day < cutoff and entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
+    
+    async def _remove_stale_caches(self) -> int:
+        """Remove the rendition and thumbnail directories of deleted replays; returns how many."""
+        batch = max(1, settings.reconcile_batch_size)
+        removed = 0
+        for area in REPLAY_CACHE_DIRS:
+            replay_ids = await asyncio.to_thread(_cache_replay_ids, self.storage_path / area)
+            for start in range(0, len(replay_ids), batch):
+                page = replay_ids[start:start + batch]
+                result = await self.db.execute(select(Replay.id).where(Replay.id.in_(page)))
+                existing = set(result.scalars().all())
+                for replay_id in page:
+                    if replay_id not in existing:
+                        await asyncio.to_thread(shutil.rmtree, replay_cache_dir(area, replay_id), True)
+                        removed += 1
+        return removed
+    
+    async def _counts(self, run_id: UUID) -> Dict[str, Dict[str, int]]:
+        result = await self.db.execute(
+            select(StorageDrift.kind, StorageDrift.resolution, func.count(StorageDrift.id))
+            .where(StorageDrift.run_id == run_id)
+            .group_by(StorageDrift.kind, StorageDrift.resolution)
+        )
+        counts: Dict[str, Dict[str, int]] = {}
+        for kind, resolution, count in result.all():
+            counts.setdefault(kind, {})[resolution or "open"] = count
+        return counts
+    
+    async def get_report(self, kind: Optional[str] = None) -> Dict[str, Any]:
+        """Latest run (or the one in progress): drift counts and the unresolved items."""
+        checkpoint = await load_checkpoint(self.db, RECONCILE_JOB)
+        if not checkpoint.get("run_id"):
+            return {"run_id": None, "drift": {}, "items": []}
+        run_id = UUID(checkpoint["run_id"])
+        
+        conditions = [StorageDrift.run_id == run_id, StorageDrift.resolution.is_(None)]
+        if kind:
+            conditions.append(StorageDrift.kind == kind)
+        result = await self.db.execute(
+            select(StorageDrift).where(and_(*conditions)).order_by(StorageDrift.id).limit(REPORTED_DRIFT)
+        )
+        items = [
+            {
+                "kind": drift.kind,
+                "path": drift.path,
+                "replay_id": str(drift.replay_id) if drift.replay_id else None,
+                "size": drift.size,
+                "expected_size": drift.expected_size,
+                "modified_at": drift.modified_at.isoformat() if drift.modified_at else None,
+            }
+            for drift in result.scalars().all()
+        ]
+        
+        return {
+            "run_id": str(run_id),
+            "started": checkpoint.get("started"),
+            "finished": checkpoint.get("finished"),
+            "fix": checkpoint.get("fix"),
+            "position": checkpoint.get("position"),
+            "drift": await self._counts(run_id),
+            "items": items,
+        }
+
+
+def _file_size(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+def _quarantine_file(path: str, target: Path, min_age: float) -> bool:
+    """Move an orphan to ``target``, unless it is gone or was touched since the scan."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if max(stat.st_mtime, stat.st_ctime) >= min_age:
+        return False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(path, str(target))
+    return True
+
+
+def _cache_replay_ids(directory: Path) -> List[UUID]:
+    """Replay IDs of the cache directories under ``directory``."""
+    replay_ids = []
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return replay_ids
+    for entry in entries:
+        try:
+            replay_id = UUID(entry.name)
+        except ValueError:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            replay_ids.append(replay_id)
+    return replay_ids
+
+
+def _decode_row_cursor(value: Optional[List[str]]) -> Optional[Tuple[str, UUID]]:
+    if not value:
+        return None
+    try:
+        return value[0], UUID(value[1])
+    except (ValueError, IndexError, TypeError):
+        return None
@@ -0,0 +1,247 @@
+"""
+Nachos Replay for Guaca - Rendition Service
+Builds cached fast-forward "review" renditions of recordings.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Dict, Any, List, Optional
+from weakref import WeakValueDictionary
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay
+from app.services.replay_service import ReplayService
+from app.utils.layout import replay_cache_dir
+from app.utils.guacamole import (
+    DEFAULT_LAYER, LAYER_STATE_OPCODES, Instruction, InstructionReader, KeyframeTracker,
+    drawing_layer, encode_instruction, sync_timestamp
+)
+
+logger = logging.getLogger(__name__)
+
+# Intervalo entre quadros da rendição, em tempo de reprodução (10 fps)
+REVIEW_FRAME_MS = 100
+
+# Limite de bytes acumulados numa janela antes de forçar o flush
+MAX_WINDOW_BYTES = 16 * 1024 * 1024
+
+
+class RenditionError(Exception):
+    """Raised when a rendition cannot be produced."""
+
+
+class ReviewRenditionBuilder:
+    """
+    Stream a recording into a review rendition for ``speed``x playback.
+    
+    Frames falling in the same window of ``speed * REVIEW_FRAME_MS`` original
+    milliseconds are merged into one: intermediate syncs are dropped, only the
+    last ``mouse`` survives, and default-layer drawing superseded by a full
+    repaint inside the window is discarded. Timestamps are divided by
+    ``speed`` and idle gaps are capped, so playing the rendition at 1x skims
+    the session at the target speed. Memory is bounded by one window.
+    """
+    
+    def __init__(self, out: BinaryIO, speed: int, idle_cap_ms: int):
+        self.out = out
+        self.speed = speed
+        self.window_ms = speed * REVIEW_FRAME_MS
+        self.idle_cap_ms = idle_cap_ms
+        
+        self.tracker = KeyframeTracker()
+        self.window: List[Instruction] = []
+        self.window_bytes = 0
+        self.window_start_ts: Optional[int] = None
+        self.pending_ts: Optional[int] = None
+        self.last_flush_ts: Optional[int] = None
+        self.out_ts: Optional[int] = None
+        
+        self.skip_streams = set()
+        self.stats = {
+            "speed": speed,
+            "input_bytes": 0,
+            "output_bytes": 0,
+            "input_frames": 0,
+            "output_frames": 0,
+            "dropped_instructions": 0,
+        }
+    
+    def build(self, fileobj: BinaryIO) -> Dict[str, Any]:
+        for instruction in InstructionReader(fileobj):
+            self.stats["input_bytes"] += len(instruction.raw)
+            self._feed(instruction)
+        self._flush()
+        return self.stats
+    
+    def _feed(self, instruction: Instruction):
+        opcode, args = instruction.opcode, instruction.args
+        
+        # Áudio não faz sentido em alta velocidade
+        if opcode == "audio" and args:
+            self.skip_streams.add(args[0])
+        if opcode in ("audio", "blob", "end") and args and args[0] in self.skip_streams:
+            if opcode == "end":
+                self.skip_streams.discard(args[0])
+            self.stats["dropped_instructions"] += 1
+            return
+        
+        ts = sync_timestamp(instruction)
+        if ts is not None:
+            self.stats["input_frames"] += 1
+            if self.window_start_ts is None:
+                self.window_start_ts = ts
+            self.pending_ts = ts
+            if ts - self.window_start_ts >= self.window_ms or self.window_bytes >= MAX_WINDOW_BYTES:
+                self._flush()
+            return
+        
+        keyframe = self.tracker.feed(instruction)
+        if keyframe is not None:
+            self._drop_superseded(keyframe)
+        
+        self.window.append(instruction)
+        self.window_bytes += len(instruction.raw)
+    
+    def _drop_superseded(self, keyframe_offset: int):
+        """Remove default-layer drawing in the window hidden by a full repaint."""
+        # Não descartar nada antes de uma leitura da camada padrão (copy para buffer)
+        floor = 0
+        for index, instruction in enumerate(self.window):
+            if instruction.offset >= keyframe_offset:
+                break
+            if (instruction.opcode in ("copy", "transfer") and instruction.args
+                    and instruction.args[0] == DEFAULT_LAYER
+                    and drawing_layer(instruction) != DEFAULT_LAYER):
+                floor = index + 1
+        
+        kept = self.window[:floor]
+        dropped_streams = set()
+        for instruction in self.window[floor:]:
+            if instruction.offset < keyframe_offset and instruction.opcode not in LAYER_STATE_OPCODES:
+                if drawing_layer(instruction) == DEFAULT_LAYER:
+                    if instruction.opcode == "img":
+                        dropped_streams.add(instruction.args[0])
+                    continue
+                if (instruction.opcode in ("blob", "end") and instruction.args
+                        and instruction.args[0] in dropped_streams):
+                    if instruction.opcode == "end":
+                        dropped_streams.discard(instruction.args[0])
+                    continue
+            kept.append(instruction)
+        
+        self.stats["dropped_instructions"] += len(self.window) - len(kept)
+        self.window = kept
+        self.window_bytes = sum(len(i.raw) for i in kept)
+    
+    def _flush(self):
+        """Emit the merged window followed by one retimed sync."""
+        if self.pending_ts is None and not self.window:
+            return
+        
+        last_mouse = None
+        for index, instruction in enumerate(self.window):
+            if instruction.opcode == "mouse":
+                last_mouse = index
+        
+        for index, instruction in enumerate(self.window):
+            if instruction.opcode == "mouse" and index != last_mouse:
+                self.stats["dropped_instructions"] += 1
+                continue
+            self._write(instruction.raw)
+        
+        if self.pending_ts is not None:
+            if self.out_ts is None:
+                self.out_ts = self.pending_ts
+            else:
+                gap = (self.pending_ts - self.last_flush_ts) // self.speed
+                self.out_ts += max(min(gap, self.idle_cap_ms), 0)
+            self.last_flush_ts = self.pending_ts
+            self._write(encode_instruction("sync", self.out_ts))
+            self.stats["output_frames"] += 1
+        
+        self.window = []
+        self.window_bytes = 0
+        self.window_start_ts = None
+        self.pending_ts = None
+    
+    def _write(self, data: bytes):
+        self.out.write(data)
+        self.stats["output_bytes"] += len(data)
+
+
+class RenditionService:
+    """Service for cached review renditions of replays."""
+    
+    # Um lock por rendição enquanto alguém o usa ou espera por ele
+    _locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.replay_service = ReplayService(db)
+    
+    @staticmethod
+    def allowed_speeds() -> List[int]:
+        return [int(s) for s in settings.rendition_speeds.split(",") if s.strip()]
+    
+    def rendition_path(self, replay: Replay, speed: int) -> Path:
+        return replay_cache_dir("renditions", replay.id) / f"review-{speed}x.guac"
+    
+    async def get_rendition(self, replay: Replay, speed: int) -> Path:
+        """
+        Return the cached rendition for ``speed``, building it if needed. A
+        rendition belongs to the content it was built from (its checksum),
+        so tier moves and recompression keep it and new content rebuilds it.
+        """
+        if speed not in self.allowed_speeds():
+            raise RenditionError(f"Unsupported review speed: {speed}x")
+        
+        target = self.rendition_path(replay, speed)
+        lock = self._locks.setdefault(str(target), asyncio.Lock())
+        source = _source_key(replay)
+        
+        async with lock:
+            built = (replay.metadata_json or {}).get("renditions", {}).get(f"{speed}x") or {}
+            if built.get("source") == source and await asyncio.to_thread(target.exists):
+                return target
+            
+            stats = await asyncio.to_thread(self._build, replay, speed, target)
+            stats["source"] = source
+            
+            renditions = dict((replay.metadata_json or {}).get("renditions", {}))
+            renditions[f"{speed}x"] = stats
+            replay.metadata_json = {**(replay.metadata_json or {}), "renditions": renditions}
+            
+            logger.info(
+                f"Built {speed}x rendition of {replay.filename}: "
+                f"{stats['input_bytes']} -> {stats['output_bytes']} bytes"
+            )
+            return target
+    
+    def _build(self, replay: Replay, speed: int, target: Path) -> Dict[str, Any]:
+        """Build a rendition into ``target`` atomically (runs in a worker thread)."""
+        source = self.replay_service.open_replay_data(replay)
+        if source is None:
+            raise FileNotFoundError(replay.stored_path)
+        
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=target.parent, suffix=".part")
+        try:
+            with source, os.fdopen(fd, "wb") as out:
+                builder = ReviewRenditionBuilder(out, speed, settings.rendition_idle_cap_ms)
+                stats = builder.build(source)
+            os.replace(tmp_name, target)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        
+        return stats
+
+
+def _source_key(replay: Replay) -> str:
+    """Identity of the content a rendition is built from."""
+    return replay.checksum_sha256 or replay.stored_path or ""
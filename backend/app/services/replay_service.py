@@ -4,24 +4,56 @@ Handles replay file management, monitoring, and storage.
 """
 import os
 import shutil
-import gzip
 import logging
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
-from typing import Optional, List, Dict, Any, BinaryIO
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Any, BinaryIO, Tuple
 from uuid import UUID
 import json
 import re
+import asyncio
 
-from sqlalchemy import select, func, and_, or_
+from sqlalchemy import select, func, and_, or_, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
 from app.models import Replay, ReplayStatus, User
 from app.schemas import ReplaySearch, ReplayCreate, PaginationParams
+from app.services.blob_service import BlobService
+from app.services.chunk_store_service import ChunkStoreService
+from app.services.dictionary_service import DictionaryService, select_dictionary
+from app.services.integrity_service import IntegrityService, get_hash_pool
+from app.services.restore_cache_service import get_restore_cache_service
+from app.services.job_progress import (
+    get_job_registry, load_checkpoint, save_checkpoint, clear_checkpoint, decode_cursor, encode_cursor
+)
+from app.utils.compression import (
+    SeekableGzipReader, compress_file, compressed_suffix, is_random_access, open_recording
+)
+from app.utils.chunk_store import MANIFEST_SUFFIX, ChunkedReader
+from app.utils.storage import (
+    delete_location, get_tier_backend, is_packed, is_remote, location_exists, location_size, tier_key
+)
+from app.utils.filename_templates import get_filename_templates
+from app.utils.hash_tree import HashTree, hash_content
+from app.utils.layout import recording_dir, remove_replay_caches
+from app.utils.guacamole import (
+    GuacamoleParseError, RawInstructionReader, RecordingHeader, TailReport,
+    scan_tail, sniff_header, sync_timestamp
+)
 
 logger = logging.getLogger(__name__)
 
+# Timestamp de uma instrução sync (4.sync,13.1700000000000;)
+SYNC_PATTERN = re.compile(rb"4\.sync,\d+\.(\d+)[,;]")
+SYNC_PROBE_BYTES = 64 * 1024
+
+# Campos que o cabeçalho pode preencher (tamanho das colunas em Replay)
+HEADER_FIELD_LIMITS = {"username": 100, "hostname": 255, "connection_name": 255}
+
+ARCHIVAL_JOB = "archival"
+
 
 class ReplayService:
     """Service for replay file operations."""
@@ -64,7 +96,7 @@ class ReplayService:
                 replay = await self.import_replay(file_path)
                 if replay:
                     imported.append(replay.filename)
-                    
+            
             except Exception as e:
                 logger.error(f"Error processing {file_path}: {e}")
         
@@ -73,26 +105,29 @@ class ReplayService:
     async def import_replay(self, source_file: Path) -> Optional[Replay]:
         """Import a single replay file into the system."""
         try:
-            # Parse filename for metadata
-            metadata = self._parse_replay_filename(source_file.name)
+            # Metadados do template de nome e do cabeçalho da gravação
+            metadata = await self._extract_metadata(source_file)
             
-            # Create storage directory structure: hot/YYYY/MM/ (novos replays vão para HOT)
-            now = datetime.now(timezone.utc)
-            target_dir = self.storage_path / "hot" / str(now.year) / f"{now.month:02d}"
-            target_dir.mkdir(parents=True, exist_ok=True)
+            # Checksum e árvore de hashes por bloco, numa só leitura
+            checksum, tree = await self._hash_content(source_file)
+            
+            # Gravação já armazenada (cópia renomeada): compartilhar o arquivo
+            blob = await BlobService(self.db).find(checksum)
             
-            # Copy file to storage
+            # Create storage directory structure: hot/YYYY/MM/<shards>/ (novos replays vão para HOT)
+            now = datetime.now(timezone.utc)
+            target_dir = recording_dir("hot", now, source_file.name)
             target_file = target_dir / source_file.name
-            shutil.copy2(source_file, target_file)
+            stored_location = str(target_file)
+            if blob is None:
+                # Copy file to storage (local ou bucket do tier HOT)
+                stored_location = await self.store_in_tier(source_file, target_file, "hot", move=False)
             
             # Get file info
-            file_stats = target_file.stat()
+            file_stats = source_file.stat()
             
             # Try to extract duration from replay file
-            duration = await self._extract_replay_duration(target_file)
-            
-            # Calculate checksum
-            checksum = await self._calculate_checksum(target_file)
+            duration = await self._extract_replay_duration(source_file)
             
             # Import StorageTier
             from app.models import StorageTier
@@ -101,7 +136,7 @@ class ReplayService:
             replay = Replay(
                 filename=source_file.name,
                 original_path=str(source_file),
-                stored_path=str(target_file),
+                stored_path=stored_location,
                 session_name=metadata.get("session_name"),
                 owner_username=metadata.get("username"),
                 client_ip=metadata.get("client_ip"),
@@ -118,9 +153,16 @@ class ReplayService:
                 checksum_sha256=checksum,
                 is_compressed=False,
                 original_size=file_stats.st_size,
-                metadata_json=metadata
+                metadata_json={
+                    **metadata,
+                    "timestamp": metadata["timestamp"].isoformat() if metadata.get("timestamp") else None
+                }
             )
             
+            if blob is not None:
+                BlobService.share(replay, blob)
+                logger.info(f"{source_file.name} has the same content as {blob.filename}, sharing its file")
+            
             # Try to link to existing user
             if metadata.get("username"):
                 user_result = await self.db.execute(
@@ -132,127 +174,185 @@ class ReplayService:
             
             self.db.add(replay)
             await self.db.flush()
+            if tree is not None:
+                await IntegrityService(self.db).save_hash_tree(replay, tree)
+            await self.validate_replay(replay)
+            await self.analyze_replay(replay)
             
             logger.info(f"Imported replay: {source_file.name}")
             return replay
-            
+        
         except Exception as e:
             logger.error(f"Failed to import replay {source_file}: {e}")
             return None
     
-    def _parse_replay_filename(self, filename: str) -> Dict[str, Any]:
+    async def store_in_tier(self, source_file: Path, target_file: Path, tier: str, move: bool = True) -> str:
         """
-        Parse Guacamole replay filename for metadata.
-        
-        Formatos suportados:
-        - username_protocol_hostname_timestamp.guac
-        - username_connectionname_timestamp.guac
-        - connectionid_timestamp.guac
-        - protocol-hostname_timestamp.guac
+        Store a local file at ``target_file`` (a path under the storage
+        root) in the backend of ``tier``. Returns its location.
+        """
+        backend = get_tier_backend(tier)
+        return await asyncio.to_thread(backend.put, source_file, tier_key(target_file), move)
+    
+    def _parse_replay_filename(self, source_file: Path) -> Dict[str, Any]:
+        """
+        Parse the recording filename with the templates configured for its
+        recordings root (see app/utils/filename_templates.py).
         """
-        metadata = {
-            "original_filename": filename,
-            "session_name": filename.replace(".guac", "")
+        metadata: Dict[str, Any] = {
+            "original_filename": source_file.name,
+            "session_name": source_file.name.replace(".guac", "")
         }
         
-        name_without_ext = filename.replace(".guac", "")
-        parts = name_without_ext.split("_")
-        
-        # Tentar detectar protocolo por padrões conhecidos
-        protocols = ["rdp", "ssh", "vnc", "telnet", "kubernetes"]
-        detected_protocol = None
-        
-        for part in parts:
-            part_lower = part.lower()
-            for proto in protocols:
-                if proto in part_lower:
-                    detected_protocol = proto.upper()
-                    # Tentar extrair hostname após o protocolo
-                    if "-" in part:
-                        # Formato: protocol-hostname
-                        proto_parts = part.split("-", 1)
-                        if len(proto_parts) > 1:
-                            metadata["hostname"] = proto_parts[1]
-                    break
-            if detected_protocol:
-                break
-        
-        if detected_protocol:
-            metadata["protocol"] = detected_protocol
-        
-        if len(parts) >= 2:
-            # Primeiro elemento geralmente é username
-            metadata["username"] = parts[0]
-            
-            # Se temos mais de 2 partes, a do meio pode ser connection_name ou hostname
-            if len(parts) >= 3:
-                middle_part = parts[1]
-                
-                # Verificar se é um hostname (contém pontos ou parece ser IP)
-                if "." in middle_part or re.match(r'^[\d]+$', middle_part):
-                    metadata["hostname"] = middle_part
-                else:
-                    metadata["connection_name"] = middle_part
-            
-            # Tentar parsear timestamp do último elemento
-            try:
-                timestamp_str = parts[-1]
-                if len(timestamp_str) == 13:  # Milliseconds
-                    metadata["timestamp"] = datetime.fromtimestamp(
-                        int(timestamp_str) / 1000, tz=timezone.utc
-                    )
-                elif len(timestamp_str) == 10:  # Seconds
-                    metadata["timestamp"] = datetime.fromtimestamp(
-                        int(timestamp_str), tz=timezone.utc
-                    )
-            except (ValueError, OSError):
-                pass
+        try:
+            relative = PurePosixPath(source_file.relative_to(self.source_path).as_posix())
+        except ValueError:
+            relative = PurePosixPath(source_file.name)
         
+        matched = get_filename_templates().match(relative)
+        if matched:
+            metadata.update(matched)
+        else:
+            logger.debug(f"No filename template matches {relative}")
         return metadata
     
+    async def _extract_metadata(self, source_file: Path) -> Dict[str, Any]:
+        """
+        Session metadata from the filename template and the recording header.
+        Only the first ``replay_header_sniff_bytes`` of the file are read.
+        """
+        metadata = self._parse_replay_filename(source_file)
+        
+        header = await self.read_header(source_file)
+        if header is None:
+            return metadata
+        metadata["header"] = header.to_dict()
+        
+        # O cabeçalho completa o que o nome do arquivo não traz
+        hints = {**header.arguments, "connection_name": header.name}
+        for field, limit in HEADER_FIELD_LIMITS.items():
+            if not metadata.get(field) and hints.get(field):
+                metadata[field] = hints[field][:limit]
+        if not metadata.get("timestamp") and header.first_sync_ts:
+            metadata["timestamp"] = datetime.fromtimestamp(header.first_sync_ts / 1000, tz=timezone.utc)
+        return metadata
+    
+    async def read_header(self, file_path: Path) -> Optional[RecordingHeader]:
+        """Sniff the recording header; None if unreadable."""
+        try:
+            return await asyncio.to_thread(sniff_header, str(file_path), settings.replay_header_sniff_bytes)
+        except OSError as e:
+            logger.debug(f"Could not read header of {file_path}: {e}")
+            return None
+    
     async def _extract_replay_duration(self, file_path: Path) -> int:
         """
-        Extract duration from Guacamole replay file.
-        The format is: timestamp.instruction;
-        We find the last timestamp to get duration.
+        Estimate the duration from the first and last ``sync`` timestamps,
+        reading only the head and tail of the file. The import analysis
+        replaces it with the exact value.
         """
         try:
-            duration = 0
-            
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                # Read in chunks from the end
+            with open(file_path, 'rb') as f:
+                head = f.read(SYNC_PROBE_BYTES)
                 f.seek(0, 2)
-                file_size = f.tell()
-                
-                # Read last 10KB
-                read_size = min(10240, file_size)
-                f.seek(max(0, file_size - read_size))
-                content = f.read()
-                
-                # Find timestamps (format: timestamp.instruction)
-                timestamps = re.findall(r'^(\d+)\.\w+', content, re.MULTILINE)
-                
-                if timestamps:
-                    duration = int(timestamps[-1]) // 1000  # Convert ms to seconds
-            
-            return duration
+                f.seek(max(0, f.tell() - SYNC_PROBE_BYTES))
+                tail = f.read()
             
+            first = SYNC_PATTERN.search(head)
+            last = SYNC_PATTERN.findall(tail)
+            if first and last:
+                return max(int(last[-1]) - int(first.group(1)), 0) // 1000
+            return 0
+        
         except Exception as e:
             logger.debug(f"Could not extract duration from {file_path}: {e}")
             return 0
     
-    async def _calculate_checksum(self, file_path: Path) -> str:
-        """Calculate SHA-256 checksum for a file."""
-        import hashlib
+    async def _hash_content(self, file_path: Path) -> Tuple[str, Optional[HashTree]]:
+        """SHA-256 and hash tree of a file, in a worker thread (blocks hashed in parallel)."""
         try:
-            sha256_hash = hashlib.sha256()
-            with open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    sha256_hash.update(chunk)
-            return sha256_hash.hexdigest()
+            return await asyncio.to_thread(hash_content, str(file_path), None, get_hash_pool())
         except Exception as e:
             logger.debug(f"Could not calculate checksum for {file_path}: {e}")
-            return ""
+            return "", None
+    
+    async def validate_replay(self, replay: Replay) -> Dict[str, Any]:
+        """
+        Check that the recording ends with a complete instruction and store
+        the result in ``metadata_json["integrity"]``. The file is never
+        modified; a damaged tail is cut at the last complete ``sync`` when
+        streaming (see ``repair_offset``).
+        """
+        try:
+            integrity = await asyncio.to_thread(self._check_tail, replay)
+        except OSError as e:
+            logger.warning(f"Could not validate replay {replay.filename}: {e}")
+            return {"status": "unknown"}
+        
+        integrity["checked_at"] = datetime.now(timezone.utc).isoformat()
+        replay.metadata_json = {**(replay.metadata_json or {}), "integrity": integrity}
+        
+        if integrity["status"] != "ok":
+            logger.warning(
+                f"Replay {replay.filename} is {integrity['status']}: "
+                f"{integrity['trailing_bytes']} trailing bytes after offset {integrity['valid_bytes']}"
+            )
+        return integrity
+    
+    def _check_tail(self, replay: Replay) -> Dict[str, Any]:
+        source = open_recording(replay.stored_path)
+        
+        if is_random_access(source):
+            # Arquivo simples, sgzip ou em chunks: só o final é lido (e descomprimido)
+            with source:
+                if isinstance(source, (SeekableGzipReader, ChunkedReader)):
+                    size = source.size
+                else:
+                    size = location_size(replay.stored_path)
+                report = scan_tail(source, size)
+        else:
+            # gzip/zstd comuns não permitem ler de trás para frente: varredura completa
+            with source:
+                reader = RawInstructionReader(source)
+                report = None
+                last_sync_end = last_sync_ts = None
+                try:
+                    for instruction in reader:
+                        ts = sync_timestamp(instruction)
+                        if ts is not None:
+                            last_sync_end, last_sync_ts = instruction.offset + instruction.size, ts
+                except GuacamoleParseError:
+                    report = TailReport(reader.offset, 0, last_sync_end, last_sync_ts, True)
+                if report is None:
+                    report = TailReport(reader.offset, reader.trailing_bytes, last_sync_end, last_sync_ts, False)
+        
+        if report is None:
+            return {"status": "unreadable", "valid_bytes": 0, "trailing_bytes": 0, "repair_offset": None}
+        
+        if report.malformed:
+            status = "malformed"
+        elif report.trailing_bytes:
+            status = "truncated"
+        else:
+            status = "ok"
+        
+        return {
+            "status": status,
+            "valid_bytes": report.valid_end,
+            "trailing_bytes": report.trailing_bytes,
+            "last_sync_ts": report.last_sync_ts,
+            # Offset no conteúdo descomprimido, que é o que o stream serve
+            "repair_offset": report.last_sync_end if status != "ok" else None,
+        }
+    
+    async def analyze_replay(self, replay: Replay):
+        """Compute statistics, activity histogram and transcript of a new replay (best effort)."""
+        from app.services.analysis_service import AnalysisService
+        
+        try:
+            await AnalysisService(self.db).analyze_replay(replay)
+        except Exception as e:
+            logger.warning(f"Failed to analyze replay {replay.filename}: {e}")
     
     async def get_replay(self, replay_id: UUID) -> Optional[Replay]:
         """Get a single replay by ID."""
@@ -364,27 +464,42 @@ class ReplayService:
         return list(replays), total
     
     async def get_replay_file(self, replay: Replay) -> Optional[BinaryIO]:
-        """Get replay file for streaming."""
+        """
+        Get the (decompressed) replay for streaming. Plain and seekable
+        archives support cheap seeks for range requests (see is_random_access).
+        """
+        return await asyncio.to_thread(self.open_replay_data, replay)
+    
+    def open_replay_data(self, replay: Replay) -> Optional[BinaryIO]:
+        """
+        Open the (decompressed) recording for reading in a worker thread.
+        Seeking into an ``sgzip`` archive decompresses only the frames read.
+        """
         if not replay.stored_path:
             return None
         
-        file_path = Path(replay.stored_path)
-        
-        if not file_path.exists():
-            logger.error(f"Replay file not found: {file_path}")
+        if not location_exists(replay.stored_path):
+            logger.error(f"Replay file not found: {replay.stored_path}")
             return None
         
-        return open(file_path, 'rb')
+        return open_recording(replay.stored_path)
     
     async def delete_replay(self, replay: Replay, hard_delete: bool = False) -> bool:
         """Delete or archive a replay."""
         try:
             if hard_delete:
-                # Remove file
-                if replay.stored_path:
-                    file_path = Path(replay.stored_path)
-                    if file_path.exists():
-                        file_path.unlink()
+                # Remove file, unless other replays share it
+                if replay.stored_path and not await BlobService(self.db).count_references(
+                    replay.stored_path, exclude_id=replay.id
+                ):
+                    if replay.stored_path.endswith(MANIFEST_SUFFIX):
+                        # Chunks sem outras referências ficam para o coletor de lixo
+                        await ChunkStoreService(self.db).release_manifest(replay.stored_path)
+                    await asyncio.to_thread(delete_location, replay.stored_path)
+                    await asyncio.to_thread(get_restore_cache_service().discard, replay.stored_path)
+                
+                # Rendições e miniaturas são do replay, mesmo com o arquivo compartilhado
+                await asyncio.to_thread(remove_replay_caches, replay.id)
                 
                 # Remove database record
                 await self.db.delete(replay)
@@ -394,62 +509,178 @@ class ReplayService:
             
             await self.db.flush()
             return True
-            
+        
         except Exception as e:
             logger.error(f"Failed to delete replay {replay.id}: {e}")
             return False
     
-    async def archive_old_replays(self) -> int:
-        """Archive replays older than retention period."""
-        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.retention_days)
+    async def archive_old_replays(self, batch_size: Optional[int] = None) -> int:
+        """
+        Archive replays older than retention period.
         
-        result = await self.db.execute(
-            select(Replay).where(
-                and_(
-                    Replay.status == ReplayStatus.ACTIVE,
-                    Replay.imported_at < cutoff
-                )
-            )
-        )
-        replays = result.scalars().all()
+        Replays are read in keyset pages ordered by (imported_at, id) and
+        compressed in a process pool, keeping at most ``archive_max_inflight_mb``
+        of source files in flight. Each page is committed with a checkpoint,
+        so the event loop stays free and an interrupted night resumes where
+        it stopped. Progress is reported in the job registry.
+        """
+        batch_size = batch_size or settings.archive_batch_size
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.retention_days)
+        progress = get_job_registry().start(ARCHIVAL_JOB)
+        checkpoint = await load_checkpoint(self.db, ARCHIVAL_JOB)
+        # Gravações pequenas usam o dicionário zstd do protocolo
+        dictionaries = await DictionaryService(self.db).get_latest_ids()
+        after = decode_cursor(checkpoint.get("after"))
+        if after is not None:
+            logger.info(f"Resuming archival after {checkpoint['after']}")
         
         archived_count = 0
-        
-        for replay in replays:
-            try:
-                # Compress file if enabled
-                if settings.archive_enabled and replay.stored_path:
-                    await self._compress_replay(replay)
+        try:
+            while True:
+                conditions = [Replay.status == ReplayStatus.ACTIVE, Replay.imported_at < cutoff]
+                if after is not None:
+                    conditions.append(tuple_(Replay.imported_at, Replay.id) > tuple_(*after))
+                result = await self.db.execute(
+                    select(Replay)
+                    .where(and_(*conditions))
+                    .order_by(Replay.imported_at, Replay.id)
+                    .limit(batch_size)
+                )
+                replays = list(result.scalars().all())
+                if not replays:
+                    break
                 
-                replay.status = ReplayStatus.ARCHIVED
-                archived_count += 1
+                archived, failed, nbytes, originals = await self._archive_batch(replays, progress, dictionaries)
+                archived_count += archived
                 
-            except Exception as e:
-                logger.error(f"Failed to archive replay {replay.id}: {e}")
-        
-        await self.db.flush()
-        logger.info(f"Archived {archived_count} old replays")
+                after = (replays[-1].imported_at, replays[-1].id)
+                await save_checkpoint(self.db, ARCHIVAL_JOB, {"after": encode_cursor(after)})
+                await self.db.commit()
+                await asyncio.to_thread(_remove_originals, originals)
+                progress.add_batch(archived, failed, nbytes)
+            
+            await clear_checkpoint(self.db, ARCHIVAL_JOB)
+            await self.db.commit()
+            progress.finish()
         
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        
+        metrics = progress.to_dict()
+        logger.info(
+            f"Archived {archived_count} old replays "
+            f"({progress.failed} failed, {metrics['mb_per_second']} MB/s)"
+        )
         return archived_count
     
-    async def _compress_replay(self, replay: Replay):
-        """Compress a replay file with gzip."""
-        if not replay.stored_path:
-            return
-        
-        source = Path(replay.stored_path)
-        if not source.exists():
-            return
-        
-        target = source.with_suffix('.guac.gz')
-        
-        with open(source, 'rb') as f_in:
-            with gzip.open(target, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+    async def compress_replays(self, replays: List[Replay], progress) -> Tuple[int, int, int]:
+        """
+        Compress replays in place, keeping their tier and status (used by the
+        storage quota), and commit; returns (compressed, failed, source bytes).
+        """
+        dictionaries = await DictionaryService(self.db).get_latest_ids()
+        compressed, failed, nbytes, originals = await self._archive_batch(
+            replays, progress, dictionaries, archive=False
+        )
+        await self.db.commit()
+        await asyncio.to_thread(_remove_originals, originals)
+        return compressed, failed, nbytes
+    
+    async def _archive_batch(
+        self,
+        replays: List[Replay],
+        progress,
+        dictionaries: Optional[Dict[str, int]] = None,
+        archive: bool = True
+    ) -> Tuple[int, int, int, List[str]]:
+        """
+        Compress and archive one page; returns (archived, failed, source bytes,
+        originals). The uncompressed originals are left in place for the caller
+        to remove once the page is committed: until then the rows point to them.
+        With ``archive=False`` the replays are only compressed.
+        """
+        loop = asyncio.get_running_loop()
+        pool = get_archive_pool()
+        budget = settings.archive_max_inflight_mb * 1024 * 1024
+        pending: Dict[asyncio.Future, Tuple[Replay, int, Optional[int]]] = {}
+        # Arquivos compartilhados (mesmo conteúdo) são comprimidos uma só vez
+        compressed: List[Tuple[str, Replay]] = []
+        seen_paths = set()
+        inflight = 0
+        archived = failed = nbytes = 0
+        
+        async def drain(until_bytes: int):
+            nonlocal inflight, archived, failed, nbytes
+            while pending and inflight > until_bytes:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    replay, size, dictionary_id = pending.pop(future)
+                    inflight -= size
+                    try:
+                        target, original_size, compressed_size = future.result()
+                    except Exception as e:
+                        failed += 1
+                        progress.error(f"{replay.filename}: {e}")
+                        logger.error(f"Failed to archive replay {replay.id}: {e}")
+                        continue
+                    compressed.append((replay.stored_path, replay))
+                    replay.stored_path = target
+                    replay.is_compressed = True
+                    replay.original_size = original_size
+                    replay.file_size = compressed_size
+                    replay.compression_dict_id = dictionary_id
+                    if archive:
+                        replay.status = ReplayStatus.ARCHIVED
+                    archived += 1
+                    nbytes += original_size
+                    progress.count("compressed")
+                    progress.count("bytes_saved", max(original_size - compressed_size, 0))
+                    if dictionary_id:
+                        progress.count("dictionary")
         
-        # Update stored path and remove original
-        replay.stored_path = str(target)
-        source.unlink()
+        for replay in replays:
+            # Objetos em storage remoto não são baixados para recompressão; membros de packs são imutáveis
+            remote = bool(replay.stored_path) and is_remote(replay.stored_path)
+            packed = bool(replay.stored_path) and is_packed(replay.stored_path)
+            source = Path(replay.stored_path) if replay.stored_path and not remote and not packed else None
+            compress = (
+                (settings.archive_enabled or not archive) and source is not None
+                and not replay.is_compressed and replay.stored_path not in seen_paths
+                and source.exists()
+            )
+            if source is not None:
+                seen_paths.add(replay.stored_path)
+            if not compress:
+                if remote:
+                    progress.count("remote")
+                elif packed:
+                    progress.count("packed")
+                elif source is not None and not source.exists():
+                    progress.count("missing")
+                if archive:
+                    replay.status = ReplayStatus.ARCHIVED
+                    archived += 1
+                continue
+            
+            size = source.stat().st_size
+            # Espera liberar espaço no orçamento (um arquivo maior que ele passa sozinho)
+            await drain(max(budget - size, 0))
+            dictionary_id = select_dictionary(dictionaries or {}, replay.protocol, size)
+            future = loop.run_in_executor(pool, _compress_file, str(source), dictionary_id)
+            pending[future] = (replay, size, dictionary_id)
+            inflight += size
+        
+        await drain(-1)
+        
+        blobs = BlobService(self.db)
+        for old_path, replay in compressed:
+            await blobs.relocate(old_path, replay)
+        return archived, failed, nbytes, [old_path for old_path, _ in compressed]
     
     async def get_storage_stats(self) -> Dict[str, Any]:
         """Get storage statistics."""
@@ -495,3 +726,46 @@ class ReplayService:
             "disk_free_bytes": disk_free,
             "max_storage_bytes": settings.max_storage_gb * 1024 * 1024 * 1024
         }
+
+
+_archive_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_archive_pool() -> ProcessPoolExecutor:
+    """Get the process pool used to compress archived replays."""
+    global _archive_pool
+    if _archive_pool is None:
+        _archive_pool = ProcessPoolExecutor(max_workers=max(1, settings.archive_workers))
+    return _archive_pool
+
+
+def shutdown_archive_pool():
+    global _archive_pool
+    if _archive_pool is not None:
+        _archive_pool.shutdown(wait=False, cancel_futures=True)
+        _archive_pool = None
+
+
+def _compress_file(source_path: str, dictionary_id: Optional[int] = None) -> Tuple[str, int, int]:
+    """
+    Compress a replay next to itself with the configured codec (zstd with
+    ``dictionary_id``, if given); runs in the archive pool, one thread per
+    file since the pool already compresses files in parallel. The original
+    stays until the batch commits (see _remove_originals); a target left by
+    an interrupted run is overwritten. Returns (target path, original size,
+    compressed size).
+    """
+    source = Path(source_path)
+    target = source.with_name(source.name + compressed_suffix("zstd" if dictionary_id else None))
+    original_size = source.stat().st_size
+    compressed_size = compress_file(source, target, threads=1, dictionary_id=dictionary_id)
+    return str(target), original_size, compressed_size
+
+
+def _remove_originals(paths: List[str]):
+    """Remove the originals of a committed batch of compressed replays."""
+    for path in paths:
+        try:
+            Path(path).unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {e}")
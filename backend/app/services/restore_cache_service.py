@@ -0,0 +1,296 @@
+"""
+Nachos Replay for Guaca - Restore Cache Service
+Keeps decompressed copies of COLD replays on fast local disk.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Set
+
+from app.config import settings
+from app.models import Replay, StorageTier
+from app.utils.compression import open_recording
+
+logger = logging.getLogger(__name__)
+
+RESTORE_SUFFIX = ".guac"
+PARTIAL_SUFFIX = ".part"
+COPY_SIZE = 1024 * 1024
+
+# Restaurações recentes usadas nas métricas de latência
+LATENCY_SAMPLES = 512
+
+
+class RestoreCacheService:
+    """
+    Read-through cache of restored COLD recordings.
+    
+    COLD recordings may sit on slow media and be compressed, chunked or
+    packed, so every view pays to fetch and decompress them. The first
+    stream of one is served from the tier as usual while a worker thread
+    restores it, decompressed, into ``restore_cache_path``; later streams
+    open that plain copy, which also answers Range requests directly.
+    
+    Entries are keyed by stored location (a recording never changes in
+    place; a tier move or repack gives it a new one) and evicted least
+    recently used to stay within ``restore_cache_budget_mb``. The copy is
+    checked against the replay's checksum before it is published. The index
+    is rebuilt from the directory on first use and hits touch the file, so
+    the order survives restarts and is shared, loosely, between workers.
+    """
+    
+    def __init__(self):
+        self.enabled = settings.restore_cache_enabled
+        self.root = Path(settings.restore_cache_path or Path(settings.replay_storage_path) / "restore-cache")
+        self.budget_bytes = settings.restore_cache_budget_mb * 1024 * 1024
+        
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._restoring: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self._metrics = {
+            "hits": 0,
+            "misses": 0,
+            "restores": 0,
+            "restore_failures": 0,
+            "bytes_restored": 0,
+            "evictions": 0,
+            "skipped_budget": 0,
+        }
+    
+    def applies(self, replay: Replay) -> bool:
+        return bool(self.enabled and replay.stored_path and replay.storage_tier == StorageTier.COLD)
+    
+    async def open(self, replay: Replay) -> Optional[BinaryIO]:
+        """
+        Open the restored copy of a COLD replay. On a miss, schedule its
+        restore and return None: the caller streams from the tier meanwhile.
+        """
+        if not self.applies(replay):
+            return None
+        
+        handle = await asyncio.to_thread(self._lookup, _cache_key(replay.stored_path))
+        if handle is None:
+            self._schedule(replay)
+        return handle
+    
+    def discard(self, stored_path: Optional[str]):
+        """Drop the restored copy of a location (its file was deleted)."""
+        if not self.enabled or not stored_path:
+            return
+        key = _cache_key(stored_path)
+        with self._lock:
+            self._bytes -= self._entries.pop(key, 0)
+        _unlink(self._path(key))
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return hit/miss counters, restore latency and current budget usage."""
+        with self._lock:
+            metrics = dict(self._metrics)
+            latencies = sorted(self._latencies)
+            lookups = metrics["hits"] + metrics["misses"]
+            metrics.update({
+                "enabled": self.enabled,
+                "hit_ratio": metrics["hits"] / lookups if lookups else 0.0,
+                "cached_files": len(self._entries),
+                "cached_bytes": self._bytes,
+                "budget_bytes": self.budget_bytes,
+                "in_flight": len(self._restoring),
+            })
+        
+        metrics["restore_latency_ms"] = {
+            "samples": len(latencies),
+            "avg": int(sum(latencies) / len(latencies)) if latencies else 0,
+            "p50": _percentile(latencies, 0.5),
+            "p95": _percentile(latencies, 0.95),
+            "max": latencies[-1] if latencies else 0,
+        }
+        return metrics
+    
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}{RESTORE_SUFFIX}"
+    
+    def _lookup(self, key: str) -> Optional[BinaryIO]:
+        """Open a cached copy and mark it recently used (runs in a worker thread)."""
+        self._load()
+        path = self._path(key)
+        try:
+            handle = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._entries.pop(key, 0)
+                self._metrics["misses"] += 1
+            return None
+        
+        try:
+            os.utime(handle.fileno())
+        except OSError:
+            pass
+        victims = []
+        with self._lock:
+            self._metrics["hits"] += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Restaurado por outro worker
+                victims = self._admit(key, os.fstat(handle.fileno()).st_size)
+        self._evict(victims)
+        return handle
+    
+    def _schedule(self, replay: Replay):
+        """Restore a replay in a worker thread without blocking the caller."""
+        key = _cache_key(replay.stored_path)
+        expected = replay.original_size or replay.file_size or 0
+        with self._lock:
+            if key in self._restoring:
+                return
+            if expected > self.budget_bytes:
+                self._metrics["skipped_budget"] += 1
+                return
+            self._restoring.add(key)
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            with self._lock:
+                self._restoring.discard(key)
+            return
+        
+        task = loop.create_task(
+            asyncio.to_thread(self._restore, replay.stored_path, key, replay.checksum_sha256)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _restore(self, stored_path: str, key: str, checksum: Optional[str]):
+        """Decompress a recording into the cache, publishing it only once complete."""
+        start = time.monotonic()
+        path = self._path(key)
+        temp = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=path.parent, suffix=PARTIAL_SUFFIX)
+            sha256 = hashlib.sha256()
+            size = 0
+            with open_recording(stored_path) as source, os.fdopen(fd, "wb") as out:
+                while True:
+                    data = source.read(COPY_SIZE)
+                    if not data:
+                        break
+                    sha256.update(data)
+                    out.write(data)
+                    size += len(data)
+            if checksum and sha256.hexdigest() != checksum:
+                raise ValueError("restored content does not match the replay checksum")
+            if size > self.budget_bytes:
+                with self._lock:
+                    self._metrics["skipped_budget"] += 1
+                return
+            os.replace(temp, path)
+            temp = None
+        except Exception as e:
+            logger.warning(f"Could not restore {stored_path} into the cache: {e}")
+            with self._lock:
+                self._metrics["restore_failures"] += 1
+            return
+        finally:
+            if temp is not None:
+                _unlink(Path(temp))
+            with self._lock:
+                self._restoring.discard(key)
+        
+        with self._lock:
+            self._metrics["restores"] += 1
+            self._metrics["bytes_restored"] += size
+            self._latencies.append(int((time.monotonic() - start) * 1000))
+            self._bytes -= self._entries.pop(key, 0)
+            victims = self._admit(key, size)
+        self._evict(victims)
+    
+    def _admit(self, key: str, size: int) -> List[str]:
+        """Add an entry; returns the least recently used keys to evict for it (lock held)."""
+        self._entries[key] = size
+        self._bytes += size
+        victims = []
+        while self._bytes > self.budget_bytes and len(self._entries) > 1:
+            oldest, oldest_size = self._entries.popitem(last=False)
+            self._bytes -= oldest_size
+            self._metrics["evictions"] += 1
+            victims.append(oldest)
+        return victims
+    
+    def _evict(self, victims: List[str]):
+        # Quem já abriu a cópia continua lendo: o arquivo só some no último close
+        for key in victims:
+            _unlink(self._path(key))
+    
+    def _load(self):
+        """Index the copies left on disk by earlier runs, oldest access first."""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        
+        found = []
+        for path in self.root.glob("*/*"):
+            try:
+                if path.name.endswith(PARTIAL_SUFFIX):
+                    # Restauração interrompida
+                    path.unlink()
+                elif path.name.endswith(RESTORE_SUFFIX):
+                    stat = path.stat()
+                    found.append((stat.st_mtime, path.name[:-len(RESTORE_SUFFIX)], stat.st_size))
+            except OSError:
+                continue
+        
+        victims = []
+        with self._lock:
+            # Mais antigos à frente, antes dos restaurados nesta execução
+            for _, key, size in sorted(found, reverse=True):
+                if key not in self._entries:
+                    self._entries[key] = size
+                    self._entries.move_to_end(key, last=False)
+                    self._bytes += size
+            while self._bytes > self.budget_bytes and self._entries:
+                oldest, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                self._metrics["evictions"] += 1
+                victims.append(oldest)
+        self._evict(victims)
+
+
+def _cache_key(stored_path: str) -> str:
+    return hashlib.sha256(stored_path.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def _percentile(values: List[int], fraction: float) -> int:
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _unlink(path: Path):
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+_restore_cache_service: Optional[RestoreCacheService] = None
+
+
+def get_restore_cache_service() -> RestoreCacheService:
+    """Get the process-wide restore cache."""
+    global _restore_cache_service
+    if _restore_cache_service is None:
+        _restore_cache_service = RestoreCacheService()
+    return _restore_cache_service
@@ -0,0 +1,391 @@
+"""
+Nachos Replay for Guaca - Thumbnail Service
+Renders poster frames and hover-preview sprite sheets of recordings.
+
+Rendering decodes images and composites the default layer, which is CPU and
+memory heavy, so it runs in a separate process pool whose workers have an
+address-space limit: a pathological recording kills its worker, not the API.
+"""
+import asyncio
+import base64
+import io
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+from weakref import WeakValueDictionary
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import Replay, ReplayStatus
+from app.utils.compression import open_recording
+from app.utils.layout import replay_cache_dir
+from app.utils.storage import location_exists
+from app.utils.guacamole import DEFAULT_LAYER, InstructionReader, sync_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Limite de pixels somando todas as camadas/buffers mantidos por um worker
+MAX_TOTAL_PIXELS = 64 * 1024 * 1024
+
+# Limite de dados base64 acumulados por stream de imagem
+MAX_STREAM_CHARS = 32 * 1024 * 1024
+
+THUMBNAIL_KINDS = ("poster", "sprite")
+
+
+class ThumbnailError(Exception):
+    """Raised when thumbnails cannot be rendered for a recording."""
+
+
+class LayerCompositor:
+    """
+    Minimal Guacamole display model for thumbnail rendering.
+    
+    Tracks layers and buffers as RGBA images and applies the instructions
+    that put pixels on them: ``img``/``blob``/``end`` streams, legacy
+    ``png``/``jpeg``, ``rect``+``cfill`` and ``copy``. Paths other than
+    rectangles, transforms and channel masks are not modeled; the result is
+    good enough to recognize a screen, not pixel exact.
+    """
+    
+    def __init__(self):
+        from PIL import Image
+        
+        self._Image = Image
+        self.layers: Dict[str, Any] = {}
+        self.streams: Dict[str, Dict[str, Any]] = {}
+        self.rects: Dict[str, tuple] = {}
+        self.total_pixels = 0
+    
+    def feed(self, opcode: str, args: List[str]):
+        handler = getattr(self, f"_op_{opcode}", None)
+        if handler is not None:
+            try:
+                handler(args)
+            except (ValueError, IndexError, OSError, self._Image.DecompressionBombError):
+                # Instrução ou imagem inválida: ignorar, como faria o cliente
+                pass
+    
+    def snapshot(self, width: int):
+        """Default layer scaled to ``width`` (RGB), or None if nothing drawn yet."""
+        layer = self.layers.get(DEFAULT_LAYER)
+        if layer is None:
+            return None
+        height = max(1, round(layer.height * width / layer.width))
+        return layer.convert("RGB").resize((width, height), self._Image.BILINEAR)
+    
+    def _layer(self, name: str, width: int = 0, height: int = 0):
+        layer = self.layers.get(name)
+        if layer is None and width > 0 and height > 0:
+            if self.total_pixels + width * height > MAX_TOTAL_PIXELS:
+                return None
+            layer = self._Image.new("RGBA", (width, height), (0, 0, 0, 255 if name == DEFAULT_LAYER else 0))
+            self.layers[name] = layer
+            self.total_pixels += width * height
+        return layer
+    
+    def _put(self, layer_name: str, mask: str, x: int, y: int, image):
+        layer = self._layer(layer_name, x + image.width, y + image.height)
+        if layer is None:
+            return
+        image = image.convert("RGBA")
+        if mask == "12":
+            layer.paste(image, (x, y))
+        else:
+            layer.paste(image, (x, y), image)
+    
+    def _op_size(self, args):
+        name, width, height = args[0], int(args[1]), int(args[2])
+        old = self.layers.pop(name, None)
+        if old is not None:
+            self.total_pixels -= old.width * old.height
+        layer = self._layer(name, width, height)
+        if layer is not None and old is not None:
+            layer.paste(old, (0, 0))
+    
+    def _op_dispose(self, args):
+        old = self.layers.pop(args[0], None)
+        if old is not None:
+            self.total_pixels -= old.width * old.height
+    
+    def _op_img(self, args):
+        stream, mask, layer, _mimetype, x, y = args[:6]
+        self.streams[stream] = {
+            "mask": mask, "layer": layer, "x": int(x), "y": int(y),
+            "chunks": [], "size": 0,
+        }
+    
+    def _op_blob(self, args):
+        pending = self.streams.get(args[0])
+        if pending is None:
+            return
+        pending["size"] += len(args[1])
+        if pending["size"] > MAX_STREAM_CHARS:
+            del self.streams[args[0]]
+            return
+        pending["chunks"].append(args[1])
+    
+    def _op_end(self, args):
+        pending = self.streams.pop(args[0], None)
+        if pending is None or not pending["chunks"]:
+            return
+        data = base64.b64decode("".join(pending["chunks"]))
+        image = self._Image.open(io.BytesIO(data))
+        self._put(pending["layer"], pending["mask"], pending["x"], pending["y"], image)
+    
+    def _op_png(self, args):
+        mask, layer, x, y, data = args[:5]
+        image = self._Image.open(io.BytesIO(base64.b64decode(data)))
+        self._put(layer, mask, int(x), int(y), image)
+    
+    _op_jpeg = _op_png
+    
+    def _op_rect(self, args):
+        self.rects[args[0]] = tuple(int(v) for v in args[1:5])
+    
+    def _op_cfill(self, args):
+        mask, layer_name = args[0], args[1]
+        rect = self.rects.get(layer_name)
+        layer = self.layers.get(layer_name)
+        if rect is None or layer is None:
+            return
+        x, y, w, h = rect
+        color = tuple(int(v) for v in args[2:6])
+        fill = self._Image.new("RGBA", (max(w, 1), max(h, 1)), color)
+        self._put(layer_name, "12" if color[3] == 255 else mask, x, y, fill)
+    
+    def _op_copy(self, args):
+        src_name, sx, sy, w, h, mask, dst_name, dx, dy = args[:9]
+        source = self.layers.get(src_name)
+        if source is None:
+            return
+        sx, sy, w, h = int(sx), int(sy), int(w), int(h)
+        region = source.crop((sx, sy, sx + w, sy + h))
+        self._put(dst_name, mask, int(dx), int(dy), region)
+
+
+def _limit_worker_memory(limit_mb: int):
+    """Process pool initializer: cap the worker's address space."""
+    if limit_mb <= 0:
+        return
+    try:
+        import resource
+        
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def render_thumbnails(
+    source_path: str,
+    out_dir: str,
+    duration_ms: int,
+    count: int,
+    columns: int,
+    tile_width: int,
+    poster_width: int
+) -> Dict[str, Any]:
+    """
+    Render ``poster.jpg`` and ``sprite.jpg`` into ``out_dir`` (runs in a worker process).
+    
+    Tiles are taken at the middle of ``count`` equal slices of the session;
+    the poster is the middle tile at a larger size. One forward pass.
+    """
+    from PIL import Image
+    
+    # Imagens maiores que o limite de pixels são tratadas como bomba de descompressão
+    Image.MAX_IMAGE_PIXELS = MAX_TOTAL_PIXELS
+    
+    count = max(count, 1)
+    slice_ms = max(duration_ms, 0) / count
+    targets = [int((i + 0.5) * slice_ms) for i in range(count)]
+    poster_index = count // 2
+    
+    compositor = LayerCompositor()
+    tiles: List[Any] = []
+    poster = None
+    first_ts: Optional[int] = None
+    
+    try:
+        with open_recording(source_path) as source:
+            for instruction in InstructionReader(source):
+                ts = sync_timestamp(instruction)
+                if ts is None:
+                    compositor.feed(instruction.opcode, instruction.args)
+                    continue
+                
+                if first_ts is None:
+                    first_ts = ts
+                while len(tiles) < count and ts - first_ts >= targets[len(tiles)]:
+                    if len(tiles) == poster_index:
+                        poster = compositor.snapshot(poster_width)
+                    tiles.append(compositor.snapshot(tile_width))
+                
+                if len(tiles) >= count:
+                    break
+    except MemoryError:
+        raise ThumbnailError("Thumbnail worker exceeded its memory limit")
+    
+    # Gravação mais curta que o previsto: completar com o último quadro
+    while len(tiles) < count:
+        if len(tiles) == poster_index:
+            poster = compositor.snapshot(poster_width)
+        tiles.append(compositor.snapshot(tile_width))
+    
+    reference = next((t for t in tiles if t is not None), None)
+    if reference is None:
+        raise ThumbnailError("Recording has no drawable default layer")
+    
+    tile_height = reference.height
+    columns = max(1, min(columns, count))
+    rows = (count + columns - 1) // columns
+    sprite = Image.new("RGB", (tile_width * columns, tile_height * rows))
+    for index, tile in enumerate(tiles):
+        if tile is not None:
+            sprite.paste(tile.resize((tile_width, tile_height)), ((index % columns) * tile_width, (index // columns) * tile_height))
+    
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    _save_atomic(sprite, out / "sprite.jpg")
+    _save_atomic(poster or reference, out / "poster.jpg")
+    
+    return {
+        "count": count,
+        "columns": columns,
+        "rows": rows,
+        "tile_width": tile_width,
+        "tile_height": tile_height,
+        "timestamps_ms": targets,
+    }
+
+
+def _save_atomic(image, target: Path):
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            image.save(out, format="JPEG", quality=80, optimize=True)
+        os.replace(tmp_name, target)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+_thumbnail_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_thumbnail_pool() -> ProcessPoolExecutor:
+    """Get the process pool used for rendering."""
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        _thumbnail_pool = ProcessPoolExecutor(
+            max_workers=settings.thumbnail_workers,
+            initializer=_limit_worker_memory,
+            initargs=(settings.thumbnail_worker_memory_mb,),
+            # Reciclar workers limita a fragmentação de memória do Pillow
+            max_tasks_per_child=50,
+        )
+    return _thumbnail_pool
+
+
+def shutdown_thumbnail_pool():
+    global _thumbnail_pool
+    if _thumbnail_pool is not None:
+        _thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+        _thumbnail_pool = None
+
+
+class ThumbnailService:
+    """Service for cached poster frames and sprite sheets."""
+    
+    # Um lock por replay enquanto alguém o usa ou espera por ele
+    _locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+    
+    def thumbnail_dir(self, replay: Replay) -> Path:
+        return replay_cache_dir("thumbnails", replay.id)
+    
+    async def get_thumbnail(self, replay: Replay, kind: str) -> Path:
+        """Return the poster or sprite of ``replay``, rendering it if needed."""
+        if kind not in THUMBNAIL_KINDS:
+            raise ThumbnailError(f"Unknown thumbnail kind: {kind}")
+        
+        target = self.thumbnail_dir(replay) / f"{kind}.jpg"
+        if target.exists() and "thumbnails" in (replay.metadata_json or {}):
+            return target
+        
+        await self.render(replay)
+        return target
+    
+    async def render(self, replay: Replay) -> Dict[str, Any]:
+        """Render the thumbnails of ``replay`` in the process pool."""
+        out_dir = self.thumbnail_dir(replay)
+        lock = self._locks.setdefault(str(out_dir), asyncio.Lock())
+        
+        async with lock:
+            existing = (replay.metadata_json or {}).get("thumbnails")
+            if existing and (out_dir / "sprite.jpg").exists():
+                return existing
+            
+            if not location_exists(replay.stored_path):
+                raise FileNotFoundError(replay.stored_path)
+            
+            loop = asyncio.get_running_loop()
+            try:
+                info = await loop.run_in_executor(
+                    get_thumbnail_pool(),
+                    render_thumbnails,
+                    replay.stored_path,
+                    str(out_dir),
+                    (replay.duration_seconds or 0) * 1000,
+                    settings.thumbnail_count,
+                    settings.thumbnail_columns,
+                    settings.thumbnail_width,
+                    settings.thumbnail_poster_width,
+                )
+            except BrokenProcessPool:
+                # Worker morto (ex.: limite de memória): recriar o pool na próxima vez
+                shutdown_thumbnail_pool()
+                raise ThumbnailError("Thumbnail worker died while rendering")
+            
+            info["rendered_at"] = datetime.now(timezone.utc).isoformat()
+            replay.metadata_json = {**(replay.metadata_json or {}), "thumbnails": info}
+            await self.db.flush()
+            
+            logger.info(f"Rendered thumbnails for {replay.filename}")
+            return info
+    
+    async def render_pending(self, limit: int) -> int:
+        """Render thumbnails for active replays that do not have them yet."""
+        result = await self.db.execute(
+            select(Replay)
+            .where(
+                Replay.status == ReplayStatus.ACTIVE,
+                ~Replay.metadata_json.has_key("thumbnails"),
+                ~Replay.metadata_json.has_key("thumbnails_error"),
+            )
+            .order_by(Replay.imported_at.desc())
+            .limit(limit)
+        )
+        
+        rendered = 0
+        for replay in result.scalars().all():
+            try:
+                await self.render(replay)
+                rendered += 1
+            except Exception as e:
+                # Não tentar de novo a cada execução (worker morto, arquivo inválido...)
+                logger.warning(f"Failed to render thumbnails for {replay.filename}: {e}")
+                replay.metadata_json = {**(replay.metadata_json or {}), "thumbnails_error": str(e)[:500]}
+        
+        return rendered
@@ -0,0 +1,314 @@
+"""
+Nachos Replay for Guaca - Transcript Service
+Extracts typed text and clipboard content from recordings for full-text search.
+"""
+import asyncio
+import base64
+import logging
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Any, List, Optional
+
+from sqlalchemy import select, delete, func, or_, and_, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Replay, ReplayStatus, ReplayTranscriptSegment
+from app.services.replay_service import ReplayService
+from app.utils.guacamole import RawInstruction, RawInstructionReader, sync_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Pausa de digitação que encerra um segmento
+SEGMENT_PAUSE_MS = 5000
+MAX_SEGMENT_CHARS = 1000
+MAX_CLIPBOARD_CHARS = 64 * 1024
+
+# Mesma configuração da coluna gerada tsv (ver ReplayTranscriptSegment)
+TS_CONFIG = literal_column("'simple'::regconfig")
+
+# Keysyms X11 de teclas especiais
+SPECIAL_KEYSYMS = {
+    0xFF09: "\t", 0xFF1B: "<Esc>", 0xFFFF: "<Del>", 0xFF63: "<Ins>",
+    0xFF50: "<Home>", 0xFF57: "<End>", 0xFF55: "<PgUp>", 0xFF56: "<PgDn>",
+    0xFF51: "<Left>", 0xFF52: "<Up>", 0xFF53: "<Right>", 0xFF54: "<Down>",
+    0xFF80: " ", 0xFFAA: "*", 0xFFAB: "+", 0xFFAD: "-", 0xFFAE: ".", 0xFFAF: "/",
+}
+SPECIAL_KEYSYMS.update({0xFFB0 + n: str(n) for n in range(10)})         # KP_0..KP_9
+SPECIAL_KEYSYMS.update({0xFFBE + n: f"<F{n + 1}>" for n in range(12)})  # F1..F12
+
+KEYSYM_BACKSPACE = 0xFF08
+KEYSYMS_ENTER = {0xFF0D, 0xFF8D}
+
+MODIFIER_KEYSYMS = {
+    0xFFE1: "Shift", 0xFFE2: "Shift",
+    0xFFE3: "Ctrl", 0xFFE4: "Ctrl",
+    0xFFE7: "Meta", 0xFFE8: "Meta",
+    0xFFE9: "Alt", 0xFFEA: "Alt",
+    0xFFEB: "Super", 0xFFEC: "Super",
+}
+COMBO_MODIFIERS = ("Ctrl", "Alt", "Meta", "Super")
+
+
+def keysym_to_text(keysym: int) -> Optional[str]:
+    """Character produced by a keysym, or a ``<Name>`` token for special keys."""
+    if 0x20 <= keysym <= 0x7E or 0xA0 <= keysym <= 0xFF:
+        return chr(keysym)
+    if 0x01000000 <= keysym <= 0x0110FFFF:
+        return chr(keysym - 0x01000000)
+    return SPECIAL_KEYSYMS.get(keysym)
+
+
+@dataclass
+class TranscriptSegment:
+    offset_ms: int
+    kind: str
+    text: str
+
+
+class TranscriptExtractor:
+    """
+    Rebuild typed text from ``key`` instructions and text clipboard streams.
+    
+    Keystrokes are grouped into lines: Enter, a pause in typing or a
+    clipboard event closes the current segment. Backspace edits the line
+    being typed, and key combinations are kept as tokens like ``<Ctrl+C>``,
+    so the transcript reads like what the user meant to type.
+    """
+    
+    OPCODES = {"key", "clipboard", "blob", "end"}
+    
+    def __init__(self):
+        self.segments: List[TranscriptSegment] = []
+        self.first_ts: Optional[int] = None
+        self.current_ts = 0
+        self.pressed_modifiers: Dict[int, str] = {}
+        self.clipboard_streams: Dict[str, List[str]] = {}
+        self._line: List[str] = []
+        self._line_start = 0
+        self._last_key_ts = 0
+    
+    def feed(self, opcode: str, args: List[str], ts: Optional[int] = None):
+        if ts is not None:
+            if self.first_ts is None:
+                self.first_ts = ts
+            self.current_ts = ts
+        elif opcode == "key" and len(args) >= 2:
+            self._key(args)
+        elif opcode == "clipboard" and len(args) >= 2:
+            if args[1].startswith("text/"):
+                self.clipboard_streams[args[0]] = []
+        elif opcode == "blob" and len(args) >= 2 and args[0] in self.clipboard_streams:
+            self.clipboard_streams[args[0]].append(args[1])
+        elif opcode == "end" and args and args[0] in self.clipboard_streams:
+            self._clipboard(self.clipboard_streams.pop(args[0]))
+    
+    def feed_raw(self, instruction: RawInstruction, ts: Optional[int] = None):
+        """Like feed(), decoding arguments only for the instructions used."""
+        if ts is not None:
+            self.feed("sync", [], ts)
+            return
+        opcode = instruction.opcode
+        if opcode not in self.OPCODES or not instruction.arg_count:
+            return
+        if opcode in ("blob", "end") and instruction.arg(0) not in self.clipboard_streams:
+            return
+        self.feed(opcode, instruction.args)
+    
+    def finish(self) -> List[TranscriptSegment]:
+        self._flush_line()
+        return self.segments
+    
+    def _relative(self, ts: int) -> int:
+        if self.first_ts is None:
+            self.first_ts = ts
+        return max(ts - self.first_ts, 0)
+    
+    def _key(self, args: List[str]):
+        try:
+            keysym, pressed = int(args[0]), args[1] == "1"
+            ts = int(args[2]) if len(args) >= 3 else self.current_ts
+        except ValueError:
+            return
+        
+        modifier = MODIFIER_KEYSYMS.get(keysym)
+        if modifier:
+            if pressed:
+                self.pressed_modifiers[keysym] = modifier
+            else:
+                self.pressed_modifiers.pop(keysym, None)
+            return
+        if not pressed:
+            return
+        
+        offset = self._relative(ts)
+        if self._line and offset - self._last_key_ts >= SEGMENT_PAUSE_MS:
+            self._flush_line()
+        self._last_key_ts = offset
+        
+        if keysym in KEYSYMS_ENTER:
+            self._flush_line()
+            return
+        if keysym == KEYSYM_BACKSPACE:
+            if self._line:
+                self._line.pop()
+            return
+        
+        text = keysym_to_text(keysym)
+        if text is None:
+            return
+        
+        held = set(self.pressed_modifiers.values())
+        combo = [m for m in COMBO_MODIFIERS if m in held]
+        if combo:
+            if "Shift" in held:
+                combo.append("Shift")
+            key_name = text.strip("<>") if len(text) > 1 else text.upper()
+            text = f"<{'+'.join(combo)}+{key_name}>"
+        
+        if not self._line:
+            self._line_start = offset
+        self._line.append(text)
+        if len(self._line) >= MAX_SEGMENT_CHARS:
+            self._flush_line()
+    
+    def _clipboard(self, chunks: List[str]):
+        self._flush_line()
+        try:
+            text = base64.b64decode("".join(chunks)).decode("utf-8", errors="replace")
+        except ValueError:
+            return
+        text = text[:MAX_CLIPBOARD_CHARS].strip()
+        if text:
+            self.segments.append(
+                TranscriptSegment(self._relative(self.current_ts), "clipboard", text)
+            )
+    
+    def _flush_line(self):
+        text = "".join(self._line).strip()
+        if text:
+            self.segments.append(TranscriptSegment(self._line_start, "keys", text))
+        self._line = []
+
+
+def extract_transcript(fileobj: BinaryIO) -> List[TranscriptSegment]:
+    """Single forward pass over a recording."""
+    extractor = TranscriptExtractor()
+    for instruction in RawInstructionReader(fileobj):
+        extractor.feed_raw(instruction, sync_timestamp(instruction))
+    return extractor.finish()
+
+
+class TranscriptService:
+    """Service for replay transcripts and content search."""
+    
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.replay_service = ReplayService(db)
+    
+    async def index_replay(self, replay: Replay) -> int:
+        """Extract and (re)index the transcript of a replay; returns segment count."""
+        segments = await asyncio.to_thread(self._extract, replay)
+        return await self.save_segments(replay, segments)
+    
+    async def save_segments(self, replay: Replay, segments: List[TranscriptSegment]) -> int:
+        """Replace the indexed transcript of a replay."""
+        await self.db.execute(
+            delete(ReplayTranscriptSegment).where(ReplayTranscriptSegment.replay_id == replay.id)
+        )
+        for segment in segments:
+            self.db.add(ReplayTranscriptSegment(
+                replay_id=replay.id,
+                offset_ms=segment.offset_ms,
+                kind=segment.kind,
+                text=segment.text,
+            ))
+        
+        replay.metadata_json = {
+            **(replay.metadata_json or {}),
+            "transcript_segments": len(segments),
+        }
+        await self.db.flush()
+        return len(segments)
+    
+    def _extract(self, replay: Replay) -> List[TranscriptSegment]:
+        source = self.replay_service.open_replay_data(replay)
+        if source is None:
+            return []
+        with source:
+            return extract_transcript(source)
+    
+    async def get_transcript(self, replay: Replay) -> List[ReplayTranscriptSegment]:
+        result = await self.db.execute(
+            select(ReplayTranscriptSegment)
+            .where(ReplayTranscriptSegment.replay_id == replay.id)
+            .order_by(ReplayTranscriptSegment.offset_ms)
+        )
+        return list(result.scalars().all())
+    
+    async def search(
+        self,
+        text: str,
+        user_id=None,
+        allowed_usernames: Optional[List[str]] = None,
+        limit: int = 20,
+        matches_per_replay: int = 20
+    ) -> List[Dict[str, Any]]:
+        """
+        Find replays whose transcript matches ``text`` (web search syntax,
+        e.g. ``"drop table"``), with the time offsets of each match.
+        """
+        tsquery = func.websearch_to_tsquery(TS_CONFIG, text)
+        
+        conditions = [Replay.status != ReplayStatus.DELETED]
+        if allowed_usernames is not None:
+            if allowed_usernames:
+                conditions.append(
+                    or_(
+                        Replay.owner_username.in_(allowed_usernames),
+                        Replay.owner_id == user_id
+                    )
+                )
+            else:
+                conditions.append(Replay.owner_id == user_id)
+        
+        matching = (
+            select(ReplayTranscriptSegment.replay_id)
+            .where(ReplayTranscriptSegment.tsv.op("@@")(tsquery))
+            .distinct()
+            .subquery()
+        )
+        result = await self.db.execute(
+            select(Replay)
+            .join(matching, matching.c.replay_id == Replay.id)
+            .where(and_(*conditions))
+            .order_by(Replay.session_start.desc().nulls_last())
+            .limit(limit)
+        )
+        replays = list(result.scalars().all())
+        if not replays:
+            return []
+        
+        headline = func.ts_headline(
+            TS_CONFIG, ReplayTranscriptSegment.text, tsquery,
+            "MaxWords=20, MinWords=5, StartSel=<<, StopSel=>>"
+        )
+        result = await self.db.execute(
+            select(
+                ReplayTranscriptSegment.replay_id,
+                ReplayTranscriptSegment.offset_ms,
+                ReplayTranscriptSegment.kind,
+                headline.label("snippet"),
+            )
+            .where(
+                ReplayTranscriptSegment.replay_id.in_([r.id for r in replays]),
+                ReplayTranscriptSegment.tsv.op("@@")(tsquery),
+            )
+            .order_by(ReplayTranscriptSegment.replay_id, ReplayTranscriptSegment.offset_ms)
+        )
+        
+        matches: Dict[Any, List[Dict[str, Any]]] = {}
+        for row in result:
+            bucket = matches.setdefault(row.replay_id, [])
+            if len(bucket) < matches_per_replay:
+                bucket.append({"offset_ms": row.offset_ms, "kind": row.kind, "snippet": row.snippet})
+        
+        return [{"replay": replay, "matches": matches.get(replay.id, [])} for replay in replays]
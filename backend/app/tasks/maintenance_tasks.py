@@ -3,19 +3,33 @@ Nachos Replay for Guaca - Maintenance Tasks
 Handles periodic maintenance operations for replay storage.
 """
 import os
-import gzip
+import asyncio
 import shutil
-import hashlib
 import logging
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
-from typing import List, Tuple
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
 from app.models import Replay, ReplayStatus, StorageTier
+from app.utils.chunk_store import MANIFEST_SUFFIX, ManifestSummary, missing_chunks, summarize_manifest
+from app.utils.compression import compress_file, compressed_suffix, frame_dictionary_id
+from app.utils.layout import recording_dir
+from app.utils.storage import (
+    WritableStorageBackend, delete_location, get_location_backend, get_tier_backend,
+    is_remote, location_exists, tier_key
+)
+from app.services.blob_service import BlobService
+from app.services.chunk_store_service import ChunkStoreService, store_recording
+from app.services.dictionary_service import DictionaryService, select_dictionary
+from app.services.integrity_service import FAILED_STATUSES, IntegrityService, hash_recording
+from app.services.job_progress import (
+    get_job_registry, load_checkpoint, save_checkpoint, clear_checkpoint, decode_cursor, encode_cursor
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +38,28 @@ HOT_TO_WARM_MONTHS = 4      # Mover para warm após 4 meses
 WARM_TO_COLD_YEARS = 2      # Mover para cold após 2 anos
 COMPRESSION_THRESHOLD = 2 * 1024 * 1024 * 1024  # 2GB em bytes
 
+TIER_MIGRATION_JOB = "tier_migration"
+MAX_REPORTED_ERRORS = 100
+
+
+class MovedFile(NamedTuple):
+    """Outcome of moving a replay file to another tier."""
+    path: Path
+    original_size: Optional[int]
+    compressed: bool
+    dictionary_id: Optional[int] = None
+    # Gravação dividida em chunks: o original só é removido após o commit
+    chunks: Optional[ManifestSummary] = None
+    source: Optional[Path] = None
+    # Local do arquivo num backend remoto (path é a cópia local enviada)
+    location: Optional[str] = None
+    # Locais substituídos, removidos só depois do commit
+    obsolete: Tuple[str, ...] = ()
+    
+    @property
+    def stored_location(self) -> str:
+        return self.location or str(self.path)
+
 
 class MaintenanceService:
     """Service for replay storage maintenance operations."""
@@ -32,11 +68,22 @@ class MaintenanceService:
         self.db = db
         self.storage_path = Path(settings.replay_storage_path)
     
-    async def run_tier_migration(self) -> dict:
+    async def run_tier_migration(self, batch_size: Optional[int] = None) -> dict:
         """
         Execute tier migration for all replays based on age.
+        
+        Candidates are read in keyset pages of ``tier_migration_batch_size``
+        ordered by (imported_at, id); each page is moved by a bounded thread
+        pool and committed with a checkpoint, so an interrupted run resumes
+        where it stopped and loses at most one batch of bookkeeping.
         Returns statistics about the migration.
         """
+        batch_size = batch_size or settings.tier_migration_batch_size
+        progress = get_job_registry().start(TIER_MIGRATION_JOB)
+        checkpoint = await load_checkpoint(self.db, TIER_MIGRATION_JOB)
+        if checkpoint:
+            logger.info(f"Retomando migração de tiers do checkpoint {checkpoint}")
+        
         stats = {
             "hot_to_warm": 0,
             "warm_to_cold": 0,
@@ -45,70 +92,196 @@ class MaintenanceService:
         }
         
         now = datetime.now(timezone.utc)
-        hot_cutoff = now - timedelta(days=HOT_TO_WARM_MONTHS * 30)
-        cold_cutoff = now - timedelta(days=WARM_TO_COLD_YEARS * 365)
-        
-        # Migrar HOT -> WARM (replays com mais de 4 meses)
-        hot_replays = await self._get_replays_for_tier_change(
-            StorageTier.HOT, 
-            hot_cutoff
-        )
+        phases = [
+            # (fase, tier atual, novo tier, corte, comprimir se grande)
+            ("hot_to_warm", StorageTier.HOT, StorageTier.WARM,
+             now - timedelta(days=HOT_TO_WARM_MONTHS * 30), False),
+            ("warm_to_cold", StorageTier.WARM, StorageTier.COLD,
+             now - timedelta(days=WARM_TO_COLD_YEARS * 365), True),
+        ]
         
-        for replay in hot_replays:
-            try:
-                await self._migrate_to_tier(replay, StorageTier.WARM)
-                stats["hot_to_warm"] += 1
-            except Exception as e:
-                error_msg = f"Erro ao migrar {replay.filename} para WARM: {e}"
-                logger.error(error_msg)
-                stats["errors"].append(error_msg)
+        # Na ida para COLD, gravações pequenas usam o dicionário zstd do protocolo
+        dictionaries = await DictionaryService(self.db).get_latest_ids()
         
-        # Migrar WARM -> COLD (replays com mais de 2 anos)
-        warm_replays = await self._get_replays_for_tier_change(
-            StorageTier.WARM,
-            cold_cutoff
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.tier_migration_workers),
+            thread_name_prefix="tier-migration"
         )
+        try:
+            for phase, current_tier, new_tier, cutoff, compress in phases:
+                after = decode_cursor(checkpoint.get(phase))
+                
+                while True:
+                    batch = await self._next_batch(current_tier, cutoff, after, batch_size)
+                    if not batch:
+                        break
+                    
+                    migrated, failed, moved_bytes, obsolete = await self._migrate_batch(
+                        batch, new_tier, compress, executor,
+                        dictionaries if compress else None, progress, stats
+                    )
+                    stats[phase] += migrated
+                    progress.count(phase, migrated)
+                    
+                    after = (batch[-1].imported_at, batch[-1].id)
+                    checkpoint[phase] = encode_cursor(after)
+                    await save_checkpoint(self.db, TIER_MIGRATION_JOB, checkpoint)
+                    await self.db.commit()
+                    progress.add_batch(migrated, failed, moved_bytes)
+                    await self._delete_obsolete(obsolete, executor)
+                    
+                    logger.debug(
+                        f"Migração {phase}: lote de {len(batch)} "
+                        f"({migrated} movidos, {failed} erros), "
+                        f"{progress.to_dict()['items_per_second']} arquivos/s"
+                    )
+                
+                checkpoint.pop(phase, None)
+            
+            await clear_checkpoint(self.db, TIER_MIGRATION_JOB)
+            await self.db.commit()
+            progress.finish()
         
-        for replay in warm_replays:
-            try:
-                compressed = await self._migrate_to_tier(
-                    replay, 
-                    StorageTier.COLD,
-                    compress_if_large=True
-                )
-                stats["warm_to_cold"] += 1
-                if compressed:
-                    stats["compressed"] += 1
-            except Exception as e:
-                error_msg = f"Erro ao migrar {replay.filename} para COLD: {e}"
-                logger.error(error_msg)
-                stats["errors"].append(error_msg)
-        
-        await self.db.commit()
+        except asyncio.CancelledError:
+            progress.finish("interrupted")
+            raise
+        except Exception as e:
+            progress.error(str(e))
+            progress.finish("failed")
+            raise
+        finally:
+            executor.shutdown(wait=False)
         
+        summary = progress.to_dict()
         logger.info(
             f"Migração de tiers concluída: "
             f"HOT->WARM: {stats['hot_to_warm']}, "
             f"WARM->COLD: {stats['warm_to_cold']}, "
-            f"Comprimidos: {stats['compressed']}"
+            f"Comprimidos: {stats['compressed']}, "
+            f"Erros: {progress.failed}, "
+            f"{summary['items_per_second']} arquivos/s, {summary['mb_per_second']} MB/s"
         )
         
         return stats
     
-    async def _get_replays_for_tier_change(
-        self, 
+    async def migrate_replays(
+        self,
+        replays: List[Replay],
+        new_tier: StorageTier,
+        progress
+    ) -> Tuple[int, int, int]:
+        """
+        Move ``replays`` to ``new_tier`` now, whatever their age (used by the
+        storage quota), and commit. Returns (migrated, failed, bytes moved).
+        """
+        compress = new_tier == StorageTier.COLD
+        dictionaries = await DictionaryService(self.db).get_latest_ids() if compress else None
+        stats = {"compressed": 0, "errors": []}
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, settings.tier_migration_workers),
+            thread_name_prefix="tier-migration"
+        )
+        try:
+            migrated, failed, moved_bytes, obsolete = await self._migrate_batch(
+                replays, new_tier, compress, executor, dictionaries, progress, stats
+            )
+            await self.db.commit()
+            await self._delete_obsolete(obsolete, executor)
+        finally:
+            executor.shutdown(wait=False)
+        return migrated, failed, moved_bytes
+    
+    async def _migrate_batch(
+        self,
+        batch: List[Replay],
+        new_tier: StorageTier,
+        compress: bool,
+        executor: ThreadPoolExecutor,
+        dictionaries: Optional[Dict[str, int]],
+        progress,
+        stats: Dict[str, Any]
+    ) -> Tuple[int, int, int, List[str]]:
+        """
+        Move one batch of replays to ``new_tier``, without committing.
+        Returns (migrated, failed, bytes moved, locations to delete once the
+        batch is committed).
+        """
+        # Um arquivo compartilhado por vários replays é movido uma vez
+        movers, seen_paths = [], set()
+        for replay in batch:
+            if replay.stored_path not in seen_paths:
+                movers.append(replay)
+            if replay.stored_path:
+                seen_paths.add(replay.stored_path)
+        old_paths = [replay.stored_path for replay in movers]
+        results = await asyncio.gather(*(
+            self._migrate_to_tier(replay, new_tier, compress, executor, dictionaries)
+            for replay in movers
+        ), return_exceptions=True)
+        
+        migrated = failed = moved_bytes = 0
+        chunked: List[Tuple[Replay, MovedFile]] = []
+        obsolete: List[str] = []
+        for replay, old_path, result in zip(movers, old_paths, results):
+            if isinstance(result, Exception):
+                failed += 1
+                error_msg = f"Erro ao migrar {replay.filename} para {new_tier.value.upper()}: {result}"
+                logger.error(error_msg)
+                progress.error(error_msg)
+                if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+                    stats["errors"].append(error_msg)
+                continue
+            if replay.storage_tier == new_tier:
+                migrated += 1
+                moved_bytes += replay.file_size or 0
+            if result is None:
+                continue
+            if result.compressed:
+                stats["compressed"] += 1
+                progress.count("compressed")
+            if result.chunks is not None:
+                chunked.append((replay, result))
+            obsolete.extend(result.obsolete)
+            if old_path:
+                progress.count("shared", await BlobService(self.db).relocate(old_path, replay))
+        
+        if chunked:
+            await self._reference_chunks(chunked, executor, progress)
+        return migrated, failed, moved_bytes, obsolete
+    
+    async def _delete_obsolete(self, locations: List[str], executor: ThreadPoolExecutor):
+        """
+        Remove the files replaced by a committed batch: originals of chunked
+        recordings, uploaded local copies and remote objects moved away.
+        """
+        loop = asyncio.get_running_loop()
+        for location in locations:
+            try:
+                await loop.run_in_executor(executor, delete_location, location)
+            except Exception as e:
+                logger.warning(f"Não foi possível remover {location}: {e}")
+    
+    async def _next_batch(
+        self,
         current_tier: StorageTier,
-        cutoff_date: datetime
+        cutoff_date: datetime,
+        after: Optional[Tuple[datetime, Any]],
+        batch_size: int
     ) -> List[Replay]:
-        """Get replays that should be moved to a different tier."""
+        """Next page of replays to move to a different tier, after ``after``."""
+        conditions = [
+            Replay.storage_tier == current_tier,
+            Replay.status == ReplayStatus.ACTIVE,
+            Replay.imported_at <= cutoff_date
+        ]
+        if after is not None:
+            conditions.append(tuple_(Replay.imported_at, Replay.id) > tuple_(*after))
+        
         result = await self.db.execute(
-            select(Replay).where(
-                and_(
-                    Replay.storage_tier == current_tier,
-                    Replay.status == ReplayStatus.ACTIVE,
-                    Replay.imported_at <= cutoff_date
-                )
-            )
+            select(Replay)
+            .where(and_(*conditions))
+            .order_by(Replay.imported_at, Replay.id)
+            .limit(batch_size)
         )
         return list(result.scalars().all())
     
@@ -116,108 +289,119 @@ class MaintenanceService:
         self, 
         replay: Replay, 
         new_tier: StorageTier,
-        compress_if_large: bool = False
-    ) -> bool:
+        compress_if_large: bool = False,
+        executor: Optional[ThreadPoolExecutor] = None,
+        dictionaries: Optional[Dict[str, int]] = None
+    ) -> Optional[MovedFile]:
         """
         Migrate a replay file to a new storage tier.
-        Returns True if file was compressed.
+        The file work runs in ``executor``; the record is updated here.
+        Small files are compressed with their protocol's entry in
+        ``dictionaries``, if any; large ones going to COLD are split into
+        deduplicated chunks (the caller references them and removes the
+        original). Returns how the file was moved, None if it wasn't.
         """
         if not replay.stored_path:
-            return False
+            return None
         
-        source_path = Path(replay.stored_path)
-        if not source_path.exists():
-            logger.warning(f"Arquivo não encontrado: {source_path}")
-            return False
-        
-        # Determinar novo caminho
+        # Determinar novo caminho: COLD por ano, HOT e WARM por ano/mês (+ shards)
         session_date = replay.session_start or replay.imported_at
-        if new_tier == StorageTier.COLD:
-            # Para COLD, apenas ano
-            target_dir = self.storage_path / "cold" / str(session_date.year)
-        else:
-            # Para HOT e WARM, ano/mês
-            target_dir = (
-                self.storage_path / new_tier.value / 
-                str(session_date.year) / f"{session_date.month:02d}"
-            )
+        target_dir = recording_dir(new_tier.value, session_date, PurePosixPath(replay.stored_path).name)
         
-        target_dir.mkdir(parents=True, exist_ok=True)
+        backend = get_tier_backend(new_tier.value)
+        size = replay.original_size or replay.file_size or 0
+        # O store de chunks é local: tiers em storage remoto recebem o arquivo inteiro
+        chunk = (
+            new_tier == StorageTier.COLD and settings.chunk_store_enabled
+            and backend.name == "local"
+            and size >= settings.chunk_store_min_file_kb * 1024
+            and not replay.stored_path.endswith(MANIFEST_SUFFIX)
+        )
+        dictionary_id = None
+        if dictionaries and not replay.is_compressed and not chunk:
+            dictionary_id = select_dictionary(dictionaries, replay.protocol, size)
         
-        # Verificar se deve comprimir
-        should_compress = (
-            compress_if_large and 
-            source_path.stat().st_size >= COMPRESSION_THRESHOLD and
-            not replay.is_compressed
+        loop = asyncio.get_running_loop()
+        moved = await loop.run_in_executor(
+            executor, _transfer_replay_file,
+            replay.stored_path, target_dir, self.storage_path / "staging",
+            compress_if_large and not replay.is_compressed,
+            dictionary_id, chunk, backend
         )
+        if moved is None:
+            logger.warning(f"Arquivo não encontrado: {replay.stored_path}")
+            return None
         
-        if should_compress:
-            target_path = target_dir / f"{source_path.name}.gz"
-            original_size = source_path.stat().st_size
-            
-            # Comprimir arquivo
-            with open(source_path, 'rb') as f_in:
-                with gzip.open(target_path, 'wb', compresslevel=6) as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            
-            # Remover original
-            source_path.unlink()
-            
-            # Atualizar registro
-            replay.stored_path = str(target_path)
+        replay.stored_path = moved.stored_location
+        if moved.compressed:
             replay.is_compressed = True
-            replay.original_size = original_size
-            replay.file_size = target_path.stat().st_size
+            replay.compression_dict_id = moved.dictionary_id
+            replay.original_size = moved.original_size or replay.original_size or replay.file_size
+            if moved.chunks is not None:
+                # Manifesto + chunks que esta gravação acrescentou ao store
+                replay.file_size = moved.chunks.manifest_size + moved.chunks.new_bytes
+            else:
+                replay.file_size = moved.path.stat().st_size
             
             logger.info(
                 f"Comprimido {replay.filename}: "
-                f"{original_size / 1024 / 1024:.1f}MB -> "
+                f"{replay.original_size / 1024 / 1024:.1f}MB -> "
                 f"{replay.file_size / 1024 / 1024:.1f}MB"
             )
-        else:
-            # Apenas mover o arquivo
-            target_path = target_dir / source_path.name
-            shutil.move(str(source_path), str(target_path))
-            replay.stored_path = str(target_path)
         
         # Atualizar tier
         replay.storage_tier = new_tier
         
-        return should_compress
+        return moved
+    
+    async def _reference_chunks(
+        self,
+        chunked: List[Tuple[Replay, MovedFile]],
+        executor: Optional[ThreadPoolExecutor],
+        progress
+    ):
+        """
+        Reference the chunks of the batch's new manifests, in the batch's
+        transaction. A chunk collected between being found in the store and
+        referenced here is written again from the original.
+        """
+        await ChunkStoreService(self.db).add_references(moved.chunks for _, moved in chunked)
+        
+        loop = asyncio.get_running_loop()
+        for replay, moved in chunked:
+            missing = await loop.run_in_executor(executor, missing_chunks, moved.chunks.chunks)
+            if not missing:
+                continue
+            if moved.source is None or not moved.source.exists():
+                raise RuntimeError(f"{replay.filename}: {len(missing)} chunks missing and no original to rebuild them")
+            logger.warning(f"Reescrevendo {len(missing)} chunks coletados de {replay.filename}")
+            await loop.run_in_executor(executor, store_recording, moved.source, moved.path)
+        
+        progress.count("chunked", len(chunked))
+        progress.count("chunked_bytes", sum(moved.chunks.size for _, moved in chunked))
+        progress.count("chunk_bytes_stored", sum(moved.chunks.new_bytes for _, moved in chunked))
     
     async def calculate_checksum(self, replay: Replay) -> str:
         """Calculate SHA-256 checksum for a replay file."""
         if not replay.stored_path:
             return ""
         
-        file_path = Path(replay.stored_path)
-        if not file_path.exists():
+        if not await asyncio.to_thread(location_exists, replay.stored_path):
             return ""
         
-        sha256_hash = hashlib.sha256()
-        
-        # Abrir como gzip se comprimido
-        if replay.is_compressed:
-            with gzip.open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    sha256_hash.update(chunk)
-        else:
-            with open(file_path, 'rb') as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    sha256_hash.update(chunk)
-        
-        checksum = sha256_hash.hexdigest()
+        # Descomprimir se comprimido (o codec é detectado pelo arquivo), numa thread
+        checksum, _ = await asyncio.to_thread(hash_recording, replay.stored_path)
         replay.checksum_sha256 = checksum
         
         return checksum
     
     async def verify_integrity(self, replay: Replay) -> bool:
-        """Verify replay file integrity using stored checksum."""
-        if not replay.checksum_sha256:
-            return True  # Sem checksum, assumir ok
-        
-        current_checksum = await self.calculate_checksum(replay)
-        return current_checksum == replay.checksum_sha256
+        """
+        Verify replay file integrity using stored checksum; the result is
+        recorded like the scrubber's (see IntegrityService).
+        """
+        check = await IntegrityService(self.db).check_replay(replay)
+        return check is None or check.status not in FAILED_STATUSES
     
     async def get_storage_stats(self) -> dict:
         """Get statistics about storage usage by tier."""
@@ -253,3 +437,105 @@ class MaintenanceService:
                 return f"{size_bytes:.1f} {unit}"
             size_bytes /= 1024
         return f"{size_bytes:.1f} PB"
+
+
+def _transfer_replay_file(
+    location: str,
+    target_dir: Path,
+    staging_dir: Path,
+    compress_if_large: bool,
+    dictionary_id: Optional[int],
+    chunk: bool,
+    backend: WritableStorageBackend
+) -> Optional[MovedFile]:
+    """
+    Move a replay file to another tier through the storage backends; runs
+    in a worker thread. A remote source is first downloaded to
+    ``staging_dir``; the file is then moved or compressed locally (see
+    _move_replay_file) and, if the tier lives in ``backend`` remotely,
+    uploaded there. The replaced remote object and the uploaded local copy
+    are returned in ``obsolete`` for the caller to delete after committing.
+    """
+    obsolete: List[str] = []
+    if is_remote(location):
+        source_path = staging_dir / PurePosixPath(location).name
+        if location_exists(location):
+            staging_dir.mkdir(parents=True, exist_ok=True)
+            get_location_backend(location).fetch(location, source_path)
+            obsolete.append(location)
+    else:
+        source_path = Path(location)
+    
+    moved = _move_replay_file(source_path, target_dir, compress_if_large, dictionary_id, chunk)
+    if moved is None:
+        return None
+    
+    if backend.name != "local":
+        # Envio multipart em paralelo; a cópia local sai junto com o original
+        uploaded = backend.put(moved.path, tier_key(moved.path), move=False)
+        moved = moved._replace(location=uploaded, obsolete=moved.obsolete + (str(moved.path),))
+    return moved._replace(obsolete=moved.obsolete + tuple(obsolete))
+
+
+def _move_replay_file(
+    source_path: Path,
+    target_dir: Path,
+    compress_if_large: bool,
+    dictionary_id: Optional[int] = None,
+    chunk: bool = False
+) -> Optional[MovedFile]:
+    """
+    Move (or compress, if large) a replay file into ``target_dir``; runs in a
+    worker thread. With ``dictionary_id`` a small file is compressed as zstd
+    with that dictionary; with ``chunk`` it is split into the chunk store
+    and replaced by a manifest, leaving the original for the caller to
+    remove. Returns None if the file is missing.
+    
+    A run interrupted after moving a file but before committing leaves the
+    file at its target; finding it there is treated as already moved.
+    """
+    plain_target = target_dir / source_path.name
+    compressed_target = target_dir / f"{source_path.name}{compressed_suffix()}"
+    dictionary_target = target_dir / f"{source_path.name}{compressed_suffix('zstd')}"
+    manifest_target = target_dir / f"{source_path.name}{MANIFEST_SUFFIX}"
+    
+    if not source_path.exists():
+        if plain_target.exists():
+            return MovedFile(plain_target, plain_target.stat().st_size, False)
+        for target in (compressed_target, dictionary_target):
+            if target.exists():
+                return MovedFile(target, None, True, frame_dictionary_id(target))
+        if manifest_target.exists():
+            summary = summarize_manifest(manifest_target)
+            return MovedFile(manifest_target, summary.size, True, chunks=summary)
+        return None
+    
+    target_dir.mkdir(parents=True, exist_ok=True)
+    original_size = source_path.stat().st_size
+    
+    if chunk:
+        # Chunks já comprimidos e compartilhados com outras gravações
+        summary = store_recording(source_path, manifest_target)
+        return MovedFile(
+            manifest_target, summary.size, True,
+            chunks=summary, source=source_path, obsolete=(str(source_path),)
+        )
+    
+    # Verificar se deve comprimir
+    if compress_if_large and original_size >= COMPRESSION_THRESHOLD:
+        # Arquivos grandes usam todos os núcleos (ARCHIVE_COMPRESSION=pgzip ou zstd)
+        compress_file(source_path, compressed_target)
+        
+        # Remover original
+        source_path.unlink()
+        return MovedFile(compressed_target, original_size, True)
+    
+    if dictionary_id is not None:
+        # Arquivos pequenos: zstd com o dicionário do protocolo, uma thread basta
+        compress_file(source_path, dictionary_target, threads=1, dictionary_id=dictionary_id)
+        source_path.unlink()
+        return MovedFile(dictionary_target, original_size, True, dictionary_id)
+    
+    # Apenas mover o arquivo
+    shutil.move(str(source_path), str(plain_target))
+    return MovedFile(plain_target, original_size, False)
@@ -33,7 +33,7 @@ async def scan_new_replays():
                 await db.commit()
             else:
                 logger.debug("No new replays found")
-                
+    
     except Exception as e:
         logger.error(f"Error scanning replays: {e}")
 
@@ -53,7 +53,7 @@ async def archive_old_replays():
             if count > 0:
                 logger.info(f"Archived {count} old replays")
                 await db.commit()
-                
+    
     except Exception as e:
         logger.error(f"Error archiving replays: {e}")
 
@@ -77,11 +77,159 @@ async def cleanup_expired_tokens():
             if result.rowcount > 0:
                 logger.info(f"Cleaned up {result.rowcount} expired tokens")
                 await db.commit()
-                
+    
     except Exception as e:
         logger.error(f"Error cleaning up tokens: {e}")
 
 
+async def migrate_storage_tiers():
+    """Move aged replays HOT -> WARM -> COLD, in resumable batches."""
+    logger.info("Starting storage tier migration...")
+    
+    try:
+        from app.database import async_session_maker
+        from app.tasks.maintenance_tasks import MaintenanceService
+        
+        async with async_session_maker() as db:
+            service = MaintenanceService(db)
+            stats = await service.run_tier_migration()
+            
+            if stats["errors"]:
+                logger.warning(f"Tier migration finished with {len(stats['errors'])} errors")
+    
+    except Exception as e:
+        logger.error(f"Error migrating storage tiers: {e}")
+
+
+async def train_compression_dictionaries():
+    """Train new zstd dictionaries for small recordings of each protocol."""
+    logger.info("Starting compression dictionary training...")
+    
+    try:
+        from app.database import async_session_maker
+        from app.services.dictionary_service import DictionaryService
+        
+        async with async_session_maker() as db:
+            service = DictionaryService(db)
+            trained = await service.train_all()
+            await db.commit()
+            
+            if trained:
+                logger.info(f"Trained {len(trained)} compression dictionaries")
+    
+    except Exception as e:
+        logger.error(f"Error training compression dictionaries: {e}")
+
+
+async def collect_chunk_garbage():
+    """Remove chunk store files no longer referenced by any recording."""
+    logger.info("Starting chunk store garbage collection...")
+    
+    try:
+        from app.database import async_session_maker
+        from app.services.chunk_store_service import ChunkStoreService
+        
+        async with async_session_maker() as db:
+            service = ChunkStoreService(db)
+            await service.collect_garbage()
+    
+    except Exception as e:
+        logger.error(f"Error collecting chunk store garbage: {e}")
+
+
+async def enforce_storage_quota():
+    """Free local storage when usage crosses the quota's high watermark."""
+    try:
+        from app.database import async_session_maker
+        from app.services.quota_service import QuotaService
+        
+        async with async_session_maker() as db:
+            service = QuotaService(db)
+            await service.enforce()
+    
+    except Exception as e:
+        logger.error(f"Error enforcing storage quota: {e}")
+
+
+async def scrub_replay_integrity():
+    """Re-hash the next slice of stored recordings against their checksums."""
+    try:
+        from app.database import async_session_maker
+        from app.services.integrity_service import IntegrityService
+        
+        async with async_session_maker() as db:
+            service = IntegrityService(db)
+            stats = await service.scrub()
+            
+            failures = stats["mismatch"] + stats["missing"] + stats["error"]
+            if failures:
+                logger.error(f"Integrity scrub found {failures} failed replays (see /stats/integrity)")
+    
+    except Exception as e:
+        logger.error(f"Error scrubbing replay integrity: {e}")
+
+
+async def reconcile_storage():
+    """Compare the stored files with the replays table and, if enabled, fix the drift."""
+    try:
+        from app.database import async_session_maker
+        from app.services.reconcile_service import ReconcileService
+        
+        async with async_session_maker() as db:
+            service = ReconcileService(db)
+            await service.run()
+    
+    except Exception as e:
+        logger.error(f"Error reconciling storage: {e}")
+
+
+async def pack_cold_storage():
+    """Pack small COLD recordings into pack files, then compact the packs with dead members."""
+    try:
+        from app.database import async_session_maker
+        from app.services.pack_service import PackService
+        
+        async with async_session_maker() as db:
+            service = PackService(db)
+            await service.pack_cold()
+            await service.compact()
+    
+    except Exception as e:
+        logger.error(f"Error packing cold storage: {e}")
+
+
+async def migrate_storage_layout():
+    """Move a slice of the stored recordings into the configured directory layout."""
+    try:
+        from app.database import async_session_maker
+        from app.services.layout_service import StorageLayoutService
+        
+        async with async_session_maker() as db:
+            service = StorageLayoutService(db)
+            await service.migrate()
+    
+    except Exception as e:
+        logger.error(f"Error migrating storage layout: {e}")
+
+
+async def generate_thumbnails():
+    """Render poster frames and sprite sheets for new replays."""
+    try:
+        from app.database import async_session_maker
+        from app.services.thumbnail_service import ThumbnailService
+        
+        async with async_session_maker() as db:
+            service = ThumbnailService(db)
+            count = await service.render_pending(settings.thumbnail_batch_size)
+            await db.commit()
+            
+            if count > 0:
+                logger.info(f"Rendered thumbnails for {count} replays")
+    
+    except Exception as e:
+        logger.error(f"Error generating thumbnails: {e}")
+
+
 def start_scheduler():
     """Start the background task scheduler."""
     # Scan for new replays every 5 minutes
@@ -99,9 +247,98 @@ def start_scheduler():
         trigger=CronTrigger(hour=2, minute=0),
         id="archive_replays",
         name="Archive old replays",
-        replace_existing=True
+        replace_existing=True,
+        max_instances=1
     )
     
+    # Migrate storage tiers daily, after the archival
+    if settings.tier_migration_enabled:
+        scheduler.add_job(
+            migrate_storage_tiers,
+            trigger=CronTrigger(hour=settings.tier_migration_hour, minute=0),
+            id="migrate_tiers",
+            name="Migrate storage tiers",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Train zstd dictionaries weekly, before the night's archival and migration
+    if settings.compression_dictionary_enabled:
+        scheduler.add_job(
+            train_compression_dictionaries,
+            trigger=CronTrigger(day_of_week="sun", hour=settings.compression_dictionary_training_hour, minute=0),
+            id="train_dictionaries",
+            name="Train compression dictionaries",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Collect unreferenced chunks daily, after the tier migration
+    if settings.chunk_store_enabled:
+        scheduler.add_job(
+            collect_chunk_garbage,
+            trigger=CronTrigger(hour=settings.chunk_gc_hour, minute=0),
+            id="collect_chunk_garbage",
+            name="Collect chunk store garbage",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Check the storage quota periodically (usage comes from incremental totals)
+    if settings.quota_enabled:
+        scheduler.add_job(
+            enforce_storage_quota,
+            trigger=IntervalTrigger(minutes=settings.quota_check_minutes),
+            id="enforce_storage_quota",
+            name="Enforce storage quota",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Re-hash a slice of the archive at a time: the whole of it every 1 / SCRUB_FRACTION_PER_DAY days
+    if settings.scrub_enabled:
+        scheduler.add_job(
+            scrub_replay_integrity,
+            trigger=IntervalTrigger(minutes=settings.scrub_interval_minutes),
+            id="scrub_integrity",
+            name="Scrub replay integrity",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Reconcile files and replays daily, after the night's moves and collection
+    if settings.reconcile_enabled:
+        scheduler.add_job(
+            reconcile_storage,
+            trigger=CronTrigger(hour=settings.reconcile_hour, minute=0),
+            id="reconcile_storage",
+            name="Reconcile storage",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Pack small COLD recordings daily, after the night's tier migration
+    if settings.pack_enabled:
+        scheduler.add_job(
+            pack_cold_storage,
+            trigger=CronTrigger(hour=settings.pack_hour, minute=0),
+            id="pack_cold_storage",
+            name="Pack cold storage",
+            replace_existing=True,
+            max_instances=1
+        )
+    
+    # Move existing recordings to the directory layout in small slices (a no-op once done)
+    if settings.storage_layout_migration_enabled:
+        scheduler.add_job(
+            migrate_storage_layout,
+            trigger=IntervalTrigger(minutes=settings.storage_layout_migration_minutes),
+            id="migrate_storage_layout",
+            name="Migrate storage layout",
+            replace_existing=True,
+            max_instances=1
+        )
+    
     # Clean up expired tokens every hour
     scheduler.add_job(
         cleanup_expired_tokens,
@@ -111,8 +348,19 @@ def start_scheduler():
         replace_existing=True
     )
     
+    # Render thumbnails for new replays every 10 minutes
+    if settings.thumbnail_enabled:
+        scheduler.add_job(
+            generate_thumbnails,
+            trigger=IntervalTrigger(minutes=10),
+            id="generate_thumbnails",
+            name="Generate replay thumbnails",
+            replace_existing=True,
+            max_instances=1
+        )
+    
     scheduler.start()
-    logger.info("Background scheduler started with 3 jobs")
+    logger.info(f"Background scheduler started with {len(scheduler.get_jobs())} jobs")
 
 
 def stop_scheduler():
@@ -120,3 +368,10 @@ def stop_scheduler():
     if scheduler.running:
         scheduler.shutdown(wait=False)
         logger.info("Background scheduler stopped")
+    
+    from app.services.thumbnail_service import shutdown_thumbnail_pool
+    from app.services.replay_service import shutdown_archive_pool
+    from app.services.integrity_service import shutdown_hash_pool
+    shutdown_thumbnail_pool()
+    shutdown_archive_pool()
+    shutdown_hash_pool()
@@ -0,0 +1,439 @@
+"""
+Nachos Replay for Guaca - Chunk Store
+Content-addressed storage of COLD recordings, deduplicated across sessions.
+
+RDP recordings of the same desktops send the same PNG tiles (taskbars,
+wallpapers, window chrome) over and over, as base64 ``blob`` payloads.
+Each payload would be identical across sessions were it not for the
+instruction header in front of it (``4.blob,1.5,4.8064.``), whose stream
+index changes from one session to the next. So a recording is split in
+two streams before chunking:
+
+- blob payloads of at least ``MIN_PAYLOAD_SIZE`` bytes, each one (or
+  pieces of it, if larger than the maximum chunk size) a chunk of its own;
+- the remaining instruction text (the "skeleton"), cut into chunks by
+  content: a cut is made after a ``sync`` instruction when a hash of the
+  preceding ``WINDOW`` bytes falls under a threshold, within the minimum
+  and maximum chunk sizes (content-defined chunking).
+
+Chunks are stored once, zstd-compressed, under ``chunks/ab/cd/<sha256>``.
+The recording becomes a manifest: its chunk table and the list of slices
+(chunk, offset, length) that rebuild it byte for byte. ChunkedReader
+reassembles it with streaming, seekable reads. The segmentation only
+affects how much is shared, never the bytes served, so instruction-like
+text inside a payload or a truncated tail are harmless.
+
+Reference counts of the chunks live in the database (see
+ChunkStoreService).
+"""
+import bisect
+import hashlib
+import io
+import os
+import re
+import struct
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from app.config import settings
+
+MANIFEST_MAGIC = b"NRCM"
+MANIFEST_VERSION = 1
+MANIFEST_SUFFIX = ".chunks"
+MANIFEST_HEADER = struct.Struct("<4sB3xQII")  # magic, versão, tamanho original, chunks, fatias
+MANIFEST_CHUNK = struct.Struct("<32sI")      # sha256, tamanho descomprimido
+MANIFEST_SLICE = struct.Struct("<III")       # chunk, offset no chunk, tamanho
+
+CHUNK_DIR = "chunks"
+CHUNK_COMPRESSION_LEVEL = 3
+
+READ_SIZE = 8 * 1024 * 1024
+MIN_PAYLOAD_SIZE = 1024
+# Payload maior que isto é tratado como texto (não fica inteiro em memória)
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+# Cabeçalho de um blob até o início do payload; o grupo é o tamanho do payload
+BLOB_HEADER = re.compile(rb"4\.blob,\d{1,4}\.[^,;]{1,10},(\d{1,10})\.")
+BLOB_HEADER_MAX = 40
+
+# Pontos de corte candidatos: fim de um sync no texto, "++"/"+/"... no base64
+SKELETON_CANDIDATES = re.compile(rb"4\.sync,[^;]{1,64};")
+PAYLOAD_CANDIDATES = re.compile(rb"[+/][+/]")
+WINDOW = 48
+
+PathLike = Union[str, Path]
+
+
+class ChunkInfo(NamedTuple):
+    digest: bytes
+    size: int
+    stored_size: int
+    new: bool
+
+
+class ManifestSummary(NamedTuple):
+    """Result of chunking one recording."""
+    size: int
+    chunks: List[ChunkInfo]
+    slices: int
+    manifest_size: int
+    
+    @property
+    def new_bytes(self) -> int:
+        """Stored bytes of the chunks this recording added to the store."""
+        return sum(chunk.stored_size for chunk in self.chunks if chunk.new)
+
+
+def chunk_root() -> Path:
+    return Path(settings.replay_storage_path) / CHUNK_DIR
+
+
+def chunk_path(digest: bytes, root: Optional[Path] = None) -> Path:
+    name = digest.hex()
+    return (root or chunk_root()) / name[:2] / name[2:4] / name
+
+
+def is_manifest(path: PathLike) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+    except OSError:
+        return False
+
+
+class _Cutter:
+    """Content-defined cut points for one kind of stream."""
+    
+    def __init__(self, candidates: "re.Pattern", min_size: int, avg_size: int, max_size: int, spacing: int):
+        self.candidates = candidates
+        self.min_size = max(min_size, WINDOW)
+        self.max_size = max(max_size, self.min_size + 1)
+        # Chance de aceitar um candidato, pelo espaçamento típico entre eles
+        chance = min(1.0, spacing / max(avg_size - self.min_size, 1))
+        self.threshold = int(chance * 0xFFFFFFFF)
+    
+    def cut(self, buf: bytes, view: memoryview, start: int, final: bool) -> Optional[int]:
+        """End of the chunk starting at ``start``, or None if more data is needed."""
+        available = len(buf) - start
+        if available <= 0:
+            return None
+        if available <= self.min_size:
+            return len(buf) if final else None
+        
+        limit = min(start + self.max_size, len(buf))
+        for match in self.candidates.finditer(buf, start + self.min_size - WINDOW, limit):
+            end = match.end()
+            if end - start >= self.min_size and zlib.crc32(view[end - WINDOW:end]) <= self.threshold:
+                return end
+        if limit == start + self.max_size or final:
+            return limit
+        return None
+
+
+class ChunkWriter:
+    """
+    Cut a recording into chunks, store the new ones and write its manifest.
+    
+    Memory is bounded by the read buffer, one payload and the slice list
+    (12 bytes per slice).
+    """
+    
+    def __init__(
+        self,
+        root: Optional[Path] = None,
+        min_size: int = 4 * 1024,
+        avg_size: int = 16 * 1024,
+        max_size: int = 128 * 1024
+    ):
+        import zstandard
+        
+        self.root = root or chunk_root()
+        self.skeleton_cutter = _Cutter(SKELETON_CANDIDATES, min_size, avg_size, max_size, spacing=512)
+        self.payload_cutter = _Cutter(PAYLOAD_CANDIDATES, min_size, avg_size, max_size, spacing=1024)
+        self._compressor = zstandard.ZstdCompressor(level=CHUNK_COMPRESSION_LEVEL)
+    
+    def write(self, source: BinaryIO, manifest_path: PathLike) -> ManifestSummary:
+        self._chunks: List[ChunkInfo] = []
+        self._index: Dict[bytes, int] = {}
+        # Fatias: chunk (-1 = texto, resolvido no fim), offset, tamanho
+        self._slice_chunk = array("q")
+        self._slice_offset = array("q")
+        self._slice_size = array("q")
+        self._skeleton = bytearray()
+        self._skeleton_start = 0          # offset no texto do início de _skeleton
+        self._skeleton_cuts: List[Tuple[int, int]] = []  # (offset no texto, chunk)
+        total = 0
+        
+        carry = b""
+        eof = False
+        while not eof:
+            block = source.read(READ_SIZE)
+            eof = not block
+            buf = carry + block
+            total += len(block)
+            carry = self._segment(buf, eof)
+            self._flush_skeleton(final=eof)
+        
+        return self._write_manifest(Path(manifest_path), total)
+    
+    def _segment(self, buf: bytes, eof: bool) -> bytes:
+        """Split ``buf`` into text and payloads; returns what must wait for more data."""
+        pos = 0
+        while True:
+            match = BLOB_HEADER.search(buf, pos)
+            if match is None:
+                # Um cabeçalho pode estar cortado no fim do bloco
+                keep = 0 if eof else min(BLOB_HEADER_MAX, len(buf) - pos)
+                self._add_text(buf, pos, len(buf) - keep)
+                return buf[len(buf) - keep:]
+            
+            start = match.end()
+            length = int(match.group(1))
+            end = start + length
+            if length > MAX_PAYLOAD_SIZE or (end > len(buf) and eof):
+                self._add_text(buf, pos, start)
+                pos = start
+                continue
+            if end > len(buf):
+                self._add_text(buf, pos, match.start())
+                return buf[match.start():]
+            if length < MIN_PAYLOAD_SIZE:
+                self._add_text(buf, pos, end)
+            else:
+                self._add_text(buf, pos, start)
+                self._add_payload(buf, start, end)
+            pos = end
+    
+    def _add_text(self, buf: bytes, start: int, end: int):
+        if end <= start:
+            return
+        offset = self._skeleton_start + len(self._skeleton)
+        self._skeleton += buf[start:end]
+        self._add_slice(-1, offset, end - start)
+    
+    def _add_payload(self, buf: bytes, start: int, end: int):
+        payload = buf[start:end]
+        view = memoryview(payload)
+        pos = 0
+        while pos < len(payload):
+            cut = self.payload_cutter.cut(payload, view, pos, final=True)
+            index = self._store(payload[pos:cut])
+            self._add_slice(index, 0, cut - pos)
+            pos = cut
+    
+    def _add_slice(self, chunk: int, offset: int, size: int):
+        # Texto contíguo ao da fatia anterior: estender
+        if (
+            chunk == -1 and self._slice_chunk and self._slice_chunk[-1] == -1
+            and self._slice_offset[-1] + self._slice_size[-1] == offset
+        ):
+            self._slice_size[-1] += size
+            return
+        self._slice_chunk.append(chunk)
+        self._slice_offset.append(offset)
+        self._slice_size.append(size)
+    
+    def _flush_skeleton(self, final: bool):
+        """Store the complete text chunks accumulated so far."""
+        data = bytes(self._skeleton)
+        view = memoryview(data)
+        pos = 0
+        while True:
+            cut = self.skeleton_cutter.cut(data, view, pos, final)
+            if cut is None:
+                break
+            self._skeleton_cuts.append((self._skeleton_start + pos, self._store(data[pos:cut])))
+            pos = cut
+        self._skeleton = bytearray(data[pos:])
+        self._skeleton_start += pos
+    
+    def _store(self, data: bytes) -> int:
+        digest = hashlib.sha256(data).digest()
+        index = self._index.get(digest)
+        if index is not None:
+            return index
+        
+        path = chunk_path(digest, self.root)
+        try:
+            # Reutilizado: renovar o mtime para a coleta de órfãos não removê-lo
+            # antes do commit das linhas de chunks desta gravação
+            os.utime(path)
+            stored_size = path.stat().st_size
+            new = False
+        except FileNotFoundError:
+            compressed = self._compressor.compress(data)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            partial = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.part")
+            partial.write_bytes(compressed)
+            partial.replace(path)
+            stored_size = len(compressed)
+            new = True
+        
+        index = len(self._chunks)
+        self._index[digest] = index
+        self._chunks.append(ChunkInfo(digest, len(data), stored_size, new))
+        return index
+    
+    def _resolved_slices(self):
+        """Slices with text offsets translated to (text chunk, offset in it), split at chunk edges."""
+        starts = [start for start, _ in self._skeleton_cuts]
+        for chunk, offset, size in zip(self._slice_chunk, self._slice_offset, self._slice_size):
+            if chunk != -1:
+                yield chunk, offset, size
+                continue
+            while size:
+                i = bisect.bisect_right(starts, offset) - 1
+                chunk_start, index = self._skeleton_cuts[i]
+                within = offset - chunk_start
+                take = min(size, self._chunks[index].size - within)
+                yield index, within, take
+                offset += take
+                size -= take
+    
+    def _write_manifest(self, path: Path, total: int) -> ManifestSummary:
+        partial = path.with_name(path.name + ".part")
+        slices = 0
+        try:
+            with open(partial, "wb") as f:
+                f.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, total, len(self._chunks), 0))
+                for chunk in self._chunks:
+                    f.write(MANIFEST_CHUNK.pack(chunk.digest, chunk.size))
+                for entry in self._resolved_slices():
+                    f.write(MANIFEST_SLICE.pack(*entry))
+                    slices += 1
+                f.seek(0)
+                f.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, total, len(self._chunks), slices))
+            partial.replace(path)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        
+        return ManifestSummary(total, self._chunks, slices, path.stat().st_size)
+
+
+class Manifest(NamedTuple):
+    size: int
+    chunks: List[Tuple[bytes, int]]
+    slice_chunk: array
+    slice_offset: array
+    slice_size: array
+
+
+def read_manifest(path: PathLike, with_slices: bool = True) -> Manifest:
+    with open(path, "rb") as f:
+        data = f.read() if with_slices else f.read(MANIFEST_HEADER.size)
+        magic, version, size, chunk_count, slice_count = MANIFEST_HEADER.unpack_from(data)
+        if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+            raise ValueError(f"{path} is not a chunk manifest")
+        if not with_slices:
+            data += f.read(chunk_count * MANIFEST_CHUNK.size)
+    
+    pos = MANIFEST_HEADER.size
+    end = pos + chunk_count * MANIFEST_CHUNK.size
+    chunks = [tuple(entry) for entry in MANIFEST_CHUNK.iter_unpack(data[pos:end])]
+    slice_chunk, slice_offset, slice_size = array("q"), array("q"), array("q")
+    if with_slices:
+        table = data[end:end + slice_count * MANIFEST_SLICE.size]
+        if len(table) != slice_count * MANIFEST_SLICE.size:
+            raise ValueError(f"{path}: truncated chunk manifest")
+        for chunk, offset, length in MANIFEST_SLICE.iter_unpack(table):
+            slice_chunk.append(chunk)
+            slice_offset.append(offset)
+            slice_size.append(length)
+    return Manifest(size, chunks, slice_chunk, slice_offset, slice_size)
+
+
+def summarize_manifest(path: PathLike, root: Optional[Path] = None) -> ManifestSummary:
+    """Summary of an existing manifest; raises FileNotFoundError if a chunk is missing."""
+    manifest = read_manifest(path, with_slices=False)
+    chunks = [
+        ChunkInfo(digest, size, chunk_path(digest, root).stat().st_size, False)
+        for digest, size in manifest.chunks
+    ]
+    return ManifestSummary(manifest.size, chunks, 0, Path(path).stat().st_size)
+
+
+def missing_chunks(chunks: List[ChunkInfo], root: Optional[Path] = None) -> List[ChunkInfo]:
+    return [chunk for chunk in chunks if not chunk_path(chunk.digest, root).exists()]
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+    Seekable reader that rebuilds a recording from its manifest.
+    
+    A few decompressed chunks are cached: reads alternate between the
+    text chunk and the payload chunks it surrounds.
+    """
+    
+    CACHED_CHUNKS = 4
+    
+    def __init__(self, path: PathLike, root: Optional[Path] = None):
+        import zstandard
+        
+        super().__init__()
+        manifest = read_manifest(path)
+        self.size = manifest.size
+        self._root = root or chunk_root()
+        self._chunks = manifest.chunks
+        self._slice_chunk = manifest.slice_chunk
+        self._slice_offset = manifest.slice_offset
+        self._slice_size = manifest.slice_size
+        self._starts = array("q", [0])
+        for length in manifest.slice_size:
+            self._starts.append(self._starts[-1] + length)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._pos = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self._pos < self.size:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            within = self._pos - self._starts[i]
+            take = min(self._slice_size[i] - within, len(view) - written)
+            data = self._chunk(self._slice_chunk[i])
+            start = self._slice_offset[i] + within
+            view[written:written + take] = data[start:start + take]
+            written += take
+            self._pos += take
+        return written
+    
+    def _chunk(self, index: int) -> bytes:
+        data = self._cache.get(index)
+        if data is not None:
+            self._cache.move_to_end(index)
+            return data
+        
+        digest, size = self._chunks[index]
+        with open(chunk_path(digest, self._root), "rb") as f:
+            data = self._decompressor.decompress(f.read(), max_output_size=size)
+        if len(data) != size:
+            raise IOError(f"chunk {digest.hex()} has {len(data)} bytes, expected {size}")
+        self._cache[index] = data
+        if len(self._cache) > self.CACHED_CHUNKS:
+            self._cache.popitem(last=False)
+        return data
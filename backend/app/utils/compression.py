@@ -0,0 +1,466 @@
+"""
+Nachos Replay for Guaca - Compression Helpers
+Codecs used to compress archived and COLD replays.
+
+- ``gzip``: single-threaded gzip, readable by any tool.
+- ``pgzip``: the file is split in blocks compressed in parallel, each one
+  a complete gzip member; the concatenation is a standard multi-member
+  gzip file (RFC 1952), so ``gzip -d`` and ``gzip.open`` read it as usual.
+- ``sgzip``: seekable gzip. Like ``pgzip`` with fixed-size frames, plus a
+  footer index mapping uncompressed to compressed offsets, so a read at
+  any position decompresses only the frames it touches (see
+  SeekableGzipReader). Still a plain multi-member gzip for other tools.
+- ``zstd``: multi-threaded zstd (needs the ``zstandard`` package).
+
+Small recordings can also be compressed with a zstd dictionary trained on
+recordings of the same protocol (see DictionaryService). The dictionary ID
+is written in the frame header and dictionaries are kept as files under
+``<replay_storage_path>/dictionaries``, so readers find them without a
+database lookup.
+
+COLD recordings may instead be split into deduplicated chunks and kept as
+a manifest (see chunk_store); open_recording reassembles them.
+
+Recordings are opened by location, so the same readers serve files kept in
+S3-compatible object storage or inside COLD pack files (see storage).
+
+Readers detect the format by its magic bytes, so replays compressed with
+different codecs over time coexist.
+"""
+import gzip
+import io
+import os
+import shutil
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+from app.config import settings
+from app.utils.chunk_store import MANIFEST_MAGIC, ChunkedReader
+from app.utils.storage import open_location
+
+CODECS = ("gzip", "pgzip", "sgzip", "zstd")
+
+SUFFIXES = {"gzip": ".gz", "pgzip": ".gz", "sgzip": ".gz", "zstd": ".zst"}
+
+DEFAULT_LEVELS = {"gzip": 6, "pgzip": 6, "sgzip": 6, "zstd": 3}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Bloco independente do pgzip: grande o bastante para a perda de razão ser desprezível
+PGZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Quadro do sgzip: unidade mínima descomprimida num acesso aleatório
+SEEKABLE_FRAME_SIZE = 1024 * 1024
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Índice do sgzip: membros gzip vazios cujo campo FEXTRA (subcampo "NR")
+# carrega os offsets; o último guarda onde o índice começa
+INDEX_SUBFIELD_ID = b"NR"
+INDEX_OFFSETS_PER_MEMBER = 8000
+TRAILER_MAGIC = b"NRSX"
+TRAILER = struct.Struct("<4sQQI")  # magic, offset do índice, tamanho original, tamanho do quadro
+
+# Cabeçalho de quadro zstd: magic (4) + até 14 bytes de parâmetros
+ZSTD_FRAME_HEADER_MAX = 18
+
+DICTIONARY_DIR = "dictionaries"
+
+PathLike = Union[str, Path]
+
+
+def get_codec(codec: Optional[str] = None) -> str:
+    """Validated codec name, ``archive_compression`` by default."""
+    codec = (codec or settings.archive_compression).lower()
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec!r}; expected one of {', '.join(CODECS)}")
+    return codec
+
+
+def compressed_suffix(codec: Optional[str] = None) -> str:
+    return SUFFIXES[get_codec(codec)]
+
+
+def compress_file(
+    source: PathLike,
+    target: PathLike,
+    codec: Optional[str] = None,
+    level: Optional[int] = None,
+    threads: Optional[int] = None,
+    dictionary_id: Optional[int] = None
+) -> int:
+    """
+    Compress ``source`` into ``target``, written through a ``.part`` file
+    and renamed when complete. ``threads`` defaults to
+    ``archive_compression_threads`` (0 = all cores). With ``dictionary_id``
+    the file is written as zstd using that stored dictionary, whatever the
+    codec. Returns the size of the compressed file.
+    """
+    codec = "zstd" if dictionary_id else get_codec(codec)
+    level = level or settings.archive_compression_level or DEFAULT_LEVELS[codec]
+    threads = threads or settings.archive_compression_threads or os.cpu_count() or 1
+    target = Path(target)
+    partial = target.with_name(target.name + ".part")
+    
+    try:
+        with open(source, "rb") as f_in, open(partial, "wb") as f_out:
+            if codec == "gzip":
+                with gzip.GzipFile(filename="", mode="wb", fileobj=f_out, compresslevel=level) as gz:
+                    shutil.copyfileobj(f_in, gz, COPY_CHUNK_SIZE)
+            elif codec == "pgzip":
+                compress_gzip_blocks(f_in, f_out, level, threads)
+            elif codec == "sgzip":
+                compress_seekable(f_in, f_out, level, threads)
+            else:
+                compress_zstd(f_in, f_out, level, threads, dictionary_id)
+        partial.replace(target)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    
+    return target.stat().st_size
+
+
+def compress_gzip_blocks(
+    f_in: BinaryIO,
+    f_out: BinaryIO,
+    level: int = DEFAULT_LEVELS["pgzip"],
+    threads: int = 1,
+    block_size: int = PGZIP_BLOCK_SIZE
+):
+    """Write ``f_in`` as independent gzip members (see _gzip_members)."""
+    for member, _ in _gzip_members(f_in, level, threads, block_size):
+        f_out.write(member)
+
+
+def _gzip_members(f_in: BinaryIO, level: int, threads: int, block_size: int) -> Iterator[Tuple[bytes, int]]:
+    """
+    Compress blocks as independent gzip members on ``threads`` threads
+    (zlib releases the GIL), yielding (member, block size) in order. At most
+    two blocks per thread are held in memory.
+    """
+    if threads <= 1:
+        for block in iter(lambda: f_in.read(block_size), b""):
+            yield gzip.compress(block, level, mtime=0), len(block)
+        return
+    
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="pgzip") as pool:
+        pending = deque()
+        for block in iter(lambda: f_in.read(block_size), b""):
+            pending.append((pool.submit(gzip.compress, block, level, mtime=0), len(block)))
+            if len(pending) >= threads * 2:
+                future, size = pending.popleft()
+                yield future.result(), size
+        while pending:
+            future, size = pending.popleft()
+            yield future.result(), size
+
+
+def compress_seekable(
+    f_in: BinaryIO,
+    f_out: BinaryIO,
+    level: int = DEFAULT_LEVELS["sgzip"],
+    threads: int = 1,
+    frame_size: int = SEEKABLE_FRAME_SIZE
+):
+    """Write ``f_in`` as frames of ``frame_size`` followed by the index."""
+    offsets: List[int] = []
+    position = 0
+    total = 0
+    for member, size in _gzip_members(f_in, level, threads, frame_size):
+        offsets.append(position)
+        f_out.write(member)
+        position += len(member)
+        total += size
+    
+    index_offset = position
+    for i in range(0, len(offsets), INDEX_OFFSETS_PER_MEMBER):
+        chunk = offsets[i:i + INDEX_OFFSETS_PER_MEMBER]
+        f_out.write(_empty_member(struct.pack(f"<{len(chunk)}Q", *chunk)))
+    f_out.write(_empty_member(TRAILER.pack(TRAILER_MAGIC, index_offset, total, frame_size)))
+
+
+def _empty_member(payload: bytes) -> bytes:
+    """A gzip member with no content, carrying ``payload`` in FEXTRA."""
+    subfield = INDEX_SUBFIELD_ID + struct.pack("<H", len(payload)) + payload
+    return (
+        b"\x1f\x8b\x08\x04"             # magic, deflate, FEXTRA
+        + b"\x00\x00\x00\x00\x00\xff"   # mtime, XFL, OS
+        + struct.pack("<H", len(subfield)) + subfield
+        + b"\x03\x00"                   # bloco deflate vazio
+        + b"\x00" * 8                   # CRC32 e ISIZE de conteúdo vazio
+    )
+
+
+def _parse_empty_member(data: bytes, pos: int) -> Optional[Tuple[bytes, int]]:
+    """Payload and end of an index member at ``pos``, or None."""
+    if data[pos:pos + 4] != b"\x1f\x8b\x08\x04" or len(data) < pos + 12:
+        return None
+    (xlen,) = struct.unpack_from("<H", data, pos + 10)
+    extra = data[pos + 12:pos + 12 + xlen]
+    end = pos + 12 + xlen + 10
+    if len(extra) < 4 or extra[:2] != INDEX_SUBFIELD_ID or end > len(data):
+        return None
+    (length,) = struct.unpack_from("<H", extra, 2)
+    return extra[4:4 + length], end
+
+
+TRAILER_MEMBER_SIZE = len(_empty_member(b"\x00" * TRAILER.size))
+
+
+class SeekableGzipReader(io.RawIOBase):
+    """
+    Random-access reader for ``sgzip`` files.
+    
+    The footer index is loaded on open; reads decompress only the frames
+    covering the requested range, keeping the last frame decompressed for
+    sequential reads. Takes ownership of ``fileobj``.
+    """
+    
+    def __init__(self, fileobj: BinaryIO):
+        super().__init__()
+        self._file = fileobj
+        try:
+            self.size, self.frame_size, self._offsets = _read_index(self._file)
+        except BaseException:
+            self._file.close()
+            raise
+        self._pos = 0
+        self._frame_index = -1
+        self._frame = b""
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self._pos < self.size:
+            index = self._pos // self.frame_size
+            if index != self._frame_index:
+                self._load(index)
+            start = self._pos - index * self.frame_size
+            chunk = self._frame[start:start + len(view) - written]
+            if not chunk:
+                break
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self._pos += len(chunk)
+        return written
+    
+    def _load(self, index: int):
+        start, end = self._offsets[index], self._offsets[index + 1]
+        self._file.seek(start)
+        self._frame = zlib.decompress(self._file.read(end - start), wbits=31)
+        self._frame_index = index
+    
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def _read_index(f: BinaryIO) -> Tuple[int, int, List[int]]:
+    """(uncompressed size, frame size, frame offsets + index offset)."""
+    f.seek(0, io.SEEK_END)
+    file_size = f.tell()
+    if file_size < TRAILER_MEMBER_SIZE:
+        raise ValueError("not a seekable gzip file")
+    f.seek(file_size - TRAILER_MEMBER_SIZE)
+    parsed = _parse_empty_member(f.read(TRAILER_MEMBER_SIZE), 0)
+    if parsed is None or len(parsed[0]) != TRAILER.size:
+        raise ValueError("not a seekable gzip file")
+    magic, index_offset, size, frame_size = TRAILER.unpack(parsed[0])
+    if magic != TRAILER_MAGIC or index_offset > file_size - TRAILER_MEMBER_SIZE or not frame_size:
+        raise ValueError("not a seekable gzip file")
+    
+    f.seek(index_offset)
+    data = f.read(file_size - TRAILER_MEMBER_SIZE - index_offset)
+    offsets: List[int] = []
+    pos = 0
+    while pos < len(data):
+        parsed = _parse_empty_member(data, pos)
+        if parsed is None or len(parsed[0]) % 8:
+            raise ValueError("corrupt seekable gzip index")
+        payload, pos = parsed
+        offsets.extend(struct.unpack(f"<{len(payload) // 8}Q", payload))
+    
+    if len(offsets) != -(-size // frame_size):
+        raise ValueError("corrupt seekable gzip index")
+    offsets.append(index_offset)
+    return size, frame_size, offsets
+
+
+def is_seekable_gzip(f: BinaryIO) -> bool:
+    """Whether the open file ``f`` ends with an sgzip index trailer."""
+    f.seek(0, io.SEEK_END)
+    file_size = f.tell()
+    if file_size < TRAILER_MEMBER_SIZE:
+        return False
+    f.seek(file_size - TRAILER_MEMBER_SIZE)
+    parsed = _parse_empty_member(f.read(TRAILER_MEMBER_SIZE), 0)
+    return parsed is not None and parsed[0][:4] == TRAILER_MAGIC
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    """GzipFile that also closes the file object it reads from."""
+    
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def is_random_access(fileobj) -> bool:
+    """Whether seeking ``fileobj`` is cheap (plain file, sgzip or chunked)."""
+    return isinstance(fileobj, (SeekableGzipReader, ChunkedReader, io.BufferedReader, io.FileIO))
+
+
+def compress_zstd(
+    f_in: BinaryIO,
+    f_out: BinaryIO,
+    level: int = DEFAULT_LEVELS["zstd"],
+    threads: int = 1,
+    dictionary_id: Optional[int] = None
+):
+    import zstandard
+    
+    dict_data = _compression_dictionary(dictionary_id, level) if dictionary_id else None
+    compressor = zstandard.ZstdCompressor(
+        level=level, threads=threads if threads > 1 else 0, dict_data=dict_data
+    )
+    compressor.copy_stream(f_in, f_out, read_size=COPY_CHUNK_SIZE, write_size=COPY_CHUNK_SIZE)
+
+
+def train_dictionary(samples: List[bytes], size: int, level: int = DEFAULT_LEVELS["zstd"]) -> Tuple[int, bytes]:
+    """Train a zstd dictionary of at most ``size`` bytes; returns (dictionary ID, content)."""
+    import zstandard
+    
+    trained = zstandard.train_dictionary(size, samples, level=level, threads=-1)
+    return trained.dict_id(), trained.as_bytes()
+
+
+def dictionary_path(dictionary_id: int) -> Path:
+    return Path(settings.replay_storage_path) / DICTIONARY_DIR / f"{dictionary_id}.zdict"
+
+
+def save_dictionary(dictionary_id: int, data: bytes):
+    """Write a dictionary to the local store (through a ``.part`` file)."""
+    path = dictionary_path(dictionary_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".part")
+    partial.write_bytes(data)
+    partial.replace(path)
+
+
+@lru_cache(maxsize=32)
+def load_dictionary(dictionary_id: int) -> bytes:
+    """Content of a stored dictionary; dictionaries are immutable, so cached."""
+    try:
+        return dictionary_path(dictionary_id).read_bytes()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"zstd dictionary {dictionary_id} not found in the dictionary store") from None
+
+
+@lru_cache(maxsize=8)
+def _compression_dictionary(dictionary_id: int, level: int):
+    """Dictionary prepared for ``level``, reused across the (small) files of a job."""
+    import zstandard
+    
+    dict_data = zstandard.ZstdCompressionDict(load_dictionary(dictionary_id))
+    dict_data.precompute_compress(level=level)
+    return dict_data
+
+
+def frame_dictionary_id(path: PathLike) -> Optional[int]:
+    """Dictionary ID in the header of a zstd file, or None (no dictionary / not zstd)."""
+    with open_location(path) as f:
+        return _header_dictionary_id(f.read(ZSTD_FRAME_HEADER_MAX))
+
+
+def _header_dictionary_id(header: bytes) -> Optional[int]:
+    if not header.startswith(ZSTD_MAGIC):
+        return None
+    import zstandard
+    
+    try:
+        return zstandard.get_frame_parameters(header).dict_id or None
+    except zstandard.ZstdError:
+        return None
+
+
+def detect_codec(path: PathLike) -> Optional[str]:
+    """``gzip``, ``zstd``, ``chunked`` or None (uncompressed) from the file's magic bytes."""
+    with open_location(path) as f:
+        return _magic_codec(f.read(4))
+
+
+def _magic_codec(magic: bytes) -> Optional[str]:
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    if magic == MANIFEST_MAGIC:
+        return "chunked"
+    return None
+
+
+def open_recording(path: PathLike) -> BinaryIO:
+    """
+    Open a recording for reading, decompressing if needed. Plain,
+    ``sgzip`` and chunked files support cheap seeks (see is_random_access).
+    
+    The location is opened once and the same handle is probed and read,
+    which matters for S3 objects where each open and read is a request.
+    """
+    f = open_location(path)
+    try:
+        header = f.read(ZSTD_FRAME_HEADER_MAX)
+        codec = _magic_codec(header[:4])
+        if codec == "chunked":
+            # Manifestos são sempre arquivos locais
+            f.close()
+            return ChunkedReader(path)
+        if codec == "gzip":
+            if is_seekable_gzip(f):
+                return SeekableGzipReader(f)
+            f.seek(0)
+            return _ClosingGzipFile(fileobj=f, mode="rb")
+        f.seek(0)
+        if codec == "zstd":
+            import zstandard
+            
+            dictionary_id = _header_dictionary_id(header)
+            dict_data = zstandard.ZstdCompressionDict(load_dictionary(dictionary_id)) if dictionary_id else None
+            return zstandard.ZstdDecompressor(dict_data=dict_data).stream_reader(
+                f, closefd=True, read_across_frames=True
+            )
+        return f
+    except BaseException:
+        f.close()
+        raise
@@ -0,0 +1,177 @@
+"""
+Nachos Replay for Guaca - Recording Filename Templates
+Metadata from recording filenames, following the ``recording-name``
+configured in Guacamole for each recordings directory.
+
+A template is the filename without extension, with fields in braces,
+e.g. ``{username}_{protocol}_{hostname}_{timestamp}``. Guacamole tokens
+(``${GUAC_USERNAME}``, ``${GUAC_DATE}``, ``${GUAC_TIME}``) are accepted too,
+so ``recording-name`` can be copied as is.
+
+The setting lists templates per root (a directory relative to the
+recordings path, ``*`` for the default), tried in order::
+    
+    *={username}_{protocol}_{hostname}_{timestamp}|{username}_{timestamp};rdp=${GUAC_DATE}-${GUAC_TIME}
+"""
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import PurePosixPath
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import settings
+
+DEFAULT_ROOT = "*"
+
+PROTOCOLS = ("rdp", "ssh", "vnc", "telnet", "kubernetes")
+
+# Expressão de cada campo; os livres são preguiçosos e não atravessam diretórios
+FIELD_PATTERNS = {
+    "username": r"[^/]+?",
+    "connection_name": r"[^/]+?",
+    "session_name": r"[^/]+?",
+    "hostname": r"[A-Za-z0-9.\-]+?",
+    "client_ip": r"[0-9A-Fa-f.:]+",
+    "protocol": r"(?i:" + "|".join(PROTOCOLS) + r")",
+    "timestamp": r"\d{13}|\d{10}",
+    "date": r"\d{8}",
+    "time": r"\d{6}",
+    "any": r"[^/]*?",
+}
+
+# Tokens do recording-name do Guacamole
+GUAC_TOKENS = {
+    "GUAC_USERNAME": "username",
+    "GUAC_DATE": "date",
+    "GUAC_TIME": "time",
+    "GUAC_CLIENT_ADDRESS": "client_ip",
+    "GUAC_CLIENT_HOSTNAME": "any",
+}
+
+_PLACEHOLDER = re.compile(r"\$\{(\w+)\}|\{(\w+)\}")
+
+RECORDING_EXTENSIONS = (".guac.gz", ".guac")
+
+
+def compile_template(template: str) -> "re.Pattern":
+    """Regex with one named group per field; raises ValueError if invalid."""
+    parts = []
+    seen = set()
+    pos = 0
+    any_count = 0
+    
+    for match in _PLACEHOLDER.finditer(template):
+        parts.append(re.escape(template[pos:match.start()]))
+        pos = match.end()
+        
+        if match.group(1):
+            field = GUAC_TOKENS.get(match.group(1))
+            if field is None:
+                raise ValueError(f"Unknown Guacamole token ${{{match.group(1)}}} in template {template!r}")
+        else:
+            field = match.group(2)
+            if field not in FIELD_PATTERNS:
+                raise ValueError(f"Unknown field {{{field}}} in template {template!r}")
+        
+        if field == "any":
+            any_count += 1
+            parts.append(f"(?:{FIELD_PATTERNS[field]})")
+            continue
+        if field in seen:
+            raise ValueError(f"Field {{{field}}} repeated in template {template!r}")
+        seen.add(field)
+        parts.append(f"(?P<{field}>{FIELD_PATTERNS[field]})")
+    
+    parts.append(re.escape(template[pos:]))
+    if not seen and not any_count:
+        raise ValueError(f"Template {template!r} has no fields")
+    return re.compile("".join(parts))
+
+
+def parse_templates(spec: str) -> Dict[str, List[Tuple[str, "re.Pattern"]]]:
+    """Parse ``root=tpl|tpl;root=tpl`` into compiled templates per root."""
+    registry: Dict[str, List[Tuple[str, re.Pattern]]] = {}
+    for entry in spec.split(";"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        root, sep, templates = entry.partition("=")
+        if not sep:
+            root, templates = DEFAULT_ROOT, entry
+        root = root.strip().strip("/") or DEFAULT_ROOT
+        registry.setdefault(root, []).extend(
+            (template.strip(), compile_template(template.strip()))
+            for template in templates.split("|") if template.strip()
+        )
+    return registry
+
+
+def _split_extension(filename: str) -> str:
+    for extension in RECORDING_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def _convert(fields: Dict[str, str]) -> Dict[str, Any]:
+    metadata: Dict[str, Any] = {k: v for k, v in fields.items() if v}
+    
+    if "protocol" in metadata:
+        metadata["protocol"] = metadata["protocol"].upper()
+    
+    try:
+        if "timestamp" in metadata:
+            value = int(metadata.pop("timestamp"))
+            if value >= 10 ** 12:  # milissegundos
+                value /= 1000
+            metadata["timestamp"] = datetime.fromtimestamp(value, tz=timezone.utc)
+        elif "date" in metadata:
+            stamp = metadata.pop("date") + metadata.pop("time", "000000")
+            metadata["timestamp"] = datetime.strptime(stamp, "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+    except (ValueError, OSError, OverflowError):
+        metadata.pop("timestamp", None)
+    metadata.pop("date", None)
+    metadata.pop("time", None)
+    
+    return metadata
+
+
+class FilenameTemplateRegistry:
+    """Compiled filename templates, selected by recordings root."""
+    
+    def __init__(self, spec: str):
+        self.templates = parse_templates(spec)
+        # Raízes mais específicas primeiro
+        self._roots = sorted(
+            (root for root in self.templates if root != DEFAULT_ROOT),
+            key=lambda root: -len(PurePosixPath(root).parts)
+        )
+    
+    def templates_for(self, relative_path: PurePosixPath) -> List[Tuple[str, "re.Pattern"]]:
+        parts = relative_path.parent.parts
+        for root in self._roots:
+            root_parts = PurePosixPath(root).parts
+            if parts[:len(root_parts)] == root_parts:
+                return self.templates[root]
+        return self.templates.get(DEFAULT_ROOT, [])
+    
+    def match(self, relative_path: PurePosixPath) -> Optional[Dict[str, Any]]:
+        """
+        Metadata from the first template matching the filename, with the
+        timestamp as a datetime and the protocol in upper case. The template
+        used is returned in ``filename_template``. None if none match.
+        """
+        stem = _split_extension(relative_path.name)
+        for template, pattern in self.templates_for(relative_path):
+            found = pattern.fullmatch(stem)
+            if found:
+                metadata = _convert(found.groupdict())
+                metadata["filename_template"] = template
+                return metadata
+        return None
+
+
+@lru_cache()
+def get_filename_templates() -> FilenameTemplateRegistry:
+    """Registry compiled once from the settings."""
+    return FilenameTemplateRegistry(settings.replay_filename_templates)
@@ -0,0 +1,567 @@
+"""
+Nachos Replay for Guaca - Guacamole Protocol Helpers
+Incremental reader/writer for recorded Guacamole instructions.
+
+A recording is a sequence of instructions such as ``4.sync,13.1700000000000;``:
+each element is ``LENGTH.VALUE`` where LENGTH counts Unicode characters,
+elements are separated by ``,`` and the instruction ends with ``;``.
+"""
+import base64
+import mmap
+import re
+import struct
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.utils.compression import detect_codec, open_recording
+from app.utils.storage import is_remote
+
+# Tamanho padrão de leitura incremental
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Operações de composição que substituem o conteúdo (SRC e OVER)
+REPLACING_MASKS = {"12", "14"}
+
+DEFAULT_LAYER = "0"
+
+# Janela inicial e máxima da varredura reversa do final da gravação
+TAIL_WINDOW = 64 * 1024
+TAIL_MAX_WINDOW = 16 * 1024 * 1024
+
+# Trecho inicial examinado pelo sniffer de cabeçalho
+HEADER_SNIFF_BYTES = 16 * 1024
+MAX_HEADER_ARGUMENT_CHARS = 4096
+
+# Parâmetros argv que nunca são guardados
+SECRET_ARGUMENT_WORDS = ("password", "passphrase", "private-key", "secret", "token")
+
+
+class GuacamoleParseError(ValueError):
+    """Raised when a recording contains a malformed instruction."""
+    
+    def __init__(self, message: str, offset: int):
+        super().__init__(f"{message} at byte {offset}")
+        self.offset = offset
+
+
+class Instruction(NamedTuple):
+    """A single decoded instruction and its position in the recording."""
+    opcode: str
+    args: List[str]
+    offset: int
+    raw: bytes
+
+
+class RawInstruction:
+    """
+    An instruction located in the reader's buffer but not decoded.
+    
+    Elements are exposed as byte ranges and only decoded on request, so
+    passes that look at a few opcodes skip the string allocations for the
+    rest (notably the large base64 ``blob`` payloads). A raw instruction
+    refers to the reader's current buffer and is only valid until the
+    iteration advances; use ``decode()`` to keep it.
+    """
+    __slots__ = ("buf", "offset", "start", "end", "bounds", "_opcode")
+    
+    def __init__(self, buf: bytes, offset: int, start: int, end: int, bounds: List[int]):
+        self.buf = buf
+        self.offset = offset
+        self.start = start
+        self.end = end
+        self.bounds = bounds
+        self._opcode: Optional[str] = None
+    
+    @property
+    def opcode(self) -> str:
+        if self._opcode is None:
+            self._opcode = self.buf[self.bounds[0]:self.bounds[1]].decode("utf-8", errors="replace")
+        return self._opcode
+    
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+    
+    @property
+    def raw(self) -> bytes:
+        return self.buf[self.start:self.end]
+    
+    @property
+    def arg_count(self) -> int:
+        return len(self.bounds) // 2 - 1
+    
+    def arg_bytes(self, index: int) -> bytes:
+        i = 2 * index + 2
+        return self.buf[self.bounds[i]:self.bounds[i + 1]]
+    
+    def arg_size(self, index: int) -> int:
+        """Encoded size in bytes of an argument, without copying it."""
+        i = 2 * index + 2
+        return self.bounds[i + 1] - self.bounds[i]
+    
+    def arg(self, index: int) -> str:
+        return self.arg_bytes(index).decode("utf-8", errors="replace")
+    
+    @property
+    def args(self) -> List[str]:
+        return [self.arg(i) for i in range(self.arg_count)]
+    
+    def decode(self) -> Instruction:
+        return Instruction(self.opcode, self.args, self.offset, self.raw)
+
+
+class RawInstructionReader:
+    """
+    Iterate over the instructions of a recording without loading it whole.
+    
+    Only the current read chunk (plus one partial instruction) is buffered.
+    After iteration, ``offset`` is the end of the last complete instruction
+    and ``trailing_bytes`` the size of an incomplete tail, if any.
+    """
+    
+    def __init__(self, fileobj: BinaryIO, start_offset: int = 0, chunk_size: int = READ_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.offset = start_offset
+        self.chunk_size = chunk_size
+        self.trailing_bytes = 0
+    
+    def __iter__(self) -> Iterator[RawInstruction]:
+        buf = b""
+        pos = 0
+        eof = False
+        # Buffer todo ASCII (o caso comum): comprimento em caracteres = em bytes
+        ascii_only = True
+        
+        while True:
+            parsed = _scan_instruction(buf, pos, self.offset, ascii_only)
+            if parsed is not None:
+                bounds, end = parsed
+                yield RawInstruction(buf, self.offset, pos, end, bounds)
+                self.offset += end - pos
+                pos = end
+                continue
+            
+            if eof:
+                self.trailing_bytes = len(buf) - pos
+                return
+            
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+            ascii_only = buf.isascii()
+
+
+class InstructionReader(RawInstructionReader):
+    """Like RawInstructionReader, but yields fully decoded instructions."""
+    
+    def __iter__(self) -> Iterator[Instruction]:
+        for instruction in super().__iter__():
+            yield instruction.decode()
+
+
+def _scan_instruction(
+    buf: bytes, pos: int, abs_offset: int, ascii_only: bool = False
+) -> Optional[Tuple[List[int], int]]:
+    """
+    Locate one instruction at ``pos`` without decoding it.
+    Returns the element bounds ``[start0, end0, start1, end1, ...]`` and the
+    end of the instruction, or None if the buffer holds only part of it.
+    ``ascii_only`` skips the per-element UTF-8 check when the caller knows
+    the whole buffer is ASCII.
+    """
+    size = len(buf)
+    find = buf.find
+    bounds = []
+    i = pos
+    
+    while True:
+        dot = find(b".", i, i + 12)
+        if dot < 0:
+            if size - i >= 12:
+                raise GuacamoleParseError("Invalid element length", abs_offset + i - pos)
+            return None
+        
+        try:
+            length = int(buf[i:dot])
+        except ValueError:
+            raise GuacamoleParseError("Invalid element length", abs_offset + i - pos)
+        
+        start = dot + 1
+        end = start + length
+        if end >= size:
+            return None
+        if not ascii_only and not buf[start:end].isascii():
+            end = _element_end(buf, start, length)
+            if end is None or end >= size:
+                return None
+        
+        bounds.append(start)
+        bounds.append(end)
+        
+        terminator = buf[end]
+        if terminator == 0x3B:  # ;
+            return bounds, end + 1
+        if terminator != 0x2C:  # ,
+            raise GuacamoleParseError("Invalid element terminator", abs_offset + end - pos)
+        i = end + 1
+
+
+def _element_end(buf: bytes, start: int, length: int) -> Optional[int]:
+    """Byte index after ``length`` UTF-8 characters starting at ``start``."""
+    end = start + length
+    if end > len(buf):
+        return None
+    if buf[start:end].isascii():
+        return end
+    
+    # Caminho lento: contar caracteres UTF-8 (bytes de continuação não contam)
+    end = start
+    remaining = length
+    while remaining > 0:
+        segment = buf[end:end + remaining]
+        if len(segment) < remaining:
+            return None
+        remaining -= sum(1 for b in segment if b & 0xC0 != 0x80)
+        end += len(segment)
+    while end < len(buf) and buf[end] & 0xC0 == 0x80:
+        end += 1
+    return end
+
+
+class TailReport(NamedTuple):
+    """State of the end of a recording, as found by scan_tail."""
+    valid_end: int                  # end of the last complete instruction
+    trailing_bytes: int             # bytes after it (partial or garbage)
+    last_sync_end: Optional[int]    # end of the last complete sync
+    last_sync_ts: Optional[int]
+    malformed: bool                 # trailing bytes are not a partial instruction
+
+
+# Possível início de instrução: comprimento e opcode em minúsculas
+_INSTRUCTION_START = re.compile(rb"\d{1,10}\.[a-z]")
+
+
+def scan_tail(fileobj: BinaryIO, file_size: int) -> Optional[TailReport]:
+    """
+    Find the last complete instruction and ``sync`` by scanning backwards.
+    
+    Reading backwards is ambiguous (``;`` may appear inside values), so the
+    scan takes a window at the end of the file and looks for the earliest
+    position after a ``;`` from which instructions parse forward up to a
+    ``sync`` and on to the end, or to a malformed tail. The window grows
+    until such a point is found, so only the tail of a healthy recording is
+    read. Returns None if nothing in the last TAIL_MAX_WINDOW bytes parses.
+    """
+    window = min(TAIL_WINDOW, file_size)
+    
+    while True:
+        base = file_size - window
+        fileobj.seek(base)
+        data = fileobj.read(window)
+        ascii_only = data.isascii()
+        
+        if base == 0:
+            candidates = [0]
+        else:
+            candidates = [
+                m.start() for m in _INSTRUCTION_START.finditer(data)
+                if m.start() > 0 and data[m.start() - 1] == 0x3B  # ;
+            ]
+        
+        # Partidas que convergem para um caminho já rejeitado terminam igual
+        rejected = set()
+        for start in candidates:
+            report = _parse_tail(data, start, base, ascii_only, rejected)
+            if report is not None:
+                return report
+        
+        if base == 0 or window >= TAIL_MAX_WINDOW:
+            return None
+        window = min(window * 4, file_size, TAIL_MAX_WINDOW)
+
+
+def _parse_tail(data: bytes, pos: int, base: int, ascii_only: bool, rejected: set) -> Optional[TailReport]:
+    """
+    Parse ``data`` forward from ``pos``. None if the path is rejected: it
+    has no ``sync`` (unless it starts the file), fails before a complete
+    instruction, or joins a path rejected before.
+    """
+    visited = []
+    last_sync_end = last_sync_ts = None
+    
+    while True:
+        if pos in rejected:
+            rejected.update(visited)
+            return None
+        visited.append(pos)
+        
+        try:
+            parsed = _scan_instruction(data, pos, base + pos, ascii_only)
+        except GuacamoleParseError:
+            parsed = False
+        
+        if not parsed:
+            malformed = parsed is False
+            if (malformed and len(visited) < 2) or (last_sync_end is None and base > 0):
+                rejected.update(visited)
+                return None
+            return TailReport(base + pos, len(data) - pos, last_sync_end, last_sync_ts, malformed)
+        
+        bounds, end = parsed
+        if data[bounds[0]:bounds[1]] == b"sync" and len(bounds) >= 4:
+            try:
+                last_sync_ts = int(data[bounds[2]:bounds[3]])
+                last_sync_end = base + end
+            except ValueError:
+                pass
+        pos = end
+
+
+class RecordingHeader(NamedTuple):
+    """What the first instructions of a recording say about the session."""
+    width: Optional[int]
+    height: Optional[int]
+    name: Optional[str]             # nome anunciado pelo guacd (hostname no RDP/SSH)
+    arguments: Dict[str, str]       # valores de streams argv, sem segredos
+    first_sync_ts: Optional[int]
+    instructions: int               # instruções completas no trecho lido
+    
+    def to_dict(self) -> Dict[str, object]:
+        return self._asdict()
+
+
+def parse_header(data: bytes) -> RecordingHeader:
+    """
+    Read the connection details from the start of a recording: the first
+    ``size`` of the default layer, ``name``, and text ``argv`` streams
+    (connection parameters). Stops at the end of ``data`` or at the first
+    malformed instruction.
+    """
+    width = height = name = first_sync_ts = None
+    arguments: Dict[str, str] = {}
+    argv_streams: Dict[str, Tuple[str, List[str]]] = {}
+    ascii_only = data.isascii()
+    count = 0
+    pos = 0
+    
+    while True:
+        try:
+            parsed = _scan_instruction(data, pos, pos, ascii_only)
+        except GuacamoleParseError:
+            break
+        if parsed is None:
+            break
+        bounds, end = parsed
+        instruction = RawInstruction(data, pos, pos, end, bounds)
+        pos = end
+        count += 1
+        
+        opcode = instruction.opcode
+        nargs = instruction.arg_count
+        if opcode == "sync":
+            if first_sync_ts is None:
+                first_sync_ts = sync_timestamp(instruction)
+        elif opcode == "size" and width is None and nargs >= 3 and instruction.arg(0) == DEFAULT_LAYER:
+            try:
+                width, height = int(instruction.arg_bytes(1)), int(instruction.arg_bytes(2))
+            except ValueError:
+                pass
+        elif opcode == "name" and name is None and nargs:
+            name = instruction.arg(0)
+        elif opcode == "argv" and nargs >= 3 and instruction.arg(1).startswith("text/"):
+            arg_name = instruction.arg(2)
+            if not _is_secret_argument(arg_name):
+                argv_streams[instruction.arg(0)] = (arg_name, [])
+        elif opcode == "blob" and nargs >= 2 and instruction.arg(0) in argv_streams:
+            argv_streams[instruction.arg(0)][1].append(instruction.arg(1))
+        elif opcode == "end" and nargs and instruction.arg(0) in argv_streams:
+            arg_name, chunks = argv_streams.pop(instruction.arg(0))
+            value = _decode_b64_prefix("".join(chunks), MAX_HEADER_ARGUMENT_CHARS)
+            arguments[arg_name] = value.decode("utf-8", errors="replace")
+    
+    return RecordingHeader(width, height, name, arguments, first_sync_ts, count)
+
+
+def _is_secret_argument(name: str) -> bool:
+    lowered = name.lower()
+    return any(word in lowered for word in SECRET_ARGUMENT_WORDS)
+
+
+def sniff_header(path: str, max_bytes: int = HEADER_SNIFF_BYTES) -> Optional[RecordingHeader]:
+    """
+    Parse the header of a recording file without reading the rest of it.
+    Plain recordings are mapped rather than read; compressed ones
+    decompress only the first ``max_bytes``. None for an empty file.
+    """
+    if is_remote(path) or detect_codec(path):
+        with open_recording(path) as source:
+            data = source.read(max_bytes)
+    else:
+        with open(path, "rb") as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[:max_bytes]
+            except ValueError:  # arquivo vazio não pode ser mapeado
+                return None
+    if not data:
+        return None
+    return parse_header(data)
+
+
+def encode_instruction(opcode: str, *args) -> bytes:
+    """Encode an instruction in Guacamole wire format."""
+    elements = []
+    for value in (opcode,) + tuple(str(a) for a in args):
+        elements.append(f"{len(value)}.{value}")
+    return (",".join(elements) + ";").encode("utf-8")
+
+
+def sync_timestamp(instruction) -> Optional[int]:
+    """Timestamp (ms) of a ``sync`` instruction (decoded or raw), or None."""
+    if instruction.opcode != "sync":
+        return None
+    try:
+        if isinstance(instruction, RawInstruction):
+            return int(instruction.arg_bytes(0)) if instruction.arg_count else None
+        return int(instruction.args[0]) if instruction.args else None
+    except ValueError:
+        return None
+
+
+def image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Width/height from the header of a PNG or JPEG image, if recognizable."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    
+    if data.startswith(b"\xff\xd8"):
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+            # SOF0..SOF15, exceto DHT/JPG/DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return width, height
+            i += 2 + seg_len
+    
+    return None
+
+
+def _decode_b64_prefix(value: str, max_chars: int = 8192) -> bytes:
+    prefix = value[:max_chars]
+    prefix = prefix[:len(prefix) - len(prefix) % 4]
+    try:
+        return base64.b64decode(prefix)
+    except ValueError:
+        return b""
+
+
+class KeyframeTracker:
+    """
+    Detect points where the default layer is completely repainted.
+
+    Everything drawn on the default layer before such a point is hidden, so a
+    player starting there only needs the layer/state instructions seen so far.
+    Detection covers full-size ``img``/``png`` draws and opaque ``rect``+``cfill``.
+    """
+    
+    def __init__(self):
+        self.layer_sizes: Dict[str, Tuple[int, int]] = {}
+        self._pending_images: Dict[str, int] = {}
+        self._last_rect: Dict[str, Tuple[int, Tuple[int, int, int, int]]] = {}
+    
+    def feed(self, instruction: Instruction) -> Optional[int]:
+        """Consume an instruction; return the keyframe start offset if one completes."""
+        opcode, args = instruction.opcode, instruction.args
+        
+        if opcode == "size" and len(args) >= 3:
+            try:
+                self.layer_sizes[args[0]] = (int(args[1]), int(args[2]))
+            except ValueError:
+                pass
+        
+        elif opcode == "img" and len(args) >= 6:
+            stream, mask, layer, _mimetype, x, y = args[:6]
+            if layer == DEFAULT_LAYER and mask in REPLACING_MASKS and x == "0" and y == "0":
+                self._pending_images[stream] = instruction.offset
+        
+        elif opcode == "blob" and len(args) >= 2:
+            start = self._pending_images.pop(args[0], None)
+            if start is not None and self._covers_layer(_decode_b64_prefix(args[1])):
+                return start
+        
+        elif opcode == "end" and args:
+            self._pending_images.pop(args[0], None)
+        
+        elif opcode == "png" and len(args) >= 5:
+            mask, layer, x, y, data = args[:5]
+            if (layer == DEFAULT_LAYER and mask in REPLACING_MASKS and x == "0" and y == "0"
+                    and self._covers_layer(_decode_b64_prefix(data))):
+                return instruction.offset
+        
+        elif opcode == "rect" and len(args) >= 5:
+            try:
+                self._last_rect[args[0]] = (
+                    instruction.offset, tuple(int(v) for v in args[1:5])
+                )
+            except ValueError:
+                pass
+        
+        elif opcode == "cfill" and len(args) >= 6:
+            mask, layer, alpha = args[0], args[1], args[5]
+            rect = self._last_rect.get(layer)
+            if layer == DEFAULT_LAYER and rect and mask in REPLACING_MASKS and alpha == "255":
+                start, (x, y, w, h) = rect
+                size = self.layer_sizes.get(DEFAULT_LAYER)
+                if size and x <= 0 and y <= 0 and x + w >= size[0] and y + h >= size[1]:
+                    return start
+        
+        return None
+    
+    def _covers_layer(self, image_head: bytes) -> bool:
+        size = self.layer_sizes.get(DEFAULT_LAYER)
+        dims = image_dimensions(image_head)
+        return bool(size and dims and dims[0] >= size[0] and dims[1] >= size[1])
+
+
+# Posição do argumento de camada de destino nas instruções de desenho
+DRAWING_LAYER_ARG = {
+    "rect": 0, "arc": 0, "curve": 0, "line": 0, "start": 0, "close": 0,
+    "clip": 0, "reset": 0, "push": 0, "pop": 0, "identity": 0, "transform": 0,
+    "cfill": 1, "cstroke": 1, "lfill": 1, "lstroke": 1,
+    "png": 1, "jpeg": 1, "img": 2, "copy": 6, "transfer": 6,
+}
+
+
+# Estado de desenho de uma camada (pilha e transformação), não pixels: nunca é
+# coberto por um repaint e não pode ser descartado sem desbalancear push/pop
+LAYER_STATE_OPCODES = frozenset({"push", "pop", "reset", "identity", "transform"})
+
+# Posição do argumento de camada de origem nas instruções que leem uma camada
+SOURCE_LAYER_ARG = {"copy": 0, "transfer": 0, "cursor": 2}
+
+# Instruções que compõem o estado da tela (camadas, desenho, cursor). As demais
+# são entrada do usuário (key, mouse), clipboard, áudio/vídeo, arquivos e pipes;
+# blob/end pertencem a qualquer stream e contam só junto com o img que o abriu
+DISPLAY_OPCODES = frozenset(DRAWING_LAYER_ARG) | {
+    "size", "move", "shade", "distort", "dispose", "set", "cursor", "blob", "end",
+}
+
+
+def drawing_layer(instruction: Instruction) -> Optional[str]:
+    """Layer an instruction draws into, or None if it does not draw."""
+    index = DRAWING_LAYER_ARG.get(instruction.opcode)
+    if index is None or len(instruction.args) <= index:
+        return None
+    return instruction.args[index]
+
+
+def source_layer(instruction: Instruction) -> Optional[str]:
+    """Layer an instruction reads pixels from (copy, transfer, cursor), or None."""
+    index = SOURCE_LAYER_ARG.get(instruction.opcode)
+    if index is None or len(instruction.args) <= index:
+        return None
+    return instruction.args[index]
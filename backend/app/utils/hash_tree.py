@@ -0,0 +1,318 @@
+"""
+Nachos Replay for Guaca - Hash Trees
+Per-block SHA-256 of recording content, for partial verification.
+
+The content (decompressed, as served) is split in fixed blocks of
+``hash_tree_block_mb``. Each block's SHA-256 is a leaf and the root is
+the SHA-256 of the concatenated leaves, a two-level Merkle tree. The
+leaves are stored as one binary string of 32 bytes per block (a 3 GB
+recording takes 24 KB) and the root is kept on the replay next to its
+whole-file checksum.
+
+Blocks hash independently: in parallel threads at ingest and when
+scrubbing (hashlib releases the GIL), one at a time to verify a Range
+request, and a damaged region is located to its blocks instead of only
+"file bad".
+"""
+import hashlib
+import io
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import BinaryIO, Deque, List, NamedTuple, Optional, Tuple
+
+from app.config import settings
+from app.utils.compression import is_random_access, open_recording
+
+DIGEST_SIZE = 32
+
+# Blocos em hashing ao mesmo tempo, por núcleo do pool
+INFLIGHT_PER_WORKER = 2
+
+
+class HashTree(NamedTuple):
+    """Leaves of a recording's content, ``block_size`` bytes each (the last may be shorter)."""
+    block_size: int
+    size: int
+    leaves: bytes
+    
+    @property
+    def root(self) -> str:
+        return tree_root(self.leaves)
+    
+    @property
+    def block_count(self) -> int:
+        return len(self.leaves) // DIGEST_SIZE
+    
+    def leaf(self, index: int) -> bytes:
+        return self.leaves[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+    
+    def block_range(self, index: int) -> Tuple[int, int]:
+        """(start, end) byte offsets of a block, end exclusive."""
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.size)
+    
+    def diff(self, other: "HashTree") -> List[int]:
+        """Indexes of the blocks that differ from ``other`` (missing blocks included)."""
+        count = max(self.block_count, other.block_count)
+        return [i for i in range(count) if self.leaf(i) != other.leaf(i)]
+
+
+def tree_root(leaves: bytes) -> str:
+    return hashlib.sha256(leaves).hexdigest()
+
+
+def block_size_bytes() -> int:
+    return settings.hash_tree_block_mb * 1024 * 1024
+
+
+def _digest(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+class _Digests:
+    """Block digests in order, computed inline or in ``executor`` with a bounded backlog."""
+    
+    def __init__(self, executor: Optional[Executor]):
+        self.executor = executor
+        self.limit = max(1, getattr(executor, "_max_workers", 1) * INFLIGHT_PER_WORKER)
+        self.done: List[bytes] = []
+        self.pending: Deque[Future] = deque()
+    
+    def add(self, data):
+        if self.executor is None:
+            self.done.append(_digest(data))
+            return
+        while len(self.pending) >= self.limit:
+            self.done.append(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(_digest, data))
+    
+    def result(self) -> List[bytes]:
+        while self.pending:
+            self.done.append(self.pending.popleft().result())
+        return self.done
+
+
+class ContentHasher:
+    """
+    Whole-content SHA-256 and hash tree of data fed in pieces (an upload,
+    a file being read). The whole-file hash is inherently serial; block
+    hashes are computed in ``executor``, alongside it.
+    """
+    
+    def __init__(self, block_size: Optional[int] = None, executor: Optional[Executor] = None):
+        self.block_size = block_size or block_size_bytes()
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._block = bytearray()
+        self._digests = _Digests(executor)
+    
+    def update(self, data: bytes):
+        self._sha256.update(data)
+        self.size += len(data)
+        view = memoryview(data)
+        # Blocos inteiros alinhados são hasheados sem cópia (``data`` é imutável)
+        while not self._block and len(view) >= self.block_size and isinstance(data, bytes):
+            self._digests.add(view[:self.block_size])
+            view = view[self.block_size:]
+        while view:
+            take = min(self.block_size - len(self._block), len(view))
+            self._block += view[:take]
+            view = view[take:]
+            if len(self._block) == self.block_size:
+                self._digests.add(bytes(self._block))
+                self._block = bytearray()
+    
+    def finish(self) -> Tuple[str, HashTree]:
+        """(hex SHA-256 of the content, its hash tree)."""
+        if self._block:
+            self._digests.add(bytes(self._block))
+            self._block = bytearray()
+        leaves = b"".join(self._digests.result())
+        return self._sha256.hexdigest(), HashTree(self.block_size, self.size, leaves)
+
+
+def hash_content(
+    location: str,
+    block_size: Optional[int] = None,
+    executor: Optional[Executor] = None,
+    limiter=None,
+    io_ratio: float = 1.0
+) -> Tuple[str, HashTree]:
+    """
+    Whole-content checksum and hash tree of a stored recording, in one
+    sequential read (runs in a worker thread). With ``limiter`` (see
+    IORateLimiter), each block read is charged ``io_ratio`` times its size.
+    """
+    hasher = ContentHasher(block_size, executor)
+    with open_recording(location) as f:
+        while True:
+            data = f.read(hasher.block_size)
+            if not data:
+                break
+            if limiter is not None:
+                limiter.consume(len(data) * io_ratio)
+            hasher.update(data)
+    return hasher.finish()
+
+
+def rehash_blocks(
+    location: str,
+    block_size: int,
+    executor: Optional[Executor] = None,
+    limiter=None,
+    io_ratio: float = 1.0
+) -> HashTree:
+    """
+    Hash tree of a stored recording, without the serial whole-file hash;
+    compare with the stored one (HashTree.diff) to locate damaged blocks.
+    Random-access content (plain, sgzip, chunked) is read in parallel,
+    each block by its own reader in ``executor``; other codecs are read in
+    order and their blocks hashed in ``executor``.
+    """
+    with open_recording(location) as f:
+        if executor is not None and is_random_access(f):
+            size = _reader_size(f)
+            count = (size + block_size - 1) // block_size
+            leaves = _map_ordered(
+                executor,
+                lambda index: _read_block_digest(location, index, block_size, limiter, io_ratio),
+                range(count)
+            )
+            return HashTree(block_size, size, b"".join(leaves))
+        
+        digests = _Digests(executor)
+        size = 0
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            if limiter is not None:
+                limiter.consume(len(data) * io_ratio)
+            digests.add(data)
+            size += len(data)
+    return HashTree(block_size, size, b"".join(digests.result()))
+
+
+def _map_ordered(executor: Executor, func, items) -> List[bytes]:
+    """executor.map with a bounded backlog (a few blocks in memory per worker)."""
+    limit = max(1, getattr(executor, "_max_workers", 1) * INFLIGHT_PER_WORKER)
+    pending: Deque[Future] = deque()
+    results = []
+    for item in items:
+        if len(pending) >= limit:
+            results.append(pending.popleft().result())
+        pending.append(executor.submit(func, item))
+    while pending:
+        results.append(pending.popleft().result())
+    return results
+
+
+def _read_block_digest(location: str, index: int, block_size: int, limiter, io_ratio: float) -> bytes:
+    with open_recording(location) as f:
+        f.seek(index * block_size)
+        data = f.read(block_size)
+    if limiter is not None:
+        limiter.consume(len(data) * io_ratio)
+    return _digest(data)
+
+
+def _reader_size(f: BinaryIO) -> int:
+    size = getattr(f, "size", None)
+    if size is None and isinstance(f, io.BufferedReader):
+        size = getattr(f.raw, "size", None)
+    if size is None:
+        size = f.seek(0, io.SEEK_END)
+        f.seek(0)
+    return size
+
+
+class VerifiedReader(io.RawIOBase):
+    """
+    Reader that checks every block it serves against a hash tree. Reads
+    load the whole block under the position, so a Range request costs at
+    most one extra block at each end. A block that doesn't match raises
+    BlockMismatchError instead of serving corrupted bytes.
+    """
+    
+    def __init__(self, raw: BinaryIO, tree: HashTree):
+        super().__init__()
+        self.raw = raw
+        self.tree = tree
+        self.size = tree.size
+        self._pos = 0
+        self._index = -1
+        self._block = b""
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        if self._pos >= self.size:
+            return 0
+        index = self.check()
+        offset = self._pos - index * self.tree.block_size
+        view = memoryview(buffer).cast("B")
+        n = min(len(view), len(self._block) - offset)
+        view[:n] = self._block[offset:offset + n]
+        self._pos += n
+        return n
+    
+    def check(self) -> int:
+        """Load and verify the block under the position (before responding); returns its index."""
+        index = self._pos // self.tree.block_size
+        if index == self._index:
+            return index
+        start, end = self.tree.block_range(index)
+        self.raw.seek(start)
+        data = self.raw.read(end - start)
+        if len(data) != end - start or _digest(data) != self.tree.leaf(index):
+            raise BlockMismatchError(index, start, end)
+        self._index = index
+        self._block = data
+        return index
+    
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class BlockMismatchError(IOError):
+    """A block's content doesn't match its leaf in the hash tree."""
+    
+    def __init__(self, index: int, start: int, end: int):
+        super().__init__(f"block {index} (bytes {start}-{end - 1}) does not match its hash")
+        self.index = index
+        self.start = start
+        self.end = end
+
+
+def block_ranges(tree: HashTree, indexes: List[int]) -> List[List[int]]:
+    """Merge block indexes into [start, end] byte ranges of the content (end inclusive)."""
+    ranges: List[List[int]] = []
+    for index in sorted(indexes):
+        start = index * tree.block_size
+        end = start + tree.block_size - 1
+        if index < tree.block_count:
+            end = min(end, tree.size - 1)
+        if ranges and ranges[-1][1] + 1 >= start:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
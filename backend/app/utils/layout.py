@@ -0,0 +1,82 @@
+"""
+Nachos Replay for Guaca - Storage Layout
+Directories of the recordings stored under ``replay_storage_path``.
+
+Recordings are grouped by area and date (``hot/2025/03/``; COLD by year
+only) and, below that, spread over ``storage_shard_levels`` levels of
+``storage_shard_width`` hex digits of a hash of the file's base name
+(``hot/2025/03/4f/a2/<file>``), so a busy month doesn't put 100k files in
+one directory. The base name leaves out the compression and manifest
+suffixes: a recording keeps its shard when it is compressed, chunked or
+moved to another tier, and replays sharing a file agree on where it goes.
+Zero levels is the flat layout of earlier versions.
+"""
+import hashlib
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from app.config import settings
+from app.utils.chunk_store import MANIFEST_SUFFIX
+from app.utils.compression import SUFFIXES
+
+# Níveis de data abaixo de cada área: ano/mês, ou só ano no COLD
+DATE_DEPTH = {"clips": 2, "cold": 1, "hot": 2, "uploads": 2, "warm": 2}
+
+STORED_SUFFIXES = tuple(sorted(set(SUFFIXES.values()))) + (MANIFEST_SUFFIX,)
+
+# Caches derivados de cada replay, em <área>/<id do replay>/
+REPLAY_CACHE_DIRS = ("renditions", "thumbnails")
+
+
+def base_name(name: str) -> str:
+    """File name without the suffixes added when storing it (``.gz``, ``.zst``, ``.chunks``)."""
+    while name.endswith(STORED_SUFFIXES):
+        name = name[:name.rindex(".")]
+    return name
+
+
+def shard_parts(name: str, levels: Optional[int] = None, width: Optional[int] = None) -> Tuple[str, ...]:
+    """Shard directories of a stored file name, e.g. ``("4f", "a2")``."""
+    levels = settings.storage_shard_levels if levels is None else levels
+    width = settings.storage_shard_width if width is None else width
+    if levels <= 0:
+        return ()
+    digest = hashlib.sha1(base_name(name).encode("utf-8", "surrogateescape")).hexdigest()
+    return tuple(digest[i * width:(i + 1) * width] for i in range(levels))
+
+
+def recording_dir(area: str, when: datetime, name: str) -> Path:
+    """Directory for the recording file ``name`` of ``area`` (a tier, ``uploads`` or ``clips``) dated ``when``."""
+    date_parts = (str(when.year), f"{when.month:02d}")[:DATE_DEPTH[area]]
+    return Path(settings.replay_storage_path).joinpath(area, *date_parts, *shard_parts(name))
+
+
+def replay_cache_dir(area: str, replay_id) -> Path:
+    """Directory of the files of ``area`` (``renditions`` or ``thumbnails``) derived from a replay."""
+    return Path(settings.replay_storage_path) / area / str(replay_id)
+
+
+def remove_replay_caches(replay_id):
+    """Remove the renditions and thumbnails of a replay."""
+    for area in REPLAY_CACHE_DIRS:
+        shutil.rmtree(replay_cache_dir(area, replay_id), ignore_errors=True)
+
+
+def layout_location(location: str) -> Optional[str]:
+    """
+    Where a stored local file belongs in the configured layout (its own
+    location if already there), or None if it isn't a recording under
+    ``replay_storage_path``.
+    """
+    root = Path(settings.replay_storage_path)
+    try:
+        parts = Path(location).relative_to(root).parts
+    except ValueError:
+        return None
+    depth = DATE_DEPTH.get(parts[0]) if parts else None
+    if depth is None or len(parts) < depth + 2:
+        return None
+    name = parts[-1]
+    return str(root.joinpath(*parts[:depth + 1], *shard_parts(name), name))
@@ -0,0 +1,166 @@
+"""
+Nachos Replay for Guaca - Pack Files
+Small COLD recordings appended into large immutable files.
+
+Years of retention leave millions of small SSH recordings in COLD, one
+inode each, and backups and filesystem scans walk them one by one. They
+are appended instead, as stored (compressed or not), into pack files of
+about ``pack_target_mb`` under ``packs/YYYY/MM/<uuid>.pack``::
+    
+    header | member | member | ... | index | trailer
+
+The index has one entry per member: offset, length, SHA-256 of its
+stored bytes and file name; the trailer holds the index offset and entry
+count. A pack is written under a temporary name and renamed once its
+index is on disk, and never changes afterwards. Members are addressed by
+``pack://<key>#<offset>+<length>`` locations (see storage), so reads are
+range reads of the pack; deleting a replay leaves its bytes in place
+until compaction rewrites the pack (see PackService).
+
+The index is also kept in the database; the copy in the file makes each
+pack self-describing, for verification and disaster recovery.
+"""
+import hashlib
+import os
+import struct
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, List, NamedTuple, Union
+from uuid import uuid4
+
+from app.config import settings
+
+PACK_MAGIC = b"NRPK"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<4sB3x")     # magic, versão
+PACK_ENTRY = struct.Struct("<QQ32sH")     # offset, tamanho, sha256, tamanho do nome
+PACK_TRAILER = struct.Struct("<QI4s")     # offset do índice, membros, magic
+
+PACK_DIR = "packs"
+PACK_SUFFIX = ".pack"
+PARTIAL_SUFFIX = ".part"
+
+COPY_SIZE = 1024 * 1024
+
+PathLike = Union[str, Path]
+
+
+class PackMember(NamedTuple):
+    offset: int
+    length: int
+    checksum: str  # SHA-256 dos bytes armazenados (não do conteúdo descomprimido)
+    name: str
+
+
+def pack_root() -> Path:
+    return Path(settings.replay_storage_path) / PACK_DIR
+
+
+def new_pack_path(when: datetime) -> Path:
+    return pack_root() / str(when.year) / f"{when.month:02d}" / f"{uuid4().hex}{PACK_SUFFIX}"
+
+
+class PackWriter:
+    """
+    Writes one pack file: add members, then seal (index, fsync, rename)
+    or abort. Runs in a worker thread.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.partial = path.with_name(path.name + PARTIAL_SUFFIX)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.partial, "wb")
+        self._file.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION))
+        self.size = PACK_HEADER.size
+        self.members: List[PackMember] = []
+    
+    def add(self, source: BinaryIO, name: str, length: int = -1) -> PackMember:
+        """Append ``length`` bytes (or all) of ``source``."""
+        sha256 = hashlib.sha256()
+        offset = self.size
+        remaining = length
+        while remaining:
+            data = source.read(COPY_SIZE if remaining < 0 else min(COPY_SIZE, remaining))
+            if not data:
+                break
+            sha256.update(data)
+            self._file.write(data)
+            self.size += len(data)
+            remaining -= len(data)
+        if remaining > 0:
+            raise EOFError(f"{name}: {remaining} bytes missing")
+        member = PackMember(offset, self.size - offset, sha256.hexdigest(), name)
+        self.members.append(member)
+        return member
+    
+    def add_file(self, path: PathLike) -> PackMember:
+        with open(path, "rb") as f:
+            return self.add(f, Path(path).name)
+    
+    def seal(self) -> int:
+        """Write the index and make the pack visible under its name. Returns its size."""
+        index_offset = self.size
+        for member in self.members:
+            name = member.name.encode("utf-8", "surrogateescape")
+            self._file.write(PACK_ENTRY.pack(member.offset, member.length, bytes.fromhex(member.checksum), len(name)))
+            self._file.write(name)
+        self._file.write(PACK_TRAILER.pack(index_offset, len(self.members), PACK_MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.partial, self.path)
+        self.size = self.path.stat().st_size
+        return self.size
+    
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+        self.partial.unlink(missing_ok=True)
+
+
+def read_pack_index(path: PathLike) -> List[PackMember]:
+    """Members listed in a pack's index."""
+    with open(path, "rb") as f:
+        magic, version = PACK_HEADER.unpack(f.read(PACK_HEADER.size))
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError(f"not a pack file: {path}")
+        f.seek(-PACK_TRAILER.size, os.SEEK_END)
+        trailer_offset = f.tell()
+        index_offset, count, magic = PACK_TRAILER.unpack(f.read(PACK_TRAILER.size))
+        if magic != PACK_MAGIC or index_offset > trailer_offset:
+            raise ValueError(f"pack without index: {path}")
+        f.seek(index_offset)
+        data = f.read(trailer_offset - index_offset)
+    
+    members = []
+    pos = 0
+    for _ in range(count):
+        offset, length, digest, name_size = PACK_ENTRY.unpack_from(data, pos)
+        pos += PACK_ENTRY.size
+        name = data[pos:pos + name_size].decode("utf-8", "surrogateescape")
+        pos += name_size
+        members.append(PackMember(offset, length, digest.hex(), name))
+    if pos != len(data):
+        raise ValueError(f"corrupt pack index: {path}")
+    return members
+
+
+def copy_member(source: BinaryIO, member: PackMember, writer: PackWriter) -> PackMember:
+    """Copy a member of an open pack into ``writer``, checking its SHA-256."""
+    source.seek(member.offset)
+    copied = writer.add(source, member.name, member.length)
+    if copied.checksum != member.checksum:
+        raise ValueError(f"member {member.name} at {member.offset} does not match its checksum")
+    return copied
+
+
+def remove_pack(path: PathLike):
+    Path(path).unlink(missing_ok=True)
+    parent = Path(path).parent
+    # Diretórios de mês/ano vazios
+    for directory in (parent, parent.parent):
+        try:
+            directory.rmdir()
+        except OSError:
+            break
@@ -0,0 +1,438 @@
+"""
+Nachos Replay for Guaca - Storage Backends
+Where stored recordings live: local filesystem or S3-compatible object storage.
+
+``Replay.stored_path`` is a location: an absolute local path, or an
+``s3://bucket/key`` URI for objects. Each tier is mapped to a backend
+(``STORAGE_BACKEND_HOT``/``_WARM``/``_COLD``) and, for S3, to its own
+bucket, so COLD recordings can move to cheap object storage while the
+API keeps reading them through open_recording.
+
+- ``local``: files under ``replay_storage_path``.
+- ``s3``: any S3-compatible service (AWS, MinIO, Ceph), through ``boto3``
+  (optional dependency, imported on first use). One client per process
+  with a pooled connection set is shared by all threads; uploads use
+  parallel multipart transfers and reads are ranged GETs, so seeking
+  into an object (sgzip frames, HTTP Range requests) fetches only the
+  bytes read.
+
+Chunk manifests (see chunk_store) reference a local chunk store and are
+only written to local tiers.
+
+Small COLD recordings may be appended to a local pack file (see
+pack_store); their location is ``pack://<pack key>#<offset>+<length>``
+and reads are reads of that range of the pack.
+"""
+import io
+import logging
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+S3_SCHEME = "s3://"
+PACK_SCHEME = "pack://"
+BACKENDS = ("local", "s3")
+
+# Leitura antecipada de membros de packs (a leitura sequencial domina)
+PACK_READ_SIZE = 1024 * 1024
+
+PathLike = Union[str, Path]
+
+
+def is_remote(location: PathLike) -> bool:
+    return isinstance(location, str) and location.startswith(S3_SCHEME)
+
+
+def is_packed(location: PathLike) -> bool:
+    return isinstance(location, str) and location.startswith(PACK_SCHEME)
+
+
+def pack_location(key: str, offset: int, length: int) -> str:
+    """Location of the member at ``offset`` of the pack file ``key``."""
+    return f"{PACK_SCHEME}{key}#{offset}+{length}"
+
+
+def parse_pack_location(location: str) -> Tuple[Path, int, int]:
+    """(pack file, offset, length) of a ``pack://key#offset+length`` location."""
+    key, _, span = location[len(PACK_SCHEME):].rpartition("#")
+    offset, _, length = span.partition("+")
+    if not key or not offset.isdigit() or not length.isdigit():
+        raise ValueError(f"invalid pack location: {location}")
+    return Path(settings.replay_storage_path) / key, int(offset), int(length)
+
+
+def parse_s3_location(location: str) -> Tuple[str, str]:
+    """(bucket, key) of an ``s3://bucket/key`` location."""
+    bucket, _, key = location[len(S3_SCHEME):].partition("/")
+    if not bucket or not key:
+        raise ValueError(f"invalid S3 location: {location}")
+    return bucket, key
+
+
+class StorageBackend(ABC):
+    """Holds recording files and opens them for reading by location."""
+    
+    name = ""
+    
+    @abstractmethod
+    def fetch(self, location: str, target: Path) -> Path:
+        """Copy the file at ``location`` to the local path ``target``."""
+    
+    @abstractmethod
+    def open(self, location: str) -> BinaryIO:
+        """Seekable binary reader of the stored bytes."""
+    
+    @abstractmethod
+    def exists(self, location: str) -> bool:
+        """Whether a file is stored at ``location``."""
+    
+    @abstractmethod
+    def size(self, location: str) -> int:
+        """Size in bytes of the stored file."""
+    
+    @abstractmethod
+    def delete(self, location: str):
+        """Remove the file at ``location``; missing files are ignored."""
+
+
+class WritableStorageBackend(StorageBackend):
+    """Backend that a storage tier can be mapped to: new files are put in it."""
+    
+    @abstractmethod
+    def put(self, source: Path, key: str, move: bool = True) -> str:
+        """Store the local file ``source`` under ``key``; returns its location."""
+
+
+class LocalStorageBackend(WritableStorageBackend):
+    """Files under ``replay_storage_path``; keys are relative paths."""
+    
+    name = "local"
+    
+    def __init__(self, root: Optional[PathLike] = None):
+        self.root = Path(root or settings.replay_storage_path)
+    
+    def put(self, source: Path, key: str, move: bool = True) -> str:
+        target = self.root / key
+        if target != source:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if move:
+                shutil.move(str(source), str(target))
+            else:
+                shutil.copy2(source, target)
+        return str(target)
+    
+    def fetch(self, location: str, target: Path) -> Path:
+        shutil.copy2(location, target)
+        return target
+    
+    def open(self, location: str) -> BinaryIO:
+        return open(location, "rb")
+    
+    def exists(self, location: str) -> bool:
+        return Path(location).exists()
+    
+    def size(self, location: str) -> int:
+        return Path(location).stat().st_size
+    
+    def delete(self, location: str):
+        Path(location).unlink(missing_ok=True)
+
+
+class S3StorageBackend(WritableStorageBackend):
+    """S3-compatible object storage; one bucket per tier (see STORAGE_BACKEND_*)."""
+    
+    name = "s3"
+    
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.prefix = settings.s3_prefix.strip("/")
+    
+    def put(self, source: Path, key: str, move: bool = True) -> str:
+        from boto3.s3.transfer import TransferConfig
+        
+        key = f"{self.prefix}/{key}" if self.prefix else key
+        # Acima do limiar, partes de s3_multipart_chunk_mb enviadas em paralelo
+        config = TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold_mb * 1024 * 1024,
+            multipart_chunksize=settings.s3_multipart_chunk_mb * 1024 * 1024,
+            max_concurrency=settings.s3_transfer_concurrency,
+            use_threads=settings.s3_transfer_concurrency > 1
+        )
+        get_s3_client().upload_file(str(source), self.bucket, key, Config=config)
+        if move:
+            source.unlink()
+        return f"{S3_SCHEME}{self.bucket}/{key}"
+    
+    def fetch(self, location: str, target: Path) -> Path:
+        from boto3.s3.transfer import TransferConfig
+        
+        bucket, key = parse_s3_location(location)
+        config = TransferConfig(
+            multipart_chunksize=settings.s3_multipart_chunk_mb * 1024 * 1024,
+            max_concurrency=settings.s3_transfer_concurrency,
+            use_threads=settings.s3_transfer_concurrency > 1
+        )
+        get_s3_client().download_file(bucket, key, str(target), Config=config)
+        return target
+    
+    def open(self, location: str) -> BinaryIO:
+        bucket, key = parse_s3_location(location)
+        raw = S3ObjectReader(bucket, key)
+        return io.BufferedReader(raw, buffer_size=settings.s3_read_block_kb * 1024)
+    
+    def exists(self, location: str) -> bool:
+        try:
+            self.size(location)
+        except FileNotFoundError:
+            return False
+        return True
+    
+    def size(self, location: str) -> int:
+        bucket, key = parse_s3_location(location)
+        return _head_object(bucket, key)["ContentLength"]
+    
+    def delete(self, location: str):
+        bucket, key = parse_s3_location(location)
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+
+
+class PackStorageBackend(StorageBackend):
+    """
+    Members of local pack files (see pack_store). Read-only: packs are
+    written by PackService; deleting a member leaves its bytes in the pack
+    until compaction.
+    """
+    
+    name = "pack"
+    
+    def fetch(self, location: str, target: Path) -> Path:
+        with self.open(location) as source, open(target, "wb") as out:
+            shutil.copyfileobj(source, out, PACK_READ_SIZE)
+        return target
+    
+    def open(self, location: str) -> BinaryIO:
+        path, offset, length = parse_pack_location(location)
+        return io.BufferedReader(FileRangeReader(path, offset, length), buffer_size=PACK_READ_SIZE)
+    
+    def exists(self, location: str) -> bool:
+        path, offset, length = parse_pack_location(location)
+        try:
+            return path.stat().st_size >= offset + length
+        except FileNotFoundError:
+            return False
+    
+    def size(self, location: str) -> int:
+        path, _, length = parse_pack_location(location)
+        if not path.exists():
+            raise FileNotFoundError(location)
+        return length
+    
+    def delete(self, location: str):
+        pass
+
+
+class FileRangeReader(io.RawIOBase):
+    """Seekable reader of ``length`` bytes of a local file, starting at ``offset``."""
+    
+    def __init__(self, path: PathLike, offset: int, length: int):
+        super().__init__()
+        self._file = open(path, "rb", buffering=0)
+        self.offset = offset
+        self.size = length
+        self._pos = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        n = min(len(view), self.size - self._pos)
+        if n <= 0:
+            return 0
+        self._file.seek(self.offset + self._pos)
+        read = self._file.readinto(view[:n]) or 0
+        self._pos += read
+        return read
+    
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    Seekable reader of an S3 object: each read is a ranged GET of the
+    bytes asked for (wrap in io.BufferedReader for read-ahead).
+    """
+    
+    def __init__(self, bucket: str, key: str):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.size = _head_object(bucket, key)["ContentLength"]
+        self._pos = 0
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def tell(self) -> int:
+        return self._pos
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return self._pos
+    
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        end = min(self._pos + len(view), self.size)
+        if end <= self._pos:
+            return 0
+        
+        response = get_s3_client().get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={self._pos}-{end - 1}"
+        )
+        written = 0
+        with response["Body"] as body:
+            while written < end - self._pos:
+                data = body.read(end - self._pos - written)
+                if not data:
+                    break
+                view[written:written + len(data)] = data
+                written += len(data)
+        self._pos += written
+        return written
+
+
+_s3_client = None
+_s3_lock = threading.Lock()
+_backends: Dict[str, StorageBackend] = {}
+
+
+def get_s3_client():
+    """Shared boto3 S3 client (thread-safe, with a pool of ``s3_max_pool_connections``)."""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                import boto3
+                from botocore.config import Config
+                
+                _s3_client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=settings.s3_endpoint_url or None,
+                    region_name=settings.s3_region or None,
+                    aws_access_key_id=settings.s3_access_key_id or None,
+                    aws_secret_access_key=settings.s3_secret_access_key or None,
+                    config=Config(
+                        max_pool_connections=settings.s3_max_pool_connections,
+                        retries={"max_attempts": 5, "mode": "standard"},
+                        s3={"addressing_style": "path" if settings.s3_endpoint_url else "auto"}
+                    )
+                )
+    return _s3_client
+
+
+def _head_object(bucket: str, key: str) -> dict:
+    from botocore.exceptions import ClientError
+    
+    try:
+        return get_s3_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            raise FileNotFoundError(f"{S3_SCHEME}{bucket}/{key}") from e
+        raise
+
+
+def get_tier_backend(tier: str) -> WritableStorageBackend:
+    """Backend configured for a storage tier (``hot``, ``warm`` or ``cold``)."""
+    tier = getattr(tier, "value", tier)
+    backend_name = getattr(settings, f"storage_backend_{tier}", "local")
+    if backend_name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend for {tier}: {backend_name!r}")
+    
+    if backend_name == "s3":
+        return _bucket_backend(getattr(settings, f"s3_bucket_{tier}"))
+    return _local_backend()
+
+
+def get_location_backend(location: PathLike) -> StorageBackend:
+    """Backend holding ``location``."""
+    if is_remote(location):
+        return _bucket_backend(parse_s3_location(location)[0])
+    if is_packed(location):
+        return _pack_backend()
+    return _local_backend()
+
+
+def _local_backend() -> WritableStorageBackend:
+    backend = _backends.get("")
+    if backend is None:
+        backend = _backends.setdefault("", LocalStorageBackend())
+    return backend
+
+
+def _pack_backend() -> StorageBackend:
+    backend = _backends.get(PACK_SCHEME)
+    if backend is None:
+        backend = _backends.setdefault(PACK_SCHEME, PackStorageBackend())
+    return backend
+
+
+def _bucket_backend(bucket: str) -> WritableStorageBackend:
+    backend = _backends.get(bucket)
+    if backend is None:
+        backend = _backends.setdefault(bucket, S3StorageBackend(bucket))
+    return backend
+
+
+def open_location(location: PathLike) -> BinaryIO:
+    return get_location_backend(location).open(str(location))
+
+
+def location_exists(location: Optional[PathLike]) -> bool:
+    return bool(location) and get_location_backend(location).exists(str(location))
+
+
+def location_size(location: PathLike) -> int:
+    return get_location_backend(location).size(str(location))
+
+
+def delete_location(location: PathLike):
+    get_location_backend(location).delete(str(location))
+
+
+def tier_key(path: Path) -> str:
+    """Key of a file under ``replay_storage_path`` (its relative path)."""
+    return path.relative_to(settings.replay_storage_path).as_posix()
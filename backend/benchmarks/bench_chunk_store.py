@@ -0,0 +1,131 @@
+"""
+Nachos Replay for Guaca - Chunk store benchmark
+
+Stores a set of graphical recordings that repaint the same screens (a pool
+of shared PNG tiles, sent as ``blob`` pieces under varying stream indexes)
+into a scratch chunk store, and compares the bytes on disk with
+compressing each file on its own. Also measures chunking speed and a
+full read back through ChunkedReader.
+
+Usage (from backend/):
+    python benchmarks/bench_chunk_store.py [recording.guac ...] [--sessions 8] [--size-mb 16] [--tiles 40]
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.chunk_store import ChunkWriter, ChunkedReader  # noqa: E402
+from app.utils.compression import compress_file  # noqa: E402
+from app.utils.guacamole import encode_instruction  # noqa: E402
+
+BLOB_PIECE = 4096
+
+
+def synthetic_tiles(count: int, seed: int = 5):
+    """Base64 PNG-like payloads shared by every session (taskbar, wallpaper, windows)."""
+    rng = random.Random(seed)
+    return [base64.b64encode(rng.randbytes(rng.randint(8000, 60000))).decode() for _ in range(count)]
+
+
+def synthetic_session(size_mb: int, tiles, seed: int) -> bytes:
+    """Graphical session: shared tiles and unique updates, mouse movement and syncs."""
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    out = io.BytesIO()
+    out.write(encode_instruction("size", 0, 1920, 1080))
+    ts = 1700000000000 + seed * 10 ** 6
+    stream = rng.randint(1, 64)
+    
+    while out.tell() < target:
+        for _ in range(rng.randint(0, 2)):
+            if rng.random() < 0.6:
+                payload = rng.choice(tiles)
+            else:
+                payload = base64.b64encode(rng.randbytes(rng.randint(200, 6000))).decode()
+            out.write(encode_instruction("img", stream, 14, 0, "image/png", rng.randint(0, 1800), rng.randint(0, 1000)))
+            for start in range(0, len(payload), BLOB_PIECE):
+                out.write(encode_instruction("blob", stream, payload[start:start + BLOB_PIECE]))
+            out.write(encode_instruction("end", stream))
+            stream = stream % 64 + 1
+        out.write(encode_instruction("mouse", rng.randint(0, 1919), rng.randint(0, 1079), 0, ts))
+        ts += 40
+        out.write(encode_instruction("sync", ts))
+    
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", help="recordings to store (default: synthetic)")
+    parser.add_argument("--sessions", type=int, default=8, help="number of synthetic recordings")
+    parser.add_argument("--size-mb", type=int, default=16, help="size of each synthetic recording")
+    parser.add_argument("--tiles", type=int, default=40, help="shared tiles in the synthetic recordings")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory(prefix="bench-chunks-") as tmp:
+        tmp = Path(tmp)
+        if args.recordings:
+            paths = [Path(p) for p in args.recordings]
+        else:
+            tiles = synthetic_tiles(args.tiles)
+            paths = []
+            for i in range(args.sessions):
+                path = tmp / f"session-{i}.guac"
+                path.write_bytes(synthetic_session(args.size_mb, tiles, seed=i))
+                paths.append(path)
+        
+        root = tmp / "chunks"
+        writer = ChunkWriter(root)
+        logical = per_file = stored = 0
+        chunk_seconds = read_seconds = 0.0
+        
+        print(f"{'recording':<24} {'MB':>8} {'zstd MB':>8} {'new MB':>8} {'chunks':>7} {'MB/s':>7}")
+        for path in paths:
+            size = path.stat().st_size
+            zstd_size = compress_file(path, tmp / "single.zst", codec="zstd")
+            
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                summary = writer.write(f, tmp / "recording.chunks")
+            elapsed = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            with ChunkedReader(tmp / "recording.chunks", root) as reader, open(path, "rb") as original:
+                while True:
+                    data = reader.read(1024 * 1024)
+                    if data != original.read(1024 * 1024):
+                        raise SystemExit(f"{path.name}: content differs after reassembly")
+                    if not data:
+                        break
+            read_seconds += time.perf_counter() - start
+            
+            logical += size
+            per_file += zstd_size
+            stored += summary.new_bytes + summary.manifest_size
+            chunk_seconds += elapsed
+            print(
+                f"{path.name[:24]:<24} {size / 2 ** 20:8.1f} {zstd_size / 2 ** 20:8.1f} "
+                f"{summary.new_bytes / 2 ** 20:8.1f} {len(summary.chunks):7d} {size / elapsed / 2 ** 20:7.1f}"
+            )
+        
+        print(
+            f"\nlogical {logical / 2 ** 20:.1f} MB; zstd per file {per_file / 2 ** 20:.1f} MB "
+            f"(ratio {logical / per_file:.2f}); chunk store {stored / 2 ** 20:.1f} MB "
+            f"(ratio {logical / stored:.2f})"
+        )
+        print(
+            f"chunking {logical / chunk_seconds / 2 ** 20:.1f} MB/s, "
+            f"reassembly {logical / read_seconds / 2 ** 20:.1f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Nachos Replay for Guaca - Compression codec benchmark
+
+Compares wall time and ratio of the archive codecs (gzip, pgzip, sgzip, zstd) on
+synthetic recordings: a graphical session dominated by base64 image blobs
+and a terminal session made of many small drawing instructions.
+
+Usage (from backend/):
+    python benchmarks/bench_compression.py [recording.guac ...] [--size-mb 64] [--threads 0]
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.compression import CODECS, compress_file, open_recording  # noqa: E402
+from app.utils.guacamole import encode_instruction  # noqa: E402
+
+
+def synthetic_graphical(size_mb: int, seed: int = 42) -> bytes:
+    """
+    Graphical session: image updates with distinct (already compressed,
+    hence random-looking) payloads, mouse movement and a sync every 40 ms.
+    """
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    out = io.BytesIO()
+    out.write(encode_instruction("size", 0, 1920, 1080))
+    ts = 1700000000000
+    stream = 1
+    
+    while out.tell() < target:
+        for _ in range(rng.randint(0, 2)):
+            out.write(encode_instruction("img", stream, 14, 0, "image/png", rng.randint(0, 1800), rng.randint(0, 1000)))
+            out.write(encode_instruction("blob", stream, base64.b64encode(rng.randbytes(rng.randint(200, 6000))).decode()))
+            out.write(encode_instruction("end", stream))
+            stream = stream % 64 + 1
+        out.write(encode_instruction("mouse", rng.randint(0, 1919), rng.randint(0, 1079), 0, ts))
+        ts += 40
+        out.write(encode_instruction("sync", ts))
+    
+    return out.getvalue()
+
+
+def synthetic_terminal(size_mb: int, seed: int = 7) -> bytes:
+    """Terminal-like session: keystrokes, glyph copies and small fills."""
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    out = io.BytesIO()
+    out.write(encode_instruction("size", 0, 1024, 768))
+    ts = 1700000000000
+    
+    while out.tell() < target:
+        keysym = rng.randint(0x20, 0x7E)
+        out.write(encode_instruction("key", keysym, 1, ts))
+        out.write(encode_instruction("key", keysym, 0, ts + 30))
+        for _ in range(rng.randint(1, 8)):
+            col, row = rng.randint(0, 127), rng.randint(0, 47)
+            out.write(encode_instruction("copy", -1, keysym * 8 % 1024, 0, 8, 16, 14, 0, col * 8, row * 16))
+        if rng.random() < 0.1:
+            out.write(encode_instruction("rect", 0, 0, rng.randint(0, 47) * 16, 1024, 16))
+            out.write(encode_instruction("cfill", 14, 0, 0, 0, 0, 255))
+        ts += rng.randint(40, 400)
+        out.write(encode_instruction("sync", ts))
+    
+    return out.getvalue()
+
+
+def run(name: str, path: str, size: int, codec: str, threads: int):
+    target = f"{path}.{codec}"
+    try:
+        start = time.perf_counter()
+        compressed = compress_file(path, target, codec=codec, threads=threads or None)
+        elapsed = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        with open_recording(target) as source:
+            restored = sum(len(chunk) for chunk in iter(lambda: source.read(1024 * 1024), b""))
+        read_elapsed = time.perf_counter() - start
+    except ImportError as e:
+        print(f"{name:<12} {codec:<6} skipped ({e})")
+        return
+    finally:
+        if os.path.exists(target):
+            os.unlink(target)
+    
+    assert restored == size, f"{codec}: {restored} != {size} bytes after decompression"
+    mb = size / (1024 * 1024)
+    print(
+        f"{name:<12} {codec:<6} {elapsed:7.2f} s  {mb / elapsed:8.1f} MB/s  "
+        f"ratio {size / max(compressed, 1):6.2f}  read {mb / read_elapsed:8.1f} MB/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", help="recordings to compress (default: synthetic)")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of each synthetic recording")
+    parser.add_argument("--threads", type=int, default=0, help="compression threads (0 = all cores)")
+    args = parser.parse_args()
+    
+    print(f"CPU cores: {os.cpu_count()}, threads: {args.threads or 'all'}")
+    with tempfile.TemporaryDirectory() as tmp:
+        corpora = [(os.path.basename(p), p) for p in args.recordings]
+        if not corpora:
+            for name, data in (
+                ("graphical", synthetic_graphical(args.size_mb)),
+                ("terminal", synthetic_terminal(args.size_mb)),
+            ):
+                path = os.path.join(tmp, f"{name}.guac")
+                with open(path, "wb") as f:
+                    f.write(data)
+                corpora.append((name, path))
+        
+        for name, path in corpora:
+            size = os.path.getsize(path)
+            print(f"\n{name}: {size / (1024 * 1024):.1f} MB")
+            for codec in CODECS:
+                run(name, path, size, codec, args.threads)
+
+
+if __name__ == "__main__":
+    main()
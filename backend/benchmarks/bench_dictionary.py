@@ -0,0 +1,132 @@
+"""
+Nachos Replay for Guaca - zstd dictionary benchmark
+
+Compares gzip, zstd and zstd with a trained dictionary on many small
+terminal recordings, by file size: total ratio and compression speed.
+The dictionary is trained on a separate set of recordings, as the weekly
+training job does.
+
+Usage (from backend/):
+    python benchmarks/bench_dictionary.py [recording.guac ...] [--files 2000] [--dict-kb 112]
+"""
+import argparse
+import gzip
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.compression import DEFAULT_LEVELS, train_dictionary  # noqa: E402
+from app.utils.guacamole import encode_instruction  # noqa: E402
+
+SIZE_BUCKETS_KB = (4, 16, 64, 256, 1024)
+
+
+def synthetic_session(size: int, seed: int) -> bytes:
+    """Small SSH-like session: header, keystrokes, glyph copies and fills."""
+    rng = random.Random(seed)
+    out = io.BytesIO()
+    out.write(encode_instruction("size", 0, 1024, 768))
+    out.write(encode_instruction("name", f"srv-{rng.randint(1, 40):02d}.example.com"))
+    out.write(encode_instruction("rect", 0, 0, 0, 1024, 768))
+    out.write(encode_instruction("cfill", 14, 0, 0, 0, 0, 255))
+    ts = 1700000000000 + rng.randint(0, 10 ** 9)
+    
+    while out.tell() < size:
+        keysym = rng.randint(0x20, 0x7E)
+        out.write(encode_instruction("key", keysym, 1, ts))
+        out.write(encode_instruction("key", keysym, 0, ts + rng.randint(20, 90)))
+        for _ in range(rng.randint(1, 8)):
+            col, row = rng.randint(0, 127), rng.randint(0, 47)
+            out.write(encode_instruction("copy", -1, keysym * 8 % 1024, 0, 8, 16, 14, 0, col * 8, row * 16))
+        if rng.random() < 0.1:
+            out.write(encode_instruction("rect", 0, 0, rng.randint(0, 47) * 16, 1024, 16))
+            out.write(encode_instruction("cfill", 14, 0, 0, 0, 0, 255))
+        ts += rng.randint(40, 400)
+        out.write(encode_instruction("sync", ts))
+    
+    return out.getvalue()
+
+
+def synthetic_corpus(count: int, seed: int):
+    rng = random.Random(seed)
+    return [
+        synthetic_session(rng.randint(1, rng.choice(SIZE_BUCKETS_KB)) * 1024, seed * 100000 + i)
+        for i in range(count)
+    ]
+
+
+def bucket(size: int) -> int:
+    for kb in SIZE_BUCKETS_KB:
+        if size <= kb * 1024:
+            return kb
+    return SIZE_BUCKETS_KB[-1] + 1
+
+
+def measure(name, compress, files):
+    raw = sum(len(f) for f in files)
+    start = time.perf_counter()
+    compressed = sum(len(compress(f)) for f in files)
+    elapsed = time.perf_counter() - start
+    return name, raw / max(compressed, 1), raw / elapsed / (1024 * 1024), len(files) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", help="small recordings (default: synthetic)")
+    parser.add_argument("--files", type=int, default=2000, help="number of synthetic recordings")
+    parser.add_argument("--dict-kb", type=int, default=112, help="dictionary size")
+    parser.add_argument("--sample-kb", type=int, default=64, help="bytes of each training recording")
+    args = parser.parse_args()
+    
+    import zstandard
+    
+    if args.recordings:
+        corpus = []
+        for path in args.recordings:
+            with open(path, "rb") as f:
+                corpus.append(f.read())
+        random.Random(1).shuffle(corpus)
+    else:
+        corpus = synthetic_corpus(args.files, seed=1)
+    
+    # Metade para treino, metade para medir (arquivos nunca vistos pelo treino)
+    training, test = corpus[::2], corpus[1::2]
+    start = time.perf_counter()
+    _, data = train_dictionary([f[:args.sample_kb * 1024] for f in training], args.dict_kb * 1024)
+    print(
+        f"Trained {len(data) / 1024:.0f} KB dictionary on {len(training)} recordings "
+        f"in {time.perf_counter() - start:.1f} s; testing on {len(test)}"
+    )
+    
+    level = DEFAULT_LEVELS["zstd"]
+    plain = zstandard.ZstdCompressor(level=level)
+    dictionary = zstandard.ZstdCompressionDict(data)
+    dictionary.precompute_compress(level=level)
+    with_dictionary = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+    codecs = (
+        ("gzip", lambda f: gzip.compress(f, DEFAULT_LEVELS["gzip"], mtime=0)),
+        ("zstd", plain.compress),
+        ("zstd+dict", with_dictionary.compress),
+    )
+    
+    groups = {}
+    for f in test:
+        groups.setdefault(bucket(len(f)), []).append(f)
+    
+    print(f"\n{'size':<10} {'files':>6} {'codec':<10} {'ratio':>7} {'MB/s':>8} {'files/s':>9}")
+    for kb in sorted(groups) + ["all"]:
+        files = test if kb == "all" else groups[kb]
+        if kb == "all":
+            label = "all"
+        else:
+            label = f"<={kb} KB" if kb in SIZE_BUCKETS_KB else f">{SIZE_BUCKETS_KB[-1]} KB"
+        for name, ratio, mbps, fps in (measure(name, fn, files) for name, fn in codecs):
+            print(f"{label:<10} {len(files):>6} {name:<10} {ratio:7.2f} {mbps:8.1f} {fps:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Nachos Replay for Guaca - Guacamole parser benchmark
+
+Reports parse throughput (MB/s) of the instruction readers and of the
+single-pass import analysis, over a real recording or a synthetic one.
+
+Usage (from backend/):
+    python benchmarks/bench_guac_parser.py [recording.guac] [--size-mb 64] [--repeat 3]
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.analysis_service import analyze_recording  # noqa: E402
+from app.utils.guacamole import (  # noqa: E402
+    InstructionReader, RawInstructionReader, encode_instruction
+)
+
+
+def synthetic_recording(size_mb: int, seed: int = 42) -> bytes:
+    """
+    Recording with a realistic mix: image updates sent as ~6 KB base64
+    blobs (the bulk of the bytes), small drawing instructions, mouse and
+    key events, and a sync every 40 ms.
+    """
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    out = io.BytesIO()
+    out.write(encode_instruction("size", 0, 1920, 1080))
+    out.write(encode_instruction("name", "sessão de benchmark"))
+    
+    payload = base64.b64encode(rng.randbytes(4536)).decode()
+    ts = 1700000000000
+    stream = 1
+    
+    while out.tell() < target:
+        for _ in range(rng.randint(0, 3)):
+            out.write(encode_instruction("img", stream, 14, 0, "image/png", rng.randint(0, 1800), rng.randint(0, 1000)))
+            for _ in range(rng.randint(1, 4)):
+                out.write(encode_instruction("blob", stream, payload))
+            out.write(encode_instruction("end", stream))
+            stream = stream % 64 + 1
+        for _ in range(rng.randint(0, 6)):
+            out.write(encode_instruction("rect", 0, rng.randint(0, 1900), rng.randint(0, 1000), 16, 16))
+            out.write(encode_instruction("cfill", 14, 0, 255, 255, 255, 255))
+        out.write(encode_instruction("mouse", rng.randint(0, 1919), rng.randint(0, 1079), 0, ts))
+        if rng.random() < 0.3:
+            out.write(encode_instruction("key", rng.randint(0x20, 0x7E), 1, ts))
+        ts += 40
+        out.write(encode_instruction("sync", ts))
+    
+    return out.getvalue()
+
+
+def measure(name: str, data: bytes, repeat: int, run):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = run(io.BytesIO(data))
+        best = min(best, time.perf_counter() - start)
+    mb = len(data) / (1024 * 1024)
+    print(f"{name:<24} {mb / best:8.1f} MB/s   ({count} instructions, best of {repeat})")
+
+
+def count_decoded(fileobj) -> int:
+    return sum(1 for _ in InstructionReader(fileobj))
+
+
+def count_raw(fileobj) -> int:
+    return sum(1 for _ in RawInstructionReader(fileobj))
+
+
+def run_analysis(fileobj) -> int:
+    return analyze_recording(fileobj).stats.instructions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", nargs="?", help="recording to parse (default: synthetic)")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the synthetic recording")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    
+    if args.recording:
+        with open(args.recording, "rb") as f:
+            data = f.read()
+        source = args.recording
+    else:
+        data = synthetic_recording(args.size_mb)
+        source = "synthetic"
+    
+    print(f"Recording: {source}, {len(data) / (1024 * 1024):.1f} MB")
+    measure("InstructionReader", data, args.repeat, count_decoded)
+    measure("RawInstructionReader", data, args.repeat, count_raw)
+    measure("analyze_recording", data, args.repeat, run_analysis)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Nachos Replay for Guaca - Hash tree benchmark
+
+Compares the whole-file SHA-256 (serial) with hashing the per-block tree
+in a thread pool, and locating a corrupted block by re-hashing the tree.
+
+Usage (from backend/):
+    python benchmarks/bench_hash_tree.py [recording.guac] [--size-mb 512] [--block-mb 4] [--workers 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.integrity_service import hash_recording  # noqa: E402
+from app.utils.hash_tree import hash_content, rehash_blocks  # noqa: E402
+
+
+def timed(label: str, total: int, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed:8.2f} s {total / elapsed / 2 ** 20:9.1f} MB/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", nargs="?", help="recording to hash (default: synthetic)")
+    parser.add_argument("--size-mb", type=int, default=512, help="size of the synthetic recording")
+    parser.add_argument("--block-mb", type=int, default=4, help="hash tree block size")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="hashing threads")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory(prefix="bench-hash-tree-") as tmp:
+        path = Path(args.recording) if args.recording else Path(tmp) / "session.guac"
+        if not args.recording:
+            with open(path, "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+        total = path.stat().st_size
+        block_size = args.block_mb * 1024 * 1024
+        
+        print(f"{total / 2 ** 20:.0f} MB, {args.block_mb} MB blocks, {args.workers} threads, {os.cpu_count()} CPUs\n")
+        expected, _ = timed("whole-file SHA-256", total, lambda: hash_recording(str(path), block_size))
+        timed("SHA-256 + tree, inline", total, lambda: hash_content(str(path), block_size))
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            checksum, tree = timed(
+                f"SHA-256 + tree, {args.workers} threads", total,
+                lambda: hash_content(str(path), block_size, pool)
+            )
+            found = timed(
+                f"tree only, {args.workers} parallel readers", total,
+                lambda: rehash_blocks(str(path), block_size, pool)
+            )
+        if checksum != expected or found != tree:
+            raise SystemExit("hashes differ")
+        print(f"\nroot {tree.root}, {tree.block_count} blocks, {len(tree.leaves)} bytes of leaves")
+
+
+if __name__ == "__main__":
+    main()
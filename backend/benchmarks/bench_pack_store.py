@@ -0,0 +1,105 @@
+"""
+Nachos Replay for Guaca - Pack file benchmark
+
+Writes a set of small recordings as loose files (one inode each, in the
+sharded COLD layout) and as pack files, then compares a filesystem scan
+(what backups and the reconciler do) and reading every recording back:
+loose files one open() each, packed ones as range reads of their pack.
+
+Usage (from backend/):
+    python benchmarks/bench_pack_store.py [--files 20000] [--size-kb 16] [--pack-mb 256]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings  # noqa: E402
+from app.utils.layout import shard_parts  # noqa: E402
+from app.utils.pack_store import PackWriter, new_pack_path  # noqa: E402
+from app.utils.storage import open_location, pack_location, tier_key  # noqa: E402
+
+
+def timed(label: str, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<40} {time.perf_counter() - start:8.2f} s")
+    return result
+
+
+def scan(root: Path) -> int:
+    count = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            os.stat(os.path.join(directory, name))
+            count += 1
+    return count
+
+
+def read_all(locations) -> int:
+    total = 0
+    for location in locations:
+        with open_location(location) as f:
+            total += len(f.read())
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20000, help="number of recordings")
+    parser.add_argument("--size-kb", type=int, default=16, help="size of each recording")
+    parser.add_argument("--pack-mb", type=int, default=256, help="pack file size")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory(prefix="bench-packs-") as tmp:
+        settings.replay_storage_path = tmp
+        cold = Path(tmp) / "cold" / "2025"
+        payload = os.urandom(args.size_kb * 1024)
+        
+        def write_loose():
+            paths = []
+            for i in range(args.files):
+                name = f"user_ssh_host{i % 97}_{i:08d}.guac.zst"
+                path = cold.joinpath(*shard_parts(name), name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(payload)
+                paths.append(str(path))
+            return paths
+        
+        def write_packs():
+            locations, writer = [], None
+            target = args.pack_mb * 1024 * 1024
+            for path in paths:
+                if writer is None:
+                    writer = PackWriter(new_pack_path(datetime.now()))
+                member = writer.add_file(path)
+                locations.append((writer, member))
+                if writer.size >= target:
+                    writer.seal()
+                    writer = None
+            if writer is not None:
+                writer.seal()
+            return [pack_location(tier_key(w.path), m.offset, m.length) for w, m in locations]
+        
+        total = args.files * args.size_kb * 1024
+        print(f"{args.files} recordings of {args.size_kb} KB ({total / 2 ** 20:.0f} MB), {args.pack_mb} MB packs\n")
+        paths = timed("write loose files", write_loose)
+        locations = timed("append to packs", write_packs)
+        packs = sum(1 for _ in Path(tmp, "packs").rglob("*.pack"))
+        
+        print()
+        timed(f"scan loose ({args.files} files)", lambda: scan(Path(tmp) / "cold"))
+        timed(f"scan packs ({packs} files)", lambda: scan(Path(tmp) / "packs"))
+        loose_bytes = timed("read loose files", lambda: read_all(paths))
+        packed_bytes = timed("read packed members", lambda: read_all(locations))
+        if loose_bytes != packed_bytes:
+            raise SystemExit("sizes differ")
+
+
+if __name__ == "__main__":
+    main()
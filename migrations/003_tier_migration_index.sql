@@ -0,0 +1,5 @@
+-- Migração: Índice para a migração de tiers em lotes
+-- Data: 2026-10-19
+-- Descrição: A migração percorre os replays de um tier por (imported_at, id) em páginas (keyset)
+
+CREATE INDEX IF NOT EXISTS idx_replays_tier_imported ON replays(storage_tier, imported_at, id);
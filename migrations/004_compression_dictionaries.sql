@@ -0,0 +1,24 @@
+-- Migração: Dicionários zstd para gravações pequenas
+-- Data: 2026-10-19
+-- Descrição: Dicionários versionados por protocolo e o dicionário usado por cada replay comprimido
+
+CREATE TABLE IF NOT EXISTS compression_dictionaries (
+    id BIGINT PRIMARY KEY,
+    protocol VARCHAR(20) NOT NULL,
+    version INTEGER NOT NULL,
+    data BYTEA NOT NULL,
+    size_bytes INTEGER DEFAULT 0,
+    sample_count INTEGER DEFAULT 0,
+    sample_bytes BIGINT DEFAULT 0,
+    ratio DOUBLE PRECISION,
+    baseline_ratio DOUBLE PRECISION,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_compression_dictionaries_protocol UNIQUE (protocol, version)
+);
+
+ALTER TABLE replays ADD COLUMN IF NOT EXISTS compression_dict_id BIGINT
+    REFERENCES compression_dictionaries(id) ON DELETE RESTRICT;
+
+CREATE INDEX IF NOT EXISTS idx_replays_compression_dict ON replays(compression_dict_id);
+
+COMMENT ON COLUMN replays.compression_dict_id IS 'ID do dicionário zstd usado na compressão (também gravado no cabeçalho do arquivo)';
@@ -0,0 +1,17 @@
+-- Migração: Armazenamento deduplicado em chunks
+-- Data: 2026-10-19
+-- Descrição: Contagem de referências dos chunks compartilhados pelas gravações COLD
+
+CREATE TABLE IF NOT EXISTS chunks (
+    hash BYTEA PRIMARY KEY,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Só os chunks sem referências interessam ao coletor de lixo
+CREATE INDEX IF NOT EXISTS idx_chunks_unreferenced ON chunks(updated_at) WHERE refcount <= 0;
+
+COMMENT ON TABLE chunks IS 'Chunks (SHA-256) das gravações COLD deduplicadas; arquivos em <storage>/chunks/ab/cd/<hash>';
@@ -0,0 +1,9 @@
+-- Migração: Deduplicação de arquivos inteiros
+-- Data: 2026-10-19
+-- Descrição: Replays com o mesmo SHA-256 compartilham o arquivo armazenado
+
+-- Busca de um arquivo existente pelo checksum na importação e no upload
+CREATE INDEX IF NOT EXISTS idx_replays_checksum ON replays(checksum_sha256);
+
+-- Contagem de referências de um arquivo compartilhado (exclusão, migração)
+CREATE INDEX IF NOT EXISTS idx_replays_stored_path ON replays(stored_path);
@@ -0,0 +1,77 @@
+-- Migração: Cota de armazenamento com marcas alta e baixa
+-- Data: 2026-10-19
+-- Descrição: Contabilidade incremental do uso de armazenamento (trigger em replays) e índices dos candidatos da cota
+
+CREATE TABLE IF NOT EXISTS storage_usage (
+    storage_tier VARCHAR(10) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    is_compressed BOOLEAN NOT NULL,
+    is_remote BOOLEAN NOT NULL,
+    files BIGINT NOT NULL DEFAULT 0,
+    bytes BIGINT NOT NULL DEFAULT 0,
+    original_bytes BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (storage_tier, status, is_compressed, is_remote)
+);
+
+-- Deltas anexados pelo trigger; o serviço de cota os consolida em storage_usage
+CREATE TABLE IF NOT EXISTS storage_usage_deltas (
+    id BIGSERIAL PRIMARY KEY,
+    storage_tier VARCHAR(10) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    is_compressed BOOLEAN NOT NULL,
+    is_remote BOOLEAN NOT NULL,
+    files BIGINT NOT NULL,
+    bytes BIGINT NOT NULL,
+    original_bytes BIGINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION account_storage_usage() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.stored_path IS NOT NULL THEN
+        INSERT INTO storage_usage_deltas
+            (storage_tier, status, is_compressed, is_remote, files, bytes, original_bytes)
+        VALUES (
+            COALESCE(OLD.storage_tier::text, 'hot'), COALESCE(OLD.status::text, 'active'),
+            COALESCE(OLD.is_compressed, false), left(OLD.stored_path, 5) = 's3://',
+            -1, -COALESCE(OLD.file_size, 0), -COALESCE(OLD.original_size, OLD.file_size, 0)
+        );
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.stored_path IS NOT NULL THEN
+        INSERT INTO storage_usage_deltas
+            (storage_tier, status, is_compressed, is_remote, files, bytes, original_bytes)
+        VALUES (
+            COALESCE(NEW.storage_tier::text, 'hot'), COALESCE(NEW.status::text, 'active'),
+            COALESCE(NEW.is_compressed, false), left(NEW.stored_path, 5) = 's3://',
+            1, COALESCE(NEW.file_size, 0), COALESCE(NEW.original_size, NEW.file_size, 0)
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Totais iniciais e trigger na mesma transação: nenhuma mudança fica de fora
+BEGIN;
+LOCK TABLE replays IN SHARE MODE;
+
+CREATE OR REPLACE TRIGGER replays_storage_usage
+AFTER INSERT OR DELETE OR UPDATE OF stored_path, storage_tier, status, is_compressed, file_size, original_size
+ON replays FOR EACH ROW EXECUTE FUNCTION account_storage_usage();
+
+DELETE FROM storage_usage_deltas;
+DELETE FROM storage_usage;
+INSERT INTO storage_usage (storage_tier, status, is_compressed, is_remote, files, bytes, original_bytes)
+SELECT
+    COALESCE(storage_tier::text, 'hot'), COALESCE(status::text, 'active'),
+    COALESCE(is_compressed, false), left(stored_path, 5) = 's3://',
+    COUNT(*), COALESCE(SUM(file_size), 0), COALESCE(SUM(COALESCE(original_size, file_size)), 0)
+FROM replays
+WHERE stored_path IS NOT NULL
+GROUP BY 1, 2, 3, 4;
+COMMIT;
+
+-- Candidatos da cota: maiores arquivos WARM sem compressão e replays removidos (soft delete)
+CREATE INDEX IF NOT EXISTS idx_replays_warm_uncompressed ON replays(file_size DESC, id)
+    WHERE storage_tier = 'warm' AND NOT is_compressed;
+CREATE INDEX IF NOT EXISTS idx_replays_deleted ON replays(updated_at, id) WHERE status = 'deleted';
+
+COMMENT ON TABLE storage_usage IS 'Bytes armazenados por tier, status, compressão e local (local ou s3), mantidos por trigger';
@@ -0,0 +1,20 @@
+-- Migração: Verificação contínua de integridade
+-- Data: 2026-10-19
+-- Descrição: Resultados do re-hash periódico dos arquivos armazenados (scrubber)
+
+CREATE TABLE IF NOT EXISTS replay_integrity_checks (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    replay_id UUID NOT NULL REFERENCES replays(id) ON DELETE CASCADE,
+    checked_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    status VARCHAR(20) NOT NULL,
+    expected_checksum VARCHAR(64),
+    actual_checksum VARCHAR(64),
+    bytes_read BIGINT DEFAULT 0,
+    duration_ms INTEGER DEFAULT 0,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_integrity_replay_checked ON replay_integrity_checks(replay_id, checked_at);
+CREATE INDEX IF NOT EXISTS idx_integrity_checked_at ON replay_integrity_checks(checked_at);
+
+COMMENT ON COLUMN replay_integrity_checks.status IS 'ok, recorded (checksum registrado), mismatch, missing ou error';
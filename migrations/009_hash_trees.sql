@@ -0,0 +1,20 @@
+-- Migração: Árvore de hashes por bloco
+-- Data: 2026-10-19
+-- Descrição: SHA-256 de cada bloco do conteúdo (verificação paralela e de
+-- requisições Range) e trechos corrompidos encontrados pelo scrubber
+
+ALTER TABLE replays ADD COLUMN IF NOT EXISTS hash_tree_root VARCHAR(64);
+
+CREATE TABLE IF NOT EXISTS replay_hash_trees (
+    replay_id UUID PRIMARY KEY REFERENCES replays(id) ON DELETE CASCADE,
+    block_size INTEGER NOT NULL,
+    size BIGINT NOT NULL,
+    leaves BYTEA NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE replay_integrity_checks ADD COLUMN IF NOT EXISTS bad_ranges JSONB;
+
+COMMENT ON COLUMN replays.hash_tree_root IS 'sha256 das folhas concatenadas em replay_hash_trees';
+COMMENT ON COLUMN replay_hash_trees.leaves IS 'SHA-256 de cada bloco de block_size bytes, 32 bytes por bloco';
+COMMENT ON COLUMN replay_integrity_checks.bad_ranges IS 'Trechos [início, fim] cujos blocos não conferem';
@@ -0,0 +1,27 @@
+-- Migração: Reconciliação arquivos x banco
+-- Data: 2026-10-19
+-- Descrição: Divergências entre os arquivos armazenados e a tabela de replays,
+-- e índice de stored_path em ordem de bytes para a varredura ordenada
+
+CREATE INDEX IF NOT EXISTS idx_replays_stored_path_c ON replays((stored_path COLLATE "C"), id);
+
+CREATE TABLE IF NOT EXISTS storage_drift (
+    id BIGSERIAL PRIMARY KEY,
+    run_id UUID NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    path TEXT NOT NULL,
+    replay_id UUID REFERENCES replays(id) ON DELETE CASCADE,
+    size BIGINT,
+    expected_size BIGINT,
+    modified_at TIMESTAMP WITH TIME ZONE,
+    checksum VARCHAR(64),
+    resolution VARCHAR(20),
+    resolved_path TEXT,
+    found_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_storage_drift_run ON storage_drift(run_id, kind, id);
+CREATE INDEX IF NOT EXISTS idx_storage_drift_checksum ON storage_drift(run_id, checksum);
+
+COMMENT ON COLUMN storage_drift.kind IS 'missing (replay sem arquivo), orphan (arquivo sem replay) ou size';
+COMMENT ON COLUMN storage_drift.resolution IS 'relinked, quarantined, resized ou NULL (em aberto)';
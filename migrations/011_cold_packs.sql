@@ -0,0 +1,28 @@
+-- Migração: Pack files no COLD
+-- Data: 2026-10-19
+-- Descrição: Arquivos que agrupam gravações COLD pequenas e o índice de cada um
+-- (offset, tamanho e checksum dos membros)
+
+CREATE TABLE IF NOT EXISTS storage_packs (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    key VARCHAR(500) NOT NULL UNIQUE,
+    size BIGINT NOT NULL,
+    member_count INTEGER NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS storage_pack_members (
+    pack_id UUID NOT NULL REFERENCES storage_packs(id) ON DELETE CASCADE,
+    "offset" BIGINT NOT NULL,
+    length BIGINT NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    name VARCHAR(500) NOT NULL,
+    location VARCHAR(1000) NOT NULL,
+    PRIMARY KEY (pack_id, "offset")
+);
+
+-- Membros por replays.stored_path (pack://<key>#<offset>+<tamanho>)
+CREATE INDEX IF NOT EXISTS idx_storage_pack_members_location ON storage_pack_members(location);
+
+COMMENT ON TABLE storage_packs IS 'Pack files em <storage>/packs/YYYY/MM/<uuid>.pack; imutáveis, reescritos pela compactação';
+COMMENT ON COLUMN storage_pack_members.checksum IS 'SHA-256 dos bytes armazenados do membro (comprimidos, se for o caso)';
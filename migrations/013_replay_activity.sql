@@ -0,0 +1,14 @@
+-- Migração: Histograma de atividade
+-- Data: 2026-10-19
+-- Descrição: Bytes e instruções por segundo de cada replay, calculados na
+-- importação (linha do tempo do player)
+
+CREATE TABLE IF NOT EXISTS replay_activity (
+    replay_id UUID PRIMARY KEY REFERENCES replays(id) ON DELETE CASCADE,
+    bucket_ms INTEGER NOT NULL DEFAULT 1000,
+    bucket_count INTEGER NOT NULL DEFAULT 0,
+    histogram BYTEA NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON COLUMN replay_activity.histogram IS 'Dois arrays uint32 little-endian concatenados: bytes e instruções por bucket';
@@ -0,0 +1,18 @@
+-- Migração: Transcrição pesquisável
+-- Data: 2026-10-19
+-- Descrição: Texto digitado e conteúdo de clipboard dos replays, com busca
+-- full-text (tsvector gerado, configuração 'simple', e índice GIN)
+
+CREATE TABLE IF NOT EXISTS replay_transcript_segments (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    replay_id UUID NOT NULL REFERENCES replays(id) ON DELETE CASCADE,
+    offset_ms BIGINT NOT NULL DEFAULT 0,
+    kind VARCHAR(20) NOT NULL,
+    text TEXT NOT NULL,
+    tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED
+);
+
+CREATE INDEX IF NOT EXISTS idx_transcript_replay_offset ON replay_transcript_segments(replay_id, offset_ms);
+CREATE INDEX IF NOT EXISTS idx_transcript_tsv ON replay_transcript_segments USING GIN (tsv);
+
+COMMENT ON COLUMN replay_transcript_segments.kind IS 'keys (texto digitado) ou clipboard';